@@ -519,6 +519,61 @@ def acl_represent(acl, options):
 
     return " ".join(values)
 
+# =============================================================================
+# Asynchronous Tasks
+# =============================================================================
+@auth.s3_requires_membership(1)
+def task_metrics():
+    """ Queue depth and runtime statistics of asynchronous tasks """
+
+    try:
+        hours = int(request.get_vars.get("hours", 24))
+    except ValueError:
+        hours = 24
+
+    NONE = messages["NONE"]
+    def seconds(value):
+        return "%.1f" % value if value is not None else NONE
+
+    header = TR(TH(T("Queue")),
+                TH(T("Task")),
+                TH(T("Queued")),
+                TH(T("Due")),
+                TH(T("Longest Wait (s)")),
+                TH(T("Running")),
+                TH(T("Failed")),
+                TH(T("Runs")),
+                TH(T("Failures")),
+                TH(T("Average Runtime (s)")),
+                TH(T("Maximum Runtime (s)")),
+                )
+    items = TABLE(THEAD(header),
+                  _id = "list",
+                  _class = "dataTable display",
+                  )
+    body = TBODY()
+    for item in s3task.metrics(hours=hours):
+        body.append(TR(item.queue,
+                       item.task,
+                       item.queued,
+                       item.due,
+                       seconds(item.waiting),
+                       item.running,
+                       item.failed,
+                       item.runs,
+                       item.failures,
+                       seconds(item.avg),
+                       seconds(item.max),
+                       ))
+    items.append(body)
+
+    title = T("Task Queues")
+    subtitle = T("Runtimes in the last %(hours)s hours") % dict(hours=hours)
+    return dict(title=title,
+                subtitle=subtitle,
+                items=items,
+                )
+
 # =============================================================================
 # Ticket viewing
 # =============================================================================
@@ -564,6 +619,27 @@ def errors():
 
     return dict(app=appname, tickets=tickets)
 
+# -----------------------------------------------------------------------------
+@auth.s3_requires_membership(1)
+def profile():
+    """
+        Profile of the models pipeline, aggregated over all requests
+        handled by this server process (see settings.log.profile)
+    """
+
+    from s3profiler import S3Profiler
+
+    if request.post_vars.get("reset"):
+        S3Profiler.reset()
+        redirect(URL())
+
+    requests, items = S3Profiler.report()
+
+    return dict(enabled = settings.get_log_profile(),
+                requests = requests,
+                items = items,
+                )
+
 # =============================================================================
 # Management scripts
 # =============================================================================
@@ -211,6 +211,23 @@ def shelter():
 
     return s3_rest_controller(rheader = s3db.cr_shelter_rheader)
 
+# -----------------------------------------------------------------------------
+def shelter_aggregate():
+    """
+        RESTful CRUD controller
+        Capacity/population totals per location and shelter type
+        (read-only, maintained by the cr_shelter model)
+    """
+
+    def prep(r):
+        if r.method == "map":
+            # Only show the locations, not the aggregate per type
+            r.resource.add_filter(FS("shelter_type_id") == None)
+        return True
+    s3.prep = prep
+
+    return s3_rest_controller()
+
 # =============================================================================
 def incoming():
     """ Incoming Shipments """
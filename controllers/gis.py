@@ -472,6 +472,9 @@ def ldata():
                    'f' : parent,
                    'b' : [lon_min, lat_min, lon_max, lat_max]
                    }}
+
+        - served from a per-parent, per-language cache in /static/cache/ldata,
+          which is invalidated when locations or their names change
     """
 
     args = request.args
@@ -479,94 +482,16 @@ def ldata():
     if len(args) == 0:
         raise HTTP(400)
 
-    id = args[0]
+    try:
+        id = int(args[0])
+    except ValueError:
+        raise HTTP(400)
 
-    # Translate options using gis_location_name?
-    translate = settings.get_L10n_translate_gis_location()
-    if translate:
-        language = current.session.s3.language
-        if language == current.deployment_settings.get_L10n_default_language():
-            translate = False
+    path = gis.get_ldata(id, language=gis.ldata_language())
+    if not path:
+        return ""
 
-    table = s3db.gis_location
-    query = (table.deleted == False) & \
-            (table.end_date == None) & \
-            ((table.parent == id) | \
-             (table.id == id))
-    fields = [table.id,
-              table.name,
-              table.level,
-              table.parent,
-              table.lon_min,
-              table.lat_min,
-              table.lon_max,
-              table.lat_max,
-              ]
-    if translate:
-        ntable = s3db.gis_location_name
-        fields.append(ntable.name_l10n)
-        left = ntable.on((ntable.deleted == False) & \
-                         (ntable.language == language) & \
-                         (ntable.location_id == table.id))
-    else:
-        left = None
-    locations = db(query).select(*fields,
-                                 left=left)
-    if translate:
-        try:
-            id_level = int(locations.as_dict(key="gis_location.id")[int(id)]["gis_location"]["level"][1:])
-        except:
-            return ""
-    else:
-        try:
-            id_level = int(locations.as_dict()[int(id)]["level"][1:])
-        except:
-            return ""
-    output_level = id_level + 1
-    search_level = "L%s" % output_level
-    location_dict = {}
-    if translate:
-        for location in locations:
-            l = location["gis_location"]
-            if l.level == search_level:
-                name = location["gis_location_name.name_l10n"] or l.name
-                if l.lon_min is not None:
-                    location_dict[int(l.id)] = dict(n=name,
-                                                    l=output_level,
-                                                    f=int(l.parent),
-                                                    b=[l.lon_min,
-                                                       l.lat_min,
-                                                       l.lon_max,
-                                                       l.lat_max
-                                                       ],
-                                                    )
-                else:
-                    location_dict[int(l.id)] = dict(n=name,
-                                                    l=output_level,
-                                                    f=int(l.parent),
-                                                    )
-    else:
-        for l in locations:
-            if l.level == search_level:
-                if l.lon_min is not None:
-                    location_dict[int(l.id)] = dict(n=l.name,
-                                                    l=output_level,
-                                                    f=int(l.parent),
-                                                    b=[l.lon_min,
-                                                       l.lat_min,
-                                                       l.lon_max,
-                                                       l.lat_max
-                                                       ],
-                                                    )
-                else:
-                    location_dict[int(l.id)] = dict(n=l.name,
-                                                    l=output_level,
-                                                    f=int(l.parent),
-                                                    )
-
-    script = '''n=%s\n''' % json.dumps(location_dict)
-    response.headers["Content-Type"] = "application/json"
-    return script
+    return cached_script(path)
 
 # -----------------------------------------------------------------------------
 def hdata():
@@ -578,6 +503,9 @@ def hdata():
                       2 : l2_name,
                       etc,
                       }}
+
+        - served from a cache in /static/cache/hdata, which is invalidated
+          when the hierarchy labels change
     """
 
     args = request.args
@@ -585,37 +513,60 @@ def hdata():
     if len(args) == 0:
         raise HTTP(400)
 
-    id = args[0]
+    try:
+        id = int(args[0])
+    except ValueError:
+        raise HTTP(400)
 
     # @ToDo: Translate options using gis_hierarchy_name?
-    #translate = settings.get_L10n_translate_gis_location()
-    #if translate:
-    #    language = current.session.s3.language
-    #    if language == current.deployment_settings.get_L10n_default_language():
-    #        translate = False
-
-    table = s3db.gis_hierarchy
-    query = (table.deleted == False) & \
-            (table.location_id == id)
-    fields = [table.L1,
-              table.L2,
-              table.L3,
-              table.L4,
-              table.L5,
-              ]
-    row = db(query).select(*fields,
-                           limitby=(0, 1)
-                           ).first()
-    if not row:
+    path = gis.get_hdata(id)
+    if not path:
         return ""
 
-    hdict = {}
-    for l in ["L1", "L2", "L3", "L4", "L5"]:
-        if row[l]:
-            hdict[int(l[1:])] = row[l]
+    return cached_script(path)
 
-    script = '''n=%s\n''' % json.dumps(hdict)
-    response.headers["Content-Type"] = "application/json"
+# -----------------------------------------------------------------------------
+def cached_script(path):
+    """
+        Serve a cached script file with ETag and Last-Modified headers,
+        responding with 304 Not Modified if the client has a current copy
+
+        @param path: the file path
+    """
+
+    from email.utils import formatdate, mktime_tz, parsedate_tz
+
+    stat = os.stat(path)
+    etag = '"%x-%x"' % (int(stat.st_mtime * 1000), stat.st_size)
+
+    headers = response.headers
+    headers["Content-Type"] = "application/json"
+    headers["ETag"] = etag
+    headers["Last-Modified"] = formatdate(stat.st_mtime, usegmt=True)
+    # Clients may store, but must revalidate (the data can change)
+    headers["Cache-Control"] = "private, no-cache"
+    # Language is in the session
+    headers["Vary"] = "Cookie"
+
+    env = request.env
+    if_none_match = env.http_if_none_match
+    if if_none_match:
+        not_modified = etag in [t.strip() for t in if_none_match.split(",")]
+    else:
+        if_modified_since = env.http_if_modified_since
+        not_modified = False
+        if if_modified_since:
+            since = parsedate_tz(if_modified_since)
+            if since and int(stat.st_mtime) <= mktime_tz(since):
+                not_modified = True
+    if not_modified:
+        raise HTTP(304, **headers)
+
+    f = open(path, "rb")
+    try:
+        script = f.read()
+    finally:
+        f.close()
     return script
 
 # -----------------------------------------------------------------------------
@@ -1081,6 +1032,7 @@ def enable_layer(r, **attr):
     query = (ltable.config_id == r.id) & \
             (ltable.layer_id == r.component_id)
     db(query).update(enabled = True)
+    gis.invalidate_config()
     session.confirmation = T("Layer has been Enabled")
     redirect(URL(args=[r.id, "layer_entity"]))
 
@@ -1099,6 +1051,7 @@ def disable_layer(r, **attr):
     query = (ltable.config_id == r.id) & \
             (ltable.layer_id == r.component_id)
     db(query).update(enabled = False)
+    gis.invalidate_config()
     session.confirmation = T("Layer has been Disabled")
     redirect(URL(args=[r.id, "layer_entity"]))
 
@@ -591,6 +591,18 @@ def track_movement():
         del output["add_btn"]
     return output
 
+# -----------------------------------------------------------------------------
+def stock_movement():
+    """ REST Controller for the Stock Movement Ledger (read-only) """
+
+    return s3_rest_controller()
+
+# -----------------------------------------------------------------------------
+def stock_snapshot():
+    """ REST Controller for the Stock Snapshots (read-only) """
+
+    return s3_rest_controller()
+
 # -----------------------------------------------------------------------------
 def inv_item_quantity():
     """
@@ -759,6 +771,8 @@ def return_process():
         tracktable[track_item.id] = dict(recv_quantity = track_item.quantity - return_qnty)
         if return_qnty:
             db(invtable.id == send_inv_id).update(quantity = invtable.quantity + return_qnty)
+            s3db.inv_stock_post(send_inv_id, "return",
+                                track_item_id=track_item.id)
 
 
     stable[send_id] = dict(status = inv_ship_status["RECEIVED"],
@@ -1251,7 +1265,8 @@ def recv_cancel():
     # and put them back in the track item record
     query = (tracktable.recv_id == recv_id) & \
             (tracktable.deleted == False)
-    recv_items = db(query).select(tracktable.recv_inv_item_id,
+    recv_items = db(query).select(tracktable.id,
+                                  tracktable.recv_inv_item_id,
                                   tracktable.recv_quantity,
                                   tracktable.send_id,
                                   )
@@ -1264,6 +1279,8 @@ def recv_cancel():
             db(inv_item_table.id == inv_item_id).delete()
         else:
             db(inv_item_table.id == inv_item_id).update(quantity = quantity)
+        s3db.inv_stock_post(inv_item_id, "cancel",
+                            track_item_id=recv_item.id)
         db(tracktable.recv_id == recv_id).update(status = 2) # In transit
         # @todo potential problem in that the send id should be the same for all track items but is not explicitly checked
         if send_id is None and recv_item.send_id is not None:
@@ -1554,6 +1571,7 @@ def adj_close():
     query = (aitable.adj_id == adj_id) & \
             (aitable.deleted == False)
     adj_items = db(query).select()
+    inv_item_ids = []
     for adj_item in adj_items:
         if adj_item.inv_item_id is None:
             # Create a new stock item
@@ -1569,6 +1587,7 @@ def adj_close():
                                                )
             # Add the inventory item id to the adjustment record
             db(aitable.id == adj_item.id).update(inv_item_id = inv_item_id)
+            inv_item_ids.append(inv_item_id)
         elif adj_item.new_quantity is not None:
             # Update the existing stock item
             db(inv_item_table.id == adj_item.inv_item_id).update(item_pack_id = adj_item.item_pack_id,
@@ -1579,6 +1598,10 @@ def adj_close():
                                                                  owner_org_id = adj_item.new_owner_org_id,
                                                                  status = adj_item.new_status,
                                                                 )
+            inv_item_ids.append(adj_item.inv_item_id)
+    # Post the changes to the stock movement ledger
+    s3db.inv_stock_post(inv_item_ids, "adj", adj_id=adj_id)
+
     # Change the status of the adj record to Complete
     db(atable.id == adj_id).update(status=1)
     # Go to the Inventory of the Site which has adjusted these items
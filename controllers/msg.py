@@ -1883,40 +1883,20 @@ def tag():
 def readKeyGraph(queryID):
     """  """
 
-    import os
-    curpath = os.getcwd()
-
-    f = open("%s.txt" % queryID, "r")
-
-    topics = int(f.next())
+    from s3.s3msg import S3KeyGraph
+    topics = S3KeyGraph(queryID).get_topics()
 
     nodelabel = {}
     E = []
     nodetopic = {}
-    for x in range(0, topics):
-        thisnodes = []
-        nodes = int(f.next().split("KEYGRAPH_NODES:")[1])
-        for y in range(0, nodes):
-            s = f.next()
-            nodeid = s.split(":")[0]
-            nodetopic[str(nodeid)] = x
-            l1 = s.split(":")[1]
-            l2 = s.split(":")[2]
-            try:
-                nodelabel[str(nodeid)] = unicode(l2.strip())
-            except:
-                pass
-        edges = int(f.next().split("KEYGRAPH_EDGES:")[1])
-        edges = edges / 2
-        for y in range(0,edges):
-            s = f.next()
-            n1 = s.split(" ")[0].strip()
-            n2 = s.split(" ")[1].strip()
-            if (n1 in nodelabel.keys()) and (n2 in nodelabel.keys()):
-                E.append((str(n1), str(n2)))
-
-        f.next()
-        f.next()
+    for x, topic in enumerate(topics):
+        for term in topic["terms"]:
+            nodeid = str(len(nodelabel))
+            nodelabel[term] = nodeid
+            nodetopic[nodeid] = x
+        for term1, term2, count in topic["edges"]:
+            E.append((nodelabel[term1], nodelabel[term2]))
+    nodelabel = dict((v, k) for k, v in nodelabel.items())
 
     """
     for x in range(0,len(E)):
@@ -750,6 +750,15 @@ def req_item():
 
     return output
 
+# -----------------------------------------------------------------------------
+def candidate():
+    """
+        REST Controller for the best supplier sites for open requests,
+        as pre-computed by the req_update_matches task
+    """
+
+    return s3_rest_controller()
+
 # -----------------------------------------------------------------------------
 def req_item_packs():
     """
@@ -1 +1,9 @@
-current._scheduler.worker_loop(heartbeat=20)
\ No newline at end of file
+# Worker for the web2py Scheduler
+#
+# To run a worker for particular queues only, pass the queue names, e.g.:
+# python web2py.py -S eden -M -R applications/eden/cron/scheduler.py -A interactive
+#
+import sys
+if len(sys.argv) > 1:
+    current._scheduler.group_names = sys.argv[1:]
+current._scheduler.worker_loop(heartbeat=20)
@@ -6,6 +6,12 @@
     Instantiate Classes
 """
 
+# Profiler (if enabled), starts with the time for models/000_*.py
+import s3profiler
+profiler = s3profiler.S3Profiler.setup(start=request.now)
+if profiler:
+    profiler.checkpoint("000_1st_run.py+000_config.py")
+
 if settings.get_L10n_languages_readonly():
     # Make the Language files read-only for improved performance
     T.is_writable = False
@@ -89,6 +95,8 @@ else:
 
 current.db = db
 db.set_folder("upload")
+if profiler:
+    profiler.attach(db)
 
 # Sessions Storage
 if settings.get_base_session_memcache():
@@ -215,4 +223,8 @@ def s3_auth_on_logout(user):
     """
     s3_clear_session()
 
+# =============================================================================
+if profiler:
+    profiler.checkpoint("00_db.py")
+
 # END =========================================================================
@@ -114,6 +114,11 @@ else:
 #    # Use what browser requests (default web2py behaviour)
 #    T.force(T.http_accept_language)
 
+# Use compiled language catalogs
+if settings.get_L10n_compiled_catalogs():
+    from s3.s3translate import TranslateCatalog
+    TranslateCatalog.install(s3.l10n_languages)
+
 # IE doesn't set request.env.http_accept_language
 #if language != "en":
 T.force(language)
@@ -313,4 +318,8 @@ s3.crud_strings = Storage(
     name_nice = T("Record"),
     name_nice_plural = T("Records"))
 
+# =============================================================================
+if profiler:
+    profiler.checkpoint("00_settings.py")
+
 # END =========================================================================
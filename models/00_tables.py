@@ -67,4 +67,8 @@ from s3.s3fields import S3ReusableField, s3_comments, s3_meta_fields
 s3.comments = s3_comments
 s3.meta_fields = s3_meta_fields
 
+# =============================================================================
+if profiler:
+    profiler.checkpoint("00_tables.py")
+
 # END =========================================================================
@@ -95,7 +95,11 @@ if auth.permission.format in ("html"):
             if "S3OptionsMenu" in deployment_menus.__dict__:
                 S3OptionsMenu = deployment_menus.S3OptionsMenu
 
+    if profiler:
+        timer = profiler.timer()
     main = S3MainMenu.menu()
+    if profiler:
+        profiler.record("menu", "main", timer)
 else:
     main = None
 
@@ -416,4 +420,8 @@ def s3_rest_controller(prefix=None, resourcename=None, **attr):
 # Enable access to this function from modules
 current.rest_controller = s3_rest_controller
 
+# =============================================================================
+if profiler:
+    profiler.checkpoint("00_utils.py")
+
 # END =========================================================================
@@ -46,6 +46,43 @@ def crop_image(path, x1, y1, x2, y2, width):
 
 tasks["crop_image"] = crop_image
 
+# -----------------------------------------------------------------------------
+def merge_find_duplicates(tablename, user_id=None):
+    """
+        Find duplicate candidates in a table (to be reviewed in S3Merge)
+        - should be scheduled e.g. nightly, or run after large imports
+
+        @param tablename: the table name
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    result = s3base.S3DuplicateFinder(tablename)()
+    db.commit()
+    return result
+
+tasks["merge_find_duplicates"] = merge_find_duplicates
+
+# -----------------------------------------------------------------------------
+if settings.has_module("cr"):
+
+    def cr_shelter_rebuild_aggregates(user_id=None):
+        """
+            Rebuild the shelter capacity/population aggregates
+
+            @param user_id: calling request's auth.user.id or None
+        """
+        if user_id:
+            # Authenticate
+            auth.s3_impersonate(user_id)
+        # Run the Task
+        s3db.cr_shelter_rebuild_aggregates()
+        db.commit()
+
+    tasks["cr_shelter_rebuild_aggregates"] = cr_shelter_rebuild_aggregates
+
 # -----------------------------------------------------------------------------
 if settings.has_module("doc"):
 
@@ -172,13 +209,98 @@ def gis_update_location_tree(feature, user_id=None):
         # Authenticate
         auth.s3_impersonate(user_id)
     # Run the Task & return the result
+    from s3.s3gis import S3Gazetteer
     feature = json.loads(feature)
     path = gis.update_location_tree(feature)
     db.commit()
+    # Invalidate the cached hierarchy data & update the gazetteer
+    if feature:
+        location_id = feature["id"]
+        gis.invalidate_ldata([location_id])
+        if feature.get("level"):
+            # Lx: names, paths and bounds of the descendants may have changed
+            S3Gazetteer().update([location_id], descendants=True)
+            S3Gazetteer.invalidate()
+        else:
+            # Specific location: only its own index entries are affected
+            S3Gazetteer().update([location_id])
+    else:
+        gis.invalidate_ldata()
+        S3Gazetteer().rebuild()
+    db.commit()
     return path
 
 tasks["gis_update_location_tree"] = gis_update_location_tree
 
+# -----------------------------------------------------------------------------
+def gis_rebuild_gazetteer(user_id=None):
+    """
+        Rebuild the gazetteer for the local geocoder, and remove expired
+        results from the geocoding cache
+
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    from s3.s3gis import S3Gazetteer
+    result = S3Gazetteer().rebuild()
+    db.commit()
+    return result
+
+tasks["gis_rebuild_gazetteer"] = gis_rebuild_gazetteer
+
+# -----------------------------------------------------------------------------
+def gis_export_ldata(countries=[], location_ids=None, user_id=None):
+    """
+        Pre-package the Location Selector hierarchy data for whole countries
+            - will normally be done Asynchronously if there is a worker alive
+
+        @param countries: list of ISO2 country codes, empty list for all
+        @param location_ids: list of L0 location IDs (alternative to countries)
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task
+    gis.export_ldata(countries=countries, location_ids=location_ids)
+
+tasks["gis_export_ldata"] = gis_export_ldata
+
+# -----------------------------------------------------------------------------
+def s3_run_deferred_hooks(user_id=None):
+    """
+        Run the pending deferred post-commit hooks
+
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    result = current.s3task.run_deferred_hooks()
+    db.commit()
+    return result
+
+tasks["s3_run_deferred_hooks"] = s3_run_deferred_hooks
+
+# -----------------------------------------------------------------------------
+def s3_audit_load(user_id=None):
+    """
+        Load the buffered audit log into the audit table
+
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    return current.audit.load()
+
+tasks["s3_audit_load"] = s3_audit_load
+
 # -----------------------------------------------------------------------------
 def org_facility_geojson(user_id=None):
     """
@@ -194,6 +316,26 @@ def org_facility_geojson(user_id=None):
 
 tasks["org_facility_geojson"] = org_facility_geojson
 
+# -----------------------------------------------------------------------------
+if settings.has_module("inv"):
+
+    def inv_stock_snapshot(user_id=None):
+        """
+            Reconcile the Stock Movement Ledger with the current stock
+            levels and take a snapshot of the stock in all sites
+
+            @param user_id: calling request's auth.user.id or None
+        """
+        if user_id:
+            # Authenticate
+            auth.s3_impersonate(user_id)
+        # Run the Task & return the result
+        result = s3db.inv_stock_update_snapshots()
+        db.commit()
+        return result
+
+    tasks["inv_stock_snapshot"] = inv_stock_snapshot
+
 # -----------------------------------------------------------------------------
 if settings.has_module("msg"):
 
@@ -237,12 +379,13 @@ if settings.has_module("msg"):
     tasks["msg_twitter_search"] = msg_twitter_search
 
     # -------------------------------------------------------------------------
-    def msg_process_keygraph(search_id, user_id=None):
+    def msg_process_keygraph(search_id=None, user_id=None):
         """
-            Process Twitter Search Results with KeyGraph
+            Update the keyword graph of Twitter Search Results
             - will normally be done Asynchronously if there is a worker alive
 
-            @param search_id: one of s3db.msg_twitter_search.id
+            @param search_id: one of s3db.msg_twitter_search.id, None for
+                              the graph of all inbound messages
             @param user_id: calling request's auth.user.id or None
         """
         if user_id:
@@ -269,6 +412,21 @@ if settings.has_module("msg"):
 
     tasks["msg_poll"] = msg_poll
 
+    # -----------------------------------------------------------------------------
+    def msg_poll_channels(tablename, user_id=None):
+        """
+            Poll all enabled Channels of a type (RSS Feeds or Mailboxes)
+            concurrently
+        """
+        if user_id:
+            auth.s3_impersonate(user_id)
+        # Run the Task & return the result
+        result = msg.poll_channels(tablename)
+        db.commit()
+        return result
+
+    tasks["msg_poll_channels"] = msg_poll_channels
+
     # -----------------------------------------------------------------------------
     def msg_parse(channel_id, function_name, user_id=None):
         """
@@ -344,6 +502,23 @@ if settings.has_module("req"):
 
     tasks["req_add_from_template"] = req_add_from_template
 
+    # -------------------------------------------------------------------------
+    def req_update_matches(user_id=None):
+        """
+            Re-compute the best supplier sites for all open Requests
+
+            @param user_id: calling request's auth.user.id or None
+        """
+        if user_id:
+            # Authenticate
+            auth.s3_impersonate(user_id)
+        # Run the Task & return the result
+        result = s3db.req_update_matches()
+        db.commit()
+        return result
+
+    tasks["req_update_matches"] = req_update_matches
+
 # -----------------------------------------------------------------------------
 if settings.has_module("stats"):
     def stats_demographic_update_aggregates(records=None, user_id=None):
@@ -449,6 +624,30 @@ if settings.has_module("stats"):
 
         tasks["vulnerability_update_location_aggregate"] = vulnerability_update_location_aggregate
 
+# -----------------------------------------------------------------------------
+if settings.has_module("survey"):
+
+    def survey_rebuild_question_stats(series_id=None, user_id=None):
+        """
+            Rebuild the pre-aggregated answer statistics
+
+            @param series_id: the survey_series record ID, None for all series
+            @param user_id: calling request's auth.user.id or None
+        """
+        if user_id:
+            # Authenticate
+            auth.s3_impersonate(user_id)
+        if series_id:
+            series_ids = [series_id]
+        else:
+            series_ids = [row.id for row in s3db.survey_getAllSeries()]
+        # Run the Task
+        for series_id in series_ids:
+            s3db.survey_rebuildQuestionStats(series_id)
+            db.commit()
+
+    tasks["survey_rebuild_question_stats"] = survey_rebuild_question_stats
+
 # -----------------------------------------------------------------------------
 if settings.has_module("sync"):
 
@@ -502,4 +701,8 @@ scheduler_task_id = S3ReusableField("scheduler_task_id",
                                     ondelete="CASCADE")
 s3.scheduler_task_id = scheduler_task_id
 
+# =============================================================================
+if profiler:
+    profiler.checkpoint("tasks.py")
+
 # END =========================================================================
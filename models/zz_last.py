@@ -18,7 +18,11 @@ if auth.permission.format in ("html"):
     controller = request.controller
     if controller not in s3_menu_dict:
         # No custom menu, so use standard menu for this controller
+        if profiler:
+            timer = profiler.timer()
         menu.options = S3OptionsMenu(controller).menu
+        if profiler:
+            profiler.record("menu", "options:%s" % controller, timer)
         if not menu.options:
             # Fallback to an auto-generated list of resources
             # @ToDo
@@ -44,3 +48,10 @@ if auth.permission.format in ("html"):
 
     # Add breadcrumbs
     menu.breadcrumbs = S3OptionsMenu.breadcrumbs
+
+# Profile of the models pipeline
+if profiler:
+    profiler.checkpoint("zz_last.py")
+    profiler.finish()
+
+# END =========================================================================
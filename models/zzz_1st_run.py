@@ -119,6 +119,46 @@ if len(pop_list) > 0:
                              timeout=300,
                              repeats=0)
 
+    if has_module("inv"):
+
+        # Daily stock snapshot
+        s3task.schedule_task("inv_stock_snapshot",
+                             period=86400, # seconds, so 1/day
+                             timeout=3600, # seconds
+                             repeats=0     # unlimited
+                             )
+
+    if has_module("req") and has_module("inv"):
+
+        # Match open requests against inventory stock every 15 minutes
+        s3task.schedule_task("req_update_matches",
+                             period=900,  # seconds
+                             timeout=600, # seconds
+                             repeats=0    # unlimited
+                             )
+
+    # Retry failed deferred hooks every 5 minutes
+    s3task.schedule_task("s3_run_deferred_hooks",
+                         period=300,  # seconds
+                         timeout=600, # seconds
+                         repeats=0    # unlimited
+                         )
+
+    # Rebuild the gazetteer for the local geocoder once a day
+    s3task.schedule_task("gis_rebuild_gazetteer",
+                         period=86400, # seconds, so 1/day
+                         timeout=3600, # seconds
+                         repeats=0     # unlimited
+                         )
+
+    # Load the buffered audit log every 5 minutes
+    if settings.get_security_audit_buffer() == "log":
+        s3task.schedule_task("s3_audit_load",
+                             period=300,  # seconds
+                             timeout=600, # seconds
+                             repeats=0    # unlimited
+                             )
+
     # Daily maintenance
     s3task.schedule_task("maintenance",
                          vars={"period":"daily"},
@@ -135,7 +175,8 @@ if len(pop_list) > 0:
     auth.override = True
 
     # Load all Models to ensure all DB tables present
-    s3db.load_all_models()
+    # (also generates the model manifest for lazy model loading)
+    s3db.build_manifest()
 
     # Shortcuts
     path_join = os.path.join
@@ -166,9 +207,32 @@ if len(pop_list) > 0:
     tablename = "gis_location"
     field = "name"
     db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+    # Gazetteer & geocoding cache lookups
+    for tablename, field in (("gis_gazetteer", "name"),
+                             ("gis_gazetteer", "location_id"),
+                             ("gis_geocode_cache", "query_key"),
+                             ):
+        db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % \
+                      (tablename, field, tablename, field))
+
+    # Stock Ledger lookups by snapshot
+    if has_module("inv"):
+        for tablename, field in (("inv_stock_movement", "snapshot"),
+                                 ("inv_stock_snapshot", "watermark"),
+                                 ):
+            s3db.table(tablename)
+            db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % \
+                          (tablename, field, tablename, field))
 
     # Messaging Module
     if has_module("msg"):
+        # Duplicate checks for RSS posts
+        tablename = "msg_rss"
+        field = "link_hash"
+        s3db.table(tablename)
+        db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % \
+                      (tablename, field, tablename, field))
+
         update_super = s3db.update_super
         # To read inbound email, set username (email address), password, etc.
         # here. Insert multiple records for multiple email sources.
@@ -319,6 +383,13 @@ if len(pop_list) > 0:
     end = datetime.datetime.now()
     print >> sys.stdout, "Location Tree update completed in %s" % (end - start)
 
+    # Build the gazetteer for the local geocoder
+    start = datetime.datetime.now()
+    from s3.s3gis import S3Gazetteer
+    S3Gazetteer().rebuild()
+    end = datetime.datetime.now()
+    print >> sys.stdout, "Gazetteer build completed in %s" % (end - start)
+
     # Countries are only editable by MapAdmin
     db(db.gis_location.level == "L0").update(owned_by_group=map_admin)
 
@@ -104,9 +104,10 @@ from s3sync import *
 
 # Import
 from s3import import *
+from s3csvmap import *
 
 # De-duplication
-from s3merge import S3Merge
+from s3merge import S3Merge, S3DuplicateFinder
 
 # Don't load S3PDF unless needed (very slow import with reportlab)
 #from s3pdf import S3PDF
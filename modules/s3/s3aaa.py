@@ -38,6 +38,7 @@ __all__ = ["AuthS3",
            ]
 
 import datetime
+import os
 #import re
 from uuid import uuid4
 
@@ -57,6 +58,7 @@ except:
     from gluon.contrib.simplejson.ordered_dict import OrderedDict
 
 from gluon import *
+from gluon import portalocker
 from gluon.dal import Row, Rows, Query, Table
 from gluon.sqlhtml import OptionsWidget
 from gluon.storage import Storage
@@ -67,7 +69,7 @@ from s3error import S3PermissionError
 from s3fields import S3Represent, s3_uid, s3_timestamp, s3_deletion_status, s3_comments
 from s3rest import S3Method
 from s3track import S3Tracker
-from s3utils import s3_mark_required
+from s3utils import s3_mark_required, s3_on_commit
 
 DEFAULT = lambda: None
 #table_field = re.compile("[\w_]+\.[\w_]+")
@@ -6328,6 +6330,18 @@ class S3Audit(object):
         """
 
         settings = current.deployment_settings
+
+        # Buffered auditing (only for HTTP requests: shell scripts and
+        # scheduler tasks do not call response.custom_commit, so buffered
+        # entries would never be written)
+        buffered = settings.get_security_audit_buffer()
+        if buffered:
+            request = current.request
+            if request.is_shell or request.is_scheduler:
+                buffered = False
+        self.buffered = buffered
+        self.buffer = []
+
         audit_read = settings.get_security_audit_read()
         audit_write = settings.get_security_audit_write()
         if not audit_read and not audit_write:
@@ -6425,13 +6439,13 @@ class S3Audit(object):
 
         if method in ("list", "read"):
             if audit_read:
-                table.insert(timestmp = now,
-                             user_id = self.user_id,
-                             method = method,
-                             tablename = tablename,
-                             record_id = record,
-                             representation = representation,
-                             )
+                self.write(timestmp = now,
+                           user_id = self.user_id,
+                           method = method,
+                           tablename = tablename,
+                           record_id = record,
+                           representation = representation,
+                           )
 
         elif method == "create":
             if audit_write:
@@ -6443,14 +6457,14 @@ class S3Audit(object):
                                  for var in form_vars if form_vars[var]]
                 else:
                     new_value = []
-                table.insert(timestmp = now,
-                             user_id = self.user_id,
-                             method = method,
-                             tablename = tablename,
-                             record_id = record,
-                             representation = representation,
-                             new_value = new_value,
-                             )
+                self.write(timestmp = now,
+                           user_id = self.user_id,
+                           method = method,
+                           tablename = tablename,
+                           record_id = record,
+                           representation = representation,
+                           new_value = new_value,
+                           )
 
         elif method == "update":
             if audit_write:
@@ -6469,15 +6483,15 @@ class S3Audit(object):
                 else:
                     new_value = []
                     old_value = []
-                table.insert(timestmp = now,
-                             user_id = self.user_id,
-                             method = method,
-                             tablename = tablename,
-                             record_id = record,
-                             representation = representation,
-                             old_value = old_value,
-                             new_value = new_value,
-                             )
+                self.write(timestmp = now,
+                           user_id = self.user_id,
+                           method = method,
+                           tablename = tablename,
+                           record_id = record,
+                           representation = representation,
+                           old_value = old_value,
+                           new_value = new_value,
+                           )
 
         elif method == "delete":
             if audit_write:
@@ -6488,17 +6502,156 @@ class S3Audit(object):
                 if row:
                     old_value = ["%s:%s" % (field, row[field])
                                  for field in row]
-                table.insert(timestmp = now,
-                             user_id = self.user_id,
-                             method = method,
-                             tablename = tablename,
-                             record_id = record,
-                             representation = representation,
-                             old_value = old_value,
-                             )
+                self.write(timestmp = now,
+                           user_id = self.user_id,
+                           method = method,
+                           tablename = tablename,
+                           record_id = record,
+                           representation = representation,
+                           old_value = old_value,
+                           )
 
         return True
 
+    # -------------------------------------------------------------------------
+    def write(self, **entry):
+        """
+            Write an audit entry, or add it to the buffer
+
+            @param entry: the audit entry as dict {fieldname: value}
+        """
+
+        if not self.buffered:
+            self.table.insert(**entry)
+            return
+
+        if not self.buffer:
+            # Flush at commit
+            s3_on_commit(self.flush)
+        self.buffer.append(entry)
+
+    # -------------------------------------------------------------------------
+    def flush(self):
+        """
+            Write all buffered audit entries, either with a single
+            multi-row insert, or by appending them to the audit log
+
+            @note: called automatically when the request commits
+        """
+
+        buffer = self.buffer
+        if not buffer:
+            return
+        self.buffer = []
+
+        if self.buffered == "log":
+            try:
+                self.append(buffer)
+            except (IOError, OSError, TypeError, ValueError), e:
+                current.log.error("Audit log not writable: %s" % e)
+            else:
+                return
+
+        self.table.bulk_insert(buffer)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def log_path():
+        """ Get the absolute path of the audit log file """
+
+        return os.path.join(current.request.folder,
+                            current.deployment_settings.get_security_audit_log())
+
+    # -------------------------------------------------------------------------
+    def append(self, entries):
+        """
+            Append entries to the audit log file
+
+            @param entries: list of audit entries
+        """
+
+        lines = []
+        for entry in entries:
+            entry = dict(entry)
+            entry["timestmp"] = entry["timestmp"].isoformat()
+            for fn in ("old_value", "new_value"):
+                value = entry.get(fn)
+                if value is not None:
+                    # Same format as the table insert
+                    entry[fn] = str(value)
+            lines.append(json.dumps(entry))
+        data = "%s\n" % "\n".join(lines)
+
+        path = self.log_path()
+        while True:
+            f = open(path, "a")
+            try:
+                portalocker.lock(f, portalocker.LOCK_EX)
+                # If the log has been moved away for loading while
+                # waiting for the lock, then start a new one
+                if os.path.exists(path) and \
+                   os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    f.write(data)
+                    f.flush()
+                    return
+            finally:
+                portalocker.unlock(f)
+                f.close()
+
+    # -------------------------------------------------------------------------
+    def load(self, chunk_size=500):
+        """
+            Load the entries from the audit log file into the audit
+            table (scheduler task s3_audit_load)
+
+            @param chunk_size: number of entries per insert
+
+            @return: the number of entries loaded
+        """
+
+        table = self.table
+        if not table:
+            return 0
+
+        path = self.log_path()
+        loading = "%s.loading" % path
+
+        # Move the current log aside (unless a previous load has failed)
+        if not os.path.exists(loading):
+            if not os.path.exists(path):
+                return 0
+            f = open(path, "a")
+            try:
+                portalocker.lock(f, portalocker.LOCK_EX)
+                os.rename(path, loading)
+            finally:
+                portalocker.unlock(f)
+                f.close()
+
+        strptime = datetime.datetime.strptime
+        entries = []
+        with open(loading) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = dict((str(k), v)
+                                 for k, v in json.loads(line).items())
+                    timestmp = entry["timestmp"].split(".", 1)[0]
+                    entry["timestmp"] = strptime(timestmp, "%Y-%m-%dT%H:%M:%S")
+                except (ValueError, KeyError):
+                    current.log.error("Invalid audit log entry: %s" % line)
+                    continue
+                entries.append(entry)
+
+        for i in xrange(0, len(entries), chunk_size):
+            table.bulk_insert(entries[i:i + chunk_size])
+        current.db.commit()
+        os.remove(loading)
+
+        return len(entries)
+
     # -------------------------------------------------------------------------
     def represent(self, records):
         """
@@ -1174,13 +1174,21 @@ class S3CRUD(S3Method):
             get_vars = self.request.get_vars
             start = get_vars.get("start", None)
             limit = get_vars.get("limit", 0)
+            seek = None
             if limit:
                 try:
-                    start = int(start)
+                    start = int(start or 0)
                     limit = int(limit)
                 except ValueError:
                     start = None
                     limit = 0 # use default
+                # Cursor for keyset pagination (from the X-Seek header
+                # of the previous page)
+                if limit and "seek" in get_vars:
+                    try:
+                        seek = json.loads(get_vars["seek"])
+                    except ValueError:
+                        seek = None
             else:
                 start = None
 
@@ -1190,13 +1198,17 @@ class S3CRUD(S3Method):
             fields = [rfield.fname for rfield in rfields
                                    if rfield.tname == tablename]
             orderby = get_config("orderby", None)
+            if orderby is None and limit:
+                # Stable order of pages (also required for seek)
+                orderby = resource.table._id
 
             exporter = S3Exporter().json
             return exporter(resource,
                             start=start,
                             limit=limit,
                             fields=fields,
-                            orderby=orderby)
+                            orderby=orderby,
+                            seek=seek)
 
         elif representation == "pdf":
 
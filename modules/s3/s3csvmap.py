@@ -0,0 +1,727 @@
+# -*- coding: utf-8 -*-
+
+""" Native CSV Column Mapping
+
+    @copyright: 2014 (c) Sahana Software Foundation
+    @license: MIT
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+
+    A column map is a JSON file next to an s3csv stylesheet (same name,
+    extension .map.json instead of .xsl) which declares how the columns
+    of a CSV/XLS source map to S3XML. Where a column map exists, batched
+    imports (see S3Resource.import_xml) convert the rows directly instead
+    of running the XSLT, and remember the records found for lookup values
+    (organisations, types, locations etc.) across batches so that they are
+    looked up only once per import.
+
+    Column map structure:
+
+    {"resource": "org_organisation",        main resource (=import target)
+     "unique": ["Organisation"],            only the first row per value
+     "ignore": ["Twitter"],                 columns the stylesheet ignores
+     "fields": [field, ...],                fields of the main resource
+     "components": [component, ...],        components of the main resource
+     "lookups": {name: lookup, ...}         records looked up by key
+     }
+
+    field:
+        {"field": "name",                   target field
+         "column": "Name",                  source column, or a list of
+                                            alternative column names
+         "value": "1",                      constant value (instead of column)
+         "key": 0,                          lookup key value (instead of column)
+         "item": true,                      item of a split column
+         "case": "upper"|"lower",           convert case
+         "country": true,                   convert country name into ISO2
+         "map": {"Open": "2"},              map column values
+         "default": "3",                    default for unmapped values
+         "attr": "value",                   write into this attribute
+                                            rather than as text
+         }
+
+        {"field": "organisation_id",        reference to a lookup record
+         "lookup": "organisation",          name of the lookup
+         "columns": ["Owned By"],           override key columns (optional)
+         }
+
+        {"field": "location_id",            location reference
+         "location": {"L0": "Country",      columns for L0-L5, and the
+                      "L1": "L1", ...       fields of a specific location
+                      "name": "Address",    (name, addr_street, addr_postcode,
+                      "lat": "Lat", ...},    lat, lon)
+         "point": "address"|"always",       when to create a specific
+                                            location: if the address column
+                                            has a value, or whenever any
+                                            column of the location has one
+         }
+
+    component:
+        {"resource": "pr_contact",
+         "alias": "contact",                component alias (optional)
+         "fields": [field, ...],
+         "require": ["Phone2"],             create only if any of these
+                                            columns has a value (default:
+                                            the columns of the fields)
+         "always": true,                    create regardless of values
+         "split": "Sectors",                one component per list item
+         "separator": ","
+         }
+
+    lookup:
+        {"resource": "org_organisation",    resource (or field spec to
+                                            choose the resource per row)
+         "columns": ["Organisation"],       key columns
+         "match": {"name": 0,               DB fields to match the key
+                   "item_id": {"lookup": "supply_item"}},
+         "fields": [field, ...],            fields for new records
+         "components": [component, ...]
+         }
+"""
+
+__all__ = ["S3CSVMapping",
+           ]
+
+import os
+import sys
+
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+
+try:
+    from lxml import etree
+except ImportError:
+    print >> sys.stderr, "ERROR: lxml module needed for XML handling"
+    raise
+
+from gluon import current
+
+from s3utils import s3_debug, s3_unicode
+
+# =============================================================================
+class S3CSVMapping(object):
+    """ Declarative column map to convert CSV/XLS tables into S3XML """
+
+    # Parsed column maps {path: (mtime, spec)}
+    specs = {}
+
+    L0_UUID = "urn:iso:std:iso:3166:-1:code:%s"
+    LEVELS = ("L1", "L2", "L3", "L4", "L5")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, spec):
+        """
+            Constructor
+
+            @param spec: the column map (dict)
+        """
+
+        self.spec = spec
+        self.resource = spec.get("resource")
+        self.lookups = spec.get("lookups") or {}
+
+        # Lookup index {(lookup, resource, key): (id, uuid)}, kept
+        # across batches for the lifetime of this instance
+        self.index = {}
+
+        # Lookup elements emitted in the current batch {key: tuid}
+        self.emitted = {}
+        self.root = None
+
+        self._columns = None
+        self._countries = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def load(cls, stylesheet):
+        """
+            Get a new column map instance for a stylesheet
+
+            @param stylesheet: the stylesheet path
+
+            @return: S3CSVMapping instance, or None if there is no
+                     column map for this stylesheet
+        """
+
+        if not isinstance(stylesheet, basestring):
+            return None
+        path = "%s.map.json" % os.path.splitext(stylesheet)[0]
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        specs = cls.specs
+        cached = specs.get(path)
+        if cached and cached[0] == mtime:
+            spec = cached[1]
+        else:
+            try:
+                with open(path, "rb") as mapfile:
+                    spec = json.load(mapfile)
+            except (IOError, ValueError):
+                s3_debug("S3CSVMapping: invalid column map", path)
+                return None
+            specs[path] = (mtime, spec)
+        return cls(spec)
+
+    # -------------------------------------------------------------------------
+    def supports(self, tree):
+        """
+            Check whether this column map covers all columns with values
+            in a CSV/XLS table (otherwise the stylesheet must be used)
+
+            @param tree: the table as ElementTree (as from S3XML.csv2trees)
+        """
+
+        columns = self.columns
+        xml = current.xml
+        FIELD = xml.ATTRIBUTE.field
+        for row in tree.getroot().iterchildren(xml.TAG.row):
+            for col in row.iterchildren(xml.TAG.col):
+                if col.get(FIELD) not in columns and \
+                   col.text and col.text.strip():
+                    return False
+        return True
+
+    # -------------------------------------------------------------------------
+    def transform(self, tree):
+        """
+            Convert a CSV/XLS table into an S3XML tree
+
+            @param tree: the table as ElementTree (as from S3XML.csv2trees)
+
+            @return: the S3XML as ElementTree
+        """
+
+        xml = current.xml
+        TAG = xml.TAG
+        ATTRIBUTE = xml.ATTRIBUTE
+        FIELD = ATTRIBUTE.field
+
+        root = self.root = etree.Element(TAG.root)
+        self.emitted = {}
+
+        spec = self.spec
+        unique = spec.get("unique")
+        seen = set()
+
+        for row in tree.getroot().iterchildren(TAG.row):
+            data = {}
+            for col in row.iterchildren(TAG.col):
+                text = col.text
+                data[col.get(FIELD)] = text.strip() if text else ""
+            if unique:
+                key = tuple(data.get(c, "") for c in unique)
+                if key in seen:
+                    continue
+                seen.add(key)
+            element = etree.SubElement(root, TAG.resource)
+            element.set(ATTRIBUTE.name, self.resource)
+            self._fields(element, data, spec.get("fields"))
+            self._components(element, data, spec.get("components"))
+
+        self.root = None
+        return etree.ElementTree(root)
+
+    # -------------------------------------------------------------------------
+    @property
+    def columns(self):
+        """ All columns known to this column map """
+
+        columns = self._columns
+        if columns is None:
+            columns = set()
+            spec = self.spec
+
+            def add(colspec):
+                if isinstance(colspec, (list, tuple)):
+                    columns.update(colspec)
+                elif colspec:
+                    columns.add(colspec)
+
+            def collect(item):
+                if isinstance(item, dict):
+                    for k, v in item.items():
+                        if k in ("column", "split"):
+                            add(v)
+                        elif k in ("columns", "require"):
+                            for colspec in v:
+                                add(colspec)
+                        elif k == "location":
+                            for colspec in v.values():
+                                add(colspec)
+                        else:
+                            collect(v)
+                elif isinstance(item, list):
+                    for v in item:
+                        collect(v)
+
+            collect(spec.get("fields"))
+            collect(spec.get("components"))
+            collect(self.lookups)
+            for colspec in spec.get("unique") or []:
+                add(colspec)
+            for colspec in spec.get("ignore") or []:
+                add(colspec)
+            self._columns = columns
+        return columns
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _value(data, colspec):
+        """
+            Get the value of a column in a row
+
+            @param data: the row data {column: value}
+            @param colspec: the column name, or a list of alternative
+                            column names (first non-empty value wins)
+        """
+
+        if not colspec:
+            return ""
+        if isinstance(colspec, (list, tuple)):
+            for column in colspec:
+                value = data.get(column)
+                if value:
+                    return value
+            return ""
+        return data.get(colspec, "")
+
+    # -------------------------------------------------------------------------
+    def _country(self, value):
+        """
+            Convert a country name into its ISO2 code
+
+            @param value: the country name or code
+        """
+
+        if len(value) == 2:
+            return value.upper()
+        countries = self._countries
+        if countries is None:
+            countries = current.gis.get_countries(key_type="code") or {}
+            countries = self._countries = dict((s3_unicode(name).lower(), code)
+                                               for code, name in countries.items())
+        return countries.get(value.lower(), value)
+
+    # -------------------------------------------------------------------------
+    def _fields(self, element, data, fields, key=None, item=None):
+        """
+            Add the fields to a resource element
+
+            @param element: the resource element
+            @param data: the row data
+            @param fields: the field specs
+            @param key: the lookup key (for lookup records)
+            @param item: the list item (for split components)
+        """
+
+        if not fields:
+            return
+
+        xml = current.xml
+        ATTRIBUTE = xml.ATTRIBUTE
+        SubElement = etree.SubElement
+        DATA = xml.TAG.data
+
+        for f in fields:
+            if "lookup" in f:
+                self._reference(element, data, f, item=item)
+                continue
+            if "location" in f:
+                self._location(element, data, f)
+                continue
+
+            if "value" in f:
+                value = f["value"]
+            elif "key" in f:
+                value = key[f["key"]] if key else ""
+            elif f.get("item"):
+                value = item
+            else:
+                value = self._value(data, f.get("column"))
+            if value:
+                value = s3_unicode(value)
+                case = f.get("case")
+                if case == "upper":
+                    value = value.upper()
+                elif case == "lower":
+                    value = value.lower()
+                if f.get("country"):
+                    value = self._country(value)
+            if "map" in f:
+                value = f["map"].get(value) if value else None
+                if value is None:
+                    value = f.get("default")
+            if value is None or value == "":
+                continue
+
+            field = SubElement(element, DATA)
+            field.set(ATTRIBUTE.field, f["field"])
+            attr = f.get("attr")
+            if attr:
+                field.set(attr, s3_unicode(value))
+            else:
+                field.text = s3_unicode(value)
+
+    # -------------------------------------------------------------------------
+    def _components(self, element, data, components, key=None):
+        """
+            Add component elements to a resource element
+
+            @param element: the resource element
+            @param data: the row data
+            @param components: the component specs
+            @param key: the lookup key (for lookup records)
+        """
+
+        if not components:
+            return
+
+        xml = current.xml
+        ATTRIBUTE = xml.ATTRIBUTE
+        SubElement = etree.SubElement
+        RESOURCE = xml.TAG.resource
+
+        value = self._value
+        for c in components:
+
+            split = c.get("split")
+            if split:
+                items = value(data, split).split(c.get("separator", ","))
+                items = [i.strip() for i in items if i.strip()]
+            else:
+                require = c.get("require")
+                if require is None:
+                    require = [f.get("column") for f in c.get("fields", [])]
+                if not c.get("always") and \
+                   not any(value(data, colspec) for colspec in require):
+                    continue
+                items = [None]
+
+            for i in items:
+                component = SubElement(element, RESOURCE)
+                component.set(ATTRIBUTE.name, c["resource"])
+                if "alias" in c:
+                    component.set(ATTRIBUTE.alias, c["alias"])
+                self._fields(component, data, c.get("fields"),
+                             key = key,
+                             item = i,
+                             )
+
+    # -------------------------------------------------------------------------
+    def _key(self, data, lookup, spec=None, item=None):
+        """
+            Get the key for a lookup record
+
+            @param data: the row data
+            @param lookup: the lookup spec
+            @param spec: the referencing field spec (which can override
+                         the key columns, or use the split item as key)
+            @param item: the list item (for split components)
+
+            @return: tuple of key values, or None if all are empty
+        """
+
+        if spec and spec.get("item"):
+            key = (item or "",)
+        else:
+            columns = spec.get("columns") if spec else None
+            if not columns:
+                columns = lookup.get("columns") or []
+            key = tuple(self._value(data, colspec) for colspec in columns)
+        return key if any(key) else None
+
+    # -------------------------------------------------------------------------
+    def _resolve(self, name, data, spec=None, item=None):
+        """
+            Find or create the lookup record for a row
+
+            @param name: the lookup name
+            @param data: the row data
+            @param spec: the referencing field spec
+            @param item: the list item (for split components)
+
+            @return: tuple (resource, attribute, value, id) for the
+                     reference, attribute being either "uuid" (existing
+                     record, with its id) or "tuid" (new record, id None),
+                     or None if the row has no key for this lookup
+        """
+
+        lookup = self.lookups.get(name)
+        if not lookup:
+            return None
+        key = self._key(data, lookup, spec=spec, item=item)
+        if key is None:
+            return None
+
+        resource = lookup.get("resource")
+        if isinstance(resource, dict):
+            # Resource chosen by column value
+            value = self._value(data, resource.get("column"))
+            mapped = resource.get("map", {}).get(value) if value else None
+            resource = mapped or resource.get("default")
+
+        xml = current.xml
+        UID = xml.UID
+        TUID = xml.ATTRIBUTE.tuid
+
+        ikey = (name, resource, key)
+        index = self.index
+        if ikey in index:
+            record_id, uid = index[ikey]
+            return resource, UID, uid, record_id
+        emitted = self.emitted
+        if ikey in emitted:
+            return resource, TUID, emitted[ikey], None
+
+        record = self._match(lookup, resource, key, data)
+        if record:
+            index[ikey] = record
+            record_id, uid = record
+            return resource, UID, uid, record_id
+
+        # New record
+        tuid = "%s:%s" % (name, "/".join(key))
+        emitted[ikey] = tuid
+
+        ATTRIBUTE = xml.ATTRIBUTE
+        element = etree.SubElement(self.root, xml.TAG.resource)
+        element.set(ATTRIBUTE.name, resource)
+        element.set(TUID, tuid)
+        self._fields(element, data, lookup.get("fields"), key=key, item=item)
+        self._components(element, data, lookup.get("components"), key=key)
+
+        return resource, TUID, tuid, None
+
+    # -------------------------------------------------------------------------
+    def _match(self, lookup, resource, key, data):
+        """
+            Find an existing record for a lookup key
+
+            @param lookup: the lookup spec
+            @param resource: the resource name
+            @param key: the key
+            @param data: the row data
+
+            @return: tuple (id, uuid) of the record, or None if not found
+        """
+
+        match = lookup.get("match")
+        if not match:
+            return None
+        table = current.s3db.table(resource)
+        if table is None:
+            return None
+
+        query = None
+        if "deleted" in table.fields:
+            query = (table.deleted != True)
+        for fieldname, source in match.items():
+            if fieldname not in table.fields:
+                return None
+            field = table[fieldname]
+            if isinstance(source, dict):
+                # Reference to another lookup record which must exist
+                ref = self._resolve(source["lookup"], data, spec=source)
+                if not ref or ref[3] is None:
+                    return None
+                value = ref[3]
+            else:
+                value = key[source]
+            if value is None or value == "":
+                if field.type in ("string", "text"):
+                    q = (field == None) | (field == "")
+                else:
+                    q = (field == None)
+            else:
+                q = (field == value)
+            query = q if query is None else query & q
+
+        UID = current.xml.UID
+        row = current.db(query).select(table._id,
+                                       table[UID],
+                                       limitby = (0, 1),
+                                       ).first()
+        if row:
+            return (row[table._id.name], row[UID])
+        return None
+
+    # -------------------------------------------------------------------------
+    def _reference(self, element, data, spec, item=None):
+        """
+            Add a reference to a lookup record
+
+            @param element: the resource element
+            @param data: the row data
+            @param spec: the field spec
+            @param item: the list item (for split components)
+        """
+
+        ref = self._resolve(spec["lookup"], data, spec=spec, item=item)
+        if ref:
+            xml = current.xml
+            ATTRIBUTE = xml.ATTRIBUTE
+            reference = etree.SubElement(element, xml.TAG.reference)
+            reference.set(ATTRIBUTE.field, spec["field"])
+            resource, attr, value = ref[:3]
+            reference.set(ATTRIBUTE.resource, resource)
+            reference.set(attr, value)
+
+    # -------------------------------------------------------------------------
+    def _location(self, element, data, spec):
+        """
+            Add a location reference, along with the elements for all
+            new locations in the hierarchy
+
+            @param element: the resource element
+            @param data: the row data
+            @param spec: the field spec
+        """
+
+        xml = current.xml
+        ATTRIBUTE = xml.ATTRIBUTE
+        TAG = xml.TAG
+        UID = xml.UID
+        TUID = ATTRIBUTE.tuid
+        SubElement = etree.SubElement
+
+        columns = spec["location"]
+        value = self._value
+        index = self.index
+        emitted = self.emitted
+
+        parent = None
+        parent_id = None
+
+        # Country
+        country = value(data, columns.get("L0"))
+        if country:
+            country = self._country(country)
+            uid = self.L0_UUID % country
+            ikey = ("L0", "gis_location", (country,))
+            if ikey not in index:
+                table = current.s3db.gis_location
+                row = current.db(table[UID] == uid).select(table.id,
+                                                           limitby = (0, 1),
+                                                           ).first()
+                index[ikey] = (row.id if row else None, uid)
+            parent = (UID, uid)
+            parent_id = index[ikey][0]
+        path = (country,)
+
+        # Hierarchy
+        for level in self.LEVELS:
+            name = value(data, columns.get(level))
+            if not name:
+                continue
+            path += (level, name)
+            ikey = ("location", "gis_location", path)
+            if ikey in index:
+                parent_id, uid = index[ikey]
+                parent = (UID, uid)
+                continue
+            if ikey in emitted:
+                parent = (TUID, emitted[ikey])
+                parent_id = None
+                continue
+            row = None
+            if parent_id or not parent:
+                table = current.s3db.gis_location
+                query = (table.name == name) & \
+                        (table.level == level) & \
+                        (table.parent == parent_id) & \
+                        (table.deleted != True)
+                row = current.db(query).select(table.id,
+                                               table[UID],
+                                               limitby = (0, 1),
+                                               ).first()
+            if row:
+                index[ikey] = (row.id, row[UID])
+                parent = (UID, row[UID])
+                parent_id = row.id
+            else:
+                tuid = "location:%s" % "/".join(path)
+                emitted[ikey] = tuid
+                location = SubElement(self.root, TAG.resource)
+                location.set(ATTRIBUTE.name, "gis_location")
+                location.set(TUID, tuid)
+                self._parent(location, parent)
+                for fieldname, fvalue in (("name", name), ("level", level)):
+                    field = SubElement(location, TAG.data)
+                    field.set(ATTRIBUTE.field, fieldname)
+                    field.text = fvalue
+                parent = (TUID, tuid)
+                parent_id = None
+
+        # Specific location
+        point = {}
+        for fieldname in ("name", "addr_street", "addr_postcode", "lat", "lon"):
+            fvalue = value(data, columns.get(fieldname))
+            if fvalue:
+                point[fieldname] = fvalue
+        if spec.get("point") == "always":
+            create = bool(point) or len(path) > 1
+        else:
+            create = "name" in point
+
+        if not create and not parent:
+            return
+        reference = SubElement(element, TAG.reference)
+        reference.set(ATTRIBUTE.field, spec["field"])
+        reference.set(ATTRIBUTE.resource, "gis_location")
+        if create:
+            location = SubElement(reference, TAG.resource)
+            location.set(ATTRIBUTE.name, "gis_location")
+            self._parent(location, parent)
+            for fieldname, fvalue in point.items():
+                field = SubElement(location, TAG.data)
+                field.set(ATTRIBUTE.field, fieldname)
+                field.text = fvalue
+        else:
+            reference.set(*parent)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _parent(location, parent):
+        """
+            Add a parent reference to a location element
+
+            @param location: the location element
+            @param parent: tuple (attribute, value) of the parent reference
+        """
+
+        if parent:
+            xml = current.xml
+            ATTRIBUTE = xml.ATTRIBUTE
+            reference = etree.SubElement(location, xml.TAG.reference)
+            reference.set(ATTRIBUTE.field, "parent")
+            reference.set(ATTRIBUTE.resource, "gis_location")
+            reference.set(*parent)
+
+# END =========================================================================
@@ -74,7 +74,8 @@ class S3Exporter(object):
              start=None,
              limit=None,
              fields=None,
-             orderby=None):
+             orderby=None,
+             seek=None):
         """
             Export a resource as JSON
 
@@ -84,6 +85,9 @@ class S3Exporter(object):
             @param fields: list of field selectors for fields to include in
                            the export (None for all fields)
             @param orderby: ORDERBY expression
+            @param seek: cursor of the last record of the previous page,
+                         see S3Resource.select (the cursor for the next
+                         page is returned in the X-Seek header)
         """
 
         if fields is None:
@@ -94,11 +98,16 @@ class S3Exporter(object):
                                start=start,
                                limit=limit,
                                orderby=orderby,
+                               seek=seek,
                                as_rows=True)
 
         response = current.response
         if response:
             response.headers["Content-Type"] = "application/json"
+            cursor = getattr(rows, "seek", None)
+            if cursor is not None:
+                from gluon.serializers import json as serialize
+                response.headers["X-Seek"] = serialize(cursor)
 
         return rows.json()
 
@@ -30,14 +30,20 @@
 """
 
 __all__ = ["GIS",
+           "S3Gazetteer",
            "S3Map",
            "S3ExportPOI",
            "S3ImportPOI",
            ]
 
+import datetime
+import hashlib
+import math
 import os
 import re
 import sys
+import time
+import unicodedata
 #import logging
 import urllib           # Needed for urlencoding
 import urllib2          # Needed for quoting & error handling on fetch
@@ -81,11 +87,10 @@ from gluon.storage import Storage
 from s3fields import s3_all_meta_field_names
 from s3rest import S3Method
 from s3track import S3Trackable
-from s3utils import s3_include_ext, s3_unicode
+from s3utils import s3_include_ext, s3_on_commit, s3_unicode
 
 DEBUG = False
 if DEBUG:
-    import datetime
     print >> sys.stderr, "S3GIS: DEBUG MODE"
     def _debug(m):
         print >> sys.stderr, m
@@ -498,6 +503,24 @@ class GIS(object):
             - used by S3LocationSelectorWidget2
                       settings.get_gis_geocode_imported_addresses
 
+            Resolved from the local gazetteer where possible, otherwise
+            from the geocoding cache or the remote geocoder
+
+            @param address: street address
+            @param postcode: postcode
+            @param Lx_ids: list of ancestor IDs
+            @param geocoder: which geocoder service to use
+        """
+
+        return S3Gazetteer().geocode(address, postcode, Lx_ids,
+                                     geocoder=geocoder)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def geocode_remote(address, postcode=None, Lx_ids=None, geocoder="google"):
+        """
+            Geocode an Address using a remote geocoder service
+
             @param address: street address
             @param postcode: postcode
             @param Lx_ids: list of ancestor IDs
@@ -719,26 +742,73 @@ class GIS(object):
                     for row in rows:
                         results[row.level] = row.id
                 else:
-                    # Oh dear, this is going to be slow :/
-                    query &= (table.lat_min < lat) & \
-                             (table.lat_max > lat) & \
-                             (table.lon_min < lon) & \
-                             (table.lon_max > lon)
-                    rows = current.db(query).select(table.id,
-                                                    table.level,
-                                                    table.wkt,
-                                                    )
-                    from shapely.geometry import point
-                    from shapely.wkt import loads as wkt_loads
-                    test = point.Point(lon, lat)
-                    results = {}
-                    for row in rows:
-                        shape = wkt_loads(row.wkt)
-                        ok = test.intersects(shape)
-                        if ok:
-                            results[row.level] = row.id
+                    # Use the in-memory index of the Lx bounds
+                    results = S3Gazetteer().geocode_r(lat, lon)
         return results
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def geocode_locations(location_ids, geocoder="google"):
+        """
+            Geocode the addresses of locations which have no coordinates
+            yet, in one batch (e.g. after imports)
+
+            @param location_ids: the location IDs
+            @param geocoder: which geocoder service to use
+
+            @return: the number of locations which have been geocoded
+        """
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        query = (table.id.belongs(location_ids)) & \
+                (table.addr_street != None) & \
+                (table.lat == None) & \
+                (table.deleted != True)
+        rows = db(query).select(table.id,
+                                table.addr_street,
+                                table.addr_postcode,
+                                table.parent,
+                                )
+        if not rows:
+            return 0
+
+        # Ancestors from the paths of the parents
+        parents = set([row.parent for row in rows if row.parent])
+        paths = {}
+        if parents:
+            query = (table.id.belongs(parents))
+            for row in db(query).select(table.id, table.path):
+                path = row.path or str(row.id)
+                paths[row.id] = [int(i) for i in path.split("/") if i]
+
+        addresses = [(row.addr_street,
+                      row.addr_postcode,
+                      paths.get(row.parent),
+                      ) for row in rows]
+        results = S3Gazetteer().geocode_batch(addresses, geocoder=geocoder)
+
+        updated = 0
+        for row, result in zip(rows, results):
+            if not isinstance(result, dict):
+                current.log.warning("Geocoding failed for location %s: %s" % \
+                                    (row.id, result))
+                continue
+            lat = result["lat"]
+            lon = result["lon"]
+            db(table.id == row.id).update(lat = lat,
+                                          lon = lon,
+                                          wkt = "POINT (%s %s)" % (lon, lat),
+                                          lat_min = lat,
+                                          lat_max = lat,
+                                          lon_min = lon,
+                                          lon_max = lon,
+                                          inherited = False,
+                                          )
+            updated += 1
+        return updated
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_bearing(lat_start, lon_start, lat_end, lon_end):
@@ -1223,6 +1293,42 @@ class GIS(object):
            _gis.config.id == config_id:
             return
 
+        ttl = current.deployment_settings.get_gis_config_cache()
+        if ttl and not force_update_cache:
+            # Use the compiled config
+            pe_id = None
+            if not config_id:
+                auth = current.auth
+                if auth.is_logged_in():
+                    # Personal and OU configs
+                    pe_id = auth.user.pe_id
+            key = GIS.config_cache_key("config", config_id, pe_id)
+            config = current.cache.ram(key,
+                                       lambda: GIS._read_config(config_id),
+                                       time_expire=ttl)
+            # Copy, so that changes in this request don't affect the cache
+            config = Storage(config)
+            if config.ids:
+                config.ids = list(config.ids)
+        else:
+            config = GIS._read_config(config_id)
+
+        # Store the values
+        _gis.config = config
+        return config
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _read_config(config_id=None):
+        """
+            Read and merge the GIS configs from the DB, helper for
+            set_config()
+
+            @param config_id: the config ID
+
+            @return: the merged config (Storage)
+        """
+
         db = current.db
         s3db = current.s3db
         ctable = s3db.gis_config
@@ -1284,7 +1390,6 @@ class GIS(object):
                                    limitby=(0, 1)).first()
             if not row:
                 # No configs found at all
-                _gis.config = cache
                 return cache
 
         # If no id supplied, extend the site config with any personal or OU configs
@@ -1370,7 +1475,6 @@ class GIS(object):
 
             if not row:
                 # No configs found at all
-                _gis.config = cache
                 return cache
 
         if not cache:
@@ -1388,10 +1492,72 @@ class GIS(object):
                 cache["marker_%s" % key] = marker[key] if key in marker \
                                                        else None
 
-        # Store the values
-        _gis.config = cache
         return cache
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def config_revision(update=False):
+        """
+            Revision of the map configuration (configs, layers, markers,
+            projections and symbologies), shared by all processes through
+            the disk cache - compiled configurations of previous revisions
+            are no longer used
+
+            @param update: start a new revision
+
+            NB the revision is read only once per request
+        """
+
+        s3 = current.response.s3
+        revision = None if update else s3.gis_config_revision
+        if revision is None:
+            revision = current.cache.disk("gis_config_revision",
+                                          lambda: "%.6f" % time.time(),
+                                          time_expire = 0 if update else None)
+            s3.gis_config_revision = revision
+        return revision
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def config_cache_key(*args):
+        """
+            Cache key for a compiled map configuration
+
+            @param args: the parameters of the compiled configuration
+        """
+
+        return "gis_config/%s/%s" % (GIS.config_revision(),
+                                     "/".join([str(arg) for arg in args]))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def invalidate_config():
+        """
+            Invalidate all compiled map configurations, to be called after
+            changes to configs, layers, markers, projections or symbologies
+
+            NB the new revision is started only after the transaction has
+               been committed, as other processes could otherwise compile
+               and cache the previous configuration under the new revision;
+               until then, the current request uses a revision of its own
+        """
+
+        if s3_on_commit(GIS.update_config_revision, after=True):
+            current.response.s3.gis_config_revision = "%.6f-%s" % \
+                                                      (time.time(), os.getpid())
+        else:
+            GIS.update_config_revision()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_config_revision():
+        """
+            Start a new revision of the map configuration
+            - called by invalidate_config() after commit
+        """
+
+        GIS.config_revision(update=True)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_config():
@@ -2769,6 +2935,375 @@ class GIS(object):
 
         return None
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def ldata_language():
+        """
+            The language to translate location names into for the
+            S3LocationSelectorWidget2 hierarchy data (ldata)
+
+            @return: the language code, or None if not translating
+        """
+
+        settings = current.deployment_settings
+        if settings.get_L10n_translate_gis_location():
+            language = current.session.s3.language
+            if language != settings.get_L10n_default_language():
+                return language
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _hierarchy_cache_path(kind, name, language=None):
+        """
+            Path of a cached hierarchy data file in /static/cache
+
+            @param kind: "ldata" or "hdata"
+            @param name: the file name (without extension)
+            @param language: the language (ldata only)
+        """
+
+        folder = os.path.join(current.request.folder, "static", "cache", kind)
+        if kind == "ldata":
+            folder = os.path.join(folder, language or "default")
+        return os.path.join(folder, "%s.js" % name)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _write_cache_file(path, contents):
+        """
+            Write a cache file (atomically, so that concurrent requests
+            never read a partially written file)
+
+            @param path: the file path
+            @param contents: the file contents
+        """
+
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Created by a concurrent request
+                pass
+
+        temp = "%s.%s.tmp" % (path, os.getpid())
+        output = open(temp, "wb")
+        try:
+            output.write(contents)
+        finally:
+            output.close()
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # Windows doesn't rename over an existing file
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            try:
+                os.rename(temp, path)
+            except OSError:
+                # Written by a concurrent request
+                os.remove(temp)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _ldata(id, language=None, country=False):
+        """
+            Extract the hierarchy data for S3LocationSelectorWidget2
+
+            @param id: the parent location ID
+            @param language: the language to translate the names into
+            @param country: extract all Lx levels underneath an L0
+                            rather than just the next level
+
+            @return: dict {id : {"n" : name,
+                                 "l" : level,
+                                 "f" : parent,
+                                 "b" : [lon_min, lat_min, lon_max, lat_max]
+                                 }},
+                     or None if id is not a valid Lx
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.gis_location
+        row = db(table.id == id).select(table.level,
+                                        limitby=(0, 1)).first()
+        try:
+            id_level = int(row.level[1:])
+        except:
+            return None
+        if country and id_level != 0:
+            return None
+
+        query = (table.deleted == False) & \
+                (table.end_date == None)
+        if country:
+            query &= (table.path.like("%s/%%" % id)) & \
+                     (table.level.belongs(("L1", "L2", "L3", "L4", "L5")))
+        else:
+            query &= (table.parent == id) & \
+                     (table.level == "L%s" % (id_level + 1))
+        fields = [table.id,
+                  table.name,
+                  table.level,
+                  table.parent,
+                  table.lon_min,
+                  table.lat_min,
+                  table.lon_max,
+                  table.lat_max,
+                  ]
+        if language:
+            ntable = s3db.gis_location_name
+            fields.append(ntable.name_l10n)
+            left = ntable.on((ntable.deleted == False) & \
+                             (ntable.language == language) & \
+                             (ntable.location_id == table.id))
+        else:
+            left = None
+        rows = db(query).select(*fields,
+                                left=left)
+
+        location_dict = {}
+        for row in rows:
+            if language:
+                l = row["gis_location"]
+                name = row["gis_location_name.name_l10n"] or l.name
+            else:
+                l = row
+                name = l.name
+            data = dict(n=name,
+                        l=int(l.level[1:]),
+                        f=int(l.parent),
+                        )
+            if l.lon_min is not None:
+                data["b"] = [l.lon_min,
+                             l.lat_min,
+                             l.lon_max,
+                             l.lat_max,
+                             ]
+            location_dict[int(l.id)] = data
+
+        return location_dict
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_ldata(id, language=None):
+        """
+            Get the hierarchy data for S3LocationSelectorWidget2 from
+            the cache in /static/cache/ldata, generating the cache file
+            if required
+
+            @param id: the parent location ID (integer)
+            @param language: the language to translate the names into
+
+            @return: the path of the cached script file, or None if id
+                     is not a valid Lx
+        """
+
+        cache_path = GIS._hierarchy_cache_path
+
+        # Pre-packaged data for the whole country?
+        path = cache_path("ldata", "%s.country" % id, language)
+        if os.path.exists(path):
+            return path
+
+        path = cache_path("ldata", id, language)
+        if not os.path.exists(path):
+            location_dict = GIS._ldata(id, language)
+            if location_dict is None:
+                return None
+            script = "n=%s\n" % json.dumps(location_dict,
+                                           separators=SEPARATORS)
+            GIS._write_cache_file(path, script)
+        return path
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_hdata(id):
+        """
+            Get the hierarchy labels for S3LocationSelectorWidget2 from
+            the cache in /static/cache/hdata, generating the cache file
+            if required
+
+            @param id: the L0 location ID (integer)
+
+            @return: the path of the cached script file, or None if there
+                     is no hierarchy configured for this location
+        """
+
+        path = GIS._hierarchy_cache_path("hdata", id)
+        if not os.path.exists(path):
+            table = current.s3db.gis_hierarchy
+            query = (table.deleted == False) & \
+                    (table.location_id == id)
+            row = current.db(query).select(table.L1,
+                                           table.L2,
+                                           table.L3,
+                                           table.L4,
+                                           table.L5,
+                                           limitby=(0, 1)
+                                           ).first()
+            if not row:
+                return None
+
+            hdict = {}
+            for l in ("L1", "L2", "L3", "L4", "L5"):
+                if row[l]:
+                    hdict[int(l[1:])] = row[l]
+
+            script = "n=%s\n" % json.dumps(hdict, separators=SEPARATORS)
+            GIS._write_cache_file(path, script)
+        return path
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def export_ldata(countries=[], location_ids=None, languages=None):
+        """
+            Pre-package the hierarchy data for S3LocationSelectorWidget2
+            for whole countries into /static/cache/ldata, so that selecting
+            the country loads all its Lx levels at once
+
+            @param countries: list of ISO2 country codes, empty list for all
+            @param location_ids: list of L0 location IDs (alternative to
+                                 countries)
+            @param languages: list of language codes to export, defaults
+                              to all languages which location names get
+                              translated into
+        """
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        table = s3db.gis_location
+        query = (table.level == "L0") & \
+                (table.end_date == None) & \
+                (table.deleted == False)
+        if location_ids:
+            query &= (table.id.belongs(location_ids))
+        elif countries:
+            ttable = s3db.gis_location_tag
+            query &= (ttable.location_id == table.id) & \
+                     (ttable.tag == "ISO2") & \
+                     (ttable.value.belongs(countries))
+        rows = db(query).select(table.id)
+
+        if languages is None:
+            languages = [None]
+            if settings.get_L10n_translate_gis_location():
+                default = settings.get_L10n_default_language()
+                languages.extend([l for l in settings.get_L10n_languages()
+                                  if l != default])
+
+        cache_path = GIS._hierarchy_cache_path
+        write = GIS._write_cache_file
+        for row in rows:
+            for language in languages:
+                location_dict = GIS._ldata(row.id, language, country=True)
+                if location_dict is None:
+                    continue
+                script = "n=%s\n" % json.dumps(location_dict,
+                                               separators=SEPARATORS)
+                write(cache_path("ldata", "%s.country" % row.id, language),
+                      script)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def invalidate_ldata(location_ids=None, hierarchy=False):
+        """
+            Invalidate the cached hierarchy data after changes to locations,
+            location names or hierarchy labels (regenerated on next request)
+
+            @param location_ids: list of the IDs of the changed locations,
+                                 None to invalidate all cached data
+            @param hierarchy: invalidate the hierarchy labels (hdata)
+                              for these locations rather than the ldata
+
+            @note: the files are removed after commit, so that concurrent
+                   requests can not regenerate them from the data before
+                   the changes
+        """
+
+        folder = os.path.join(current.request.folder, "static", "cache")
+
+        if location_ids is None:
+            paths = [os.path.join(folder, kind) for kind in ("ldata", "hdata")]
+        else:
+            location_ids = [int(i) for i in location_ids if i]
+            if not location_ids:
+                return
+
+            cache_path = GIS._hierarchy_cache_path
+            if hierarchy:
+                paths = [cache_path("hdata", id) for id in location_ids]
+            else:
+                folder = os.path.join(folder, "ldata")
+                if not os.path.isdir(folder):
+                    return
+
+                # The data for the locations' parents contain the locations,
+                # and the data for the locations themselves their levels
+                table = current.s3db.gis_location
+                rows = current.db(table.id.belongs(location_ids)).select(table.id,
+                                                                         table.parent,
+                                                                         table.path)
+                parents = set(location_ids)
+                countries = set()
+                for row in rows:
+                    if row.parent:
+                        parents.add(row.parent)
+                    if row.path:
+                        countries.add(int(row.path.split("/", 1)[0]))
+
+                paths = []
+                rebuild = set()
+                for language in os.listdir(folder):
+                    if language == "default":
+                        language = None
+                    for id in parents:
+                        paths.append(cache_path("ldata", id, language))
+                    for id in countries:
+                        path = cache_path("ldata", "%s.country" % id, language)
+                        if os.path.exists(path):
+                            paths.append(path)
+                            rebuild.add(id)
+
+                if rebuild:
+                    # Pre-packaged country data exist, so rebuild them
+                    # (the task runs after commit)
+                    current.s3task.async("gis_export_ldata",
+                                         vars=dict(location_ids=list(rebuild)))
+
+        remove = lambda: GIS._remove_cache_files(paths)
+        if not s3_on_commit(remove, after=True):
+            # No commit hook (shell script or scheduler task)
+            remove()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _remove_cache_files(paths):
+        """
+            Remove cache files or folders
+
+            @param paths: list of file or folder paths
+        """
+
+        import shutil
+
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Doesn't exist
+                    pass
+
     # -------------------------------------------------------------------------
     @staticmethod
     def export_admin_areas(countries=[],
@@ -3179,6 +3714,7 @@ class GIS(object):
                 self.import_gadm1(ogr, "L2", countries=countries)
 
             current.log.debug("All done!")
+            current.s3task.async("gis_rebuild_gazetteer")
 
         elif source == "gadmv1":
             try:
@@ -3195,6 +3731,7 @@ class GIS(object):
                 self.import_gadm2(ogr, "L2", countries=countries)
 
             current.log.debug("All done!")
+            current.s3task.async("gis_rebuild_gazetteer")
 
         else:
             current.log.warning("Only GADM is currently supported")
@@ -4088,6 +4625,7 @@ class GIS(object):
                 continue
 
         current.log.debug("All done!")
+        current.s3task.async("gis_rebuild_gazetteer")
         return
 
     # -------------------------------------------------------------------------
@@ -5963,6 +6501,540 @@ class GIS(object):
                    plugins = plugins,
                    )
 
+# =============================================================================
+class S3Gazetteer(object):
+    """
+        Local geocoder
+
+        - forward geocoding against a normalised-name index (gis_gazetteer)
+          of the locations in the database, incl. their local names and
+          imported GeoNames/GADM data, using the location hierarchy to
+          disambiguate
+        - reverse geocoding against a grid index of the Lx bounding boxes
+        - results of remote geocoders are kept in a persistent cache
+          (gis_geocode_cache), so that each address only gets looked up
+          once, and is still available when offline
+    """
+
+    # Grid cell size for the reverse geocoding index (degrees)
+    GRID = 1.0
+
+    # Regex to remove punctuation from names
+    PUNCTUATION = re.compile(r"[^\w]+", re.UNICODE)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def normalise(cls, name):
+        """
+            Normalise a name for the index: lower case, without accents,
+            punctuation and redundant whitespace
+
+            @param name: the name
+
+            @return: the normalised name (utf-8 str)
+        """
+
+        if not name:
+            return ""
+        name = unicodedata.normalize("NFKD", s3_unicode(name).lower())
+        name = u"".join([c for c in name if not unicodedata.combining(c)])
+        name = u" ".join(cls.PUNCTUATION.sub(u" ", name).split())
+        return name[:128].encode("utf-8")
+
+    # -------------------------------------------------------------------------
+    # Index maintenance
+    # -------------------------------------------------------------------------
+    def rebuild(self, chunk_size=5000):
+        """
+            Rebuild the gazetteer index for all locations, and remove
+            expired entries from the geocoding cache
+
+            @param chunk_size: number of locations to index at a time
+
+            @return: the number of index entries
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.gis_gazetteer
+        db(table.id > 0).delete()
+
+        gtable = s3db.gis_location
+        last = 0
+        total = 0
+        while True:
+            query = (gtable.id > last) & \
+                    (gtable.deleted != True)
+            rows = db(query).select(gtable.id,
+                                    orderby=gtable.id,
+                                    limitby=(0, chunk_size))
+            if not rows:
+                break
+            location_ids = [row.id for row in rows]
+            last = location_ids[-1]
+            total += self._index(location_ids)
+
+        days = current.deployment_settings.get_gis_geocode_cache()
+        if days:
+            ctable = s3db.gis_geocode_cache
+            cutoff = current.request.utcnow - datetime.timedelta(days=days)
+            db(ctable.created_on < cutoff).delete()
+
+        self.invalidate()
+        return total
+
+    # -------------------------------------------------------------------------
+    def update(self, location_ids, descendants=False):
+        """
+            Update the gazetteer index for locations
+
+            @param location_ids: the location IDs
+            @param descendants: also update the descendants of the
+                                locations (e.g. after a change of parent)
+        """
+
+        location_ids = set([int(i) for i in location_ids if i])
+        if not location_ids:
+            return
+
+        db = current.db
+        s3db = current.s3db
+
+        if descendants:
+            gtable = s3db.gis_location
+            query = None
+            for location_id in location_ids:
+                q = (gtable.path.like("%%/%s/%%" % location_id)) | \
+                    (gtable.path.like("%s/%%" % location_id))
+                query = q if query is None else query | q
+            query &= (gtable.deleted != True)
+            rows = db(query).select(gtable.id)
+            location_ids |= set([row.id for row in rows])
+
+        location_ids = list(location_ids)
+        table = s3db.gis_gazetteer
+        db(table.location_id.belongs(location_ids)).delete()
+        self._index(location_ids)
+
+    # -------------------------------------------------------------------------
+    def _index(self, location_ids):
+        """
+            Add index entries for locations
+
+            @param location_ids: the location IDs
+
+            @return: the number of index entries
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        gtable = s3db.gis_location
+        query = (gtable.id.belongs(location_ids)) & \
+                (gtable.deleted != True)
+        rows = db(query).select(gtable.id,
+                                gtable.name,
+                                gtable.level,
+                                gtable.path,
+                                gtable.lat,
+                                gtable.lon,
+                                )
+
+        # Local names
+        ntable = s3db.gis_location_name
+        query = (ntable.location_id.belongs(location_ids)) & \
+                (ntable.deleted != True)
+        names = {}
+        for row in db(query).select(ntable.location_id, ntable.name_l10n):
+            names.setdefault(row.location_id, []).append(row.name_l10n)
+
+        normalise = self.normalise
+        entries = []
+        append = entries.append
+        for row in rows:
+            location_id = row.id
+            keys = set([normalise(row.name)])
+            for name in names.get(location_id, ()):
+                keys.add(normalise(name))
+            keys.discard("")
+            for key in keys:
+                append({"location_id": location_id,
+                        "name": key,
+                        "level": row.level,
+                        "path": row.path,
+                        "lat": row.lat,
+                        "lon": row.lon,
+                        })
+        if entries:
+            s3db.gis_gazetteer.bulk_insert(entries)
+        return len(entries)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def revision(update=False):
+        """
+            Revision of the gazetteer, shared by all processes through the
+            disk cache - in-memory indexes of previous revisions are no
+            longer used
+
+            @param update: start a new revision
+        """
+
+        return current.cache.disk("gis_gazetteer_revision",
+                                  lambda: "%.6f" % time.time(),
+                                  time_expire = 0 if update else None)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls):
+        """
+            Invalidate the in-memory indexes, to be called after changes
+            to the locations hierarchy or bounds
+        """
+
+        cls.revision(update=True)
+
+    # -------------------------------------------------------------------------
+    # Forward geocoding
+    # -------------------------------------------------------------------------
+    def geocode(self, address, postcode=None, Lx_ids=None,
+                geocoder="google", remote=True):
+        """
+            Geocode an address
+
+            @param address: the address
+            @param postcode: the postcode
+            @param Lx_ids: list of ancestor IDs
+            @param geocoder: the remote geocoder to use if the address can
+                             not be resolved locally, None to not use any
+            @param remote: False to only use the results of the geocoder
+                           which are already in the cache
+
+            @return: dict(lat=lat, lon=lon), or an error message
+        """
+
+        return self.geocode_batch([(address, postcode, Lx_ids)],
+                                  geocoder=geocoder,
+                                  remote=remote)[0]
+
+    # -------------------------------------------------------------------------
+    def geocode_batch(self, addresses, geocoder="google", remote=True):
+        """
+            Geocode a batch of addresses (e.g. during imports)
+
+            Addresses naming a place in the gazetteer are resolved locally,
+            all others from the cache or the remote geocoder, falling back
+            to the nearest place in the gazetteer (e.g. the village of a
+            street address) only if the remote geocoder has been tried and
+            failed.
+
+            @param addresses: list of tuples (address, postcode, Lx_ids)
+            @param geocoder: the remote geocoder to use if an address can
+                             not be resolved locally, None to not use any
+            @param remote: False to only use the results of the geocoder
+                           which are already in the cache (and never the
+                           nearest place in the gazetteer)
+
+            @return: list of results (dict(lat=lat, lon=lon), or an error
+                     message) in the same order as the addresses
+        """
+
+        settings = current.deployment_settings
+
+        if settings.get_gis_gazetteer():
+            local = self._geocode_local(addresses)
+        else:
+            local = [(None, False)] * len(addresses)
+
+        results = [None] * len(addresses)
+        pending = []
+        for index, (result, exact) in enumerate(local):
+            if exact:
+                results[index] = result
+            else:
+                pending.append(index)
+
+        # Addresses the remote geocoder has been tried for
+        tried = set()
+
+        if pending and geocoder:
+            use_cache = settings.get_gis_geocode_cache()
+            keys = dict((index, self.cache_key(geocoder, *addresses[index]))
+                        for index in pending)
+            if use_cache:
+                cached = self._cache_lookup(keys.values())
+            else:
+                cached = {}
+            store = []
+            for index in pending:
+                key = keys[index]
+                result = cached.get(key)
+                if result is None and remote:
+                    address, postcode, Lx_ids = addresses[index]
+                    result = GIS.geocode_remote(address, postcode, Lx_ids,
+                                                geocoder=geocoder)
+                    tried.add(index)
+                    if isinstance(result, dict):
+                        cached[key] = result
+                        store.append({"query_key": key,
+                                      "provider": geocoder,
+                                      "result": json.dumps(result),
+                                      })
+                results[index] = result
+            if store and use_cache:
+                current.s3db.gis_geocode_cache.bulk_insert(store)
+
+        for index in pending:
+            result = results[index]
+            if isinstance(result, dict):
+                continue
+            if index in tried:
+                # Fall back to the nearest place in the gazetteer
+                approximate = local[index][0]
+                if isinstance(approximate, dict):
+                    result = approximate
+            results[index] = result or "No results found"
+        return results
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cache_key(geocoder, address, postcode=None, Lx_ids=None):
+        """
+            Key for the geocoding cache
+
+            @param geocoder: the remote geocoder
+            @param address: the address
+            @param postcode: the postcode
+            @param Lx_ids: list of ancestor IDs
+        """
+
+        normalise = S3Gazetteer.normalise
+        Lx_ids = ",".join([str(i) for i in sorted(Lx_ids or [])])
+        key = "%s|%s|%s|%s" % (geocoder,
+                               normalise(address),
+                               normalise(postcode),
+                               Lx_ids)
+        return hashlib.sha1(key).hexdigest()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _cache_lookup(keys):
+        """
+            Look up results in the geocoding cache
+
+            @param keys: the cache keys
+
+            @return: dict {key: result}
+        """
+
+        if not keys:
+            return {}
+
+        table = current.s3db.gis_geocode_cache
+        query = (table.query_key.belongs(set(keys)))
+        days = current.deployment_settings.get_gis_geocode_cache()
+        if days:
+            cutoff = current.request.utcnow - datetime.timedelta(days=days)
+            query &= (table.created_on >= cutoff)
+        rows = current.db(query).select(table.query_key,
+                                        table.result,
+                                        )
+        cached = {}
+        for row in rows:
+            try:
+                cached[row.query_key] = json.loads(row.result)
+            except (TypeError, ValueError):
+                continue
+        return cached
+
+    # -------------------------------------------------------------------------
+    def _geocode_local(self, addresses):
+        """
+            Geocode addresses from the gazetteer
+
+            Each comma-separated part of the address is looked up in the
+            index, starting from the most specific (first) part. Candidates
+            must be located within the Lx_ids, and further parts of the
+            address naming their ancestors are used to disambiguate.
+
+            @param addresses: list of tuples (address, postcode, Lx_ids)
+
+            @return: list of tuples (result, exact), where exact means
+                     that the first part of the address has been resolved
+        """
+
+        db = current.db
+        table = current.s3db.gis_gazetteer
+        normalise = self.normalise
+
+        # Normalise the address parts
+        parts = []
+        names = set()
+        for address, postcode, Lx_ids in addresses:
+            address_parts = [normalise(p) for p in (address or "").split(",")]
+            address_parts = [p for p in address_parts if p]
+            parts.append(address_parts)
+            names.update(address_parts)
+        if not names:
+            return [(None, False)] * len(addresses)
+
+        # Look up all names at once
+        candidates = {}
+        query = (table.name.belongs(names)) & \
+                (table.lat != None) & \
+                (table.lon != None)
+        rows = db(query).select(table.location_id,
+                                table.name,
+                                table.level,
+                                table.path,
+                                table.lat,
+                                table.lon,
+                                )
+        ancestors = set()
+        for row in rows:
+            candidates.setdefault(row.name, []).append(row)
+            if row.path:
+                ancestors.update(row.path.split("/")[:-1])
+
+        # Names of the ancestors (for disambiguation)
+        ancestor_names = {}
+        ancestors = [int(i) for i in ancestors if i.isdigit()]
+        if ancestors:
+            query = (table.location_id.belongs(ancestors))
+            for row in db(query).select(table.location_id, table.name):
+                ancestor_names.setdefault(str(row.location_id), set()).add(row.name)
+
+        results = []
+        for index, (address, postcode, Lx_ids) in enumerate(addresses):
+            Lx_ids = [str(i) for i in Lx_ids or [] if i]
+            address_parts = parts[index]
+            result = (None, False)
+            for position, name in enumerate(address_parts):
+                # Candidates within the Lx, but not the Lx themselves
+                matches = {}
+                for row in candidates.get(name, ()):
+                    location_id = str(row.location_id)
+                    if location_id in Lx_ids or location_id in matches:
+                        continue
+                    path = (row.path or location_id).split("/")
+                    if Lx_ids and not all([i in path for i in Lx_ids]):
+                        continue
+                    matches[location_id] = (row, path[:-1])
+                if not matches:
+                    continue
+
+                # Disambiguate by the other address parts
+                others = set(address_parts[position + 1:])
+                best = []
+                best_score = -1
+                for location_id, (row, path) in matches.items():
+                    score = 0
+                    for ancestor in path:
+                        if ancestor_names.get(ancestor, set()) & others:
+                            score += 1
+                    if score > best_score:
+                        best = [row]
+                        best_score = score
+                    elif score == best_score:
+                        best.append(row)
+
+                if len(best) == 1:
+                    row = best[0]
+                    result = (dict(lat=row.lat, lon=row.lon), position == 0)
+                    break
+                elif position == 0:
+                    result = ("Multiple results found", False)
+            results.append(result)
+
+        return results
+
+    # -------------------------------------------------------------------------
+    # Reverse geocoding
+    # -------------------------------------------------------------------------
+    def geocode_r(self, lat, lon):
+        """
+            Reverse geocode a point from the Lx bounds index
+
+            @param lat: the latitude
+            @param lon: the longitude
+
+            @return: dict {level: location_id}
+        """
+
+        grid = self.GRID
+        cell = (int(math.floor(lat / grid)), int(math.floor(lon / grid)))
+        candidates = []
+        for location_id, level, bounds in self._grid().get(cell, ()):
+            lat_min, lat_max, lon_min, lon_max = bounds
+            if lat_min < lat < lat_max and lon_min < lon < lon_max:
+                candidates.append(location_id)
+
+        results = {}
+        if not candidates:
+            return results
+
+        from shapely.geometry import point
+        from shapely.wkt import loads as wkt_loads
+        test = point.Point(lon, lat)
+
+        table = current.s3db.gis_location
+        query = (table.id.belongs(candidates)) & \
+                (table.deleted != True)
+        rows = current.db(query).select(table.id,
+                                        table.level,
+                                        table.wkt,
+                                        )
+        for row in rows:
+            if row.wkt and test.intersects(wkt_loads(row.wkt)):
+                results[row.level] = row.id
+        return results
+
+    # -------------------------------------------------------------------------
+    def _grid(self):
+        """
+            The in-memory grid index of the Lx bounding boxes (per process)
+
+            @return: dict {(lat, lon): [(location_id, level, bounds)]}
+        """
+
+        key = "gis_gazetteer_grid/%s" % self.revision()
+        return current.cache.ram(key, self._build_grid, time_expire=86400)
+
+    # -------------------------------------------------------------------------
+    def _build_grid(self):
+        """
+            Build the grid index of the Lx bounding boxes
+        """
+
+        table = current.s3db.gis_location
+        query = (table.level != None) & \
+                (table.deleted != True) & \
+                (table.gis_feature_type != 1) & \
+                (table.lat_min != None) & \
+                (table.lat_max != None) & \
+                (table.lon_min != None) & \
+                (table.lon_max != None)
+        rows = current.db(query).select(table.id,
+                                        table.level,
+                                        table.lat_min,
+                                        table.lat_max,
+                                        table.lon_min,
+                                        table.lon_max,
+                                        )
+        grid = {}
+        size = self.GRID
+        floor = math.floor
+        for row in rows:
+            bounds = (row.lat_min, row.lat_max, row.lon_min, row.lon_max)
+            entry = (row.id, row.level, bounds)
+            for y in xrange(int(floor(row.lat_min / size)),
+                            int(floor(row.lat_max / size)) + 1):
+                for x in xrange(int(floor(row.lon_min / size)),
+                                int(floor(row.lon_max / size)) + 1):
+                    grid.setdefault((y, x), []).append(entry)
+        return grid
+
 # =============================================================================
 class MAP(DIV):
     """
@@ -5971,6 +7043,10 @@ class MAP(DIV):
         - used by gis.show_map()
     """
 
+    # Layer types which can not be compiled as they depend on the request
+    # (download feeds to the gis_cache or add scripts to the page)
+    UNCACHED_LAYERS = ("LayerGeoRSS", "LayerGoogle", "LayerKML")
+
     def __init__(self, **opts):
         """
             :param **opts: options to pass to the Map for server-side processing
@@ -5986,6 +7062,8 @@ class MAP(DIV):
 
         # Options for client-side processing
         self.options = {}
+        # Compiled layers (serialized)
+        self.layers = None
 
         # Components
         components = []
@@ -6456,7 +7534,8 @@ class MAP(DIV):
         if feature_resources:
             options["feature_resources"] = addFeatureResources(feature_resources)
 
-        if opts.get("catalogue_layers", False):
+        catalogue_layers = opts.get("catalogue_layers", False)
+        if catalogue_layers:
             # Add all Layers from the Catalogue
             layer_types = [LayerArcREST,
                            LayerBing,
@@ -6481,64 +7560,54 @@ class MAP(DIV):
         else:
             # Add just the default Base Layer
             s3.gis.base = True
-            layer_types = []
-            db = current.db
-            ltable = s3db.gis_layer_config
-            etable = db.gis_layer_entity
-            query = (etable.id == ltable.layer_id) & \
-                    (ltable.config_id == config["id"]) & \
-                    (ltable.base == True) & \
-                    (ltable.enabled == True)
-            layer = db(query).select(etable.instance_type,
-                                     limitby=(0, 1)).first()
-            if not layer:
-                # Use Site Default
-                ctable = db.gis_config
-                query = (etable.id == ltable.layer_id) & \
-                        (ltable.config_id == ctable.id) & \
-                        (ctable.uuid == "SITE_DEFAULT") & \
-                        (ltable.base == True) & \
-                        (ltable.enabled == True)
-                layer = db(query).select(etable.instance_type,
-                                         limitby=(0, 1)).first()
-            if layer:
-                layer_type = layer.instance_type
-                if layer_type == "gis_layer_openstreetmap":
-                    layer_types = [LayerOSM]
-                elif layer_type == "gis_layer_google":
-                    # NB v3 doesn't work when initially hidden
-                    layer_types = [LayerGoogle]
-                elif layer_type == "gis_layer_arcrest":
-                    layer_types = [LayerArcREST]
-                elif layer_type == "gis_layer_bing":
-                    layer_types = [LayerBing]
-                elif layer_type == "gis_layer_tms":
-                    layer_types = [LayerTMS]
-                elif layer_type == "gis_layer_wms":
-                    layer_types = [LayerWMS]
-                elif layer_type == "gis_layer_xyz":
-                    layer_types = [LayerXYZ]
-                elif layer_type == "gis_layer_empty":
-                    layer_types = [LayerEmpty]
-
-            if not layer_types:
-                layer_types = [LayerEmpty]
+            layer_types = None
 
         scripts = []
-        scripts_append = scripts.append
-        for LayerType in layer_types:
-            try:
-                # Instantiate the Class
-                layer = LayerType()
-                layer.as_dict(options)
-                for script in layer.scripts:
-                    scripts_append(script)
-            except Exception, exception:
-                error = "%s not shown: %s" % (LayerType.__name__, exception)
-                if s3.debug:
-                    raise HTTP(500, error)
-                else:
-                    response.warning += error
+        self.layers = None
+        ttl = settings.get_gis_config_cache()
+        if ttl:
+            # Use the compiled layers for this configuration, user roles
+            # and language - except for layer types which depend on the
+            # request (feed downloads, page scripts)
+            if layer_types is None:
+                key = GIS.config_cache_key("base_layer", *config.ids)
+                layer_types = current.cache.ram(key,
+                                                lambda: self._base_layer_types(config),
+                                                time_expire=ttl)
+            uncached = self.UNCACHED_LAYERS
+            cached = [l for l in layer_types if l.__name__ not in uncached]
+            if cached:
+                roles = current.session.s3.roles or []
+                key = GIS.config_cache_key("layers",
+                                           ",".join([str(i) for i in config.ids]),
+                                           bool(catalogue_layers),
+                                           ",".join([l.__name__ for l in cached]),
+                                           ",".join([str(r) for r in sorted(roles)]),
+                                           current.session.s3.language,
+                                           get_vars.get("layers"),
+                                           s3.debug,
+                                           )
+                cache = current.cache.ram
+                compiled = cache(key,
+                                 lambda: self._compile_layers(cached),
+                                 time_expire=ttl)
+                if compiled.error:
+                    # Try again next time
+                    cache(key, None)
+                    response.warning += compiled.error
+                if compiled.get_feature_info:
+                    s3.gis.get_feature_info = True
+                scripts.extend(compiled.scripts)
+                self.layers = compiled.layers
+            layer_types = [l for l in layer_types if l.__name__ in uncached]
+        elif layer_types is None:
+            layer_types = self._base_layer_types(config)
+
+        if layer_types:
+            added, error = self._add_layers(layer_types, options)
+            scripts.extend(added)
+            if error:
+                response.warning += error
 
         # WMS getFeatureInfo
         # (loads conditionally based on whether queryable WMS Layers have been added)
@@ -6574,6 +7643,126 @@ class MAP(DIV):
 
         return options
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _base_layer_types(config):
+        """
+            Get the layer type of the default base layer
+
+            @param config: the GIS config
+
+            @return: list of Layer classes
+        """
+
+        layer_types = []
+        db = current.db
+        s3db = current.s3db
+        ltable = s3db.gis_layer_config
+        etable = db.gis_layer_entity
+        query = (etable.id == ltable.layer_id) & \
+                (ltable.config_id == config["id"]) & \
+                (ltable.base == True) & \
+                (ltable.enabled == True)
+        layer = db(query).select(etable.instance_type,
+                                 limitby=(0, 1)).first()
+        if not layer:
+            # Use Site Default
+            ctable = db.gis_config
+            query = (etable.id == ltable.layer_id) & \
+                    (ltable.config_id == ctable.id) & \
+                    (ctable.uuid == "SITE_DEFAULT") & \
+                    (ltable.base == True) & \
+                    (ltable.enabled == True)
+            layer = db(query).select(etable.instance_type,
+                                     limitby=(0, 1)).first()
+        if layer:
+            layer_type = layer.instance_type
+            if layer_type == "gis_layer_openstreetmap":
+                layer_types = [LayerOSM]
+            elif layer_type == "gis_layer_google":
+                # NB v3 doesn't work when initially hidden
+                layer_types = [LayerGoogle]
+            elif layer_type == "gis_layer_arcrest":
+                layer_types = [LayerArcREST]
+            elif layer_type == "gis_layer_bing":
+                layer_types = [LayerBing]
+            elif layer_type == "gis_layer_tms":
+                layer_types = [LayerTMS]
+            elif layer_type == "gis_layer_wms":
+                layer_types = [LayerWMS]
+            elif layer_type == "gis_layer_xyz":
+                layer_types = [LayerXYZ]
+            elif layer_type == "gis_layer_empty":
+                layer_types = [LayerEmpty]
+
+        if not layer_types:
+            layer_types = [LayerEmpty]
+
+        return layer_types
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _add_layers(layer_types, options):
+        """
+            Add the layers of the active configs to the map options
+
+            @param layer_types: the Layer classes
+            @param options: the map options
+
+            @return: tuple (scripts, error)
+        """
+
+        s3 = current.response.s3
+        scripts = []
+        scripts_append = scripts.append
+        errors = []
+        for LayerType in layer_types:
+            try:
+                # Instantiate the Class
+                layer = LayerType()
+                layer.as_dict(options)
+                for script in layer.scripts:
+                    scripts_append(script)
+            except Exception, exception:
+                error = "%s not shown: %s" % (LayerType.__name__, exception)
+                if s3.debug:
+                    raise HTTP(500, error)
+                else:
+                    errors.append(error)
+        return scripts, "".join(errors)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _compile_layers(layer_types):
+        """
+            Compile the layers of the active configs for the cache
+
+            @param layer_types: the Layer classes
+
+            @return: Storage(layers = the serialized layer options, as
+                                      JSON object members,
+                             scripts = the scripts to load,
+                             get_feature_info = whether there are
+                                                queryable WMS layers,
+                             error = error message)
+        """
+
+        gis = current.response.s3.gis
+        get_feature_info = gis.get_feature_info
+        gis.get_feature_info = None
+
+        options = {}
+        scripts, error = MAP._add_layers(layer_types, options)
+        layers = json.dumps(options, separators=SEPARATORS)[1:-1]
+        compiled = Storage(layers = layers,
+                           scripts = scripts,
+                           get_feature_info = gis.get_feature_info,
+                           error = error,
+                           )
+
+        gis.get_feature_info = get_feature_info
+        return compiled
+
     # -------------------------------------------------------------------------
     def xml(self):
         """
@@ -6623,6 +7812,13 @@ class MAP(DIV):
         options = self.options
         projection = options["projection"]
         options = dumps(options, separators=SEPARATORS)
+        layers = self.layers
+        if layers:
+            # Add the compiled layers
+            if options == "{}":
+                options = "{%s}" % layers
+            else:
+                options = "%s,%s}" % (options[:-1], layers)
         plugin_callbacks = '''\n'''.join(self.plugin_callbacks)
         if callback:
             if callback == "DEFAULT":
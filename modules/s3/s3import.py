@@ -3783,10 +3783,12 @@ class S3BulkImporter(object):
             auth.rollback = True
             try:
                 # @todo: add extra_data and file attachments
+                batch_size = current.deployment_settings.get_base_import_batch_size()
                 result = resource.import_xml(csv,
                                              format="csv",
                                              stylesheet=task[4],
-                                             extra_data=extra_data)
+                                             extra_data=extra_data,
+                                             batch_size=batch_size)
             except SyntaxError, e:
                 self.errorList.append("WARNING: import error - %s (file: %s, stylesheet: %s)" %
                                      (e, filename, task[4]))
@@ -29,18 +29,22 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3Merge"]
+__all__ = ["S3Merge",
+           "S3DuplicateFinder",
+           ]
 
 import sys
+import unicodedata
 
 from gluon import *
 from gluon.html import BUTTON
 from gluon.storage import Storage
+from s3fields import S3Represent
 from s3rest import S3Method
 from s3resource import S3FieldSelector
 from s3widgets import *
 from s3validators import *
-from s3utils import s3_unicode, s3_represent_value
+from s3utils import s3_unicode, s3_represent_value, s3_jaro_winkler, soundex
 from s3data import S3DataTable
 
 # =============================================================================
@@ -239,9 +243,16 @@ class S3Merge(S3Method):
         resource = self.resource
         tablename = self.tablename
 
+        get_vars = r.get_vars
+        if "candidate" in get_vars:
+            return self.resolve(r, **attr)
+
         if r.http == "POST":
             return self.merge(r, **attr)
 
+        if "candidates" in get_vars:
+            return self.candidates(r, **attr)
+
         # Bookmarks
         record_ids = []
         DEDUPLICATE = self.DEDUPLICATE
@@ -359,6 +370,11 @@ class S3Merge(S3Method):
                 output["add_btn"] = DIV(
                     SPAN(T("Select 2 records from this list, then click 'Merge'.")),
                 )
+            if current.s3db.get_config(tablename, "merge_candidates"):
+                output["add_btn"].append(
+                    A(T("Possible Duplicates"),
+                      _href=r.url(id=0, vars={"candidates": "1"}),
+                      _class="action-lnk"))
 
             s3.dataTableID = [datatable_id]
             response.view = self._view(r, "list.html")
@@ -369,16 +385,165 @@ class S3Merge(S3Method):
         return output
 
     # -------------------------------------------------------------------------
-    def merge(self, r, **attr):
+    def candidates(self, r, **attr):
+        """
+            Renders a list of the duplicate candidates found by the
+            S3DuplicateFinder for this table, with options to merge
+            or ignore each pair
+
+            @param r: the S3Request
+            @param attr: the controller attributes for the request
+        """
+
+        s3 = current.response.s3
+        s3db = current.s3db
+
+        tablename = self.tablename
+
+        ctable = s3db.s3_merge_candidate
+        query = (S3FieldSelector("tablename") == tablename) & \
+                (S3FieldSelector("status") == "OPEN")
+        resource = s3db.resource("s3_merge_candidate", filter=query)
+
+        # Representation of the records in each pair
+        represent = S3DuplicateFinder.represent(tablename)
+        ctable.record_id.represent = represent
+        ctable.duplicate_id.represent = represent
+
+        T = current.T
+        list_fields = [(T("Original"), "record_id"),
+                       (T("Duplicate"), "duplicate_id"),
+                       (T("Score"), "score"),
+                       ]
+        ctable.score.represent = lambda v: "%.2f" % v \
+                                           if v is not None else ""
+
+        # Start/Limit
+        representation = r.representation
+        vars = r.get_vars
+        if representation == "aadata":
+            start = vars.get("iDisplayStart", None)
+            limit = vars.get("iDisplayLength", None)
+            sEcho = int(vars.sEcho or 0)
+        else: # catch all
+            start = 0
+            limit = s3.ROWSPERPAGE
+        if limit is not None:
+            try:
+                start = int(start)
+                limit = int(limit)
+            except ValueError:
+                start = None
+                limit = None # use default
+        else:
+            start = None # use default
+        if s3.dataTable_iDisplayLength:
+            display_length = s3.dataTable_iDisplayLength
+        else:
+            display_length = 25
+        if limit is None:
+            limit = 2 * display_length
+
+        # Best matches first
+        orderby = ~ctable.score
+
+        # Get the records
+        data = resource.select(list_fields,
+                               start=start,
+                               limit=limit,
+                               orderby=orderby,
+                               count=True,
+                               represent=True)
+
+        totalrows = displayrows = data["numrows"]
+
+        dt = S3DataTable(data["rfields"], data["rows"])
+        datatable_id = "s3merge_2"
+
+        if representation == "aadata":
+            output = dt.json(totalrows,
+                             displayrows,
+                             datatable_id,
+                             sEcho)
+
+        elif representation == "html":
+            output = {"title": T("Possible Duplicates")}
+
+            url = r.url(representation="aadata")
+            output["items"] = dt.html(totalrows,
+                                      displayrows,
+                                      datatable_id,
+                                      dt_ajax_url=url,
+                                      dt_displayLength=display_length)
+
+            s3.actions = [{"label": str(T("Merge")),
+                           "url": r.url(vars={"candidate": "[id]"}),
+                           "_class": "action-btn",
+                           },
+                          {"label": str(T("Ignore")),
+                           "url": r.url(vars={"candidate": "[id]",
+                                              "ignore": "1"}),
+                           "_class": "action-btn",
+                           },
+                          ]
+            output["add_btn"] = ""
+
+            s3.dataTableID = [datatable_id]
+            current.response.view = self._view(r, "list.html")
+
+        else:
+            r.error(501, current.ERROR.BAD_FORMAT)
+
+        return output
+
+    # -------------------------------------------------------------------------
+    def resolve(self, r, **attr):
+        """
+            Merge or ignore a duplicate candidate pair
+
+            @param r: the S3Request
+            @param attr: the controller attributes for the request
+        """
+
+        db = current.db
+
+        table = current.s3db.s3_merge_candidate
+        try:
+            candidate_id = long(r.get_vars["candidate"])
+        except ValueError:
+            r.error(404, current.ERROR.BAD_RECORD)
+        query = (table.id == candidate_id) & \
+                (table.tablename == self.tablename) & \
+                (table.status == "OPEN")
+        candidate = db(query).select(table.id,
+                                     table.record_id,
+                                     table.duplicate_id,
+                                     limitby=(0, 1)).first()
+        if not candidate:
+            r.error(404, current.ERROR.BAD_RECORD,
+                    next = r.url(id=0, vars={"candidates": "1"}))
+
+        if r.get_vars.get("ignore") in ("1", "true"):
+            candidate.update_record(status="IGNORED")
+            current.response.confirmation = current.T("Pair marked as not duplicate.")
+            redirect(r.url(id=0, vars={"candidates": "1"}))
+
+        return self.merge(r, candidate=candidate, **attr)
+
+    # -------------------------------------------------------------------------
+    def merge(self, r, candidate=None, **attr):
         """
             Merge form for two records
 
             @param r: the S3Request
+            @param candidate: the s3_merge_candidate Row if merging a
+                              duplicate candidate pair
             @param **attr: the controller attributes for the request
 
-            @note: this method can always only be POSTed, and requires
-                   both "selected" and "mode" in post_vars, as well as
-                   the duplicate bookmarks list in session.s3
+            @note: unless merging a candidate pair, this method can always
+                   only be POSTed, and requires both "selected" and "mode"
+                   in post_vars, as well as the duplicate bookmarks list
+                   in session.s3
         """
 
         T = current.T
@@ -391,6 +556,8 @@ class S3Merge(S3Method):
         # Get the duplicate bookmarks
         s3 = session.s3
         DEDUPLICATE = self.DEDUPLICATE
+        bookmarks = None
+        record_ids = []
         if DEDUPLICATE in s3:
             bookmarks = s3[DEDUPLICATE]
             if tablename in bookmarks:
@@ -398,6 +565,11 @@ class S3Merge(S3Method):
 
         # Process the post variables
         post_vars = r.post_vars
+        mode = None
+        if candidate is not None:
+            mode = post_vars["mode"] = "Inclusive"
+            post_vars["selected"] = "%s,%s" % (candidate.record_id,
+                                               candidate.duplicate_id)
         if "mode" in post_vars:
             mode = post_vars["mode"]
         if "selected" in post_vars:
@@ -405,6 +577,7 @@ class S3Merge(S3Method):
         else:
             selected = ""
         selected = selected.split(",")
+        ids = []
         if mode == "Inclusive":
             ids = selected
         elif mode == "Exclusive":
@@ -592,8 +765,16 @@ class S3Merge(S3Method):
                             sys.exc_info()[1],
                         next=r.url())
             else:
+                # Update the duplicate candidates
+                S3DuplicateFinder.resolve(tablename,
+                                          original[table._id],
+                                          duplicate[table._id])
+
                 # Cleanup bookmark list
-                if mode == "Inclusive":
+                if candidate is not None or \
+                   bookmarks is None or tablename not in bookmarks:
+                    pass
+                elif mode == "Inclusive":
                     bookmarks[tablename] = [i for i in record_ids if i not in ids]
                     if not bookmarks[tablename]:
                         del bookmarks[tablename]
@@ -611,8 +792,10 @@ class S3Merge(S3Method):
                                     #vars={}))
                 response.confirmation = T("Records merged successfully.")
 
-            # Go back to bookmark list
-            if search:
+            # Go back to bookmark list (or candidate list)
+            if candidate is not None:
+                self.next = r.url(id=0, vars={"candidates": "1"})
+            elif search:
                 self.next = r.url(method="", id=0, vars={})
             else:
                 self.next = r.url(id=0, vars={})
@@ -748,4 +931,296 @@ class S3Merge(S3Method):
 
         return inp
 
+# =============================================================================
+class S3DuplicateFinder(object):
+    """
+        Background duplicate detection: generates candidate pairs from
+        blocking keys and scores them with a similarity function, results
+        are stored in s3_merge_candidate to be reviewed in S3Merge
+
+        To be configured per table like:
+
+            s3db.configure(tablename,
+                           merge_candidates = {
+                                # Fields to extract (selectors)
+                                "fields": ["first_name", "last_name", ...],
+                                # Function to produce the blocking keys
+                                # for a record, returns a list of strings
+                                "keys": keys,
+                                # Function to compute the similarity of
+                                # two records (0.0 to 1.0)
+                                "similarity": similarity,
+                                # Minimum similarity for candidates
+                                "threshold": 0.8,
+                                # Representation of record IDs
+                                "represent": represent,
+                           })
+    """
+
+    # Blocks larger than this are skipped (non-selective keys)
+    MAX_BLOCK = 200
+
+    def __init__(self, tablename, threshold=None, max_block=None):
+        """
+            Constructor
+
+            @param tablename: the table to search for duplicates
+            @param threshold: override the configured minimum similarity
+            @param max_block: override the maximum block size
+        """
+
+        self.tablename = tablename
+
+        s3db = current.s3db
+        s3db.table(tablename)
+        config = s3db.get_config(tablename, "merge_candidates")
+        if not config:
+            raise KeyError("No duplicate detection configured for %s" %
+                           tablename)
+
+        self.fields = config.get("fields", [])
+        self.keys = config["keys"]
+        self.similarity = config["similarity"]
+
+        if threshold is None:
+            threshold = config.get("threshold", 0.8)
+        self.threshold = threshold
+
+        self.max_block = max_block if max_block else self.MAX_BLOCK
+
+    # -------------------------------------------------------------------------
+    def __call__(self):
+        """
+            Run the duplicate detection, and update the candidates
+
+            @return: the number of open candidate pairs
+        """
+
+        records = self.extract()
+        pairs = self.pairs(records)
+
+        similarity = self.similarity
+        threshold = self.threshold
+
+        candidates = {}
+        for pair in pairs:
+            record_id, duplicate_id = pair
+            score = similarity(records[record_id], records[duplicate_id])
+            if score >= threshold:
+                candidates[pair] = score
+
+        return self.store(candidates)
+
+    # -------------------------------------------------------------------------
+    def extract(self):
+        """
+            Extract the records
+
+            @return: a dict {record_id: record}
+        """
+
+        resource = current.s3db.resource(self.tablename)
+
+        fields = ["id"] + [f for f in self.fields if f != "id"]
+        rows = resource.select(fields, limit=None)["rows"]
+
+        colname = str(resource._id)
+        return dict((row[colname], row) for row in rows)
+
+    # -------------------------------------------------------------------------
+    def pairs(self, records):
+        """
+            Generate the candidate pairs from the blocking keys, pairs
+            of records which share at least one key
+
+            @param records: the records, a dict {record_id: record}
+
+            @return: a set of tuples (record_id, duplicate_id), with
+                     record_id < duplicate_id
+        """
+
+        keys = self.keys
+
+        blocks = {}
+        for record_id, record in records.iteritems():
+            for key in keys(record):
+                if not key:
+                    continue
+                if key in blocks:
+                    blocks[key].append(record_id)
+                else:
+                    blocks[key] = [record_id]
+
+        max_block = self.max_block
+
+        pairs = set()
+        add = pairs.add
+        for block in blocks.itervalues():
+            size = len(block)
+            if size < 2 or size > max_block:
+                continue
+            block.sort()
+            for i in xrange(size - 1):
+                record_id = block[i]
+                for duplicate_id in block[i + 1:]:
+                    add((record_id, duplicate_id))
+        return pairs
+
+    # -------------------------------------------------------------------------
+    def store(self, candidates):
+        """
+            Update the candidates table: new pairs are added, the scores
+            of previously found open pairs are updated, and open pairs
+            which are no longer found are removed. Ignored or merged pairs
+            are never re-opened.
+
+            @param candidates: dict {(record_id, duplicate_id): score}
+
+            @return: the number of open candidate pairs
+        """
+
+        db = current.db
+        table = current.s3db.s3_merge_candidate
+        tablename = self.tablename
+
+        query = (table.tablename == tablename)
+        rows = db(query).select(table.id,
+                                table.record_id,
+                                table.duplicate_id,
+                                table.score,
+                                table.status)
+        remove = []
+        for row in rows:
+            pair = (row.record_id, row.duplicate_id)
+            if row.status != "OPEN":
+                candidates.pop(pair, None)
+                continue
+            if pair not in candidates:
+                remove.append(row.id)
+                continue
+            score = candidates.pop(pair)
+            if score != row.score:
+                db(table.id == row.id).update(score=score)
+
+        if remove:
+            db(table.id.belongs(remove)).delete()
+
+        if candidates:
+            table.bulk_insert([{"tablename": tablename,
+                                "record_id": record_id,
+                                "duplicate_id": duplicate_id,
+                                "score": score,
+                                "status": "OPEN",
+                                }
+                               for (record_id, duplicate_id), score
+                               in candidates.iteritems()])
+
+        query &= (table.status == "OPEN")
+        return db(query).count()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def resolve(tablename, original_id, duplicate_id):
+        """
+            Update the candidates after two records have been merged
+
+            @param tablename: the table name
+            @param original_id: the ID of the record which has been kept
+            @param duplicate_id: the ID of the record which has been removed
+        """
+
+        db = current.db
+        table = current.s3db.s3_merge_candidate
+
+        query = (table.tablename == tablename)
+        pair = sorted((original_id, duplicate_id))
+        db(query & (table.record_id == pair[0]) & \
+                   (table.duplicate_id == pair[1])).update(status="MERGED")
+
+        # Open pairs involving the removed record are obsolete
+        query &= (table.status == "OPEN") & \
+                 ((table.record_id == duplicate_id) | \
+                  (table.duplicate_id == duplicate_id))
+        db(query).delete()
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def represent(tablename):
+        """
+            Get the representation function for record IDs of a table
+
+            @param tablename: the table name
+        """
+
+        s3db = current.s3db
+        s3db.table(tablename)
+        config = s3db.get_config(tablename, "merge_candidates")
+        if config and "represent" in config:
+            return config["represent"]
+        return S3Represent(lookup=tablename)
+
+    # Spelling variants of Arabic-script letters (Arabic, Pashto, Dari)
+    LETTER_VARIANTS = {0x0629: 0x0647, # Teh Marbuta => Heh
+                       0x0649: 0x064A, # Alef Maksura => Yeh
+                       0x06CC: 0x064A, # Farsi Yeh => Yeh
+                       0x06A9: 0x0643, # Keheh => Kaf
+                       }
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def normalize(cls, name):
+        """
+            Normalize a name for use in blocking keys and similarity
+            functions: lower-case letters of any script, without accents
+            or other diacritics (e.g. vowel marks)
+
+            @param name: the name
+        """
+
+        if not name:
+            return u""
+        name = unicodedata.normalize("NFKD", s3_unicode(name).lower())
+        return u"".join(c for c in name.translate(cls.LETTER_VARIANTS)
+                        if c.isalpha())
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def soundex(cls, name):
+        """
+            Soundex code of a (normalized) name, for blocking keys; for
+            names in non-Latin scripts, Soundex does not apply, so their
+            first four letters are used instead
+
+            @param name: the name
+        """
+
+        name = cls.normalize(name)
+        if not name:
+            return ""
+        try:
+            name = name.encode("ascii")
+        except UnicodeEncodeError:
+            return name[:4]
+        return soundex(name)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def name_similarity(cls, a, b):
+        """
+            Similarity of two names (Jaro-Winkler)
+
+            @param a: the first name
+            @param b: the second name
+
+            @return: the similarity (0.0 to 1.0), or None if either
+                     name is empty
+        """
+
+        a = cls.normalize(a)
+        b = cls.normalize(b)
+        if not a or not b:
+            return None
+        return s3_jaro_winkler(a, b)
+
 # END =========================================================================
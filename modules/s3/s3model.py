@@ -29,6 +29,17 @@
 
 __all__ = ["S3Model"]
 
+import os
+import sys
+
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+
 from gluon import *
 from gluon.dal import Table
 # Here are dependencies listed for reference:
@@ -39,14 +50,13 @@ from gluon.storage import Storage
 from gluon.tools import callback
 
 from s3navigation import S3ScriptItem
-from s3resource import S3Resource
+from s3resource import S3Resource, S3CountCache
 from s3validators import IS_ONE_OF
 
 DEFAULT = lambda: None
 
 DEBUG = False
 if DEBUG:
-    import sys
     print >> sys.stderr, "S3MODEL: DEBUG MODE"
     def _debug(m):
         print >> sys.stderr, m
@@ -65,6 +75,10 @@ class S3Model(object):
     LOAD = "s3_model_load"
     DELETED = "deleted"
 
+    # Model manifest (process-wide)
+    MANIFEST = "s3model_manifest.json"
+    _manifest = None
+
     def __init__(self, module=None):
         """ Constructor """
 
@@ -98,13 +112,26 @@ class S3Model(object):
             if self.__loaded():
                 return
             self.__lock()
+            recorder = current.model.get("recorder")
+            if recorder is not None:
+                recorder.stack.append((module, self.__class__.__name__))
+            profiler = getattr(current, "profiler", None)
+            if profiler:
+                timer = profiler.timer()
             if module in mandatory_models or \
                current.deployment_settings.has_module(module):
                 env = self.model()
             else:
                 env = self.defaults()
+            if profiler:
+                profiler.record("model", self.__class__.__name__, timer)
             if isinstance(env, (Storage, dict)):
                 response.s3.update(env)
+                if recorder is not None:
+                    for name in env:
+                        self.__record(name)
+            if recorder is not None:
+                recorder.stack.pop()
             self.__loaded(True)
             self.__unlock()
 
@@ -209,6 +236,24 @@ class S3Model(object):
              tablename in ogetattr(db, "_LAZY_TABLES"):
             return ogetattr(db, tablename)
         else:
+            # Look up the defining model in the manifest
+            location = cls.manifest()["names"].get(tablename)
+            if location:
+                prefix, name = location
+                module = models.__dict__.get(prefix)
+                if module is not None and name in module.__dict__:
+                    model = module.__dict__[name]
+                    if hasattr(model, "_s3model"):
+                        model(prefix)
+                    else:
+                        s3db.classes[tablename] = (prefix, name)
+                        return model
+                if not (not db_only and tablename in s3 or \
+                        hasattr(db, tablename)):
+                    # Manifest outdated => fall back to module scan
+                    location = None
+
+        if not location:
             prefix, name = tablename.split("_", 1)
             if hasattr(models, prefix):
                 module = models.__dict__[prefix]
@@ -262,8 +307,23 @@ class S3Model(object):
         if name in s3:
             return s3[name]
         elif "_" in name:
-            prefix = name.split("_", 1)[0]
             models = current.models
+
+            # Look up the defining model in the manifest
+            location = cls.manifest()["names"].get(name)
+            if location:
+                prefix, n = location
+                module = models.__dict__.get(prefix)
+                if module is not None and n in module.__dict__:
+                    model = module.__dict__[n]
+                    if type(model).__name__ == "type":
+                        model(prefix)
+                    else:
+                        s3[n] = model
+                if name in s3:
+                    return s3[name]
+
+            prefix = name.split("_", 1)[0]
             if hasattr(models, prefix):
                 module = models.__dict__[prefix]
                 loaded = False
@@ -339,6 +399,201 @@ class S3Model(object):
 
         return
 
+    # -------------------------------------------------------------------------
+    # Model manifest
+    # -------------------------------------------------------------------------
+    @classmethod
+    def manifest(cls):
+        """
+            Get the model manifest, i.e. a dict with:
+
+                names       - {name: (module, class)} of all tables and
+                              names exported by models
+                components  - {master: {alias: (module, class)}} of the
+                              models which define component links
+                references  - {tablename: [tablename, ...]} of the tables
+                              referencing a table
+
+            The manifest is generated by build_manifest(). If there is no
+            generated manifest (or it is older than the model modules),
+            then a manifest of just the names is compiled from the
+            "names" of the model classes (without loading any models).
+        """
+
+        manifest = cls._manifest
+        if manifest is None:
+            mtime = cls.__models_mtime()
+            try:
+                with open(cls.__manifest_path(), "rb") as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                manifest = None
+            if not manifest or manifest.get("mtime", 0) < mtime:
+                manifest = {"mtime": mtime,
+                            "names": cls.__static_names(),
+                            }
+            cls._manifest = manifest
+        return manifest
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def build_manifest(cls, path=None):
+        """
+            Generate the model manifest by loading all models, and write
+            it to a file (run e.g. from static/scripts/tools/model_manifest.py)
+
+            @param path: the file path (default: cache/s3model_manifest.json)
+
+            @return: the manifest
+        """
+
+        db = current.db
+        response = current.response
+
+        # (Re-)load all models while recording what they define
+        recorder = current.model.recorder = Storage(stack = [],
+                                                    names = {},
+                                                    components = {},
+                                                    )
+        response[cls.LOAD] = []
+        try:
+            cls.load_all_models()
+        finally:
+            del current.model["recorder"]
+
+        names = cls.__static_names()
+        names.update(recorder.names)
+
+        # Find all references (incl. list:references)
+        references = {}
+        for table in db:
+            tablename = table._tablename
+            for field in table:
+                ftype = str(field.type)
+                if ftype[:10] == "reference ":
+                    rtablename = ftype[10:]
+                elif ftype[:15] == "list:reference ":
+                    rtablename = ftype[15:]
+                else:
+                    continue
+                rtablename = rtablename.split(".", 1)[0]
+                if rtablename not in references:
+                    references[rtablename] = [tablename]
+                elif tablename not in references[rtablename]:
+                    references[rtablename].append(tablename)
+
+        manifest = {"mtime": cls.__models_mtime(),
+                    "names": names,
+                    "components": recorder.components,
+                    "references": references,
+                    }
+
+        if path is None:
+            path = cls.__manifest_path()
+        try:
+            with open(path, "wb") as f:
+                json.dump(manifest, f)
+        except IOError:
+            print >> sys.stderr, "S3Model: could not write manifest to %s" % path
+        cls._manifest = manifest
+        return manifest
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def load_references(cls, tablename):
+        """
+            Load all tables referencing a table (e.g. to merge records),
+            or all models if there is no generated manifest
+
+            @param tablename: the table name
+        """
+
+        references = cls.manifest().get("references")
+        if references is None:
+            cls.load_all_models()
+            return
+
+        tablenames = [tablename]
+        supertables = cls.get_config(tablename, "super_entity")
+        if supertables:
+            if not isinstance(supertables, (list, tuple)):
+                supertables = [supertables]
+            tablenames.extend([s if isinstance(s, str) else s._tablename
+                               for s in supertables])
+        load = cls.table
+        for tn in tablenames:
+            for rtablename in references.get(tn, []):
+                load(rtablename)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __static_names(cls):
+        """
+            Compile the names-part of the manifest from the "names" of the
+            model classes and the other names exported by the model modules
+        """
+
+        names = {}
+        models = current.models
+        if models is None:
+            return names
+        for prefix, module in models.__dict__.items():
+            if type(module).__name__ != "module" or \
+               not hasattr(module, "__all__"):
+                continue
+            for n in module.__all__:
+                model = module.__dict__.get(n)
+                if hasattr(model, "_s3model"):
+                    for name in getattr(model, "names", ()):
+                        if name not in names:
+                            names[name] = (prefix, n)
+                elif n not in names:
+                    names[n] = (prefix, n)
+        return names
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __record(cls, name):
+        """
+            Record the model currently being loaded as the source of a
+            name when generating the manifest
+        """
+
+        recorder = current.model.get("recorder")
+        if recorder is not None and recorder.stack:
+            if name not in recorder.names:
+                recorder.names[name] = recorder.stack[-1]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __manifest_path():
+        """ The path of the generated manifest file """
+
+        return os.path.join(current.request.folder,
+                            "cache",
+                            S3Model.MANIFEST)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __models_mtime():
+        """ The time of the latest modification of any model module """
+
+        mtime = 0
+        models = current.models
+        if models is not None:
+            for path in getattr(models, "__path__", ()):
+                try:
+                    filenames = os.listdir(path)
+                except OSError:
+                    continue
+                for filename in filenames:
+                    if filename[-3:] == ".py":
+                        mtime = max(mtime,
+                                    os.path.getmtime(os.path.join(path,
+                                                                  filename)))
+        return mtime
+
     # -------------------------------------------------------------------------
     @classmethod
     def define_table(cls, tablename, *fields, **args):
@@ -347,11 +602,14 @@ class S3Model(object):
             a table definition if the table is already defined.
         """
 
+        cls.__record(tablename)
+
         db = current.db
         if hasattr(db, tablename):
             table = ogetattr(db, tablename)
         else:
             table = db.define_table(tablename, *fields, **args)
+            S3CountCache.register(table)
         return table
 
     # -------------------------------------------------------------------------
@@ -485,7 +743,15 @@ class S3Model(object):
         components = current.model.components
 
         master = master._tablename if type(master) is Table else master
-        
+
+        recorder = current.model.get("recorder")
+        if recorder is not None and recorder.stack:
+            if master not in recorder.components:
+                recorder.components[master] = {}
+            recorded = recorder.components[master]
+        else:
+            recorded = None
+
         hooks = components.get(master)
         if hooks is None:
             hooks = Storage()
@@ -561,6 +827,8 @@ class S3Model(object):
                                     filterby=filterby,
                                     filterfor=filterfor)
                 hooks[alias] = component
+                if recorded is not None and alias not in recorded:
+                    recorded[alias] = recorder.stack[-1]
 
         components[master] = hooks
         return
@@ -611,6 +879,8 @@ class S3Model(object):
             single = True
             names = [names]
         h = components.get(tablename, None)
+        if names and cls.__load_component_models(tablename, names, h):
+            h = components.get(tablename, None)
         if h:
             get_hooks(hooks, h, names=names)
         if not single or single and not len(hooks):
@@ -702,6 +972,37 @@ class S3Model(object):
             components[alias] = component
         return components
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __load_component_models(cls, tablename, names, hooks):
+        """
+            Load the models which define the links for components of a
+            table (according to the manifest) which are not configured yet
+
+            @param tablename: the master table name
+            @param names: the component aliases
+            @param hooks: the currently configured hooks for the table
+
+            @return: True if any models have been loaded, otherwise False
+        """
+
+        recorded = cls.manifest().get("components")
+        if not recorded or tablename not in recorded:
+            return False
+        recorded = recorded[tablename]
+
+        models = current.models
+        loaded = False
+        for alias in names:
+            if hooks and alias in hooks or alias not in recorded:
+                continue
+            prefix, name = recorded[alias]
+            module = models.__dict__.get(prefix)
+            if module is not None and name in module.__dict__:
+                module.__dict__[name](prefix)
+                loaded = True
+        return loaded
+
     # -------------------------------------------------------------------------
     @classmethod
     def has_components(cls, table):
@@ -898,7 +1199,12 @@ class S3Model(object):
             @param args: table arguments (e.g. migrate)
         """
 
+        cls.__record(tablename)
+
         db = current.db
+        if hasattr(db, tablename):
+            # Repeat-safe (e.g. when re-loading models for the manifest)
+            return ogetattr(db, tablename)
         if db._dbname == "postgres":
             sequence_name = "%s_%s_seq" % (tablename, key)
         else:
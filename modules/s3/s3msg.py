@@ -36,15 +36,31 @@
 """
 
 __all__ = ["S3Msg",
+           "S3MsgDispatcher",
+           "S3MsgPoller",
+           "S3KeyGraph",
            "S3Compose",
            ]
 
 import base64
 import datetime
+import hashlib
+import httplib
 import os
+import Queue
+import re
+import smtplib
+import socket
 import string
+import sys
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
+
+from email.header import Header
+from email.mime.text import MIMEText
 
 try:
     from cStringIO import StringIO    # Faster, where available
@@ -67,6 +83,7 @@ except ImportError:
 
 from gluon import current, redirect
 from gluon.html import *
+from gluon.storage import Storage
 
 from s3codec import S3Codec
 from s3crud import S3CRUD
@@ -84,10 +101,16 @@ TWITTER_MAX_CHARS = 140
 TWITTER_HAS_NEXT_SUFFIX = u' \u2026'
 TWITTER_HAS_PREV_PREFIX = u'\u2026 '
 
+# Compact JSON encoding
+SEPARATORS = (",", ":")
+
 # =============================================================================
 class S3Msg(object):
     """ Messaging framework """
 
+    # Maximum number of outbox entries to dispatch per transaction
+    OUTBOX_CHUNK = 200
+
     def __init__(self,
                  modem=None):
 
@@ -225,19 +248,7 @@ class S3Msg(object):
 
         from s3parser import S3Parsing
 
-        parser = S3Parsing.parser
-        stable = current.s3db.msg_parsing_status
-        query = (stable.channel_id == channel_id) & \
-                (stable.is_parsed == False)
-        messages = current.db(query).select(stable.id,
-                                            stable.message_id)
-        for message in messages:
-            # Parse the Message
-            reply_id = parser(function_name, message.message_id)
-            # Update to show that we've parsed the message & provide a link to the reply
-            message.update_record(is_parsed=True,
-                                  reply_id=reply_id)
-        return
+        return S3Parsing.parse_batch(channel_id, function_name)
 
     # =========================================================================
     # Outbound Messages
@@ -428,12 +439,15 @@ class S3Msg(object):
 
             @param contact_method: the output channel (see pr_contact.method)
 
+            @return: list of dispatch statistics per gateway and chunk
+
             @todo: contact_method = "ALL"
         """
 
         db = current.db
         s3db = current.s3db
 
+        outgoing_sms_handler = None
         if contact_method == "SMS":
             table = s3db.msg_sms_outbound_gateway
             settings = db(table.id > 0).select(table.outgoing_sms_handler,
@@ -451,58 +465,6 @@ class S3Msg(object):
                 # task fail permanently
                 raise ValueError("No Twitter API available!")
 
-        def dispatch_to_pe_id(pe_id,
-                              subject,
-                              message,
-                              outbox_id,
-                              message_id,
-                              contact_method=contact_method):
-            """
-                Helper method to send messages by pe_id
-
-                @param pe_id: the pe_id
-                @param subject: the message subject
-                @param message: the message body
-                @param outbox_id: the outbox record ID
-                @param message_id: the message_id
-                @param contact_method: the contact method
-            """
-
-            # Get the recipient's contact info
-            table = s3db.pr_contact
-            query = (table.pe_id == pe_id) & \
-                    (table.contact_method == contact_method) & \
-                    (table.deleted == False)
-            contact_info = db(query).select(table.value,
-                                            orderby=table.priority,
-                                            limitby=(0, 1)).first()
-            # Send the message
-            if contact_info:
-                address = contact_info.value
-                if contact_method == "EMAIL":
-                    return self.send_email(address,
-                                           subject,
-                                           message)
-                elif contact_method == "SMS":
-                    if outgoing_sms_handler == "WEB_API":
-                        return self.send_sms_via_api(address,
-                                                     message,
-                                                     message_id)
-                    elif outgoing_sms_handler == "SMTP":
-                        return self.send_sms_via_smtp(address, message)
-                    elif outgoing_sms_handler == "MODEM":
-                        return self.send_sms_via_modem(address, message)
-                    elif outgoing_sms_handler == "TROPO":
-                        # NB This does not mean the message is sent
-                        return self.send_text_via_tropo(outbox_id,
-                                                        message_id,
-                                                        address,
-                                                        message)
-                elif contact_method == "TWITTER":
-                    return self.send_tweet(message, address)
-
-            return False
-
         outbox = s3db.msg_outbox
 
         petable = s3db.pr_pentity
@@ -535,11 +497,13 @@ class S3Msg(object):
             # @ToDo
             raise
 
-        rows = db(query).select(*fields,
-                                left=left,
-                                orderby=~outbox.retries)
+        # Dispatch in chunks, each committed separately, so that a task
+        # timeout doesn't lose the status of all messages sent so far
+        orderby = ~outbox.retries
+        rows = db(query).select(outbox.id, orderby=orderby)
         if not rows:
-            return
+            return []
+        outbox_ids = [row.id for row in rows]
 
         htable = s3db.hrm_human_resource
         otable = db.org_organisation
@@ -573,111 +537,335 @@ class S3Msg(object):
                                (ptable.deleted != True))
                      ]
 
+        # Multi-recipient entities: lookup table, join
+        multi = {"pr_group": (gtable, gleft),
+                 "org_organisation": (otable, oleft),
+                 }
+        if atable:
+            multi["deploy_alert"] = (atable, aleft)
+
         # chainrun: used to fire process_outbox again,
         # when messages are sent to groups or organisations
         chainrun = False
 
-        for row in rows:
+        stats = []
+        dispatcher = self._outbox_dispatcher(contact_method,
+                                             outgoing_sms_handler)
+        chunk_size = self.OUTBOX_CHUNK
+        for i in xrange(0, len(outbox_ids), chunk_size):
 
-            status = True
-
-            if contact_method == "EMAIL":
-                subject = row["msg_email.subject"] or ""
-                message = row["msg_email.body"] or ""
-            elif contact_method == "SMS":
-                subject = None
-                message = row["msg_sms.body"] or ""
-            elif contact_method == "TWITTER":
-                subject = None
-                message = row["msg_twitter.body"] or ""
-            else:
-                # @ToDo
-                continue
+            chunk = outbox_ids[i:i + chunk_size]
+            rows = db(query & outbox.id.belongs(chunk)).select(*fields,
+                                                                left=left,
+                                                                orderby=orderby)
 
-            entity_type = row["pr_pentity"].instance_type
-            if not entity_type:
-                current.log.warning("s3msg", "Entity type unknown")
-                continue
+            requeue = []
+            messages = []
+            sent = []
+            invalid = []
+            for row in rows:
 
-            row = row["msg_outbox"]
-            pe_id = row.pe_id
-            message_id = row.message_id
-
-            if entity_type == "pr_group":
-                # Re-queue the message for each member in the group
-                gquery = (gtable.pe_id == pe_id)
-                recipients = db(gquery).select(ptable.pe_id, left=gleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif entity_type == "deploy_alert":
-                # Re-queue the message for each HR in the group
-                aquery = (atable.pe_id == pe_id)
-                recipients = db(aquery).select(ptable.pe_id, left=aleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif entity_type == "org_organisation":
-                # Re-queue the message for each HR in the organisation
-                oquery = (otable.pe_id == pe_id)
-                recipients = db(oquery).select(ptable.pe_id, left=oleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
+                if contact_method == "EMAIL":
+                    subject = row["msg_email.subject"] or ""
+                    message = row["msg_email.body"] or ""
+                elif contact_method == "SMS":
+                    subject = None
+                    message = row["msg_sms.body"] or ""
+                elif contact_method == "TWITTER":
+                    subject = None
+                    message = row["msg_twitter.body"] or ""
+                else:
+                    # @ToDo
+                    continue
+
+                entity_type = row["pr_pentity"].instance_type
+                if not entity_type:
+                    current.log.warning("s3msg", "Entity type unknown")
+                    continue
+
+                row = row["msg_outbox"]
+                pe_id = row.pe_id
+                message_id = row.message_id
+
+                if entity_type in multi:
+                    # Re-queue the message for each member/HR
+                    table, join = multi[entity_type]
+                    recipients = db(table.pe_id == pe_id).select(ptable.pe_id,
+                                                                 left=join)
+                    pe_ids = set(r.pe_id for r in recipients)
+                    pe_ids.discard(None)
                     for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif entity_type == "pr_person":
-                # Send the message to this person
-                try:
-                    status = dispatch_to_pe_id(pe_id,
-                                               subject,
-                                               message,
-                                               row.id,
-                                               message_id)
-                except:
-                    status = False
-            else:
-                # Unsupported entity type
-                row.update_record(status = 4) # Invalid
-                db.commit()
-                continue
+                        requeue.append(dict(message_id=message_id,
+                                            pe_id=pe_id,
+                                            contact_method=contact_method,
+                                            system_generated=True))
+                    sent.append(row.id)
+
+                elif entity_type == "pr_person":
+                    # Send the message to this person
+                    messages.append(Storage(outbox_id = row.id,
+                                            message_id = message_id,
+                                            pe_id = pe_id,
+                                            subject = subject,
+                                            body = message,
+                                            retries = row.retries,
+                                            ))
+                else:
+                    # Unsupported entity type
+                    invalid.append(row.id)
+
+            if requeue:
+                outbox.bulk_insert(requeue)
+                chainrun = True
+
+            # Look up the recipients' addresses
+            addresses = self._get_addresses([m.pe_id for m in messages],
+                                            contact_method)
+            failed = []
+            dispatch = []
+            for m in messages:
+                address = addresses.get(m.pe_id)
+                if address:
+                    m.to = address
+                    dispatch.append(m)
+                else:
+                    failed.append(m)
 
-            if status:
-                row.update_record(status = 2) # Sent
-                db.commit()
+            # Send the messages
+            stat = None
+            if dispatcher:
+                if contact_method == "EMAIL":
+                    dispatch = self._check_mail_limit(dispatch)
+                results, stat = dispatcher.run([(m.outbox_id, m) for m in dispatch])
+                remote_ids = []
+                for m in dispatch:
+                    status, info = results.get(m.outbox_id, (False, None))
+                    if status:
+                        sent.append(m.outbox_id)
+                        if info and contact_method == "SMS":
+                            remote_ids.append((m.message_id, info))
+                    else:
+                        if info:
+                            current.log.error("s3msg: %s send failed: %s" % \
+                                              (stat.gateway, info))
+                        failed.append(m)
+                if contact_method == "EMAIL" and \
+                   current.deployment_settings.get_mail_limit():
+                    # Log the sending
+                    s3db.msg_channel_limit.bulk_insert([{}] * len(stat.sent_ids))
+                stable = s3db.msg_sms
+                for message_id, remote_id in remote_ids:
+                    # Store ID from Clickatell to be able to followup
+                    db(stable.message_id == message_id).update(remote_id=remote_id)
             else:
-                if row.retries > 0:
-                    row.update_record(retries = row.retries - 1)
-                    db.commit()
-                elif row.retries is not None:
-                    row.update_record(status = 5) # Failed
+                # Send one by one
+                for m in dispatch:
+                    try:
+                        status = self._send_to_address(m, contact_method,
+                                                       outgoing_sms_handler)
+                    except:
+                        status = False
+                    if status:
+                        sent.append(m.outbox_id)
+                    else:
+                        failed.append(m)
+
+            # Update the outbox status
+            if sent:
+                db(outbox.id.belongs(sent)).update(status = 2) # Sent
+            if invalid:
+                db(outbox.id.belongs(invalid)).update(status = 4) # Invalid
+            retry = [m.outbox_id for m in failed if m.retries > 0]
+            if retry:
+                db(outbox.id.belongs(retry)).update(retries = outbox.retries - 1)
+            given_up = [m.outbox_id for m in failed if m.retries == 0]
+            if given_up:
+                db(outbox.id.belongs(given_up)).update(status = 5) # Failed
+            db.commit()
+
+            if stat:
+                current.log.info("s3msg: %(gateway)s sent %(sent)s, failed %(failed)s "
+                                 "messages in %(seconds).1fs (%(rate).1f/s)" % stat)
+                del stat["sent_ids"]
+                stats.append(stat)
 
         if chainrun:
-            self.process_outbox(contact_method)
+            stats.extend(self.process_outbox(contact_method))
+
+        return stats
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _get_addresses(pe_ids, contact_method):
+        """
+            Look up the preferred addresses of recipients
+
+            @param pe_ids: the recipients' pe_ids
+            @param contact_method: the contact method
+
+            @return: dict {pe_id: address}
+        """
+
+        addresses = {}
+        if not pe_ids:
+            return addresses
+
+        table = current.s3db.pr_contact
+        query = (table.pe_id.belongs(set(pe_ids))) & \
+                (table.contact_method == contact_method) & \
+                (table.deleted == False)
+        rows = current.db(query).select(table.pe_id,
+                                        table.value,
+                                        orderby=table.priority)
+        for row in rows:
+            if row.pe_id not in addresses:
+                addresses[row.pe_id] = row.value
+        return addresses
+
+    # -------------------------------------------------------------------------
+    def _send_to_address(self, m, contact_method, outgoing_sms_handler=None):
+        """
+            Send an outbox message to its recipient
+
+            @param m: the message (Storage)
+            @param contact_method: the contact method
+            @param outgoing_sms_handler: the SMS gateway
+        """
+
+        address = m.to
+        if contact_method == "EMAIL":
+            return self.send_email(address, m.subject, m.body)
+        elif contact_method == "SMS":
+            if outgoing_sms_handler == "WEB_API":
+                return self.send_sms_via_api(address, m.body, m.message_id)
+            elif outgoing_sms_handler == "SMTP":
+                return self.send_sms_via_smtp(address, m.body)
+            elif outgoing_sms_handler == "MODEM":
+                return self.send_sms_via_modem(address, m.body)
+            elif outgoing_sms_handler == "TROPO":
+                # NB This does not mean the message is sent
+                return self.send_text_via_tropo(m.outbox_id,
+                                                m.message_id,
+                                                address,
+                                                m.body)
+        elif contact_method == "TWITTER":
+            return self.send_tweet(m.body, address)
+        return False
+
+    # -------------------------------------------------------------------------
+    def _outbox_dispatcher(self, contact_method, outgoing_sms_handler=None):
+        """
+            Get a concurrent dispatcher for a channel
+
+            @param contact_method: the contact method
+            @param outgoing_sms_handler: the SMS gateway
 
-        return
+            @return: S3MsgDispatcher, or None if the channel doesn't
+                     support concurrent dispatch
+        """
+
+        settings = current.deployment_settings
+        workers = settings.get_msg_outbox_workers().get(contact_method, 1)
+        rate = settings.get_msg_outbox_rate().get(contact_method)
+
+        if contact_method == "EMAIL":
+            smtp = self._smtp_config()
+            if smtp:
+                return S3MsgDispatcher("EMAIL",
+                                       S3MsgDispatcher.smtp(smtp),
+                                       workers = workers,
+                                       rate = rate,
+                                       close = S3MsgDispatcher.smtp_close,
+                                       )
+
+        elif contact_method == "SMS":
+            db = current.db
+            s3db = current.s3db
+            sanitise = self.sanitise_phone
+
+            if outgoing_sms_handler == "WEB_API":
+                table = s3db.msg_sms_webapi_channel
+                sms_api = db(table.enabled == True).select(limitby=(0, 1)).first()
+                if sms_api:
+                    return S3MsgDispatcher("WEB_API",
+                                           S3MsgDispatcher.webapi(sms_api,
+                                                                  sanitise),
+                                           workers = workers,
+                                           rate = rate,
+                                           close = S3MsgDispatcher.http_close,
+                                           )
+
+            elif outgoing_sms_handler == "SMTP":
+                table = s3db.msg_sms_smtp_channel
+                channel = db(table.enabled == True).select(limitby=(0, 1)).first()
+                smtp = self._smtp_config()
+                if channel and smtp:
+                    send = S3MsgDispatcher.smtp(smtp)
+                    def send_sms(local, m):
+                        m = Storage(m)
+                        m.to = "%s@%s" % (sanitise(m.to), channel.address)
+                        m.subject = ""
+                        return send(local, m)
+                    return S3MsgDispatcher("SMTP",
+                                           send_sms,
+                                           workers = workers,
+                                           rate = rate,
+                                           close = S3MsgDispatcher.smtp_close,
+                                           )
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _smtp_config():
+        """
+            Get the SMTP server configuration for the dispatcher
+
+            @return: Storage(host, port, login, tls, ssl, sender), or None
+                     if email is not sent through an SMTP server
+        """
+
+        settings = current.deployment_settings
+        sender = settings.get_mail_sender()
+        mail = current.mail
+        if not sender or not mail:
+            return None
+        server = mail.settings.server
+        if not server or server in ("logging", "gae"):
+            return None
+        if ":" in server:
+            host, port = server.rsplit(":", 1)
+            port = int(port)
+        else:
+            host, port = server, 25
+        return Storage(host = host,
+                       port = port,
+                       login = mail.settings.login,
+                       tls = mail.settings.tls,
+                       ssl = mail.settings.ssl,
+                       sender = sender,
+                       )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _check_mail_limit(messages):
+        """
+            Limit the messages to send to the remaining daily quota,
+            the rest stays in the outbox
+
+            @param messages: the messages
+
+            @return: the messages to send
+        """
+
+        limit = current.deployment_settings.get_mail_limit()
+        if not limit:
+            return messages
+        day = datetime.timedelta(hours=24)
+        cutoff = current.request.utcnow - day
+        table = current.s3db.msg_channel_limit
+        # @ToDo: Include Channel Info
+        check = current.db(table.created_on > cutoff).count()
+        return messages[:max(0, limit - check)]
 
     # -------------------------------------------------------------------------
     # Send Email
@@ -857,19 +1045,61 @@ class S3Msg(object):
         if not sms_api:
             return False
 
+        url = sms_api.url
+        post_data = self._sms_api_data(sms_api,
+                                       self.sanitise_phone(mobile),
+                                       text)
+        if post_data is None:
+            current.log.error("Clickatell messages cannot exceed 480 chars")
+            return False
+
+        request = urllib2.Request(url)
+        query = urllib.urlencode(post_data)
+        if sms_api.username and sms_api.password:
+            # e.g. Mobile Commons
+            base64string = base64.encodestring("%s:%s" % (sms_api.username, sms_api.password)).replace("\n", "")
+            request.add_header("Authorization", "Basic %s" % base64string)
+        try:
+            result = urllib2.urlopen(request, query)
+        except urllib2.HTTPError, e:
+            current.log.error("SMS message send failed: %s" % e)
+            return False
+        else:
+            # Parse result
+            status, info = self._sms_api_result(url, result.read())
+            if not status:
+                current.log.error("SMS message send failed: %s" % info)
+                return False
+            elif message_id and info:
+                # Store ID from Clickatell to be able to followup
+                db(s3db.msg_sms.message_id == message_id).update(remote_id=info)
+            return True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _sms_api_data(sms_api, mobile, text):
+        """
+            Build the POST data for an SMS Web API request
+
+            @param sms_api: the msg_sms_webapi_channel Row
+            @param mobile: the (sanitised) phone number
+            @param text: the message text
+
+            @return: dict of POST variables, or None if the message
+                     is too long for the gateway
+        """
+
         post_data = {}
 
         parts = sms_api.parameters.split("&")
         for p in parts:
             post_data[p.split("=")[0]] = p.split("=")[1]
 
-        mobile = self.sanitise_phone(mobile)
-
         # To send non-ASCII characters in UTF-8 encoding, we'd need
         # to hex-encode the text and activate unicode=1, but this
         # would limit messages to 70 characters, and many mobile
         # phones can't display unicode anyway.
-        
+
         # To be however able to send messages with at least special
         # European characters like á or ø,  we convert the UTF-8 to
         # the default ISO-8859-1 (latin-1) here:
@@ -880,49 +1110,42 @@ class S3Msg(object):
         post_data[sms_api.message_variable] = text_latin1
         post_data[sms_api.to_variable] = str(mobile)
 
-        url = sms_api.url
-        clickatell = "clickatell" in url
-        if clickatell:
+        if "clickatell" in sms_api.url:
             text_len = len(text)
             if text_len > 480:
-                current.log.error("Clickatell messages cannot exceed 480 chars")
-                return False
+                return None
             elif text_len > 320:
                 post_data["concat"] = 3
             elif text_len > 160:
                 post_data["concat"] = 2
 
-        request = urllib2.Request(url)
-        query = urllib.urlencode(post_data)
-        if sms_api.username and sms_api.password:
-            # e.g. Mobile Commons
-            base64string = base64.encodestring("%s:%s" % (sms_api.username, sms_api.password)).replace("\n", "")
-            request.add_header("Authorization", "Basic %s" % base64string)
-        try:
-            result = urllib2.urlopen(request, query)
-        except urllib2.HTTPError, e:
-            current.log.error("SMS message send failed: %s" % e)
-            return False
-        else:
-            # Parse result
-            output = result.read()
-            if clickatell:
-                if output.startswith("ERR"):
-                    current.log.error("Clickatell message send failed: %s" % output)
-                    return False
-                elif message_id and output.startswith("ID"):
-                    # Store ID from Clickatell to be able to followup
-                    remote_id = output[4:]
-                    db(s3db.msg_sms.message_id == message_id).update(remote_id=remote_id)
-            elif "mcommons" in url:
-                # http://www.mobilecommons.com/mobile-commons-api/rest/#errors
-                # Good = <response success="true"></response>
-                # Bad = <response success="false"><errror id="id" message="message"></response>
-                if "error" in output:
-                    current.log.error("Mobile Commons message send failed: %s" % output)
-                    return False
+        return post_data
 
-            return True
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _sms_api_result(url, output):
+        """
+            Parse the response of an SMS Web API
+
+            @param url: the API URL
+            @param output: the response body
+
+            @return: tuple (status, info), info being the remote message
+                     ID if successful (Clickatell), else the error message
+        """
+
+        if "clickatell" in url:
+            if output.startswith("ERR"):
+                return False, "Clickatell: %s" % output
+            elif output.startswith("ID"):
+                return True, output[4:]
+        elif "mcommons" in url:
+            # http://www.mobilecommons.com/mobile-commons-api/rest/#errors
+            # Good = <response success="true"></response>
+            # Bad = <response success="false"><errror id="id" message="message"></response>
+            if "error" in output:
+                return False, "Mobile Commons: %s" % output
+        return True, None
 
     # -------------------------------------------------------------------------
     def send_sms_via_modem(self, mobile, text=""):
@@ -1232,6 +1455,25 @@ class S3Msg(object):
         result = fn(channel_id)
         return result
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def poll_channels(tablename, channel_ids=None):
+        """
+            Poll multiple RSS Feeds or Mailboxes concurrently
+
+            @param tablename: msg_rss_channel or msg_email_channel
+            @param channel_ids: the channel IDs, None for all enabled
+                                channels of this type
+
+            @return: the number of channels polled successfully
+        """
+
+        results = S3MsgPoller().run(tablename, channel_ids)
+        success = len([r for r in results.values() if r == "OK"])
+        current.log.info("S3Msg", "%s: %s of %s channels polled" % \
+                         (tablename, success, len(results)))
+        return success
+
     # -------------------------------------------------------------------------
     @staticmethod
     def poll_email(channel_id):
@@ -1239,269 +1481,61 @@ class S3Msg(object):
             This is a simple mailbox polling script for the Messaging Module.
             It is normally called from the scheduler.
 
+            IMAP mailboxes only download messages which have arrived since
+            the last run, so delete_from_server is not required to avoid
+            fetching the same messages repeatedly.
+
             @ToDo: Handle MIME attachments
                    http://docs.python.org/2/library/email-examples.html
             @ToDo: If there is a need to collect from non-compliant mailers
                    then suggest using the robust Fetchmail to collect & store
                    in a more compliant mailer!
-            @ToDo: If delete_from_server is false, we don't want to download the
-                   same messages repeatedly.  Perhaps record time of fetch runs
-                   (or use info from the scheduler_run table), compare w/ message
-                   timestamp, as a filter. That may not be completely accurate,
-                   so could check msg_email for messages close to the last
-                   fetch time. Or just advise people to have a dedicated account
-                   to which email is sent, that does not also need to be read
-                   by humans. Or don't delete the fetched mail until the next run.
+        """
+
+        results = S3MsgPoller(workers=1).run("msg_email_channel", [channel_id])
+        return results.get(channel_id, "No Such Email Channel: %s" % channel_id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def poll_mcommons(channel_id):
+        """
+            Fetches the inbound SMS from Mobile Commons API
+            http://www.mobilecommons.com/mobile-commons-api/rest/#ListIncomingMessages
         """
 
         db = current.db
         s3db = current.s3db
-
-        table = s3db.msg_email_channel
-        # Read-in configuration from Database
+        table = s3db.msg_mcommons_channel
         query = (table.channel_id == channel_id)
-        channel = db(query).select(table.username,
+        channel = db(query).select(table.url,
+                                   table.username,
                                    table.password,
-                                   table.server,
-                                   table.protocol,
-                                   table.use_ssl,
-                                   table.port,
-                                   table.delete_from_server,
+                                   table.query,
+                                   table.timestmp,
                                    limitby=(0, 1)).first()
         if not channel:
-            return "No Such Email Channel: %s" % channel_id
-
-        import email
-        import mimetypes
-        import socket
-
-        from dateutil import parser
-        date_parse = parser.parse
+            return "No Such MCommons Channel: %s" % channel_id
 
+        url = channel.url
         username = channel.username
         password = channel.password
-        host = channel.server
-        protocol = channel.protocol
-        ssl = channel.use_ssl
-        port = int(channel.port)
-        delete = channel.delete_from_server
+        _query = channel.query
+        timestamp = channel.timestmp
 
-        mtable = db.msg_email
-        minsert = mtable.insert
-        stable = db.msg_channel_status
-        sinsert = stable.insert
-        atable = s3db.msg_attachment
-        ainsert = atable.insert
-        dtable = db.doc_document
-        dinsert = dtable.insert
-        store = dtable.file.store
-        update_super = s3db.update_super
-        # Is this channel connected to a parser?
-        parser = s3db.msg_parser_enabled(channel_id)
-        if parser:
-            ptable = db.msg_parsing_status
-            pinsert = ptable.insert
+        url = "%s?campaign_id=%s" % (url, campaign_id)
+        if timestamp:
+            url = "%s&start_time=%s" % (url, timestamp)
+        if _query:
+            url = "%s&query=%s" % (url, _query)
 
-        # ---------------------------------------------------------------------
-        def parse_email(message):
-            """
-                Helper to parse the mail
-            """
+        # Create a password manager
+        passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        passman.add_password(None, url, username, password)
 
-            # Create a Message object
-            msg = email.message_from_string(message)
-            # Parse the Headers
-            sender = msg["from"]
-            subject = msg.get("subject", "")
-            date_sent = msg.get("date", None)
-            # Store the whole raw message
-            raw = msg.as_string()
-            # Parse out the 'Body'
-            # Look for Attachments
-            attachments = []
-            # http://docs.python.org/2/library/email-examples.html
-            body = ""
-            for part in msg.walk():
-                if part.get_content_maintype() == "multipart":
-                    # multipart/* are just containers
-                    continue
-                filename = part.get_filename()
-                if not filename:
-                    # Assume this is the Message Body (plain text or HTML)
-                    if not body:
-                        # Plain text will come first
-                        body = part.get_payload(decode=True)
-                    continue
-                attachments.append((filename, part.get_payload(decode=True)))
-
-            # Store in DB
-            data = dict(channel_id=channel_id,
-                        from_address=sender,
-                        subject=subject[:78],
-                        body=body,
-                        raw=raw,
-                        inbound=True,
-                        )
-            if date_sent:
-                data["date"] = date_parse(date_sent)
-            id = minsert(**data)
-            record = dict(id=id)
-            update_super(mtable, record)
-            message_id = record["message_id"]
-            for a in attachments:
-                # Linux ext2/3 max filename length = 255
-                # b16encode doubles length & need to leave room for doc_document.file.16charsuuid.
-                # store doesn't support unicode, so need an ascii string
-                filename = s3_unicode(a[0][:92]).encode("ascii", "ignore")
-                fp = StringIO()
-                fp.write(a[1])
-                fp.seek(0)
-                newfilename = store(fp, filename)
-                fp.close()
-                document_id = dinsert(name=filename,
-                                      file=newfilename)
-                update_super(dtable, dict(id=document_id))
-                ainsert(message_id=message_id,
-                        document_id=document_id)
-            if parser:
-                pinsert(message_id=message_id,
-                        channel_id=channel_id)
-
-        dellist = []
-        if protocol == "pop3":
-            import poplib
-            # http://docs.python.org/library/poplib.html
-            try:
-                if ssl:
-                    p = poplib.POP3_SSL(host, port)
-                else:
-                    p = poplib.POP3(host, port)
-            except socket.error, e:
-                error = "Cannot connect: %s" % e
-                current.log.error(error)
-                # Store status in the DB
-                sinsert(channel_id=channel_id,
-                        status=error)
-                return error
-
-            try:
-                # Attempting APOP authentication...
-                p.apop(username, password)
-            except poplib.error_proto:
-                # Attempting standard authentication...
-                try:
-                    p.user(username)
-                    p.pass_(password)
-                except poplib.error_proto, e:
-                    error = "Login failed: %s" % e
-                    current.log.error(error)
-                    # Store status in the DB
-                    sinsert(channel_id=channel_id,
-                            status=error)
-                    return error
-
-            mblist = p.list()[1]
-            for item in mblist:
-                number, octets = item.split(" ")
-                # Retrieve the message (storing it in a list of lines)
-                lines = p.retr(number)[1]
-                parse_email("\n".join(lines))
-                if delete:
-                    # Add it to the list of messages to delete later
-                    dellist.append(number)
-            # Iterate over the list of messages to delete
-            for number in dellist:
-                p.dele(number)
-            p.quit()
-
-        elif protocol == "imap":
-            import imaplib
-            # http://docs.python.org/library/imaplib.html
-            try:
-                if ssl:
-                    M = imaplib.IMAP4_SSL(host, port)
-                else:
-                    M = imaplib.IMAP4(host, port)
-            except socket.error, e:
-                error = "Cannot connect: %s" % e
-                current.log.error(error)
-                # Store status in the DB
-                sinsert(channel_id=channel_id,
-                        status=error)
-                return error
-
-            try:
-                M.login(username, password)
-            except M.error, e:
-                error = "Login failed: %s" % e
-                current.log.error(error)
-                # Store status in the DB
-                sinsert(channel_id=channel_id,
-                        status=error)
-                # Explicitly commit DB operations when running from Cron
-                db.commit()
-                return error
-
-            # Select inbox
-            M.select()
-            # Search for Messages to Download
-            typ, data = M.search(None, "ALL")
-            mblist = data[0].split()
-            for number in mblist:
-                typ, msg_data = M.fetch(number, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        parse_email(response_part[1])
-                        if delete:
-                            # Add it to the list of messages to delete later
-                            dellist.append(number)
-            # Iterate over the list of messages to delete
-            for number in dellist:
-                typ, response = M.store(number, "+FLAGS", r"(\Deleted)")
-            M.close()
-            M.logout()
-
-    # -------------------------------------------------------------------------
-    @staticmethod
-    def poll_mcommons(channel_id):
-        """
-            Fetches the inbound SMS from Mobile Commons API
-            http://www.mobilecommons.com/mobile-commons-api/rest/#ListIncomingMessages
-        """
-
-        db = current.db
-        s3db = current.s3db
-        table = s3db.msg_mcommons_channel
-        query = (table.channel_id == channel_id)
-        channel = db(query).select(table.url,
-                                   table.username,
-                                   table.password,
-                                   table.query,
-                                   table.timestmp,
-                                   limitby=(0, 1)).first()
-        if not channel:
-            return "No Such MCommons Channel: %s" % channel_id
-
-        url = channel.url
-        username = channel.username
-        password = channel.password
-        _query = channel.query
-        timestamp = channel.timestmp
-
-        url = "%s?campaign_id=%s" % (url, campaign_id)
-        if timestamp:
-            url = "%s&start_time=%s" % (url, timestamp)
-        if _query:
-            url = "%s&query=%s" % (url, _query)
-
-        # Create a password manager
-        passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-        passman.add_password(None, url, username, password)
-
-        # Create the AuthHandler
-        authhandler = urllib2.HTTPBasicAuthHandler(passman)
-        opener = urllib2.build_opener(authhandler)
-        urllib2.install_opener(opener)
+        # Create the AuthHandler
+        authhandler = urllib2.HTTPBasicAuthHandler(passman)
+        opener = urllib2.build_opener(authhandler)
+        urllib2.install_opener(opener)
 
         # Update the timestamp
         # NB Ensure MCommons account is in UTC
@@ -1631,184 +1665,8 @@ class S3Msg(object):
             Fetches all new messages from a subscribed RSS Feed
         """
 
-        db = current.db
-        s3db = current.s3db
-        table = s3db.msg_rss_channel
-        query = (table.channel_id == channel_id)
-        channel = db(query).select(table.date,
-                                   table.etag,
-                                   table.url,
-                                   limitby=(0, 1)).first()
-        if not channel:
-            return "No Such RSS Channel: %s" % channel_id
-
-        # http://pythonhosted.org/feedparser
-        import feedparser
-        if channel.etag:
-            # http://pythonhosted.org/feedparser/http-etag.html
-            # NB This won't help for a server like Drupal 7 set to not allow caching & hence generating a new ETag/Last Modified each request!
-            d = feedparser.parse(channel.url, etag=channel.etag)
-        elif channel.date:
-            d = feedparser.parse(channel.url, modified=channel.date.utctimetuple())
-        else:
-            # We've not polled this feed before
-            d = feedparser.parse(channel.url)
-
-        if d.bozo:
-            # Something doesn't seem right
-            S3Msg.update_channel_status(channel_id,
-                                        status=d.bozo_exception.message,
-                                        period=(300, 3600))
-            return
-
-        # Update ETag/Last-polled
-        now = current.request.utcnow
-        data = dict(date=now)
-        etag = d.get("etag", None)
-        if etag:
-            data["etag"] = etag
-        db(query).update(**data)
-        
-        from time import mktime, struct_time
-        gis = current.gis
-        geocode_r = gis.geocode_r
-        hierarchy_level_keys = gis.hierarchy_level_keys
-        utcfromtimestamp = datetime.datetime.utcfromtimestamp
-        gtable = db.gis_location
-        ginsert = gtable.insert
-        mtable = db.msg_rss
-        minsert = mtable.insert
-        update_super = s3db.update_super
-
-        # Is this channel connected to a parser?
-        parser = s3db.msg_parser_enabled(channel_id)
-        if parser:
-            ptable = db.msg_parsing_status
-            pinsert = ptable.insert
-
-        entries = d.entries
-        if entries:
-            # Check how many we have already to see if any are new
-            count_old = db(mtable.id > 0).count()
-        for entry in entries:
-            link = entry.get("link", None)
-
-            # Check for duplicates
-            # (ETag just saves bandwidth, doesn't filter the contents of the feed)
-            exists = db(mtable.from_address == link).select(mtable.id,
-                                                            mtable.location_id,
-                                                            mtable.message_id,
-                                                            limitby=(0, 1)
-                                                            ).first()
-            if exists:
-                location_id = exists.location_id
-            else:
-                location_id = None
-
-            title = entry.title
-
-            content = entry.get("content", None)
-            if content:
-                content = content[0].value
-            else:
-                content = entry.get("description", None)
-
-            # Consider using dateutil.parser.parse(entry.get("published"))
-            # http://www.deadlybloodyserious.com/2007/09/feedparser-v-django/
-            date_published = entry.get("published_parsed", entry.get("updated_parsed"))
-            if isinstance(date_published, struct_time):
-                date_published = utcfromtimestamp(mktime(date_published))
-            else:
-                date_published = now
-
-            tags = entry.get("tags", None)
-            if tags:
-                tags = [t.term.encode("utf-8") for t in tags]
-
-            location = False
-            lat = entry.get("geo_lat", None)
-            lon = entry.get("geo_long", None)
-            if lat is None or lon is None:
-                # Try GeoRSS
-                georss = entry.get("georss_point", None)
-                if georss:
-                    location = True
-                    lat, lon = georss.split(" ")
-            else:
-                location = True
-            if location:
-                try:
-                    query = (gtable.lat == lat) &\
-                            (gtable.lon == lon)
-                    exists = db(query).select(gtable.id,
-                                              limitby=(0, 1),
-                                              orderby=gtable.level,
-                                              ).first()
-                    if exists:
-                        location_id = exists.id
-                    else:
-                        data = dict(lat=lat,
-                                    lon=lon,
-                                    )
-                        results = geocode_r(lat, lon)
-                        if isinstance(results, dict):
-                            for key in hierarchy_level_keys:
-                                v = results.get(key, None)
-                                if v:
-                                    data[key] = v
-                        #if location_id:
-                        # Location has been changed
-                        #db(gtable.id == location_id).update(**data)
-                        location_id = ginsert(**data)
-                        data["id"] = location_id
-                        gis.update_location_tree(data)
-                except:
-                    # Don't die on badly-formed Geo
-                    pass
-
-            if exists:
-                db(mtable.id == exists.id).update(channel_id = channel_id,
-                                                  title = title,
-                                                  from_address = link,
-                                                  body = content,
-                                                  author = entry.get("author", None),
-                                                  date = date_published,
-                                                  location_id = location_id,
-                                                  tags = tags,
-                                                  # @ToDo: Enclosures
-                                                  )
-                if parser:
-                    pinsert(message_id = exists.message_id,
-                            channel_id = channel_id)
-                
-            else:
-                id = minsert(channel_id = channel_id,
-                             title = entry.title,
-                             from_address = link,
-                             body = content,
-                             author = entry.get("author", None),
-                             date = date_published,
-                             location_id = location_id,
-                             tags = tags,
-                             # @ToDo: Enclosures
-                             )
-                record = dict(id=id)
-                update_super(mtable, record)
-                if parser:
-                    pinsert(message_id = record["message_id"],
-                            channel_id = channel_id)
-
-        if entries:
-            # Check again to see if there were any new ones
-            count_new = db(mtable.id > 0).count()
-            if count_new == count_old:
-                # No new posts?
-                # Back-off in-case the site isn't respecting ETags/Last-Modified
-                S3Msg.update_channel_status(channel_id,
-                                            status="+1",
-                                            period=(300, 3600))
-
-        return "OK"
+        results = S3MsgPoller(workers=1).run("msg_rss_channel", [channel_id])
+        return results.get(channel_id, "No Such RSS Channel: %s" % channel_id)
 
     #-------------------------------------------------------------------------
     @staticmethod
@@ -1960,6 +1818,7 @@ class S3Msg(object):
                                                          qtable.lang,
                                                          qtable.count,
                                                          qtable.include_entities,
+                                                         qtable.is_processed,
                                                          limitby=(0, 1)).first()
 
         tso = TwitterSearch.TwitterSearchOrder()
@@ -2016,42 +1875,27 @@ class S3Msg(object):
         # This is simplistic as we may well want to repeat the same search multiple times
         db(qtable.id == search_id).update(is_searched = True)
 
+        if search_query.is_processed:
+            # Add the new results to the keyword graph
+            current.s3task.async("msg_process_keygraph", args=[search_id])
+
         return "OK"
 
     # -------------------------------------------------------------------------
     @staticmethod
     def process_keygraph(search_id):
-        """ Process results of twitter search with KeyGraph."""
-
-        import subprocess
-        import os
-        import tempfile
-
-        db = current.db
-        s3db = current.s3db
-        curpath = os.getcwd()
-        preprocess = S3Msg.preprocess_tweet
-
-        def generateFiles():
-
-            dirpath = tempfile.mkdtemp()
-            os.chdir(dirpath)
-
-            rtable = s3db.msg_twitter_search_results
-            tweets = db(rtable.deleted == False).select(rtable.body)
-            tweetno = 1
-            for tweet in tweets:
-                filename = "%s.txt" % tweetno
-                f = open(filename, "w")
-                f.write(preprocess(tweet.body))
-                tweetno += 1
+        """
+            Update the keyword graph of the results of a Twitter search
 
-            return dirpath
+            @param search_id: the msg_twitter_search record ID, None for
+                              the graph of all inbound messages
+        """
 
-        tpath = generateFiles()
-        jarpath = os.path.join(curpath, "static", "KeyGraph", "keygraph.jar")
-        resultpath = os.path.join(curpath, "static", "KeyGraph", "results", "%s.txt" % search_id)
-        return subprocess.call(["java", "-jar", jarpath, tpath , resultpath])
+        added = S3KeyGraph(search_id).update()
+        if search_id:
+            table = current.s3db.msg_twitter_search
+            current.db(table.id == search_id).update(is_processed = True)
+        return added
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -2062,8 +1906,6 @@ class S3Msg(object):
             with their definitions.
         """
 
-        import re
-
         tagdef = S3Msg.tagdef
         tweet = tweet.lower()
         tweet = re.sub('((www\.[\s]+)|(https?://[^\s]+))', "", tweet)
@@ -2078,19 +1920,1439 @@ class S3Msg(object):
     @staticmethod
     def tagdef(hashtag):
         """
-            Returns the definition of a hashtag.
+            Returns the definition of a hashtag (cached).
         """
 
         hashtag = hashtag.split("#")[1]
+        definitions = S3KeyGraph.tagdefs([hashtag])
+        return definitions.get(hashtag.lower()) or hashtag
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def tagdef_lookup(hashtag):
+        """
+            Looks up the definition of a hashtag from tagdef.com
+
+            @param hashtag: the hashtag (without #)
 
-        turl = "http://api.tagdef.com/one.%s.json" % hashtag
+            @return: the definition, or None if not found
+        """
+
+        turl = "http://api.tagdef.com/one.%s.json" % urllib.quote(s3_unicode(hashtag).encode("utf-8"))
         try:
-            hashstr = urllib2.urlopen(turl).read()
+            hashstr = urllib2.urlopen(turl, timeout=10).read()
             hashdef = json.loads(hashstr)
+            return hashdef["defs"]["def"]["text"]
         except:
-            return hashtag
+            return None
+
+# =============================================================================
+class S3MsgPoller(object):
+    """
+        Concurrent poller for inbound RSS feeds and mailboxes
+
+        Channels are fetched by a bounded pool of worker threads (RSS feeds
+        with conditional GET, IMAP mailboxes in bulk by UID ranges), while
+        the calling thread stores the items of each channel as soon as they
+        arrive. Duplicate feed entries are detected with one query per feed,
+        and the latency and item counts of each poll are recorded in the
+        channel status. The items of each channel are committed separately,
+        and messages are deleted from the mail server only after they have
+        been committed.
+
+        NB fetch functions run outside of the request environment, and
+        therefore must not access current or the database
+    """
+
+    # Maximum number of messages and bytes per IMAP FETCH
+    IMAP_CHUNK = 50
+    IMAP_CHUNK_SIZE = 5 * 1024 * 1024
+
+    IMAP_UID = re.compile(r"UID (\d+)")
+    IMAP_SIZE = re.compile(r"RFC822\.SIZE (\d+)")
+
+    def __init__(self, workers=None):
+        """
+            Constructor
+
+            @param workers: the maximum number of channels to poll
+                            concurrently
+        """
+
+        if workers is None:
+            workers = current.deployment_settings.get_msg_poll_workers()
+        self.workers = max(1, workers)
+
+    # -------------------------------------------------------------------------
+    def run(self, tablename, channel_ids=None):
+        """
+            Poll channels
+
+            @param tablename: the channel table name (msg_rss_channel or
+                              msg_email_channel)
+            @param channel_ids: the channel IDs, None for all enabled
+                                channels
+
+            @return: dict {channel_id: "OK" or error message}
+        """
+
+        db = current.db
+        table = current.s3db[tablename]
+
+        if tablename == "msg_rss_channel":
+            fetch = self.fetch_rss
+            store = self.store_rss
+            finish = None
+            fields = ("channel_id", "url", "etag", "date")
+        elif tablename == "msg_email_channel":
+            fetch = self.fetch_email
+            store = self.store_email
+            finish = self.finish_email
+            fields = ("channel_id", "server", "protocol", "use_ssl", "port",
+                      "username", "password", "delete_from_server",
+                      "last_uid", "uidvalidity")
         else:
-            return hashdef["defs"]["def"]["text"]
+            raise ValueError("Unsupported channel type: %s" % tablename)
+
+        query = (table.deleted != True)
+        if channel_ids is None:
+            query &= (table.enabled == True)
+        else:
+            query &= (table.channel_id.belongs(channel_ids))
+        rows = db(query).select(*[table[fn] for fn in fields])
+        channels = [Storage(row.as_dict()) for row in rows]
+
+        results = {}
+        if not channels:
+            return results
+
+        pending = Queue.Queue()
+        for channel in channels:
+            pending.put(channel)
+        done = Queue.Queue()
+
+        def worker():
+            while True:
+                try:
+                    channel = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    result = fetch(channel)
+                except Exception:
+                    result = Storage(error = str(sys.exc_info()[1]))
+                result.latency = time.time() - start
+                done.put((channel, result))
+
+        threads = []
+        for i in xrange(min(self.workers, len(channels))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Store the items of each channel as soon as they arrive
+        for i in xrange(len(channels)):
+            channel, result = done.get()
+            channel_id = channel.channel_id
+            items = new = 0
+            stored = False
+            error = result.error
+            if error:
+                # Store status in the DB
+                S3Msg.update_channel_status(channel_id, status=error)
+            else:
+                try:
+                    items, new, error = store(channel, result)
+                except Exception:
+                    error = str(sys.exc_info()[1])
+                    # Discard the partially stored items
+                    db.rollback()
+                else:
+                    stored = True
+            if error:
+                current.log.error("Polling channel %s failed: %s" % \
+                                  (channel_id, error))
+            self.update_status(channel_id, result.latency, items, new)
+            db.commit()
+            if finish:
+                # Complete the poll on the server (after commit)
+                try:
+                    finish(channel, result, stored)
+                except Exception:
+                    current.log.error("Closing channel %s failed: %s" % \
+                                      (channel_id, sys.exc_info()[1]))
+            results[channel_id] = error or "OK"
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_status(channel_id, latency, items, new):
+        """
+            Record the statistics of a poll
+
+            @param channel_id: the channel ID
+            @param latency: the time to fetch the items (seconds)
+            @param items: the number of items fetched
+            @param new: the number of new items
+        """
+
+        db = current.db
+        stable = current.s3db.msg_channel_status
+        data = {"polled_on": current.request.utcnow,
+                "latency": latency,
+                "items": items,
+                "new_items": new,
+                }
+        query = (stable.channel_id == channel_id)
+        if not db(query).update(**data):
+            stable.insert(channel_id = channel_id, **data)
+
+    # -------------------------------------------------------------------------
+    # RSS
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def fetch_rss(channel):
+        """
+            Fetch a feed (runs in a worker thread)
+
+            @param channel: the msg_rss_channel data
+        """
+
+        # http://pythonhosted.org/feedparser
+        import feedparser
+        if channel.etag:
+            # http://pythonhosted.org/feedparser/http-etag.html
+            # NB This won't help for a server like Drupal 7 set to not allow caching & hence generating a new ETag/Last Modified each request!
+            d = feedparser.parse(channel.url, etag=channel.etag)
+        elif channel.date:
+            d = feedparser.parse(channel.url, modified=channel.date.utctimetuple())
+        else:
+            # We've not polled this feed before
+            d = feedparser.parse(channel.url)
+        return Storage(feed=d)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def store_rss(channel, result):
+        """
+            Store the entries of a feed
+
+            @param channel: the msg_rss_channel data
+            @param result: the result of fetch_rss
+
+            @return: tuple (items, new, error)
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        channel_id = channel.channel_id
+        d = result.feed
+
+        if d.bozo:
+            # Something doesn't seem right
+            error = str(d.bozo_exception)
+            S3Msg.update_channel_status(channel_id,
+                                        status=error,
+                                        period=(300, 3600))
+            return 0, 0, error
+
+        # Update ETag/Last-polled
+        now = current.request.utcnow
+        data = dict(date=now)
+        etag = d.get("etag", None)
+        if etag:
+            data["etag"] = etag
+        table = s3db.msg_rss_channel
+        db(table.channel_id == channel_id).update(**data)
+
+        entries = d.entries
+        if not entries:
+            return 0, 0, None
+
+        from time import mktime, struct_time
+        gis = current.gis
+        geocode_r = gis.geocode_r
+        hierarchy_level_keys = gis.hierarchy_level_keys
+        utcfromtimestamp = datetime.datetime.utcfromtimestamp
+        gtable = db.gis_location
+        ginsert = gtable.insert
+        mtable = db.msg_rss
+        minsert = mtable.insert
+        update_super = s3db.update_super
+
+        # Is this channel connected to a parser?
+        parser = s3db.msg_parser_enabled(channel_id)
+        if parser:
+            ptable = db.msg_parsing_status
+            pinsert = ptable.insert
+
+        # Check for duplicates
+        # (ETag just saves bandwidth, doesn't filter the contents of the feed)
+        links = {}
+        for entry in entries:
+            link = entry.get("link", None)
+            if link:
+                links[S3MsgPoller.link_hash(link)] = link
+        existing = {}
+        if links:
+            fields = [mtable.id,
+                      mtable.location_id,
+                      mtable.message_id,
+                      mtable.from_address,
+                      ]
+            # NB entries stored before the link hash was introduced are
+            #    updated by static/scripts/tools/rss_link_hash.py
+            query = (mtable.link_hash.belongs(links.keys()))
+            for row in db(query).select(*fields):
+                existing[row.from_address] = row
+
+        locations = {}
+        new = 0
+        for entry in entries:
+            link = entry.get("link", None)
+            exists = existing.get(link) if link else None
+            if exists:
+                location_id = exists.location_id
+            else:
+                location_id = None
+
+            title = entry.title
+
+            content = entry.get("content", None)
+            if content:
+                content = content[0].value
+            else:
+                content = entry.get("description", None)
+
+            # Consider using dateutil.parser.parse(entry.get("published"))
+            # http://www.deadlybloodyserious.com/2007/09/feedparser-v-django/
+            date_published = entry.get("published_parsed", entry.get("updated_parsed"))
+            if isinstance(date_published, struct_time):
+                date_published = utcfromtimestamp(mktime(date_published))
+            else:
+                date_published = now
+
+            tags = entry.get("tags", None)
+            if tags:
+                tags = [t.term.encode("utf-8") for t in tags]
+
+            location = False
+            lat = entry.get("geo_lat", None)
+            lon = entry.get("geo_long", None)
+            if lat is None or lon is None:
+                # Try GeoRSS
+                georss = entry.get("georss_point", None)
+                if georss:
+                    location = True
+                    lat, lon = georss.split(" ")
+            else:
+                location = True
+            if location:
+                key = (lat, lon)
+                if key in locations:
+                    location_id = locations[key]
+                else:
+                    try:
+                        query = (gtable.lat == lat) &\
+                                (gtable.lon == lon)
+                        row = db(query).select(gtable.id,
+                                               limitby=(0, 1),
+                                               orderby=gtable.level,
+                                               ).first()
+                        if row:
+                            location_id = row.id
+                        else:
+                            data = dict(lat=lat,
+                                        lon=lon,
+                                        )
+                            results = geocode_r(lat, lon)
+                            if isinstance(results, dict):
+                                for level in hierarchy_level_keys:
+                                    v = results.get(level, None)
+                                    if v:
+                                        data[level] = v
+                            location_id = ginsert(**data)
+                            data["id"] = location_id
+                            gis.update_location_tree(data)
+                        locations[key] = location_id
+                    except:
+                        # Don't die on badly-formed Geo
+                        pass
+
+            data = dict(channel_id = channel_id,
+                        title = title,
+                        from_address = link,
+                        link_hash = S3MsgPoller.link_hash(link) if link else None,
+                        body = content,
+                        author = entry.get("author", None),
+                        date = date_published,
+                        location_id = location_id,
+                        tags = tags,
+                        # @ToDo: Enclosures
+                        )
+            if exists:
+                db(mtable.id == exists.id).update(**data)
+                message_id = exists.message_id
+            else:
+                id = minsert(**data)
+                record = dict(id=id)
+                update_super(mtable, record)
+                message_id = record["message_id"]
+                if link:
+                    existing[link] = Storage(id = id,
+                                             location_id = location_id,
+                                             message_id = message_id,
+                                             )
+                new += 1
+            if parser:
+                pinsert(message_id = message_id,
+                        channel_id = channel_id)
+
+        if not new:
+            # No new posts?
+            # Back-off in-case the site isn't respecting ETags/Last-Modified
+            S3Msg.update_channel_status(channel_id,
+                                        status="+1",
+                                        period=(300, 3600))
+
+        return len(entries), new, None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def link_hash(link):
+        """
+            Hash of a link for duplicate checks
+
+            @param link: the link (URL)
+        """
+
+        return hashlib.sha1(s3_unicode(link).encode("utf-8")).hexdigest()
+
+    # -------------------------------------------------------------------------
+    # Email
+    # -------------------------------------------------------------------------
+    @classmethod
+    def fetch_email(cls, channel):
+        """
+            Fetch the messages from a mailbox (runs in a worker thread)
+
+            @param channel: the msg_email_channel data
+
+            @return: Storage with the messages, the connection to the
+                     server (to be closed by finish_email), and the
+                     numbers or UIDs of the messages to delete from the
+                     server once they have been stored
+        """
+
+        host = channel.server
+        username = channel.username
+        password = channel.password
+        port = int(channel.port)
+        ssl = channel.use_ssl
+
+        messages = []
+        delete = [] if channel.delete_from_server else None
+        result = Storage(messages = messages,
+                         protocol = channel.protocol,
+                         delete = delete,
+                         )
+
+        if channel.protocol == "pop3":
+            import poplib
+            # http://docs.python.org/library/poplib.html
+            try:
+                if ssl:
+                    p = poplib.POP3_SSL(host, port)
+                else:
+                    p = poplib.POP3(host, port)
+            except socket.error, e:
+                result.error = "Cannot connect: %s" % e
+                return result
+
+            try:
+                # Attempting APOP authentication...
+                p.apop(username, password)
+            except poplib.error_proto:
+                # Attempting standard authentication...
+                try:
+                    p.user(username)
+                    p.pass_(password)
+                except poplib.error_proto, e:
+                    result.error = "Login failed: %s" % e
+                    return result
+
+            result.connection = p
+            mblist = p.list()[1]
+            for item in mblist:
+                number, octets = item.split(" ")
+                # Retrieve the message (storing it in a list of lines)
+                lines = p.retr(number)[1]
+                messages.append("\n".join(lines))
+                if delete is not None:
+                    delete.append(number)
+
+        elif channel.protocol == "imap":
+            import imaplib
+            # http://docs.python.org/library/imaplib.html
+            try:
+                if ssl:
+                    M = imaplib.IMAP4_SSL(host, port)
+                else:
+                    M = imaplib.IMAP4(host, port)
+            except socket.error, e:
+                result.error = "Cannot connect: %s" % e
+                return result
+
+            try:
+                M.login(username, password)
+            except M.error, e:
+                result.error = "Login failed: %s" % e
+                return result
+
+            result.connection = M
+
+            # Select inbox
+            M.select()
+
+            # Only fetch messages which are newer than the last fetched
+            # one (as long as the UIDs are valid)
+            try:
+                uidvalidity = int(M.response("UIDVALIDITY")[1][0])
+            except (TypeError, ValueError, IndexError):
+                uidvalidity = None
+            last_uid = 0
+            if uidvalidity and uidvalidity == channel.uidvalidity:
+                last_uid = channel.last_uid or 0
+            typ, data = M.uid("search", None, "UID %s:*" % (last_uid + 1))
+            uids = [int(uid) for uid in data[0].split() if int(uid) > last_uid]
+
+            if uids:
+                # Get the sizes first
+                sizes = {}
+                typ, data = M.uid("fetch",
+                                  ",".join([str(uid) for uid in uids]),
+                                  "(UID RFC822.SIZE)")
+                for response_part in data:
+                    if isinstance(response_part, tuple):
+                        response_part = response_part[0]
+                    uid = cls.IMAP_UID.search(response_part or "")
+                    size = cls.IMAP_SIZE.search(response_part or "")
+                    if uid and size:
+                        sizes[int(uid.group(1))] = int(size.group(1))
+
+                # Fetch the messages in chunks
+                chunks = []
+                chunk = []
+                chunk_size = 0
+                for uid in uids:
+                    size = sizes.get(uid, 0)
+                    if chunk and (len(chunk) >= cls.IMAP_CHUNK or \
+                                  chunk_size + size > cls.IMAP_CHUNK_SIZE):
+                        chunks.append(chunk)
+                        chunk = []
+                        chunk_size = 0
+                    chunk.append(str(uid))
+                    chunk_size += size
+                if chunk:
+                    chunks.append(chunk)
+                for chunk in chunks:
+                    typ, data = M.uid("fetch", ",".join(chunk), "(UID BODY.PEEK[])")
+                    for response_part in data:
+                        if isinstance(response_part, tuple):
+                            messages.append(response_part[1])
+
+                if delete is not None:
+                    delete.extend(uids)
+
+                last_uid = uids[-1]
+
+            result.last_uid = last_uid
+            result.uidvalidity = uidvalidity
+
+        return result
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def finish_email(channel, result, stored):
+        """
+            Delete the fetched messages from the server (if so configured
+            and the messages have been stored and committed), and close
+            the connection
+
+            @param channel: the msg_email_channel data
+            @param result: the result of fetch_email
+            @param stored: whether the messages have been stored
+        """
+
+        connection = result.connection
+        if not connection:
+            return
+        delete = result.delete if stored else None
+
+        if result.protocol == "pop3":
+            if delete:
+                for number in delete:
+                    connection.dele(number)
+            # Deletions take effect when quitting the session
+            connection.quit()
+        else:
+            if delete:
+                connection.uid("store",
+                               ",".join([str(uid) for uid in delete]),
+                               "+FLAGS",
+                               r"(\Deleted)")
+                connection.expunge()
+            connection.close()
+            connection.logout()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def store_email(channel, result):
+        """
+            Store the messages fetched from a mailbox
+
+            @param channel: the msg_email_channel data
+            @param result: the result of fetch_email
+
+            @return: tuple (items, new, error)
+        """
+
+        channel_id = channel.channel_id
+
+        messages = result.messages
+        if messages:
+            S3MsgPoller.store_messages(channel_id, messages)
+
+        # Only fetch messages newer than these from now on (NB must be
+        # updated after all messages have been stored)
+        if result.uidvalidity is not None:
+            table = current.s3db.msg_email_channel
+            query = (table.channel_id == channel_id)
+            current.db(query).update(last_uid = result.last_uid,
+                                     uidvalidity = result.uidvalidity,
+                                     )
+
+        return len(messages), len(messages), None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def store_messages(channel_id, messages):
+        """
+            Store raw email messages
+
+            @param channel_id: the msg_email_channel ID
+            @param messages: the raw messages
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        import email
+
+        from dateutil import parser
+        date_parse = parser.parse
+
+        mtable = db.msg_email
+        minsert = mtable.insert
+        atable = s3db.msg_attachment
+        ainsert = atable.insert
+        dtable = db.doc_document
+        dinsert = dtable.insert
+        store = dtable.file.store
+        update_super = s3db.update_super
+        # Is this channel connected to a parser?
+        parser = s3db.msg_parser_enabled(channel_id)
+        if parser:
+            ptable = db.msg_parsing_status
+            pinsert = ptable.insert
+
+        for message in messages:
+            # Create a Message object
+            msg = email.message_from_string(message)
+            # Parse the Headers
+            sender = msg["from"]
+            subject = msg.get("subject", "")
+            date_sent = msg.get("date", None)
+            # Store the whole raw message
+            raw = msg.as_string()
+            # Parse out the 'Body'
+            # Look for Attachments
+            attachments = []
+            # http://docs.python.org/2/library/email-examples.html
+            body = ""
+            for part in msg.walk():
+                if part.get_content_maintype() == "multipart":
+                    # multipart/* are just containers
+                    continue
+                filename = part.get_filename()
+                if not filename:
+                    # Assume this is the Message Body (plain text or HTML)
+                    if not body:
+                        # Plain text will come first
+                        body = part.get_payload(decode=True)
+                    continue
+                attachments.append((filename, part.get_payload(decode=True)))
+
+            # Store in DB
+            data = dict(channel_id=channel_id,
+                        from_address=sender,
+                        subject=subject[:78],
+                        body=body,
+                        raw=raw,
+                        inbound=True,
+                        )
+            if date_sent:
+                data["date"] = date_parse(date_sent)
+            id = minsert(**data)
+            record = dict(id=id)
+            update_super(mtable, record)
+            message_id = record["message_id"]
+            for a in attachments:
+                # Linux ext2/3 max filename length = 255
+                # b16encode doubles length & need to leave room for doc_document.file.16charsuuid.
+                # store doesn't support unicode, so need an ascii string
+                filename = s3_unicode(a[0][:92]).encode("ascii", "ignore")
+                fp = StringIO()
+                fp.write(a[1])
+                fp.seek(0)
+                newfilename = store(fp, filename)
+                fp.close()
+                document_id = dinsert(name=filename,
+                                      file=newfilename)
+                update_super(dtable, dict(id=document_id))
+                ainsert(message_id=message_id,
+                        document_id=document_id)
+            if parser:
+                pinsert(message_id=message_id,
+                        channel_id=channel_id)
+
+# =============================================================================
+class S3KeyGraph(object):
+    """
+        Incremental keyword co-occurrence graph (KeyGraph) of inbound
+        messages, with topic clustering
+
+        Messages are tokenized in batches, and the term and co-occurrence
+        counts are updated with every new batch, so that only messages
+        which have arrived since the last update need to be processed.
+        Topics are the connected components of the graph of the most
+        frequent terms, linked by their strongest associations.
+    """
+
+    # Regular expressions for tokenization
+    URL = re.compile(r"(www\.[^\s]+)|(https?://[^\s]+)")
+    MENTION = re.compile(r"@[^\s]+")
+    HASHTAG = re.compile(r"#(\w+)", re.UNICODE)
+    WORD = re.compile(r"\w+", re.UNICODE)
+
+    STOPWORDS = frozenset((
+        "a", "about", "after", "all", "also", "am", "an", "and", "any", "are",
+        "as", "at", "be", "because", "been", "before", "being", "but", "by",
+        "can", "could", "did", "do", "does", "for", "from", "get", "got",
+        "had", "has", "have", "he", "her", "here", "him", "his", "how", "if",
+        "in", "into", "is", "it", "its", "just", "me", "more", "my", "no",
+        "not", "now", "of", "on", "one", "or", "our", "out", "rt", "she",
+        "so", "some", "than", "that", "the", "their", "them", "then",
+        "there", "these", "they", "this", "to", "too", "up", "us", "via",
+        "was", "we", "were", "what", "when", "where", "which", "who",
+        "will", "with", "would", "you", "your",
+        ))
+
+    # Number of messages to process at a time
+    BATCH_SIZE = 500
+
+    # Maximum number of terms per message
+    MAX_DOCUMENT_TERMS = 50
+
+    # Maximum size of the graph (low-frequency pairs are pruned beyond)
+    MAX_EDGES = 100000
+
+    # Topic clustering parameters
+    NODES = 50
+    MIN_COUNT = 2
+    MIN_ASSOCIATION = 0.1
+
+    # Maximum number of hashtag definitions to look up per batch
+    MAX_TAGDEFS = 10
+
+    # Number of days after which to retry hashtags without definition
+    TAGDEF_RETRY = 7
+
+    # -------------------------------------------------------------------------
+    def __init__(self, search_id=None):
+        """
+            Constructor
+
+            @param search_id: msg_twitter_search record ID to build the
+                              graph from its results, None to build it
+                              from all inbound messages
+        """
+
+        self.search_id = search_id
+
+    # -------------------------------------------------------------------------
+    def update(self):
+        """
+            Add all messages which have arrived since the last update
+            to the graph, and re-compute the topics
+
+            @return: the number of messages added
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        record = self.record()
+        keygraph_id = record.id
+
+        search_id = self.search_id
+        if search_id:
+            table = s3db.msg_twitter_result
+            query = (table.search_id == search_id)
+        else:
+            table = s3db.msg_message
+            query = (table.inbound == True)
+        query &= (table.deleted != True)
+
+        last_id = record.last_id or 0
+        documents = record.documents or 0
+        added = 0
+        limit = self.MAX_DOCUMENT_TERMS
+        while True:
+            rows = db(query & (table.id > last_id)).select(table.id,
+                                                           table.body,
+                                                           orderby = table.id,
+                                                           limitby = (0, self.BATCH_SIZE),
+                                                           )
+            if not rows:
+                break
+            last_id = rows.last().id
+            added += len(rows)
+
+            # Count the terms and pairs in this batch
+            terms = {}
+            edges = {}
+            for words in self.tokenize([row.body for row in rows]):
+                words = sorted(words[:limit])
+                for index, word in enumerate(words):
+                    terms[(word,)] = terms.get((word,), 0) + 1
+                    for other in words[index + 1:]:
+                        key = (word, other)
+                        edges[key] = edges.get(key, 0) + 1
+
+            # Add them to the graph
+            self.add_counts(s3db.msg_keygraph_term, keygraph_id,
+                            ("term",), terms)
+            self.add_counts(s3db.msg_keygraph_edge, keygraph_id,
+                            ("term1", "term2"), edges)
+            self.prune(keygraph_id)
+
+            # Commit the batch, so that an interrupted update (e.g. by
+            # the task timeout) can continue from here
+            documents += len(rows)
+            record.update_record(last_id = last_id,
+                                 documents = documents,
+                                 )
+            db.commit()
+
+        if not added and record.topics is not None:
+            return 0
+
+        topics = self.topics(*self.nodes(keygraph_id))
+        record.update_record(topics = json.dumps(topics, separators=SEPARATORS),
+                             updated_on = current.request.utcnow,
+                             )
+        return added
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def add_counts(table, keygraph_id, fields, counts):
+        """
+            Add term or pair counts to the graph
+
+            @param table: msg_keygraph_term or msg_keygraph_edge
+            @param keygraph_id: the msg_keygraph record ID
+            @param fields: tuple of the names of the key fields
+            @param counts: the counts {(value, ...): count}
+        """
+
+        if not counts:
+            return
+
+        db = current.db
+
+        # Find the existing rows
+        query = (table.keygraph_id == keygraph_id)
+        for index, fn in enumerate(fields):
+            query &= (table[fn].belongs(set(key[index] for key in counts)))
+        rows = db(query).select(table.id, *[table[fn] for fn in fields])
+        existing = dict((tuple(s3_unicode(row[fn]) for fn in fields), row.id)
+                        for row in rows)
+
+        # Update the existing rows with one query per increment,
+        # and insert the new ones all at once
+        increments = {}
+        entries = []
+        for key, count in counts.iteritems():
+            record_id = existing.get(key)
+            if record_id:
+                increments.setdefault(count, []).append(record_id)
+            else:
+                entry = dict(zip(fields, key))
+                entry["keygraph_id"] = keygraph_id
+                entry["count"] = count
+                entries.append(entry)
+        for count, record_ids in increments.iteritems():
+            db(table.id.belongs(record_ids)).update(count = table.count + count)
+        if entries:
+            table.bulk_insert(entries)
+
+    # -------------------------------------------------------------------------
+    def nodes(self, keygraph_id):
+        """
+            Get the counts of the most frequent terms and their pairs
+
+            @param keygraph_id: the msg_keygraph record ID
+
+            @return: tuple (terms, edges), see topics()
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        min_count = self.MIN_COUNT
+
+        table = s3db.msg_keygraph_term
+        query = (table.keygraph_id == keygraph_id) & \
+                (table.count >= min_count)
+        rows = db(query).select(table.term,
+                                table.count,
+                                orderby = ~table.count|table.term,
+                                limitby = (0, self.NODES),
+                                )
+        terms = dict((s3_unicode(row.term), row.count) for row in rows)
+
+        edges = {}
+        if terms:
+            table = s3db.msg_keygraph_edge
+            query = (table.keygraph_id == keygraph_id) & \
+                    (table.term1.belongs(terms.keys())) & \
+                    (table.term2.belongs(terms.keys())) & \
+                    (table.count >= min_count)
+            rows = db(query).select(table.term1, table.term2, table.count)
+            for row in rows:
+                key = "%s %s" % (s3_unicode(row.term1), s3_unicode(row.term2))
+                edges[key] = row.count
+
+        return terms, edges
+
+    # -------------------------------------------------------------------------
+    def record(self):
+        """
+            Get (or create) the msg_keygraph record for this graph
+        """
+
+        table = current.s3db.msg_keygraph
+        query = (table.search_id == self.search_id)
+        record = current.db(query).select(table.ALL,
+                                          limitby = (0, 1),
+                                          ).first()
+        if not record:
+            record_id = table.insert(search_id = self.search_id)
+            record = table[record_id]
+        return record
+
+    # -------------------------------------------------------------------------
+    def get_topics(self):
+        """
+            The topics as of the last update
+
+            @return: list of topics (see topics())
+        """
+
+        table = current.s3db.msg_keygraph
+        query = (table.search_id == self.search_id)
+        record = current.db(query).select(table.topics,
+                                          limitby = (0, 1),
+                                          ).first()
+        if record and record.topics:
+            return json.loads(record.topics)
+        return []
+
+    # -------------------------------------------------------------------------
+    def tokenize(self, texts):
+        """
+            Tokenize a batch of messages: remove URLs and mentions, replace
+            hashtags by their definitions and remove stop words
+
+            @param texts: list of message texts
+
+            @return: list of lists of unique terms, in order of appearance
+        """
+
+        hashtag = self.HASHTAG
+        url = self.URL
+        mention = self.MENTION
+
+        texts = [mention.sub(" ", url.sub(" ", s3_unicode(text or "").lower()))
+                 for text in texts]
+
+        # Look up the definitions of all hashtags in the batch at once
+        tags = set()
+        for text in texts:
+            tags.update(hashtag.findall(text))
+        definitions = self.tagdefs(tags) if tags else {}
+
+        def replace(match):
+            tag = match.group(1)
+            return " %s %s " % (tag, (definitions.get(tag) or "").lower())
+
+        words = self.WORD.findall
+        stopwords = self.STOPWORDS
+        documents = []
+        for text in texts:
+            seen = set()
+            terms = []
+            for word in words(hashtag.sub(replace, text)):
+                if len(word) < 3 or len(word) > 128 or word.isdigit() or \
+                   word in stopwords or word in seen:
+                    continue
+                seen.add(word)
+                terms.append(word)
+            documents.append(terms)
+        return documents
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tagdefs(cls, tags):
+        """
+            Get the definitions of hashtags, from the cache where possible
+
+            @param tags: the hashtags (without #)
+
+            @return: dict {tag: definition}
+        """
+
+        db = current.db
+        table = current.s3db.msg_hashtag
+
+        now = current.request.utcnow
+        expired = now - datetime.timedelta(days=cls.TAGDEF_RETRY)
+
+        tags = set([s3_unicode(tag).lower()[:128] for tag in tags])
+        query = (table.tag.belongs(tags))
+        rows = db(query).select(table.id,
+                                table.tag,
+                                table.definition,
+                                table.retrieved_on,
+                                )
+        definitions = {}
+        retry = {}
+        for row in rows:
+            tag = s3_unicode(row.tag)
+            if row.definition is None and \
+               (row.retrieved_on is None or row.retrieved_on < expired):
+                # Not found last time: try again
+                retry[tag] = row.id
+            else:
+                definitions[tag] = row.definition
+
+        missing = sorted([tag for tag in tags if tag not in definitions])
+        if missing and current.deployment_settings.get_msg_hashtag_definitions():
+            lookup = S3Msg.tagdef_lookup
+            entries = []
+            for tag in missing[:cls.MAX_TAGDEFS]:
+                definition = lookup(tag)
+                definitions[tag] = definition
+                record_id = retry.get(tag)
+                if record_id:
+                    db(table.id == record_id).update(definition = definition,
+                                                     retrieved_on = now,
+                                                     )
+                else:
+                    entries.append({"tag": tag,
+                                    "definition": definition,
+                                    "retrieved_on": now,
+                                    })
+            if entries:
+                table.bulk_insert(entries)
+        return definitions
+
+    # -------------------------------------------------------------------------
+    def prune(self, keygraph_id):
+        """
+            Remove the least frequent pairs (and terms only occuring in
+            such pairs) when the graph exceeds its maximum size
+
+            @param keygraph_id: the msg_keygraph record ID
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        etable = s3db.msg_keygraph_edge
+        query = (etable.keygraph_id == keygraph_id)
+        if db(query).count() <= self.MAX_EDGES:
+            return
+
+        threshold = 1
+        while db(query).count() > self.MAX_EDGES / 2:
+            db(query & (etable.count <= threshold)).delete()
+            threshold += 1
+
+        ttable = s3db.msg_keygraph_term
+        linked1 = db(query)._select(etable.term1)
+        linked2 = db(query)._select(etable.term2)
+        query = (ttable.keygraph_id == keygraph_id) & \
+                (ttable.count < threshold) & \
+                (~(ttable.term.belongs(linked1))) & \
+                (~(ttable.term.belongs(linked2)))
+        db(query).delete()
+
+    # -------------------------------------------------------------------------
+    def topics(self, terms, edges):
+        """
+            Cluster the most frequent terms into topics
+
+            @param terms: the term counts {term: count}
+            @param edges: the pair counts {"term1 term2": count}
+
+            @return: list of topics [{"terms": [term, ...],
+                                      "edges": [[term1, term2, count], ...],
+                                      "weight": count}]
+                     ordered by weight
+        """
+
+        min_count = self.MIN_COUNT
+
+        # Most frequent terms
+        nodes = sorted([t for t, v in terms.iteritems() if v >= min_count],
+                       key = lambda t: (-terms[t], t))[:self.NODES]
+        nodes = set(nodes)
+
+        # Strong associations between them
+        parent = dict((node, node) for node in nodes)
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        links = []
+        for key, count in edges.iteritems():
+            if count < min_count:
+                continue
+            term1, term2 = key.split(" ")
+            if term1 not in nodes or term2 not in nodes:
+                continue
+            # Jaccard coefficient
+            association = float(count) / (terms[term1] + terms[term2] - count)
+            if association < self.MIN_ASSOCIATION:
+                continue
+            links.append([term1, term2, count])
+            parent[find(term1)] = find(term2)
+
+        # Connected components
+        clusters = {}
+        for node in nodes:
+            clusters.setdefault(find(node), []).append(node)
+        topics = {}
+        for link in links:
+            topics.setdefault(find(link[0]), []).append(link)
+
+        results = []
+        for root, links in topics.items():
+            cluster = sorted(clusters[root], key = lambda t: (-terms[t], t))
+            results.append({"terms": cluster,
+                            "edges": sorted(links, key = lambda l: -l[2]),
+                            "weight": sum([terms[t] for t in cluster]),
+                            })
+        results.sort(key = lambda topic: -topic["weight"])
+        return results
+
+# =============================================================================
+class S3MsgDispatcher(object):
+    """
+        Concurrent dispatcher for outbound messages
+
+        Sends a batch of messages through a pool of worker threads, each
+        keeping its own persistent connection to the gateway, optionally
+        throttled to a maximum number of messages per second.
+
+        NB send functions run outside of the request environment, and
+        therefore must not access current or the database
+    """
+
+    def __init__(self, gateway, send, workers=1, rate=None, close=None):
+        """
+            Constructor
+
+            @param gateway: the gateway name (for statistics)
+            @param send: the send function send(local, message), returning
+                         a tuple (status, info)
+            @param workers: the maximum number of worker threads
+            @param rate: the maximum number of messages per second
+            @param close: function close(local) to close the connections
+                          of a worker thread
+        """
+
+        self.gateway = gateway
+        self.send = send
+        self.workers = max(1, workers or 1)
+        self.rate = rate
+        self.close = close
+
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    # -------------------------------------------------------------------------
+    def run(self, messages):
+        """
+            Send messages
+
+            @param messages: list of tuples (key, message)
+
+            @return: tuple (results, stats), with results being a dict
+                     {key: (status, info)}
+        """
+
+        start = time.time()
+
+        queue = Queue.Queue()
+        for item in messages:
+            queue.put(item)
+
+        results = {}
+        workers = min(self.workers, len(messages))
+        if workers > 1:
+            threads = [threading.Thread(target=self._worker,
+                                        args=(queue, results))
+                       for i in xrange(workers)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elif workers:
+            self._worker(queue, results)
+
+        seconds = time.time() - start
+        sent_ids = [key for key, (status, info) in results.items() if status]
+        sent = len(sent_ids)
+        stats = Storage(gateway = self.gateway,
+                        sent = sent,
+                        failed = len(messages) - sent,
+                        seconds = seconds,
+                        rate = sent / seconds if seconds else 0.0,
+                        sent_ids = sent_ids,
+                        )
+        return results, stats
+
+    # -------------------------------------------------------------------------
+    def _worker(self, queue, results):
+        """
+            Worker thread: send messages until the queue is empty
+
+            @param queue: the message queue
+            @param results: the results dict
+        """
+
+        local = Storage()
+        send = self.send
+        try:
+            while True:
+                try:
+                    key, message = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                self._throttle()
+                try:
+                    result = send(local, message)
+                except Exception, e:
+                    result = (False, str(e))
+                results[key] = result
+        finally:
+            if self.close:
+                try:
+                    self.close(local)
+                except Exception:
+                    pass
+
+    # -------------------------------------------------------------------------
+    def _throttle(self):
+        """
+            Wait for the next send slot if the rate is limited
+        """
+
+        rate = self.rate
+        if not rate:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0 / rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def smtp(config):
+        """
+            Send function for an SMTP server
+
+            @param config: the server configuration, Storage(host, port,
+                           login, tls, ssl, sender)
+        """
+
+        def connect(local):
+            if config.ssl:
+                server = smtplib.SMTP_SSL(config.host, config.port, timeout=30)
+            else:
+                server = smtplib.SMTP(config.host, config.port, timeout=30)
+            if config.tls:
+                server.ehlo()
+                server.starttls()
+                server.ehlo()
+            if config.login:
+                username, password = config.login.split(":", 1)
+                server.login(username, password)
+            local.smtp = server
+            return server
+
+        sender = config.sender
+
+        def send(local, message):
+            body = s3_unicode(message.body)
+            # Same convention as gluon.tools.Mail: a body which is an
+            # HTML document is sent as text/html
+            stripped = body.strip().lower()
+            if stripped.startswith("<html") and stripped.endswith("</html>"):
+                subtype = "html"
+            else:
+                subtype = "plain"
+            msg = MIMEText(body.encode("utf-8"), subtype, "utf-8")
+            msg["Subject"] = Header(s3_unicode(message.subject or ""), "utf-8")
+            msg["From"] = sender
+            msg["To"] = message.to
+            data = msg.as_string()
+
+            # Retry once with a new connection if the server
+            # has closed the previous one
+            server = local.smtp
+            if server:
+                try:
+                    server.sendmail(sender, [message.to], data)
+                    return True, None
+                except smtplib.SMTPServerDisconnected:
+                    local.smtp = None
+            connect(local).sendmail(sender, [message.to], data)
+            return True, None
+
+        return send
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def smtp_close(local):
+        """
+            Close the SMTP connection of a worker thread
+
+            @param local: the thread-local storage
+        """
+
+        server = local.smtp
+        if server:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            local.smtp = None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def http_close(local):
+        """
+            Close the HTTP connection of a worker thread
+
+            @param local: the thread-local storage
+        """
+
+        conn = local.http
+        if conn:
+            conn.close()
+            local.http = None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def webapi(sms_api, sanitise):
+        """
+            Send function for an SMS Web API, using keep-alive connections
+
+            @param sms_api: the msg_sms_webapi_channel Row
+            @param sanitise: function to sanitise phone numbers
+        """
+
+        url = sms_api.url
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme == "https":
+            connection = httplib.HTTPSConnection
+        else:
+            connection = httplib.HTTPConnection
+        host = parsed.netloc
+        path = parsed.path or "/"
+        if parsed.query:
+            path = "%s?%s" % (path, parsed.query)
+
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if sms_api.username and sms_api.password:
+            # e.g. Mobile Commons
+            base64string = base64.encodestring("%s:%s" % (sms_api.username, sms_api.password)).replace("\n", "")
+            headers["Authorization"] = "Basic %s" % base64string
+
+        def post(conn, body):
+            conn.request("POST", path, body, headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+
+        def send(local, message):
+            post_data = S3Msg._sms_api_data(sms_api,
+                                            sanitise(message.to),
+                                            message.body)
+            if post_data is None:
+                return False, "Clickatell messages cannot exceed 480 chars"
+            body = urllib.urlencode(post_data)
+
+            # Retry once with a new connection if the server
+            # has closed the kept-alive one
+            conn = local.http
+            result = None
+            if conn:
+                try:
+                    result = post(conn, body)
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    local.http = None
+            if result is None:
+                conn = local.http = connection(host, timeout=30)
+                try:
+                    result = post(conn, body)
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    local.http = None
+                    raise
+
+            status, output = result
+            if status >= 400:
+                return False, "HTTP Error %s" % status
+            return S3Msg._sms_api_result(url, output)
+
+        return send
 
 # =============================================================================
 class S3Compose(S3CRUD):
@@ -35,6 +35,7 @@ __all__ = ["S3Parsing"]
 import sys
 
 from gluon import current
+from gluon.storage import Storage
 
 # =============================================================================
 class S3Parsing(object):
@@ -43,43 +44,41 @@ class S3Parsing(object):
        - reusable functions
     """
 
+    # Contacts of the senders in the current batch, prefetched by
+    # parse_batch() for lookup_person/lookup_human_resource
+    contacts = None
+
     # -------------------------------------------------------------------------
     @staticmethod
     def parser(function_name, message_id, **kwargs):
         """
-           1st Stage Parser
-           - called by msg.parse()
+           1st Stage Parser for a single message
+           - batches are parsed by parse_batch()
 
            Sets the appropriate Authorisation level and then calls the
            parser function from the template
         """
 
-        reply = None
-        s3db = current.s3db
-
         # Retrieve Message
-        table = s3db.msg_message
+        table = current.s3db.msg_message
         message = current.db(table.message_id == message_id).select(limitby=(0, 1)
                                                                     ).first()
 
-        from_address = message.from_address
-        if "<" in from_address:
-            from_address = from_address.split("<")[1].split(">")[0]
-        email = S3Parsing.is_session_alive(from_address)
-        if email:
-            current.auth.s3_impersonate(email)
-        else:
-            (email, password) = S3Parsing.parse_login(message)
-            if email and password:
-                current.auth.login_bare(email, password)
-                expiration = current.session.auth["expiration"]
-                table = s3db.msg_session
-                table.insert(email = email,
-                             expiration_time = expiration,
-                             from_address = from_address)
-                reply = "Login succesful"
-                # The message may have multiple purposes
-                #return reply
+        fn = S3Parsing.parser_function(function_name)
+        if fn is None:
+            return None
+        return S3Parsing.parse_message(fn, message, **kwargs)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def parser_function(function_name):
+        """
+            Get a parser function from the template for this deployment
+
+            @param function_name: the name of the parser function
+
+            @return: the function, or None if not found
+        """
 
         # Load the Parser template for this deployment
         template = current.deployment_settings.get_msg_parser()
@@ -89,19 +88,335 @@ class S3Parsing(object):
         mymodule = sys.modules[module_name]
         S3Parser = mymodule.S3Parser()
 
-        # Pass the message to the parser
         try:
             fn = getattr(S3Parser, function_name)
         except:
             current.log.error("Parser not found: %s" % function_name)
             return None
+        return fn
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def parse_message(fn, message, session=None, **kwargs):
+        """
+            Pass a message to a parser function and send the reply
+
+            @param fn: the parser function
+            @param message: the msg_message Row
+            @param session: the email of the sender's login session (if
+                            already known), False if the sender has no
+                            alive session
+        """
+
+        reply = None
+
+        from_address = S3Parsing.sender(message.from_address)
+        if session is None:
+            session = S3Parsing.is_session_alive(from_address)
+        if session:
+            current.auth.s3_impersonate(session)
+        else:
+            (email, password) = S3Parsing.parse_login(message)
+            if email and password:
+                current.auth.login_bare(email, password)
+                expiration = current.session.auth["expiration"]
+                table = current.s3db.msg_session
+                table.insert(email = email,
+                             expiration_time = expiration,
+                             from_address = from_address)
+                reply = "Login succesful"
+                # The message may have multiple purposes
+                #return reply
+
+        # Pass the message to the parser
         reply = fn(message, **kwargs) or reply
         if not reply:
             return None
 
         # Send Reply
-        current.msg.send(from_address, reply)
+        return current.msg.send(from_address, reply)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def parse_batch(channel_id, function_name, batch_size=None):
+        """
+            Parse all unparsed messages from a channel, in batches
+            - called by msg.parse()
+
+            Each batch of messages is read with one query, the contacts and
+            login sessions of all senders in the batch are prefetched, and
+            the parsing status is written in bulk, so that the cost per
+            message is essentially that of the parser function.
+
+            If the parser fails for any message of a batch, the batch is
+            rolled back and parsed again one message at a time, so that
+            the writes of the failed parser can be rolled back separately;
+            failed messages are marked with the parse_error rather than
+            as parsed.
+
+            @param channel_id: the channel ID
+            @param function_name: the name of the parser function
+            @param batch_size: the number of messages per batch
+
+            @return: the number of messages parsed
+        """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        fn = S3Parsing.parser_function(function_name)
+        if fn is None:
+            return 0
+
+        if batch_size is None:
+            batch_size = current.deployment_settings.get_msg_parser_batch_size()
+
+        user_id = auth.user.id if auth.user else None
+
+        stable = s3db.msg_parsing_status
+        mtable = s3db.msg_message
+        query = (stable.channel_id == channel_id) & \
+                (stable.is_parsed == False) & \
+                (stable.parse_error == None) & \
+                (stable.deleted != True)
+
+        parse = S3Parsing.parse_rows
+
+        total = 0
+        last = 0
+        while True:
+            # Claim the next batch
+            rows = db(query & (stable.id > last)).select(stable.id,
+                                                         stable.message_id,
+                                                         orderby = stable.id,
+                                                         limitby = (0, batch_size),
+                                                         )
+            if not rows:
+                break
+            last = rows.last().id
+
+            # Retrieve all messages in the batch
+            message_ids = [row.message_id for row in rows]
+            messages = db(mtable.message_id.belongs(message_ids)).select()
+            messages = dict((message.message_id, message) for message in messages)
+
+            # Prefetch sessions and contacts of all senders
+            senders = set([S3Parsing.sender(message.from_address)
+                           for message in messages.values()
+                           if message.from_address])
+            sessions = S3Parsing.alive_sessions(senders)
+            S3Parsing.contacts = S3Parsing.prefetch_contacts(senders)
+
+            try:
+                # NB parse_rows adds the sessions of senders logging in,
+                #    so pass a copy to be able to start over after rollback
+                replies, errors = parse(fn, rows, messages, dict(sessions),
+                                        user_id)
+                if errors:
+                    # Roll back and parse the batch message by message
+                    db.rollback()
+                    replies, errors = parse(fn, rows, messages, dict(sessions),
+                                            user_id,
+                                            commit = True,
+                                            )
+            finally:
+                S3Parsing.contacts = None
+
+            if not errors:
+                # Update to show that we've parsed the messages & provide a
+                # link to the replies
+                status_ids = [row.id for row in rows]
+                db(stable.id.belongs(status_ids)).update(is_parsed = True)
+                for status_id, reply_id in replies.items():
+                    db(stable.id == status_id).update(reply_id = reply_id)
+                db.commit()
+
+            total += len(rows) - len(errors)
+
+        return total
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def parse_rows(fn, rows, messages, sessions, user_id, commit=False):
+        """
+            Parse the messages of a batch
+            - called by parse_batch()
+
+            @param fn: the parser function
+            @param rows: the msg_parsing_status rows of the batch
+            @param messages: the messages {message_id: Row}
+            @param sessions: the alive login sessions {sender: email},
+                             updated with the sessions of senders who
+                             log in with a message of the batch
+            @param user_id: the user to restore after each message
+            @param commit: commit after each message (or roll back if the
+                           parser fails), and update its parsing status
+
+            @return: tuple (replies, errors) with replies being a dict
+                     {status_id: reply_id} and errors a dict
+                     {status_id: error message}
+        """
+
+        db = current.db
+        auth = current.auth
+        stable = current.s3db.msg_parsing_status
+
+        replies = {}
+        errors = {}
+        for row in rows:
+            status_id = row.id
+            reply_id = None
+            message = messages.get(row.message_id)
+            if message and message.from_address:
+                sender = S3Parsing.sender(message.from_address)
+                session = sessions.get(sender, False)
+                try:
+                    reply_id = S3Parsing.parse_message(fn, message,
+                                                       session = session,
+                                                       )
+                except Exception:
+                    error = sys.exc_info()[1]
+                    current.log.error("Parsing message %s failed: %s" % \
+                                      (row.message_id, error))
+                    errors[status_id] = str(error) or error.__class__.__name__
+                if not session and status_id not in errors and \
+                   auth.user is not None and auth.user.id != user_id:
+                    email = S3Parsing.parse_login(message)[0]
+                    if email:
+                        # Sender has logged in => subsequent messages of
+                        # the batch belong to this session
+                        sessions[sender] = email
+                if auth.user is None and user_id or \
+                   auth.user is not None and auth.user.id != user_id:
+                    # Parser has logged in as the sender
+                    auth.s3_impersonate(user_id)
+
+            if status_id in errors:
+                if commit:
+                    db.rollback()
+                    db(stable.id == status_id).update(parse_error = errors[status_id])
+                    db.commit()
+            else:
+                if reply_id:
+                    replies[status_id] = reply_id
+                if commit:
+                    db(stable.id == status_id).update(is_parsed = True,
+                                                      reply_id = reply_id,
+                                                      )
+                    db.commit()
+
+        return replies, errors
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def sender(address):
+        """
+            Extract the sender address from a from_address
+
+            @param address: the from_address, e.g. "Name <name@example.com>"
+        """
+
+        if address and "<" in address:
+            address = address.split("<")[1].split(">")[0]
+        return address
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def alive_sessions(senders):
+        """
+            Look up the alive login sessions for a batch of senders
+
+            @param senders: the sender addresses
+
+            @return: dict {sender: email}
+        """
+
+        sessions = {}
+        if not senders:
+            return sessions
+
+        now = current.request.utcnow
+        stable = current.s3db.msg_session
+        query = (stable.is_expired == False) & \
+                (stable.from_address.belongs(senders))
+        records = current.db(query).select(stable.id,
+                                           stable.from_address,
+                                           stable.created_datetime,
+                                           stable.expiration_time,
+                                           stable.email,
+                                           orderby = stable.id,
+                                           )
+        expired = []
+        for record in records:
+            from_address = record.from_address
+            if from_address in sessions:
+                continue
+            time = record.created_datetime
+            time = time - now
+            time = time.total_seconds()
+            if time < record.expiration_time:
+                sessions[from_address] = record.email
+            else:
+                expired.append(record.id)
+        if expired:
+            current.db(stable.id.belongs(expired)).update(is_expired = True)
+
+        return sessions
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def prefetch_contacts(senders):
+        """
+            Look up the persons and human resources for a batch of senders
+
+            @param senders: the sender addresses
+
+            @return: dict {(contact_method, address): Storage(person_ids,
+                                                              hr_ids)}
+        """
+
+        contacts = {}
+        for sender in senders:
+            for contact_method in ("EMAIL", "SMS"):
+                contacts[(contact_method, sender)] = Storage(person_ids=set(),
+                                                             hr_ids=set())
+        if not senders:
+            return contacts
+
+        db = current.db
+        s3db = current.s3db
+
+        ptable = s3db.pr_person
+        ctable = s3db.pr_contact
+        query = (ctable.value.belongs(senders)) & \
+                (ctable.contact_method.belongs(("EMAIL", "SMS"))) & \
+                (ctable.pe_id == ptable.pe_id) & \
+                (ptable.deleted == False) & \
+                (ctable.deleted == False)
+        rows = db(query).select(ctable.value,
+                                ctable.contact_method,
+                                ptable.id,
+                                )
+        persons = {}
+        for row in rows:
+            contact = row.pr_contact
+            key = (contact.contact_method, contact.value)
+            contacts[key].person_ids.add(row.pr_person.id)
+            persons.setdefault(row.pr_person.id, []).append(key)
+
+        if persons:
+            hrtable = s3db.hrm_human_resource
+            query = (hrtable.person_id.belongs(persons.keys())) & \
+                    (hrtable.deleted == False)
+            rows = db(query).select(hrtable.id,
+                                    hrtable.person_id,
+                                    )
+            for row in rows:
+                for key in persons[row.person_id]:
+                    contacts[key].hr_ids.add(row.id)
+
+        return contacts
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -172,6 +487,15 @@ class S3Parsing(object):
 
         if "<" in address:
             address = address.split("<")[1].split(">")[0]
+
+        contacts = S3Parsing.contacts
+        if contacts and ("EMAIL", address) in contacts:
+            # Prefetched for the current batch
+            ids = contacts[("EMAIL", address)].person_ids
+            if len(ids) == 1:
+                return list(ids)[0]
+            return None
+
         ptable = s3db.pr_person
         ctable = s3db.pr_contact
         query = (ctable.value == address) & \
@@ -198,6 +522,15 @@ class S3Parsing(object):
 
         if "<" in address:
             address = address.split("<")[1].split(">")[0]
+
+        contacts = S3Parsing.contacts
+        if contacts and ("EMAIL", address) in contacts:
+            # Prefetched for the current batch
+            ids = contacts[("EMAIL", address)].hr_ids
+            if len(ids) == 1:
+                return list(ids)[0]
+            return None
+
         hrtable = s3db.hrm_human_resource
         ptable = db.pr_person
         ctable = s3db.pr_contact
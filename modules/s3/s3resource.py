@@ -38,6 +38,7 @@
 
 import collections
 import datetime
+import hashlib
 import re
 import sys
 import time
@@ -74,9 +75,10 @@ from gluon.dal import Row, Rows, Table, Field, Expression
 from gluon.storage import Storage
 from gluon.tools import callback
 
+from s3csvmap import S3CSVMapping
 from s3data import S3DataTable, S3DataList, S3PivotTable
 from s3fields import S3Represent, S3RepresentLazy, s3_all_meta_field_names
-from s3utils import s3_has_foreign_key, s3_get_foreign_key, s3_unicode, S3TypeConverter, s3_get_last_record_id, s3_remove_last_record_id
+from s3utils import s3_has_foreign_key, s3_get_foreign_key, s3_unicode, S3TypeConverter, s3_get_last_record_id, s3_remove_last_record_id, s3_on_commit
 from s3validators import IS_ONE_OF
 from s3xml import S3XMLFormat
 
@@ -528,7 +530,8 @@ class S3Resource(object):
                as_rows=False,
                represent=False,
                show_links=True,
-               raw_data=False):
+               raw_data=False,
+               seek=None):
         """
             Extract data from this resource
 
@@ -545,6 +548,14 @@ class S3Resource(object):
             @param as_rows: return the rows (don't extract)
             @param represent: render field value representations
             @param raw_data: include raw data in the result
+            @param seek: the cursor of the last record of the previous
+                         page (as returned in output["seek"], or rows.seek
+                         with as_rows), to select the next page by seeking
+                         instead of OFFSET (start is ignored then)
+
+            @note: keyset pagination (seek) requires an orderby of fields
+                   in the master table which can not be NULL, and is not
+                   available with groupby, getids or virtual filters
         """
 
         # Init
@@ -615,7 +626,12 @@ class S3Resource(object):
 
         # Resolve ORDERBY
         orderby_aggregate = orderby_fields = None
-        
+
+        # Keys for keyset pagination
+        keyset = limit is not None and \
+                 not groupby and not getids and vfltr is None
+        keys = []
+
         if orderby:
 
             if isinstance(orderby, str):
@@ -680,10 +696,39 @@ class S3Resource(object):
                     direction = direction.strip().lower()[:3]
                     if fname != pkey:
                         expression = f.min() if direction == "asc" else ~(f.max())
+                        if tname != tablename or \
+                           not f.notnull or f.type[:5] == "list:":
+                            keyset = False
+                    keys.append((f, direction))
                 else:
                     orderby.append(expression)
+                    keyset = False
                 orderby_aggregate.append(expression)
 
+            if keyset and keys:
+                # Order by primary key last, to make the order unique
+                if not any(str(f) == pkey for f, direction in keys):
+                    key = table._id
+                    keys.append((key, "asc"))
+                    orderby.append(key)
+                    orderby_fields.append(key)
+                    orderby_aggregate.append(key)
+
+        if not keyset or not keys:
+            keys = None
+
+        # Seek from the last record of the previous page
+        seeking = False
+        if keys and seek is not None:
+            seek_query = self._seek_query(keys, seek)
+            if seek_query is not None:
+                filter_query &= seek_query
+                start = 0
+                seeking = True
+
+        # Select only the record IDs of the page (rather than all)?
+        paged = seeking
+
         # Initialize master query
         master_query = filter_query
         
@@ -692,6 +737,10 @@ class S3Resource(object):
             limitby = self.limitby(start=start, limit=limit)
         else:
             limitby = None
+
+        # Page size for the cursor (limitby gets cleared when selecting
+        # the master rows by their IDs)
+        page_limitby = limitby
             
         # Filter Query:
         
@@ -702,12 +751,39 @@ class S3Resource(object):
         # Get the left joins
         filter_joins = left_joins.as_list(tablenames=ftables,
                                           aqueries=aqueries)
-
-        if getids or count or left_joins:
+        joined = bool(left_joins.as_list())
+
+        count_key = None
+        if seeking and count:
+            # Count all matching records, not just those after the cursor
+            totalrows = rfilter.count(left=left,
+                                      distinct=distinct or bool(filter_joins))
+            count = False
+
+        elif count and not groupby and vfltr is None:
+            # Cached or estimated total number of records?
+            count_key = S3CountCache.key(table,
+                                         filter_query,
+                                         left=filter_joins,
+                                         distinct=distinct)
+            if count_key:
+                totalrows = S3CountCache.get(count_key)
+                if totalrows is None:
+                    totalrows = S3CountCache.estimate(table,
+                                                      filter_query,
+                                                      left=filter_joins)
+                    if totalrows is not None:
+                        S3CountCache.set(count_key, totalrows)
+            if totalrows is not None:
+                count = False
+                count_key = None
+                paged = not getids
+
+        if getids or count or joined:
             if not groupby and not vfltr and \
-               (count or limitby or vtables != ftables):
+               (count or paged or limitby or vtables != ftables):
 
-                if getids or left_joins:
+                if getids or joined:
                     field = table._id
                     fdistinct = False
                     fgroupby = field
@@ -722,25 +798,30 @@ class S3Resource(object):
                     vf = table.virtualfields
                     osetattr(table, "virtualfields", [])
 
-                # Retrieve the ordered record IDs (or number of rows)
+                # Retrieve the ordered record IDs (or number of rows),
+                # only those of the page if the total is already known
                 rows = db(filter_query).select(field,
                                                left=filter_joins,
                                                distinct=fdistinct,
                                                orderby=orderby_aggregate,
                                                groupby=fgroupby,
+                                               limitby=limitby if paged else None,
                                                cacheable=True)
                                                
                 # Restore the virtual fields
                 if virtual:
                     osetattr(table, "virtualfields", vf)
 
-                if (getids or left_joins):
+                if (getids or joined):
                     ids = [row[pkey] for row in rows]
-                    totalrows = len(ids)
-                    if limitby:
-                        page = ids[limitby[0]:limitby[1]]
-                    else:
+                    if paged:
                         page = ids
+                    else:
+                        totalrows = len(ids)
+                        if limitby:
+                            page = ids[limitby[0]:limitby[1]]
+                        else:
+                            page = ids
                     # Use simplified master query
                     master_query = table._id.belongs(page)
                     orderby = None
@@ -748,6 +829,9 @@ class S3Resource(object):
                 else:
                     totalrows = rows.first()[field]
 
+                if count_key and totalrows is not None:
+                    S3CountCache.set(count_key, totalrows)
+
         # Master Query:
         
         # Add joins for virtual fields
@@ -890,18 +974,27 @@ class S3Resource(object):
             else:
                 rows = rfilter(rows, start=start, limit=limit)
 
-            if (getids or left_joins) and has_id:
+            if (getids or joined) and has_id:
                 ids = list(set([row[pkey] for row in rows]))
                 totalrows = len(ids)
 
         # With GROUPBY, return the grouped rows here:
         if groupby or as_rows:
+            if as_rows and keys and page_limitby:
+                # Cursor for the next page
+                page_ids = page if page is not None \
+                                else [row[pkey] for row in rows]
+                if len(page_ids) >= page_limitby[1] - page_limitby[0]:
+                    rows.seek = self._seek_cursor(keys, page_ids[-1])
+                else:
+                    rows.seek = None
             return rows
 
         # Otherwise: initialize output
         output = {"rfields": dfields,
                   "numrows": 0 if totalrows is None else totalrows,
-                  "ids": ids}
+                  "ids": ids,
+                  "seek": None}
 
         if not rows:
             output["rows"] = []
@@ -1114,7 +1207,63 @@ class S3Resource(object):
         #_debug("select DONE")
 
         output["rows"] = [results[record_id] for record_id in page]
+
+        # Cursor for the next page
+        if keys and page_limitby and \
+           len(page) >= page_limitby[1] - page_limitby[0]:
+            output["seek"] = self._seek_cursor(keys, page[-1])
+
         return output
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _seek_query(keys, cursor):
+        """
+            Construct a query for all records after the cursor (keyset
+            pagination)
+
+            @param keys: the orderby keys, list of tuples (Field, direction)
+            @param cursor: the values of the keys in the last record
+                           of the previous page
+
+            @return: the query, or None if the cursor doesn't match the keys
+        """
+
+        if not isinstance(cursor, (list, tuple)) or \
+           len(cursor) != len(keys) or None in cursor:
+            return None
+
+        query = equal = None
+        for (field, direction), value in zip(keys, cursor):
+            if direction == "asc":
+                q = (field > value)
+            else:
+                q = (field < value)
+            if equal is not None:
+                q = equal & q
+            query = q if query is None else query | q
+            e = (field == value)
+            equal = e if equal is None else equal & e
+        return query
+
+    # -------------------------------------------------------------------------
+    def _seek_cursor(self, keys, record_id):
+        """
+            Get the cursor for keyset pagination after a record
+
+            @param keys: the orderby keys, list of tuples (Field, direction)
+            @param record_id: the record ID
+
+            @return: tuple of the values of the keys in the record
+        """
+
+        table = self.table
+        fields = [field for field, direction in keys]
+        row = current.db(table._id == record_id).select(limitby=(0, 1),
+                                                        *fields).first()
+        if not row:
+            return None
+        return tuple(row[field.name] for field in fields)
         
     # -------------------------------------------------------------------------
     @staticmethod
@@ -1771,6 +1920,9 @@ class S3Resource(object):
         id_repr = table._id.represent
         table._id.represent = None
 
+        # Continue from the previous page?
+        seek, numrows = self._pagination(orderby, start, limit, getids)
+
         # Extract the data
         data = self.select(selectors,
                            start=start,
@@ -1778,9 +1930,14 @@ class S3Resource(object):
                            orderby=orderby,
                            left=left,
                            distinct=distinct,
-                           count=True,
+                           count=numrows is None,
                            getids=getids,
-                           represent=True)
+                           represent=True,
+                           seek=seek)
+        deferred = numrows is not None
+        if deferred:
+            data["numrows"] = numrows
+        self._paginated(orderby, start, data, deferred=deferred)
 
         rows = data["rows"]
 
@@ -1846,6 +2003,9 @@ class S3Resource(object):
             fields.insert(0, table._id.name)
             selectors.insert(0, table._id.name)
 
+        # Continue from the previous page?
+        seek, numrows = self._pagination(orderby, start, limit, getids)
+
         # Extract the data
         data = self.select(selectors,
                            start=start,
@@ -1853,10 +2013,15 @@ class S3Resource(object):
                            orderby=orderby,
                            left=left,
                            distinct=distinct,
-                           count=True,
+                           count=numrows is None,
                            getids=getids,
                            raw_data=True,
-                           represent=True)
+                           represent=True,
+                           seek=seek)
+        deferred = numrows is not None
+        if deferred:
+            data["numrows"] = numrows
+        self._paginated(orderby, start, data, deferred=deferred)
 
         # Generate the data list
         numrows = data["numrows"]
@@ -1890,6 +2055,102 @@ class S3Resource(object):
 
         return S3PivotTable(self, rows, cols, layers, strict=strict)
 
+    # -------------------------------------------------------------------------
+    def _pagination_key(self, orderby):
+        """
+            Key for the cursors of a paginated data table or data list
+
+            @param orderby: the orderby
+        """
+
+        if isinstance(orderby, (list, tuple)):
+            orderby = ",".join([str(o) for o in orderby])
+        return hashlib.md5("%s|%s|%s" % (self.tablename,
+                                         self.get_query(),
+                                         orderby)).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def _pagination(self, orderby, start, limit, getids=False):
+        """
+            Look up the cursor for keyset pagination of a data table or
+            data list, as stored when the previous page was selected
+
+            @param orderby: the orderby
+            @param start: index of the first record of the page
+            @param limit: maximum number of records in the page
+            @param getids: whether all record IDs are requested
+
+            @return: tuple (seek, numrows), seek being the cursor (or None
+                     if the previous page is unknown), and numrows the
+                     total number of records (or None if it needs to be
+                     counted again)
+        """
+
+        settings = current.deployment_settings
+        session = current.session
+        if not start or not limit or not orderby or getids or \
+           session is None or not session.s3 or \
+           not settings.get_ui_keyset_pagination():
+            return None, None
+
+        pagination = session.s3.pagination
+        if not pagination:
+            return None, None
+        entry = pagination.get(self._pagination_key(orderby))
+        if not entry or start not in entry["pages"]:
+            return None, None
+
+        seek, numrows, counted = entry["pages"][start]
+        max_age = settings.get_ui_deferred_totals()
+        if not max_age or time.time() - counted > max_age:
+            numrows = None
+        return seek, numrows
+
+    # -------------------------------------------------------------------------
+    def _paginated(self, orderby, start, data, deferred=False):
+        """
+            Store the cursor for the next page of a data table or data list
+
+            @param orderby: the orderby
+            @param start: index of the first record of the page
+            @param data: the data selected for the page
+            @param deferred: the total number of records has been re-used
+                             from the previous page rather than counted
+        """
+
+        seek = data.get("seek")
+        session = current.session
+        if seek is None or session is None or not session.s3 or \
+           not current.deployment_settings.get_ui_keyset_pagination():
+            return
+
+        pagination = session.s3.pagination
+        if pagination is None:
+            pagination = session.s3.pagination = {}
+
+        now = time.time()
+        key = self._pagination_key(orderby)
+        entry = pagination.get(key)
+        if entry is None:
+            # Keep only the most recently used tables/lists
+            if len(pagination) >= 10:
+                oldest = min(pagination, key=lambda k: pagination[k]["updated"])
+                del pagination[oldest]
+            entry = pagination[key] = {"pages": {}}
+        entry["updated"] = now
+
+        # Keep the time of the original count
+        pages = entry["pages"]
+        start = start or 0
+        if deferred and start in pages:
+            counted = pages[start][2]
+        else:
+            counted = now
+
+        if len(pages) >= 50:
+            pages.clear()
+        pages[start + len(data["rows"])] = (seek, data["numrows"], counted)
+
     # -------------------------------------------------------------------------
     def json(self,
              fields=None,
@@ -1897,7 +2158,9 @@ class S3Resource(object):
              limit=None,
              left=None,
              distinct=False,
-             orderby=None):
+             orderby=None,
+             seek=None,
+             cursor=False):
         """
             Export a JSON representation of the resource.
 
@@ -1907,9 +2170,15 @@ class S3Resource(object):
             @param left: list of (additional) left joins
             @param distinct: select only distinct rows
             @param orderby: Orderby-expression for the query
+            @param seek: cursor of the last record of the previous page,
+                         see select()
+            @param cursor: return the cursor for the next page together
+                           with the rows
 
             @return: the JSON (as string), representing a list of
-                     dicts with {"tablename.fieldname":"value"}
+                     dicts with {"tablename.fieldname":"value"}, or
+                     - with cursor - an object {"rows": [...], "seek": ...}
+                     where seek is None after the last page
         """
 
         data = self.select(fields=fields,
@@ -1917,9 +2186,13 @@ class S3Resource(object):
                            limit=limit,
                            orderby=orderby,
                            left=left,
-                           distinct=distinct)["rows"]
+                           distinct=distinct,
+                           seek=seek)
 
-        return json.dumps(data)
+        if cursor:
+            from gluon.serializers import json as serialize
+            return serialize({"rows": data["rows"], "seek": data["seek"]})
+        return json.dumps(data["rows"])
 
     # -------------------------------------------------------------------------
     # Data Object API
@@ -3004,6 +3277,7 @@ class S3Resource(object):
                    conflict_policy=None,
                    last_sync=None,
                    onconflict=None,
+                   batch_size=None,
                    **args):
         """
             XML Importer
@@ -3025,6 +3299,10 @@ class S3Resource(object):
             @param conflict_policy: policy for conflict resolution (sync)
             @param last_sync: last synchronization datetime (sync)
             @param onconflict: callback hook for conflict resolution (sync)
+            @param batch_size: for CSV/XLS imports, read, transform and import
+                               the source in batches of this number of rows
+                               (limits memory use for large sources, only
+                               applicable with commit_job and without id)
             @param args: parameters to pass to the transformation stylesheet
         """
 
@@ -3037,6 +3315,7 @@ class S3Resource(object):
 
         xml = current.xml
         tree = None
+        trees = None
         self.job = None
 
         if not job_id:
@@ -3056,6 +3335,17 @@ class S3Resource(object):
                         name=name,
                         utcnow=utcnow)
 
+            if batch_size and format in ("csv", "xls") and \
+               commit_job and not id:
+                # Import incrementally (batch trees are built on demand)
+                trees = self._import_batches(source,
+                                             format=format,
+                                             stylesheet=stylesheet,
+                                             extra_data=extra_data,
+                                             batch_size=batch_size,
+                                             **args)
+                source = []
+
             # Build import tree
             if not isinstance(source, (list, tuple)):
                 source = [source]
@@ -3109,16 +3399,45 @@ class S3Resource(object):
         response = current.response
         # Flag to let onvalidation/onaccept know this is coming from a Bulk Import
         response.s3.bulk = True
-        success = self.import_tree(id, tree,
-                                   ignore_errors=ignore_errors,
-                                   job_id=job_id,
-                                   commit_job=commit_job,
-                                   delete_job=delete_job,
-                                   strategy=strategy,
-                                   update_policy=update_policy,
-                                   conflict_policy=conflict_policy,
-                                   last_sync=last_sync,
-                                   onconflict=onconflict)
+        if trees is None:
+            success = self.import_tree(id, tree,
+                                       ignore_errors=ignore_errors,
+                                       job_id=job_id,
+                                       commit_job=commit_job,
+                                       delete_job=delete_job,
+                                       strategy=strategy,
+                                       update_policy=update_policy,
+                                       conflict_policy=conflict_policy,
+                                       last_sync=last_sync,
+                                       onconflict=onconflict)
+        else:
+            # One import job per batch, committed before reading the next
+            # batch (the DB transaction still covers the whole import)
+            success = True
+            error = None
+            error_tree = None
+            try:
+                for tree in trees:
+                    success = self.import_tree(None, tree,
+                                               ignore_errors=ignore_errors,
+                                               strategy=strategy,
+                                               update_policy=update_policy,
+                                               conflict_policy=conflict_policy,
+                                               last_sync=last_sync,
+                                               onconflict=onconflict)
+                    if self.error:
+                        error = error or self.error
+                        if self.error_tree is not None:
+                            if error_tree is None:
+                                error_tree = self.error_tree
+                            else:
+                                error_tree.extend(list(self.error_tree))
+                    if not success:
+                        break
+            finally:
+                response.s3.bulk = False
+            self.error = error
+            self.error_tree = error_tree
         response.s3.bulk = False
 
         self.files = Storage()
@@ -3155,6 +3474,75 @@ class S3Resource(object):
             return xml.json_message(False, 400,
                                     message=self.error, tree=tree)
 
+    # -------------------------------------------------------------------------
+    def _import_batches(self, source,
+                        format="csv",
+                        stylesheet=None,
+                        extra_data=None,
+                        batch_size=500,
+                        **args):
+        """
+            Read and transform CSV/XLS sources in batches of rows
+
+            @param source: the data source(s), see import_xml
+            @param format: the source format, "csv" or "xls"
+            @param stylesheet: the transformation stylesheet
+            @param extra_data: dict of extra cols to add to each row
+            @param batch_size: the maximum number of rows per batch
+            @param args: parameters to pass to the transformation stylesheet
+
+            @return: generator of S3XML element trees (root elements)
+
+            @note: where the stylesheet has a column map (see s3csvmap),
+                   batches are converted natively instead of transformed,
+                   unless they contain columns which the column map does
+                   not cover
+        """
+
+        xml = current.xml
+
+        mapping = S3CSVMapping.load(stylesheet)
+        if mapping is not None and mapping.resource != self.tablename:
+            mapping = None
+
+        # Compile the stylesheet only once, and only when needed
+        transformer = [None]
+        def transform(t):
+            if transformer[0] is None:
+                transformer[0] = xml.transformer(stylesheet)
+                if transformer[0] is None:
+                    raise SyntaxError(xml.error or "Invalid stylesheet")
+            return xml.transform(t, transformer[0], **args)
+
+        if not isinstance(source, (list, tuple)):
+            source = [source]
+        for item in source:
+            if isinstance(item, (list, tuple)):
+                resourcename, s = item[:2]
+            else:
+                resourcename, s = None, item
+            if isinstance(s, etree._ElementTree):
+                batches = [s]
+            elif format == "csv":
+                batches = xml.csv2trees(s,
+                                        resourcename=resourcename,
+                                        extra_data=extra_data,
+                                        batch_size=batch_size)
+            else:
+                batches = xml.xls2trees(s,
+                                        resourcename=resourcename,
+                                        extra_data=extra_data,
+                                        batch_size=batch_size)
+            for t in batches:
+                if mapping is not None and mapping.supports(t):
+                    t = mapping.transform(t)
+                elif stylesheet is not None:
+                    t = transform(t)
+                    _debug(t)
+                    if not t:
+                        raise SyntaxError(xml.error)
+                yield t.getroot()
+
     # -------------------------------------------------------------------------
     def import_tree(self, id, tree,
                     job_id=None,
@@ -6423,6 +6811,227 @@ class S3URLQuery(object):
                 
         return q
 
+# =============================================================================
+class S3CountCache(object):
+    """
+        Cache for the total numbers of records matching resource queries,
+        keyed by the tables, the query, the joins and the user's realms.
+
+        Every table defined by S3Model has a write version (shared by all
+        processes through the disk cache), which is part of the cache key.
+        Writes to a table mark it as pending, and its version is updated
+        once after the transaction has been committed - so any committed
+        write to any of the tables involved invalidates the cached counts.
+        Counts involving tables with pending writes are never cached.
+    """
+
+    # Time when the cached counts were last cleared (per process)
+    cleared = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def register(cls, table):
+        """
+            Register callbacks to update the write version of a table
+
+            @param table: the Table
+        """
+
+        if not current.deployment_settings.get_base_count_cache() or \
+           not hasattr(table, "_after_insert"):
+            return
+
+        tablename = table._tablename
+        touch = lambda *args: cls.touch(tablename)
+
+        table._after_insert.append(touch)
+        table._after_update.append(touch)
+        table._after_delete.append(touch)
+        table._s3_count_cache = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def touch(cls, tablename):
+        """
+            Mark a table as written to in the current transaction, and
+            update its write version after commit
+
+            @param tablename: the table name
+        """
+
+        s3 = current.response.s3
+        pending = s3.count_cache_pending
+        if pending is None:
+            pending = s3.count_cache_pending = set()
+
+        if s3_on_commit(cls.flush, after=True):
+            pending.add(tablename)
+        else:
+            # No commit hook (shell script or scheduler task)
+            cls.version(tablename, update=True)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def flush(cls):
+        """
+            Update the write versions of all tables written to in the
+            current transaction (after commit)
+        """
+
+        pending = current.response.s3.count_cache_pending
+        if pending:
+            for tablename in pending:
+                cls.version(tablename, update=True)
+            pending.clear()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def version(tablename, update=False):
+        """
+            The write version of a table
+
+            @param tablename: the table name
+            @param update: start a new version
+        """
+
+        return current.cache.disk("s3_count_version_%s" % tablename,
+                                  lambda: "%.6f" % time.time(),
+                                  time_expire = 0 if update else None)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def key(cls, table, query, left=None, distinct=False):
+        """
+            Get the cache key for a count
+
+            @param table: the master Table
+            @param query: the query
+            @param left: the left joins
+            @param distinct: count distinct rows
+
+            @return: the key, or None if the count can not be cached
+        """
+
+        if not current.deployment_settings.get_base_count_cache():
+            return None
+
+        db = current.db
+
+        # All tables involved must have a write version
+        tablenames = set([table._tablename])
+        try:
+            tables = db._adapter.tables
+            tablenames.update(tables(query))
+            if left:
+                for join in left:
+                    tablenames.update(tables(join))
+        except Exception:
+            return None
+        pending = current.response.s3.count_cache_pending
+        versions = []
+        for tablename in sorted(tablenames):
+            t = db[tablename] if tablename in db.tables else None
+            if t is None or not getattr(t, "_s3_count_cache", False):
+                return None
+            if pending and tablename in pending:
+                # Uncommitted writes
+                return None
+            versions.append("%s:%s" % (tablename, cls.version(tablename)))
+
+        # User realms (in case the query doesn't fully reflect them)
+        auth = current.auth
+        if auth.override:
+            realms = "override"
+        elif auth.user:
+            realms = sorted((auth.user.realms or {}).items())
+        else:
+            realms = None
+
+        left = ",".join([str(join) for join in left]) if left else ""
+        key = "|".join((";".join(versions),
+                        str(query),
+                        left,
+                        str(bool(distinct)),
+                        repr(realms),
+                        ))
+        return "s3_count_%s" % hashlib.md5(key).hexdigest()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get(key):
+        """
+            Look up a cached count
+
+            @param key: the cache key
+
+            @return: the count, or None if not cached
+        """
+
+        expire = current.deployment_settings.get_base_count_cache()
+        return current.cache.ram(key, lambda: None, time_expire=expire)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def set(cls, key, count):
+        """
+            Store a count in the cache
+
+            @param key: the cache key
+            @param count: the count
+        """
+
+        cache = current.cache.ram
+
+        # Periodically drop all counts of this process, as nothing else
+        # removes those stored under outdated versions
+        now = time.time()
+        cleared = cls.cleared
+        if cleared is None:
+            cls.cleared = now
+        elif now - cleared > current.deployment_settings.get_base_count_cache():
+            cache.clear(regex="^s3_count_")
+            cls.cleared = now
+
+        cache(key, lambda: count, time_expire=0)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def estimate(table, query, left=None):
+        """
+            Get the query planner's estimate of the number of records
+            matching a query, if above the configured threshold
+
+            @param table: the master Table
+            @param query: the query
+            @param left: the left joins
+
+            @return: the estimate, or None if below the threshold or
+                     not available
+        """
+
+        threshold = current.deployment_settings.get_base_count_approximate()
+        if threshold is None:
+            return None
+
+        db = current.db
+        if db._dbname != "postgres":
+            return None
+
+        sql = db(query)._select(table._id,
+                                left=left,
+                                groupby=table._id if left else None)
+        try:
+            plan = db.executesql("EXPLAIN %s" % sql.rstrip(";"))
+        except Exception:
+            return None
+        if not plan:
+            return None
+        match = re.search(r"rows=(\d+)", plan[0][0])
+        if not match:
+            return None
+        estimate = int(match.group(1))
+        return estimate if estimate > threshold else None
+
 # =============================================================================
 class S3ResourceFilter(object):
     """ Class representing a resource filter """
@@ -6859,13 +7468,29 @@ class S3ResourceFilter(object):
             left_joins.add(self.get_left_joins())
             left = left_joins.as_list()
 
+            query = self.query
+
+            # Cached or estimated?
+            key = S3CountCache.key(table, query, left=left)
+            if key:
+                total = S3CountCache.get(key)
+                if total is None:
+                    total = S3CountCache.estimate(table, query, left=left)
+                    if total is not None:
+                        S3CountCache.set(key, total)
+                if total is not None:
+                    return total
+
             cnt = table[table._id.name].count()
 
-            row = current.db(self.query).select(cnt, left=left).first()
+            row = current.db(query).select(cnt, left=left).first()
             if row:
-                return row[cnt]
+                total = row[cnt]
             else:
-                return 0
+                total = 0
+            if key:
+                S3CountCache.set(key, total)
+            return total
 
         else:
             data = resource.select([table._id.name],
@@ -7087,10 +7712,10 @@ class S3RecordMerger(object):
         if not permitted:
             self.raise_error("Operation not permitted", auth.permission.error)
 
-        # Load all models
+        # Load all models which could reference the records
         s3db = current.s3db
         if main:
-            s3db.load_all_models()
+            s3db.load_references(tablename)
 
         # Get the records
         original = None
@@ -45,6 +45,7 @@
 __all__ = ["S3Task"]
 
 import datetime
+import fnmatch
 
 try:
     import json # try stdlib (Python 2.6)
@@ -67,12 +68,36 @@ class S3Task(object):
 
     TASK_TABLENAME = "scheduler_task"
 
+    # Deferred hooks
+    DEFERRED_TASK = "s3_run_deferred_hooks"
+    DEFERRED_ATTEMPTS = 5
+
+    # Queue for tasks which don't match any pattern (web2py's default group)
+    DEFAULT_QUEUE = "main"
+
+    # Head start (seconds) per priority level for one-off tasks, so that
+    # workers serving multiple queues pick up higher priority tasks first
+    PRIORITY_STEP = 3600
+
     # -------------------------------------------------------------------------
     def __init__(self):
 
-        migrate = current.deployment_settings.get_base_migrate()
+        settings = current.deployment_settings
+        migrate = settings.get_base_migrate()
         tasks = current.response.s3.tasks
 
+        # Named queues in order of priority
+        queues = []
+        patterns = []
+        for queue, names in settings.get_base_task_queues():
+            queues.append(queue)
+            if names:
+                patterns.extend((name, queue) for name in names)
+        if self.DEFAULT_QUEUE not in queues:
+            queues.append(self.DEFAULT_QUEUE)
+        self.queues = queues
+        self.patterns = patterns
+
         # Instantiate Scheduler
         try:
             from gluon.scheduler import Scheduler
@@ -80,9 +105,12 @@ class S3Task(object):
             # Warning should already have been given by eden_update_check.py
             self.scheduler = None
         else:
+            # Workers serve all queues unless started for particular
+            # groups (web2py.py -K app:group, or cron/scheduler.py)
             self.scheduler = Scheduler(current.db,
                                        tasks,
-                                       migrate=migrate)
+                                       migrate=migrate,
+                                       group_names=queues)
 
     # -------------------------------------------------------------------------
     def configure_tasktable_crud(self,
@@ -224,7 +252,7 @@ class S3Task(object):
     # -------------------------------------------------------------------------
     # API Function run within the main flow of the application
     # -------------------------------------------------------------------------
-    def async(self, task, args=[], vars={}, timeout=300):
+    def async(self, task, args=[], vars={}, timeout=300, coalesce=True):
         """
             Wrapper to call an asynchronous task.
             - run from the main request
@@ -235,6 +263,9 @@ class S3Task(object):
             @param vars: The list of named vars to send to the function
             @param timeout: The length of time available for the task to complete
                             - default 300s (5 mins)
+            @param coalesce: don't queue the task if an identical task
+                             (same args and vars) is still waiting in
+                             the queue, but return that one instead
         """
 
         # Check that task is defined
@@ -273,16 +304,209 @@ class S3Task(object):
             vars["user_id"] = auth.user.id
 
         # Run the task asynchronously
-        record = current.db.scheduler_task.insert(application_name="%s/default" % current.request.application,
-                                                  task_name=task,
-                                                  function_name=task,
-                                                  args=json.dumps(args),
-                                                  vars=json.dumps(vars),
-                                                  timeout=timeout)
+        if coalesce:
+            record = self._queued_task(task, args, vars)
+            if record:
+                return record
+        record = current.db.scheduler_task.insert(**self._task_record(task,
+                                                                      args,
+                                                                      vars,
+                                                                      timeout))
 
         # Return record so that status can be polled
         return record
 
+    # -------------------------------------------------------------------------
+    def async_bulk(self, task, calls, timeout=300, coalesce=True):
+        """
+            Queue multiple calls of an asynchronous task at once
+            - run from the main request
+
+            @param task: The function which should be run
+            @param calls: list of tuples (args, vars) for the calls
+            @param timeout: The length of time available for each call
+            @param coalesce: skip calls which are identical with each
+                             other or with tasks still waiting in the queue
+
+            @return: the number of calls queued (or run synchronously)
+        """
+
+        tasks = current.response.s3.tasks
+        if not tasks or task not in tasks:
+            return 0
+
+        if not self._is_alive():
+            # Run the calls synchronously
+            for args, vars in calls:
+                self.async(task, args=args, vars=vars, timeout=timeout)
+            return len(calls)
+
+        auth = current.auth
+        user_id = auth.user.id if auth.is_logged_in() else None
+
+        seen = []
+        if coalesce:
+            seen = [(json.loads(row.args), json.loads(row.vars))
+                    for row in self._queued_tasks(task)]
+        records = []
+        for args, vars in calls:
+            vars = dict(vars)
+            if user_id:
+                vars["user_id"] = user_id
+            if coalesce:
+                call = (list(args), vars)
+                if call in seen:
+                    continue
+                seen.append(call)
+            records.append(self._task_record(task, args, vars, timeout))
+        if records:
+            current.db.scheduler_task.bulk_insert(records)
+        return len(records)
+
+    # -------------------------------------------------------------------------
+    def queue(self, task):
+        """
+            Get the queue for a task
+
+            @param task: the task name
+
+            @return: the queue name
+        """
+
+        for pattern, queue in self.patterns:
+            if fnmatch.fnmatchcase(task, pattern):
+                return queue
+        return self.DEFAULT_QUEUE
+
+    # -------------------------------------------------------------------------
+    def _task_record(self, task, args, vars, timeout):
+        """
+            Build a scheduler_task record for a one-off task, in the
+            queue of the task and with a head start according to the
+            priority of the queue
+
+            @param task: the task name
+            @param args: the args for the task
+            @param vars: the vars for the task
+            @param timeout: the timeout
+        """
+
+        queue = self.queue(task)
+        levels = len(self.queues) - 1 - self.queues.index(queue)
+        # NB the Scheduler uses local time
+        next_run_time = datetime.datetime.now() - \
+                        datetime.timedelta(seconds = levels * self.PRIORITY_STEP)
+        return dict(application_name = "%s/default" % current.request.application,
+                    task_name = task,
+                    function_name = task,
+                    args = json.dumps(args),
+                    vars = json.dumps(vars),
+                    group_name = queue,
+                    next_run_time = next_run_time,
+                    timeout = timeout,
+                    )
+
+    # -------------------------------------------------------------------------
+    def _queued_tasks(self, task):
+        """
+            Get all one-off tasks of a kind which are still waiting in the
+            queue (i.e. not yet assigned to a worker)
+
+            @param task: the task name
+        """
+
+        db = current.db
+        ttable = db.scheduler_task
+        query = (ttable.function_name == task) & \
+                (ttable.status == "QUEUED") & \
+                (ttable.repeats == 1)
+        return db(query).select(ttable.id,
+                                ttable.args,
+                                ttable.vars,
+                                )
+
+    # -------------------------------------------------------------------------
+    def _queued_task(self, task, args, vars):
+        """
+            Find an identical one-off task which is still waiting in
+            the queue
+
+            @param task: the task name
+            @param args: the args
+            @param vars: the vars
+
+            @return: the scheduler_task record ID, or None
+        """
+
+        _args = json.dumps(args)
+        for row in self._queued_tasks(task):
+            if row.args == _args and json.loads(row.vars) == vars:
+                return row.id
+        return None
+
+    # -------------------------------------------------------------------------
+    def defer(self, tablename, record_id, hook):
+        """
+            Defer a post-commit hook for a record to the scheduler
+            - run from the main request, typically from an onaccept
+
+            The hook must be declared in the table configuration as:
+                configure(tablename, deferred={hook: function})
+            where function takes a list of record IDs. Hooks are queued
+            in the current transaction (so they are dropped on rollback),
+            coalesced per record, and run in batches per table and hook
+            after commit. Failed hooks are retried with increasing delay.
+            Falls back to running the hook immediately if no worker is
+            alive.
+
+            @param tablename: the tablename
+            @param record_id: the record ID
+            @param hook: the name of the hook
+        """
+
+        s3db = current.s3db
+
+        hooks = s3db.get_config(tablename, "deferred")
+        if not hooks or hook not in hooks:
+            current.log.error("Undeclared deferred hook %s for %s" % (hook, tablename))
+            return False
+
+        if not self._is_alive():
+            # Run the hook synchronously
+            hooks[hook]([record_id])
+            return None
+
+        s3 = current.response.s3
+        deferred = s3.deferred_hooks
+        if deferred is None:
+            deferred = s3.deferred_hooks = set()
+        key = (tablename, hook, record_id)
+        if key in deferred:
+            return True
+        deferred.add(key)
+
+        db = current.db
+        table = s3db.s3_deferred_hook
+        query = (table.tablename == tablename) & \
+                (table.hook == hook) & \
+                (table.record_id == record_id) & \
+                (table.status == "PENDING") & \
+                (table.attempts == 0)
+        if not db(query).select(table.id, limitby=(0, 1)).first():
+            table.insert(tablename = tablename,
+                         hook = hook,
+                         record_id = record_id,
+                         )
+
+        if not s3.deferred_task:
+            # Queue a task to run the hooks unless one is already waiting
+            # (NB a running task may have missed our entries, so don't
+            #  count that)
+            task = self.DEFERRED_TASK
+            s3.deferred_task = self._queued_task(task, [], {}) or \
+                               db.scheduler_task.insert(**self._task_record(task, [], {}, 600))
+        return True
+
     # -------------------------------------------------------------------------
     def schedule_task(self,
                       task,
@@ -352,8 +576,8 @@ class S3Task(object):
             # NB None => enabled
             kwargs["enabled"] = enabled
 
-        if group_name:
-            kwargs["group_name"] = group_name
+        # Queue
+        kwargs["group_name"] = group_name or self.queue(function_name)
 
         if not ignore_duplicate and self._duplicate_task_exists(task, args, vars):
             # if duplicate task exists, do not insert a new one
@@ -375,6 +599,126 @@ class S3Task(object):
                                           **kwargs)
         return record
 
+    # -------------------------------------------------------------------------
+    def metrics(self, hours=24):
+        """
+            Queue depth and runtime statistics per task
+
+            @param hours: the period (in hours) for the runtime statistics
+
+            @return: list of Storages with the keys:
+                     task, queue, queued (waiting or assigned to a worker),
+                     due (waiting and due to run), waiting (seconds the
+                     oldest due one-off task has been waiting), running,
+                     failed, runs, failures (in the period), avg and max
+                     (runtime in seconds)
+        """
+
+        db = current.db
+        ttable = db.scheduler_task
+        rtable = db.scheduler_run
+
+        # NB the Scheduler uses local time
+        now = datetime.datetime.now()
+
+        metrics = {}
+        def entry(task, queue):
+            key = (task, queue or self.DEFAULT_QUEUE)
+            item = metrics.get(key)
+            if item is None:
+                item = metrics[key] = Storage(task = key[0],
+                                              queue = key[1],
+                                              queued = 0,
+                                              due = 0,
+                                              waiting = None,
+                                              running = 0,
+                                              failed = 0,
+                                              runs = 0,
+                                              failures = 0,
+                                              total = 0.0,
+                                              avg = None,
+                                              max = None,
+                                              )
+            return item
+
+        # Queue depth
+        count = ttable.id.count()
+        rows = db(ttable.status != "COMPLETED").select(ttable.function_name,
+                                                       ttable.group_name,
+                                                       ttable.status,
+                                                       count,
+                                                       groupby = (ttable.function_name,
+                                                                  ttable.group_name,
+                                                                  ttable.status,
+                                                                  ),
+                                                       )
+        for row in rows:
+            task = row.scheduler_task
+            item = entry(task.function_name, task.group_name)
+            status = task.status
+            if status in ("QUEUED", "ASSIGNED"):
+                item.queued += row[count]
+            elif status == "RUNNING":
+                item.running += row[count]
+            elif status in ("FAILED", "TIMEOUT"):
+                item.failed += row[count]
+
+        # Backlog
+        earliest = ttable.start_time.min()
+        query = (ttable.status == "QUEUED") & \
+                (ttable.next_run_time <= now) & \
+                (ttable.enabled == True)
+        rows = db(query).select(ttable.function_name,
+                                ttable.group_name,
+                                ttable.repeats,
+                                count,
+                                earliest,
+                                groupby = (ttable.function_name,
+                                           ttable.group_name,
+                                           ttable.repeats,
+                                           ),
+                                )
+        for row in rows:
+            task = row.scheduler_task
+            item = entry(task.function_name, task.group_name)
+            item.due += row[count]
+            start_time = row[earliest]
+            if task.repeats == 1 and start_time:
+                waiting = (now - start_time).total_seconds()
+                item.waiting = max(item.waiting, waiting)
+
+        # Runtimes
+        query = (rtable.start_time >= now - datetime.timedelta(hours=hours)) & \
+                (rtable.stop_time != None) & \
+                (rtable.task_id == ttable.id)
+        rows = db(query).select(ttable.function_name,
+                                ttable.group_name,
+                                rtable.status,
+                                rtable.start_time,
+                                rtable.stop_time,
+                                )
+        for row in rows:
+            task = row.scheduler_task
+            run = row.scheduler_run
+            item = entry(task.function_name, task.group_name)
+            item.runs += 1
+            if run.status != "COMPLETED":
+                item.failures += 1
+            runtime = (run.stop_time - run.start_time).total_seconds()
+            item.total += runtime
+            item.max = max(item.max, runtime)
+        for item in metrics.values():
+            if item.runs:
+                item.avg = item.total / item.runs
+
+        # Order by priority of the queue, then task name
+        queues = self.queues
+        def order(item):
+            queue = item.queue
+            return (queues.index(queue) if queue in queues else len(queues),
+                    item.task)
+        return sorted(metrics.values(), key=order)
+
     # -------------------------------------------------------------------------
     def _duplicate_task_exists(self, task, args, vars):
         """
@@ -463,4 +807,84 @@ class S3Task(object):
 
         current.auth.s3_impersonate(user_id)
 
+    # -------------------------------------------------------------------------
+    def run_deferred_hooks(self, limit=500):
+        """
+            Run pending deferred hooks in batches per table and hook
+            - run from within the task
+
+            @param limit: the maximum number of entries per batch
+
+            @return: the number of entries processed
+        """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.s3_deferred_hook
+
+        done = 0
+        failed = set()
+        while True:
+            now = datetime.datetime.utcnow()
+            query = (table.status == "PENDING") & \
+                    ((table.next_attempt == None) | \
+                     (table.next_attempt <= now))
+            if failed:
+                query &= ~(table.id.belongs(failed))
+            rows = db(query).select(table.id,
+                                    table.tablename,
+                                    table.hook,
+                                    table.record_id,
+                                    table.attempts,
+                                    limitby = (0, limit),
+                                    orderby = table.id,
+                                    )
+            if not rows:
+                break
+
+            # Coalesce by table and hook
+            batches = {}
+            for row in rows:
+                key = (row.tablename, row.hook)
+                batch = batches.get(key)
+                if batch is None:
+                    batch = batches[key] = Storage(entries=[], record_ids=set())
+                batch.entries.append(row)
+                batch.record_ids.add(row.record_id)
+
+            for (tablename, hook), batch in batches.items():
+                entry_ids = [row.id for row in batch.entries]
+                try:
+                    # Load the model and find the hook
+                    s3db.table(tablename)
+                    hooks = s3db.get_config(tablename, "deferred") or {}
+                    if hook not in hooks:
+                        raise KeyError("Undeclared deferred hook %s for %s" % \
+                                       (hook, tablename))
+                    hooks[hook](sorted(batch.record_ids))
+                except Exception, e:
+                    db.rollback()
+                    error = str(e)
+                    current.log.error("Deferred hook %s for %s failed" % \
+                                      (hook, tablename), error)
+                    for row in batch.entries:
+                        attempts = row.attempts + 1
+                        if attempts >= self.DEFERRED_ATTEMPTS:
+                            status = "FAILED"
+                        else:
+                            status = "PENDING"
+                        delay = datetime.timedelta(minutes=2 ** attempts)
+                        db(table.id == row.id).update(status = status,
+                                                      attempts = attempts,
+                                                      next_attempt = now + delay,
+                                                      error = error,
+                                                      )
+                    failed.update(entry_ids)
+                else:
+                    db(table.id.belongs(entry_ids)).delete()
+                    done += len(entry_ids)
+                db.commit()
+
+        return done
+
 # END =========================================================================
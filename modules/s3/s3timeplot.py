@@ -41,8 +41,10 @@ except ImportError:
     except:
         import gluon.contrib.simplejson as json # fallback to pure-Python module
 
+from bisect import bisect_right
 from dateutil.relativedelta import *
 from dateutil.rrule import *
+from heapq import heappop, heappush
 from itertools import izip, tee
 
 from gluon import current
@@ -133,29 +135,33 @@ class S3TimePlot(S3Method):
         except (SyntaxError, ValueError):
             r.error(400, sys.exc_info()[1])
 
-        # Add event data
+        # Add event data, aggregated in the database where possible
         try:
-            self.add_event_data(event_frame,
-                                resource,
-                                event_start,
-                                event_end,
-                                [fact])
+            if not self.add_event_totals(event_frame,
+                                         resource,
+                                         event_start,
+                                         event_end,
+                                         fact,
+                                         method):
+                self.add_event_data(event_frame,
+                                    resource,
+                                    event_start,
+                                    event_end,
+                                    [fact])
         except (SyntaxError):
             pass
 
-        # Iterate over the event frame to collect aggregates
+        # Collect the aggregates for all periods
         items = []
         new_item = items.append
-        for period in event_frame:
-            item_start = period.start
+        aggregates = event_frame.aggregate(method=method,
+                                           field=fact.colname,
+                                           event_type=resource.tablename)
+        for item_start, item_end, value in aggregates:
             if item_start:
                 item_start = item_start.isoformat()
-            item_end = period.end
             if item_end:
                 item_end = item_end.isoformat()
-            value = period.aggregate(method=method,
-                                     field=fact.colname,
-                                     event_type=resource.tablename)
             new_item((item_start, item_end, value))
 
         # Convert to JSON
@@ -292,6 +298,114 @@ class S3TimePlot(S3Method):
 
         return data
         
+    # -------------------------------------------------------------------------
+    def add_event_totals(self,
+                         event_frame,
+                         resource,
+                         event_start,
+                         event_end,
+                         fact,
+                         method):
+        """
+            Aggregate the event data in the database (grouped by event
+            start and end) and add the totals to the event frame, which
+            avoids extracting every single event if many events share the
+            same start/end (e.g. date fields)
+
+            @param event_frame: the event frame
+            @param resource: the resource
+            @param event_start: the event start field (S3ResourceField)
+            @param event_end: the event_end field (S3ResourceField)
+            @param fact: the fact field (S3ResourceField)
+            @param method: the aggregation method
+
+            @return: True if successful, False if the events must be
+                     extracted individually (add_event_data)
+        """
+
+        tablename = resource.tablename
+
+        # Only for fields in the master table, and if the resource
+        # query does not require any left joins or virtual filters
+        rfields = [event_start, fact]
+        if event_end:
+            rfields.append(event_end)
+        for rfield in rfields:
+            if rfield.field is None or \
+               rfield.tname != tablename or \
+               rfield.ftype[:5] == "list:":
+                return False
+        if resource.parent or \
+           resource.get_filter() is not None or \
+           resource.rfilter.get_left_joins():
+            return False
+
+        start_field = event_start.field
+        end_field = event_end.field if event_end else None
+        fact_field = fact.field
+
+        # Filter by event frame
+        query = resource.get_query()
+        if end_field:
+            query &= (end_field == None) | (end_field >= event_frame.start)
+        query &= (start_field == None) | (start_field <= event_frame.end)
+
+        # Aggregates
+        size = resource._id.count()
+        count = fact_field.count()
+        aggregates = [size, count]
+        total = minimum = maximum = None
+        if method in ("sum", "avg"):
+            total = fact_field.sum()
+            aggregates.append(total)
+        elif method == "min":
+            minimum = fact_field.min()
+            aggregates.append(minimum)
+        elif method == "max":
+            maximum = fact_field.max()
+            aggregates.append(maximum)
+
+        fields = [start_field]
+        groupby = start_field
+        if end_field:
+            fields.append(end_field)
+            groupby |= end_field
+        rows = current.db(query).select(groupby=groupby,
+                                        *(fields + aggregates))
+
+        # Do we need to convert dates into datetimes?
+        fromordinal = datetime.datetime.fromordinal
+        def convert(dt):
+            if dt is not None and not isinstance(dt, datetime.datetime):
+                dt = fromordinal(dt.toordinal())
+            return dt
+
+        colname = fact.colname
+
+        # Create the event groups
+        events = []
+        add_event = events.append
+        for index, row in enumerate(rows):
+            start = convert(row[start_field])
+            end = convert(row[end_field]) if end_field else None
+            num = row[count]
+            totals = {colname: (num,
+                                (row[total] or 0) if total else None,
+                                row[minimum] if minimum else None,
+                                row[maximum] if maximum else None)}
+            event = S3TimePlotEventGroup(index,
+                                         start = start,
+                                         end = end,
+                                         size = row[size],
+                                         totals = totals,
+                                         event_type = tablename)
+            add_event(event)
+
+        if events:
+            event_frame.extend(events)
+
+        return True
+
     # -------------------------------------------------------------------------
     def create_event_frame(self,
                            event_start,
@@ -608,6 +722,90 @@ class S3TimePlotEvent(object):
 
         return self.values.get(field, None)
 
+    # -------------------------------------------------------------------------
+    def summarize(self, field=None):
+        """
+            Get the totals of an attribute of this event
+
+            @param field: the attribute field name, None to count
+                          the event itself
+
+            @return: tuple (count, total, minimum, maximum), total being
+                     None if the values can not be summed up
+        """
+
+        if field is None:
+            return (1, None, None, None)
+
+        value = self.values.get(field, None)
+        if value is None:
+            return (0, 0, None, None)
+        elif type(value) is list:
+            values = [v for v in value if v is not None]
+            if not values:
+                return (0, 0, None, None)
+        else:
+            values = [value]
+
+        try:
+            total = sum(values)
+        except (TypeError, ValueError):
+            total = None
+        try:
+            minimum = min(values)
+            maximum = max(values)
+        except (TypeError, ValueError):
+            minimum = maximum = None
+        return (len(values), total, minimum, maximum)
+
+# =============================================================================
+class S3TimePlotEventGroup(S3TimePlotEvent):
+    """
+        Class representing a group of events with the same start and end,
+        with pre-computed totals (e.g. from aggregation in the database)
+    """
+
+    def __init__(self,
+                 event_id,
+                 start=None,
+                 end=None,
+                 size=1,
+                 totals=None,
+                 event_type=None):
+        """
+            Constructor
+
+            @param event_id: the event group identifier
+            @param start: start time of the events (datetime.datetime)
+            @param end: end time of the events (datetime.datetime)
+            @param size: the number of events in the group
+            @param totals: the totals of the attributes of the events,
+                           a dict {field: (count, total, minimum, maximum)}
+            @param event_type: the event type identifier
+        """
+
+        super(S3TimePlotEventGroup, self).__init__(event_id,
+                                                   start=start,
+                                                   end=end,
+                                                   event_type=event_type)
+        self.size = size
+        self.totals = totals if totals is not None else {}
+
+    # -------------------------------------------------------------------------
+    def summarize(self, field=None):
+        """
+            Get the totals of an attribute of the events in this group
+
+            @param field: the attribute field name, None to count
+                          the events
+
+            @return: tuple (count, total, minimum, maximum)
+        """
+
+        if field is None:
+            return (self.size, None, None, None)
+        return self.totals.get(field, (0, 0, None, None))
+
 # =============================================================================
 class S3TimePlotPeriod(object):
     """ Class representing a period within the time frame """
@@ -659,67 +857,75 @@ class S3TimePlotPeriod(object):
             @param method: the aggregation method
         """
 
-        if field is None and method == "count":
-            return self.count(event_type)
-        else:
-            events = self.events(event_type)
-
-            if field:
-                values = []
-                for event in events:
-                    value = event[field]
-                    if value is None:
-                        continue
-                    elif type(value) is list:
-                        values.extend([v for v in value if v is not None])
-                    else:
-                        values.append(value)
-                if method == "count":
-                    return len(values)
+        summaries = [event.summarize(field)
+                     for event in self.events(event_type)]
+        return self.combine(method, field, summaries)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def combine(cls, method, field, summaries):
+        """
+            Aggregate event summaries with the given method
+
+            @param method: the aggregation method as string
+            @param field: the attribute to aggregate
+            @param summaries: iterable of event summaries, tuples
+                              (count, total, minimum, maximum), see
+                              S3TimePlotEvent.summarize
+        """
+
+        count = 0
+        total = 0
+        minimum = maximum = None
+        for num, subtotal, low, high in summaries:
+            if not num:
+                continue
+            count += num
+            if total is not None:
+                if subtotal is None:
+                    total = None
                 else:
-                    return self._aggregate(method, values)
-            else:
-                return None
+                    try:
+                        total += subtotal
+                    except (TypeError, ValueError):
+                        total = None
+            try:
+                if low is not None and (minimum is None or low < minimum):
+                    minimum = low
+                if high is not None and (maximum is None or high > maximum):
+                    maximum = high
+            except (TypeError, ValueError):
+                pass
+        return cls.result(method, field, count, total, minimum, maximum)
 
     # -------------------------------------------------------------------------
     @staticmethod
-    def _aggregate(method, values):
+    def result(method, field, count, total, minimum, maximum):
         """
-            Aggregate a list of values with the given method
+            Get the aggregate value from the totals of a period
 
             @param method: the aggregation method as string
-            @param values: iterable of values
+            @param field: the aggregated attribute
+            @param count: the number of values (or events if no field)
+            @param total: the sum of the values (None if not summable)
+            @param minimum: the minimum value
+            @param maximum: the maximum value
         """
 
-        if values is None:
-            return None
-        else:
-            values = [v for v in values if v != None]
-
         if method == "count":
-            return len(values)
+            return count
+        elif field is None:
+            return None
+        elif method == "sum":
+            return total
+        elif method == "avg":
+            if count and total is not None:
+                return total / float(count)
+            return None
         elif method == "min":
-            try:
-                return min(values)
-            except (TypeError, ValueError):
-                return None
+            return minimum
         elif method == "max":
-            try:
-                return max(values)
-            except (TypeError, ValueError):
-                return None
-        elif method == "sum":
-            try:
-                return sum(values)
-            except (TypeError, ValueError):
-                return None
-        elif method in ("avg"):
-            try:
-                num = len(values)
-                if num:
-                    return sum(values) / float(num)
-            except (TypeError, ValueError):
-                return None
+            return maximum
         return None
 
     # -------------------------------------------------------------------------
@@ -776,9 +982,15 @@ class S3TimePlotEventFrame(object):
         self.end = end
 
         self.slots = slots
-        self.periods = {}
+
+        # All events in this frame
+        self.events = []
+
+        # Periods with their events, built on demand
+        self.periods = None
 
         self.rule = self.get_rule()
+        self._boundaries = None
 
     # -------------------------------------------------------------------------
     def get_rule(self):
@@ -820,64 +1032,183 @@ class S3TimePlotEventFrame(object):
             @param events: iterable of events
 
             @todo: integrate in constructor
-            @todo: handle self.rule == None
         """
 
-        # Order events by start datetime
-        events = sorted(events)
+        self.events.extend(events)
 
-        rule = self.rule
-        periods = self.periods
+        # Periods must be re-built
+        self.periods = None
+        return
 
-        # No point to loop over periods before the first event:
-        start = events[0].start
-        if start is None or start <= self.start:
-            first = rule[0]
-        else:
-            first = rule.before(start, inc=True)
+    # -------------------------------------------------------------------------
+    def boundaries(self):
+        """
+            Get the start and end dates of all periods within this
+            event frame, computed only once from the recurrence rule
 
-        current = []
-        for start in rule.between(first, self.end, inc=True):
+            @return: list of tuples (start, end)
+        """
 
-            # Compute end of this period
-            end = rule.after(start)
-            if not end:
-                if start < self.end:
-                    end = self.end
-                else:
-                    # Period start is at the end of the event frame
-                    break
+        boundaries = self._boundaries
+        if boundaries is None:
 
-            # Find all current events
-            for index, event in enumerate(events):
-                if event.end and event.end < start:
-                    # Event ends before this period
-                    continue
-                elif event.start is None or event.start < end:
-                    # Event starts before or during this period
-                    current.append(event)
-                else:
-                    # Event starts only after this period
+            rule = self.rule
+            if not rule:
+                # @todo: continuous periods
+                raise NotImplementedError
+
+            frame_end = self.end
+            starts = []
+            for dt in rule:
+                if dt >= frame_end:
                     break
+                starts.append(dt)
+            ends = starts[1:] + [frame_end]
+            boundaries = self._boundaries = zip(starts, ends)
+
+        return boundaries
+
+    # -------------------------------------------------------------------------
+    def span(self, event, starts):
+        """
+            Find the first and the last period an event falls into, i.e.
+            the periods which start before the end of the event and end
+            after the start of the event
+
+            @param event: the event
+            @param starts: the sorted list of period start dates
+
+            @return: tuple of period indices (first, last), or None if
+                     the event is outside of the event frame
+        """
+
+        last = len(starts) - 1
+        if last < 0:
+            return None
+
+        start = event.start
+        if start is None:
+            first = 0
+        elif start >= self.end:
+            return None
+        else:
+            first = max(0, bisect_right(starts, start) - 1)
+
+        end = event.end
+        if end is not None:
+            last = min(last, bisect_right(starts, end) - 1)
+            if last < first:
+                return None
+
+        return first, last
+
+    # -------------------------------------------------------------------------
+    def aggregate(self, method="count", field=None, event_type=None):
+        """
+            Aggregate event data for all periods in a single sweep over
+            the period boundaries: each event adds its totals where it
+            starts, and removes them after the period where it ends, so
+            the effort is proportional to the number of periods plus
+            the number of events (rather than periods times events)
+
+            @param method: the aggregation method
+            @param field: the attribute to aggregate
+            @param event_type: the event type
+
+            @return: list of tuples (start, end, value), one per period
+        """
+
+        boundaries = self.boundaries()
+        starts = [b[0] for b in boundaries]
+        num_periods = len(starts)
+
+        # Changes of the running totals at each period
+        delta_count = [0] * (num_periods + 1)
+        delta_total = [0] * (num_periods + 1)
+        delta_events = [0] * (num_periods + 1)
+        delta_invalid = [0] * (num_periods + 1)
+
+        # Values opening at each period, for min/max
+        opening = None
+        if method in ("min", "max") and field is not None:
+            opening = [[] for i in xrange(num_periods)]
+
+        span = self.span
+        for event in self.events:
+
+            if event.event_type != event_type:
+                continue
+            indices = span(event, starts)
+            if indices is None:
+                continue
+            first, last = indices
+
+            count, total, minimum, maximum = event.summarize(field)
+            if not count:
+                continue
+            after = last + 1
+
+            delta_count[first] += count
+            delta_count[after] -= count
+            delta_events[first] += 1
+            delta_events[after] -= 1
+            if total is None:
+                delta_invalid[first] += 1
+                delta_invalid[after] -= 1
+            else:
+                delta_total[first] += total
+                delta_total[after] -= total
+
+            if opening is not None:
+                value = minimum if method == "min" else maximum
+                if value is not None:
+                    if method == "max":
+                        value = _Descending(value)
+                    opening[first].append((value, last))
+
+        # Sweep
+        results = []
+        append = results.append
+
+        result = S3TimePlotPeriod.result
+        count = total = events = invalid = 0
+        heap = []
+        for index, (start, end) in enumerate(boundaries):
+
+            count += delta_count[index]
+            events += delta_events[index]
+            invalid += delta_invalid[index]
+            if events:
+                total += delta_total[index]
+            else:
+                # Reset to prevent rounding errors from accumulating
+                total = 0
+
+            minimum = maximum = None
+            if opening is not None:
+                for item in opening[index]:
+                    heappush(heap, item)
+                # Discard values of events which have ended
+                while heap and heap[0][1] < index:
+                    heappop(heap)
+                if heap:
+                    value = heap[0][0]
+                    if method == "max":
+                        maximum = value.value
+                    else:
+                        minimum = value
+
+            append((start,
+                    end,
+                    result(method,
+                           field,
+                           count,
+                           total if not invalid else None,
+                           minimum,
+                           maximum)))
+
+        return results
 
-            # Add current events to current period
-            period = periods.get(start)
-            if period is None:
-                period = periods[start] = S3TimePlotPeriod(start, end=end)
-            for event in current:
-                period.add(event)
-
-            # Remaining events
-            events = events[index:]
-            if not events:
-                # No more events
-                break
-
-            # Remove events which end during this period
-            current = [event for event in current
-                       if not event.end or event.end > end]
-        return
-        
     # -------------------------------------------------------------------------
     def __iter__(self):
         """
@@ -885,24 +1216,47 @@ class S3TimePlotEventFrame(object):
         """
 
         periods = self.periods
+        if periods is None:
+            periods = self.periods = {}
+
+            boundaries = self.boundaries()
+            starts = [b[0] for b in boundaries]
+
+            # Add each event to all periods within its span
+            span = self.span
+            for event in self.events:
+                indices = span(event, starts)
+                if indices is None:
+                    continue
+                first, last = indices
+                for index in xrange(first, last + 1):
+                    start, end = boundaries[index]
+                    period = periods.get(start)
+                    if period is None:
+                        period = periods[start] = S3TimePlotPeriod(start,
+                                                                   end=end)
+                    period.add(event)
+
+        for start, end in self.boundaries():
+            if start in periods:
+                yield periods[start]
+            else:
+                yield S3TimePlotPeriod(start, end=end)
 
-        rule = self.rule
-        if rule:
-            for dt in rule:
-                if dt >= self.end:
-                    break
-                if dt in periods:
-                    yield periods[dt]
-                else:
-                    end = rule.after(dt)
-                    if not end:
-                        end = self.end
-                    yield S3TimePlotPeriod(dt, end=end)
-        else:
-            # @todo: continuous periods
-            # sort actual periods and iterate over them
-            raise NotImplementedError
-            
         return
 
+# =============================================================================
+class _Descending(object):
+    """ Helper to use max-values in a (min-)heap """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+
+        self.value = value
+
+    def __lt__(self, other):
+
+        return self.value > other.value
+
 # END =========================================================================
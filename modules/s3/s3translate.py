@@ -27,11 +27,16 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import hashlib
+import mmap
 import os
 import parser
+import struct
+import threading
 import token
 
 from gluon import current
+from gluon.cfs import cfs, cfs_lock
 from gluon.languages import read_dict, write_dict
 
 """
@@ -50,6 +55,14 @@ from gluon.languages import read_dict, write_dict
                              (for html/js files) to obtain a list of strings
                              by calling methods from TranslateParseFiles
 
+    TranslateStringCache   : Persistent cache of the strings extracted from
+                             each file, so that only changed files need to be
+                             parsed again (in parallel)
+
+    TranslateCatalog       : Compiled, memory-mapped language catalog which
+                             replaces the dicts from languages/*.py in the
+                             translator (shared by all worker processes)
+
     Strings                : Class to manipulate strings and their files
 
     Pootle                 : Class to synchronise a Pootle server's translation
@@ -94,6 +107,36 @@ class TranslateAPI:
 
             return self.grp.modlist
 
+        # ---------------------------------------------------------------------
+        def prefetch(self, modules, files=None):
+            """
+                Extract the strings from all files of the given modules which
+                have changed since they were last read, in parallel
+
+                @param modules: list of module names
+                @param files: list of additional file names
+            """
+
+            d = self.grp.d
+            jobs = []
+            append = jobs.append
+            for module in modules:
+                for f in d.get(module, []):
+                    if f.endswith(".py"):
+                        append((f, "ALL"))
+                    elif f.endswith(".html") or f.endswith(".js"):
+                        append((f, "HTML"))
+                for f in d["special"]:
+                    if f.endswith(".py"):
+                        append((f, module))
+            for f in files or []:
+                if f.endswith(".py"):
+                    append((os.path.abspath(f), "ALL"))
+                elif f.endswith(".html") or f.endswith(".js"):
+                    append((os.path.abspath(f), "HTML"))
+
+            TranslateStringCache.prefetch(jobs, self.grp.modlist)
+
         # ---------------------------------------------------------------------
         def get_strings_by_module(self, module):
             """ Return a list of strings corresponding to a module """
@@ -106,6 +149,9 @@ class TranslateAPI:
                 current.log.warning("Module '%s' doesn't exist!" % module)
                 return []
 
+            # Parse all changed files at once
+            self.prefetch([module])
+
             modlist = grp.modlist
             strings = []
             sappend = strings.append
@@ -118,7 +164,7 @@ class TranslateAPI:
                     tmpstr = findstr(f, "ALL", modlist)
                 elif f.endswith(".html") == True or \
                      f.endswith(".js") == True:
-                    tmpstr = R.read_html_js(f)
+                    tmpstr = TranslateStringCache.get(f, "HTML")
                 else:
                     tmpstr = []
                 for s in tmpstr:
@@ -153,7 +199,7 @@ class TranslateAPI:
                 tmpstr = R.findstr(filename, "ALL", self.grp.modlist)
             elif filename.endswith(".html") == True or \
                  filename.endswith(".js") == True:
-                tmpstr = R.read_html_js(filename)
+                tmpstr = TranslateStringCache.get(filename, "HTML")
             else:
                 print "Please enter a '.py', '.js' or '.html' file path"
                 return []
@@ -625,60 +671,14 @@ class TranslateReadFiles:
                 modlist -> a list of all modules in Eden
             """
 
-            try:
-                f = open(fileName)
-            except:
+            if not os.path.isfile(fileName):
                 path = os.path.split(__file__)[0]
                 fileName = os.path.join(path, fileName)
-                try:
-                    f = open(fileName)
-                except:
-                    return
-
-            # Read all contents of file
-            fileContent = f.read()
-            f.close()
-
-            # Remove CL-RF and NOEOL characters
-            fileContent = "%s\n" % fileContent.replace("\r", "")
-
-            try:
-                st = parser.suite(fileContent)
-            except:
-                return []
-
-            # Create a parse tree list for traversal
-            stList = parser.st2list(st, line_info=1)
-
-            P = TranslateParseFiles()
-
-            # List which holds the extracted strings
-            strings = []
-
-            if spmod == "ALL":
-                # If all strings are to be extracted, call ParseAll()
-                parseAll = P.parseAll
-                for element in stList:
-                    parseAll(strings, element)
-            else:
-                # Handle cases for special files which contain
-                # strings belonging to different modules
-                appname = current.request.application
-                fileName = os.path.basename(fileName)
-                if fileName == "s3menus.py":
-                    parseMenu = P.parseMenu
-                    for element in stList:
-                        parseMenu(spmod, strings, element, 0)
-
-                elif fileName == "s3cfg.py":
-                    parseS3cfg = P.parseS3cfg
-                    for element in stList:
-                        parseS3cfg(spmod, strings, element, modlist)
+                if not os.path.isfile(fileName):
+                    return []
 
-                elif fileName in ("000_config.py", "config.py"):
-                    parseConfig = P.parseConfig
-                    for element in stList:
-                        parseConfig(spmod, strings, element, modlist)
+            # Strings from the parse tree (cached per file)
+            strings = TranslateStringCache.get(fileName, spmod, modlist)
 
             # Extract strings from deployment_settings.variable() calls
             final_strings = []
@@ -714,6 +714,82 @@ class TranslateReadFiles:
 
             return final_strings
 
+        # ---------------------------------------------------------------------
+        @staticmethod
+        def extract(fileName, spmods, modlist):
+            """
+                Extract the strings from a file, without resolving any
+                deployment_settings (must not use current as it is run in
+                worker processes)
+
+                fileName -> the file to be used for extraction
+                spmods -> the required modules ("ALL" for all strings of a
+                          .py file, "HTML" for html/js files)
+                modlist -> a list of all modules in Eden
+
+                Returns a dict {spmod: [(line, string), ...]}
+            """
+
+            results = {}
+
+            if fileName.endswith(".html") or fileName.endswith(".js"):
+                results["HTML"] = TranslateReadFiles.read_html_js(fileName)
+                return results
+
+            f = open(fileName)
+
+            # Read all contents of file
+            fileContent = f.read()
+            f.close()
+
+            # Remove CL-RF and NOEOL characters
+            fileContent = "%s\n" % fileContent.replace("\r", "")
+
+            try:
+                st = parser.suite(fileContent)
+            except:
+                for spmod in spmods:
+                    results[spmod] = []
+                return results
+
+            # Create a parse tree list for traversal
+            stList = parser.st2list(st, line_info=1)
+
+            baseName = os.path.basename(fileName)
+            for spmod in spmods:
+
+                P = TranslateParseFiles()
+
+                # List which holds the extracted strings
+                strings = []
+
+                if spmod == "ALL":
+                    # If all strings are to be extracted, call ParseAll()
+                    parseAll = P.parseAll
+                    for element in stList:
+                        parseAll(strings, element)
+                else:
+                    # Handle cases for special files which contain
+                    # strings belonging to different modules
+                    if baseName == "s3menus.py":
+                        parseMenu = P.parseMenu
+                        for element in stList:
+                            parseMenu(spmod, strings, element, 0)
+
+                    elif baseName == "s3cfg.py":
+                        parseS3cfg = P.parseS3cfg
+                        for element in stList:
+                            parseS3cfg(spmod, strings, element, modlist)
+
+                    elif baseName in ("000_config.py", "config.py"):
+                        parseConfig = P.parseConfig
+                        for element in stList:
+                            parseConfig(spmod, strings, element, modlist)
+
+                results[spmod] = strings
+
+            return results
+
         # ---------------------------------------------------------------------
         @staticmethod
         def read_html_js(filename):
@@ -895,6 +971,598 @@ class TranslateReadFiles:
 
             return database_strings
 
+# =============================================================================
+def translate_extract_strings(job):
+    """
+        Extract the strings from a file (process pool worker)
+
+        @param job: tuple (fileName, spmods, modlist)
+
+        @return: tuple (fileName, stat, checksum, strings), strings being
+                 None if the file could not be read
+    """
+
+    fileName, spmods, modlist = job
+    try:
+        stat = TranslateStringCache.stat(fileName)
+        checksum = TranslateStringCache.checksum(fileName)
+        strings = TranslateReadFiles.extract(fileName, spmods, modlist)
+    except Exception:
+        return fileName, None, None, None
+    return fileName, stat, checksum, strings
+
+# =============================================================================
+class TranslateStringCache(object):
+    """
+        Persistent cache of the strings extracted from each file, keyed
+        by modification time and size (or content checksum, if only the
+        modification time has changed), so that only changed files need
+        to be parsed again. Changed files are parsed in parallel by a pool
+        of worker processes.
+    """
+
+    VERSION = 2
+
+    # Files from which the strings of a module are extracted depending
+    # on the list of all modules
+    SPECIAL = ("s3cfg.py", "000_config.py", "config.py")
+
+    # The cache, per process: {fileName: {"stat": (mtime, size),
+    #                                     "checksum": md5,
+    #                                     "modlist": md5 or None,
+    #                                     "strings": {spmod: strings}}}
+    _cache = None
+    _dirty = False
+    lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def path():
+        """ The path of the cache file """
+
+        return os.path.join(current.request.folder,
+                            "uploads",
+                            "translate_strings.pkl")
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stat(fileName):
+        """
+            The modification time and size of a file
+
+            @param fileName: the file name
+        """
+
+        stat = os.stat(fileName)
+        return (stat.st_mtime, stat.st_size)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def checksum(fileName):
+        """
+            The checksum of the contents of a file
+
+            @param fileName: the file name
+        """
+
+        f = open(fileName, "rb")
+        try:
+            return hashlib.md5(f.read()).hexdigest()
+        finally:
+            f.close()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def modlist_hash(cls, fileName, modlist):
+        """
+            The checksum of the module list, for files from which the
+            strings are extracted depending on it
+
+            @param fileName: the file name
+            @param modlist: a list of all modules in Eden
+
+            @return: the checksum, or None if the strings of the file
+                     do not depend on the module list
+        """
+
+        if os.path.basename(fileName) not in cls.SPECIAL:
+            return None
+        return hashlib.md5(" ".join(sorted(modlist or []))).hexdigest()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def load(cls):
+        """ Load the cache from the cache file """
+
+        if cls._cache is None:
+            try:
+                import cPickle as pickle
+            except:
+                import pickle
+            cache = {}
+            path = cls.path()
+            if os.path.exists(path):
+                try:
+                    f = open(path, "rb")
+                    try:
+                        version, cache = pickle.load(f)
+                    finally:
+                        f.close()
+                    if version != cls.VERSION:
+                        cache = {}
+                except Exception:
+                    cache = {}
+            cls._cache = cache
+        return cls._cache
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def save(cls):
+        """ Write the cache to the cache file """
+
+        if not cls._dirty or cls._cache is None:
+            return
+        try:
+            import cPickle as pickle
+        except:
+            import pickle
+        path = cls.path()
+        tmp = "%s.%s" % (path, os.getpid())
+        with cls.lock:
+            # Dump a copy, as other threads may modify the cache meanwhile
+            cache = dict((fileName, dict(entry, strings=dict(entry["strings"])))
+                         for fileName, entry in cls._cache.items())
+            cls._dirty = False
+            try:
+                f = open(tmp, "wb")
+                try:
+                    pickle.dump((cls.VERSION, cache), f, pickle.HIGHEST_PROTOCOL)
+                finally:
+                    f.close()
+                os.rename(tmp, path)
+            except (IOError, OSError, RuntimeError):
+                current.log.warning("Could not write translation strings cache")
+                cls._dirty = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def lookup(cls, fileName, spmod, modlist=None):
+        """
+            Look up the strings of a file in the cache
+
+            @param fileName: the file name
+            @param spmod: the module ("ALL" or "HTML" for all strings)
+            @param modlist: a list of all modules in Eden
+
+            @return: the strings, or None if not cached or outdated
+        """
+
+        cache = cls.load()
+        entry = cache.get(fileName)
+        if entry is None:
+            return None
+        if entry.get("modlist") != cls.modlist_hash(fileName, modlist):
+            return None
+        try:
+            stat = cls.stat(fileName)
+            if stat != entry["stat"]:
+                if cls.checksum(fileName) != entry["checksum"]:
+                    del cache[fileName]
+                    cls._dirty = True
+                    return None
+                # Only touched
+                entry["stat"] = stat
+                cls._dirty = True
+        except (IOError, OSError):
+            return None
+        return entry["strings"].get(spmod)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def prefetch(cls, jobs, modlist):
+        """
+            Extract the strings from all files which are not in the cache,
+            or have changed since
+
+            @param jobs: list of tuples (fileName, spmod)
+            @param modlist: a list of all modules in Eden
+        """
+
+        lookup = cls.lookup
+        pending = {}
+        for fileName, spmod in jobs:
+            if lookup(fileName, spmod, modlist) is None:
+                pending.setdefault(fileName, set()).add(spmod)
+
+        if pending:
+            tasks = [(fileName, sorted(spmods), modlist)
+                     for fileName, spmods in pending.items()]
+            results = cls.run(tasks)
+            cache = cls.load()
+            with cls.lock:
+                for fileName, stat, checksum, strings in results:
+                    if strings is None:
+                        continue
+                    modlist_hash = cls.modlist_hash(fileName, modlist)
+                    entry = cache.get(fileName)
+                    if entry and entry["stat"] == stat and \
+                       entry.get("modlist") == modlist_hash:
+                        entry["strings"].update(strings)
+                    else:
+                        cache[fileName] = {"stat": stat,
+                                           "checksum": checksum,
+                                           "modlist": modlist_hash,
+                                           "strings": strings,
+                                           }
+                cls._dirty = True
+
+        cls.save()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, fileName, spmod, modlist=None):
+        """
+            Get the strings of a file, from the cache if possible
+
+            @param fileName: the file name
+            @param spmod: the module ("ALL" or "HTML" for all strings)
+            @param modlist: a list of all modules in Eden
+
+            @return: list of tuples (line, string)
+        """
+
+        strings = cls.lookup(fileName, spmod, modlist)
+        if strings is None:
+            cls.prefetch([(fileName, spmod)], modlist)
+            strings = cls.lookup(fileName, spmod, modlist)
+        return strings or []
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def run(tasks):
+        """
+            Run extraction tasks, in parallel if possible
+
+            @param tasks: list of tuples (fileName, spmods, modlist)
+        """
+
+        workers = current.deployment_settings.get_L10n_translate_workers()
+        if workers > 1 and len(tasks) > 1:
+            try:
+                import multiprocessing
+                pool = multiprocessing.Pool(min(workers, len(tasks)))
+                try:
+                    return pool.map(translate_extract_strings, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            except Exception:
+                current.log.warning("Parallel string extraction failed, falling back to serial")
+        return [translate_extract_strings(task) for task in tasks]
+
+# =============================================================================
+class TranslateCatalog(object):
+    """
+        Compiled language catalog: the strings from a languages/*.py file
+        in a binary file with sorted keys and string offsets, which is
+        memory-mapped (read-only) and can therefore be shared by all worker
+        processes, and is installed in place of the dict in web2py's file
+        cache, so that the translator uses it for T() lookups.
+
+        File format (all integers little-endian):
+            header: magic (8 bytes), source mtime (double),
+                    source size (uint64), number of entries (uint32)
+            index:  per entry (sorted by key): key offset, key length,
+                    value offset, value length (4x uint32)
+            data:   the UTF-8 encoded keys and values
+    """
+
+    MAGIC = "S3L10N01"
+    HEADER = struct.Struct("<8sdQI")
+    ENTRY = struct.Struct("<IIII")
+
+    # Catalogs and installed source mtimes, per process
+    catalogs = {}
+    installed = {}
+    lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def __init__(self, filename):
+        """
+            Constructor, maps a compiled catalog file
+
+            @param filename: the catalog file name
+        """
+
+        self.filename = filename
+
+        f = open(filename, "rb")
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic, self.mtime, self.size, self.count = \
+            self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            self._map.close()
+            raise ValueError("Invalid language catalog: %s" % filename)
+
+        self._index = self.HEADER.size
+        self._data = self._index + self.count * self.ENTRY.size
+
+        # Strings added at runtime (writable translator)
+        self.added = {}
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def compile(cls, source, target):
+        """
+            Compile a language file
+
+            @param source: the language file name (languages/*.py)
+            @param target: the catalog file name
+        """
+
+        stat = os.stat(source)
+        strings = read_dict(source)
+
+        encode = lambda s: s.encode("utf-8") if isinstance(s, unicode) else str(s)
+        items = sorted((encode(k), encode(v)) for k, v in strings.items())
+
+        index = []
+        data = []
+        offset = 0
+        pack = cls.ENTRY.pack
+        for key, value in items:
+            klen, vlen = len(key), len(value)
+            index.append(pack(offset, klen, offset + klen, vlen))
+            data.append(key)
+            data.append(value)
+            offset += klen + vlen
+
+        folder = os.path.dirname(target)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Write to a temporary file, then replace the catalog atomically
+        # (processes which have mapped the old file continue to use it)
+        tmp = "%s.%s" % (target, os.getpid())
+        f = open(tmp, "wb")
+        try:
+            f.write(cls.HEADER.pack(cls.MAGIC,
+                                    stat.st_mtime,
+                                    stat.st_size,
+                                    len(items)))
+            f.write("".join(index))
+            f.write("".join(data))
+        finally:
+            f.close()
+        os.rename(tmp, target)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def load(cls, code):
+        """
+            Get the catalog for a language, compile it if it doesn't exist
+            or the language file has changed
+
+            @param code: the language code
+
+            @return: the TranslateCatalog, or None if the language file
+                     doesn't exist or can not be compiled
+        """
+
+        folder = current.request.folder
+        source = os.path.join(folder, "languages", "%s.py" % code)
+        target = os.path.join(folder, "uploads", "languages", "%s.cat" % code)
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+
+        catalog = cls.catalogs.get(code)
+        if catalog is not None and catalog.current(stat):
+            return catalog
+
+        catalog = None
+        if os.path.exists(target):
+            try:
+                catalog = cls(target)
+            except (IOError, OSError, ValueError, struct.error):
+                catalog = None
+            else:
+                if not catalog.current(stat):
+                    catalog = None
+        if catalog is None:
+            try:
+                cls.compile(source, target)
+                catalog = cls(target)
+            except Exception, e:
+                current.log.error("Could not compile language catalog for %s: %s" %
+                                  (code, e))
+                return None
+
+        cls.catalogs[code] = catalog
+        return catalog
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def install(cls, languages):
+        """
+            Install the catalogs for languages in the web2py file cache
+            (which the translator reads the language files from), so that
+            these replace the dicts from the language files
+
+            @param languages: the language codes
+        """
+
+        folder = current.request.folder
+        installed = cls.installed
+
+        for code in languages:
+            source = os.path.join(folder, "languages", "%s.py" % code)
+            try:
+                mtime = os.stat(source).st_mtime
+            except OSError:
+                continue
+            if installed.get(source) == mtime:
+                continue
+
+            cls.lock.acquire()
+            try:
+                catalog = cls.load(code)
+                if catalog is None:
+                    continue
+                key = "lang:%s" % source
+                cfs_lock.acquire()
+                try:
+                    # Use the same timestamp type as the file cache
+                    item = cfs.get(key)
+                    if item is not None and int(item[0]) == int(mtime):
+                        timestamp = item[0]
+                    else:
+                        timestamp = int(mtime)
+                    cfs[key] = (timestamp, catalog)
+                finally:
+                    cfs_lock.release()
+                installed[source] = mtime
+            finally:
+                cls.lock.release()
+
+    # -------------------------------------------------------------------------
+    def current(self, stat):
+        """
+            Check whether this catalog is up-to-date
+
+            @param stat: the os.stat of the language file
+        """
+
+        return self.mtime == stat.st_mtime and self.size == stat.st_size
+
+    # -------------------------------------------------------------------------
+    def _entry(self, i):
+        """
+            Get the key and value offsets of an entry
+
+            @param i: the entry number
+        """
+
+        return self.ENTRY.unpack_from(self._map, self._index + i * self.ENTRY.size)
+
+    # -------------------------------------------------------------------------
+    def _key(self, i):
+        """
+            Get the key of an entry
+
+            @param i: the entry number
+        """
+
+        koffset, klen = self._entry(i)[:2]
+        start = self._data + koffset
+        return self._map[start:start + klen]
+
+    # -------------------------------------------------------------------------
+    def _value(self, i):
+        """
+            Get the value of an entry
+
+            @param i: the entry number
+        """
+
+        voffset, vlen = self._entry(i)[2:]
+        start = self._data + voffset
+        return self._map[start:start + vlen]
+
+    # -------------------------------------------------------------------------
+    def _find(self, key):
+        """
+            Find the entry number for a key (binary search)
+
+            @param key: the key
+
+            @return: the entry number, or None if not found
+        """
+
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        elif not isinstance(key, str):
+            return None
+
+        _key = self._key
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = _key(mid)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    # -------------------------------------------------------------------------
+    # Dict API
+    # -------------------------------------------------------------------------
+    def get(self, key, default=None):
+        """ Look up a translation """
+
+        added = self.added
+        if added and key in added:
+            return added[key]
+        i = self._find(key)
+        if i is None:
+            return default
+        return self._value(i)
+
+    def __getitem__(self, key):
+
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+
+        self.added[key] = value
+
+    def __contains__(self, key):
+
+        return key in self.added or self._find(key) is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+
+        added = [k for k in self.added if self._find(k) is None]
+        return self.count + len(added)
+
+    def __iter__(self):
+
+        _key = self._key
+        for i in xrange(self.count):
+            yield _key(i)
+        for key in self.added:
+            if self._find(key) is None:
+                yield key
+
+    iterkeys = __iter__
+
+    def keys(self):
+
+        return list(self)
+
+    def iteritems(self):
+
+        get = self.get
+        for key in self:
+            yield key, get(key)
+
+    def items(self):
+
+        return list(self.iteritems())
+
 # =============================================================================
 class Strings:
         """ Class to manipulate strings and their files """
@@ -1032,6 +1700,9 @@ class Strings:
                             if element not in modlist:
                                 modlist.append(element)
 
+            # Parse all changed files at once
+            A.prefetch(modlist, filelist)
+
             get_strings_by_module = A.get_strings_by_module
             for mod in modlist:
                 NewStrings += get_strings_by_module(mod)
@@ -1528,6 +2199,9 @@ class TranslateReportStatus(object):
         modules = api.get_modules()
         modules.append("core")
 
+        # Parse all changed files at once
+        api.prefetch(modules)
+
         # The list of all strings
         all_strings = []
         addstring = all_strings.append
@@ -1564,10 +2238,25 @@ class TranslateReportStatus(object):
                     
             indices[module] = module_indices
 
-        # Save all_strings and string_dict as pickle objects in a file
         data_file = os.path.join(current.request.folder,
                                  "uploads",
                                  "temp.pkl")
+
+        # Nothing to do if the strings haven't changed
+        if os.path.exists(data_file):
+            try:
+                f = open(data_file, "rb")
+                try:
+                    unchanged = pickle.load(f) == all_strings and \
+                                pickle.load(f) == indices
+                finally:
+                    f.close()
+            except Exception:
+                unchanged = False
+            if unchanged:
+                return
+
+        # Save all_strings and string_dict as pickle objects in a file
         f = open(data_file, "wb")
         pickle.dump(all_strings, f)
         pickle.dump(indices, f)
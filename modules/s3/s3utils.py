@@ -141,7 +141,64 @@ def s3_remove_last_record_id(tablename=None):
         if RCVARS in session:
             del session[RCVARS]
     return True
-    
+
+# =============================================================================
+def s3_on_commit(callback, after=False):
+    """
+        Register a callback to run when the current request commits
+        its transaction (web2py calls response.custom_commit with the
+        adapter of every open database connection at the end of the
+        request)
+
+        @param callback: the callback, a function without arguments;
+                         callbacks registered more than once run only
+                         once per commit
+        @param after: run the callback after commit (errors are then
+                      only logged), rather than before
+
+        @return: False if the callback can not be registered because
+                 the current request doesn't commit this way (shell
+                 scripts, scheduler tasks), otherwise True
+    """
+
+    request = current.request
+    if request.is_shell or request.is_scheduler:
+        return False
+
+    response = current.response
+    hooks = response.s3.commit_hooks
+    if hooks is None:
+        hooks = response.s3.commit_hooks = ([], [])
+        commit = response.custom_commit
+
+        def custom_commit(adapter=None):
+            db = current.db
+            if adapter is None:
+                adapter = db._adapter
+            main = adapter is db._adapter
+            if main:
+                before = hooks[0]
+                while before:
+                    before.pop(0)()
+            if commit:
+                commit(adapter)
+            else:
+                adapter.commit()
+            if main:
+                after = hooks[1]
+                while after:
+                    try:
+                        after.pop(0)()
+                    except Exception, e:
+                        current.log.error("Post-commit hook failed: %s" % e)
+
+        response.custom_commit = custom_commit
+
+    callbacks = hooks[1] if after else hooks[0]
+    if callback not in callbacks:
+        callbacks.append(callback)
+    return True
+
 # =============================================================================
 def s3_validate(table, field, value, record=None):
     """
@@ -248,7 +248,8 @@ class S3XML(S3Codec):
             Transform an element tree with XSLT
 
             @param tree: the element tree
-            @param stylesheet_path: pathname of the XSLT stylesheet
+            @param stylesheet_path: pathname of the XSLT stylesheet, or the
+                                    pre-parsed or pre-compiled stylesheet
             @param args: dict of arguments to pass to the stylesheet
         """
 
@@ -259,16 +260,21 @@ class S3XML(S3Codec):
         else:
             _args = None
             
-        if isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
+        if isinstance(stylesheet_path, etree.XSLT):
+            # Pre-compiled stylesheet (see: transformer)
+            stylesheet = transformer = stylesheet_path
+        elif isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
             # Pre-parsed stylesheet
             stylesheet = stylesheet_path
+            transformer = None
         else:
             stylesheet = self.parse(stylesheet_path)
+            transformer = None
 
         if stylesheet is not None:
             try:
-                ac = etree.XSLTAccessControl(read_file=True, read_network=True)
-                transformer = etree.XSLT(stylesheet, access_control=ac)
+                if transformer is None:
+                    transformer = self.transformer(stylesheet)
                 if _args:
                     result = transformer(tree, **_args)
                 else:
@@ -282,6 +288,27 @@ class S3XML(S3Codec):
             # Error parsing the XSL stylesheet
             return None
 
+    # -------------------------------------------------------------------------
+    def transformer(self, stylesheet_path):
+        """
+            Compile an XSLT stylesheet, to re-use it for multiple
+            transformations (e.g. of batches of the same source)
+
+            @param stylesheet_path: pathname of the XSLT stylesheet, or
+                                    the pre-parsed stylesheet
+            @return: the etree.XSLT transformer, or None for error
+        """
+
+        if isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
+            stylesheet = stylesheet_path
+        else:
+            stylesheet = self.parse(stylesheet_path)
+            if stylesheet is None:
+                return None
+
+        ac = etree.XSLTAccessControl(read_file=True, read_network=True)
+        return etree.XSLT(stylesheet, access_control=ac)
+
     # -------------------------------------------------------------------------
     def envelope(self, tree, stylesheet_path, **args):
         """
@@ -2240,6 +2267,45 @@ class S3XML(S3Codec):
             @return: an etree.ElementTree representing the table
         """
 
+        for tree in cls.xls2trees(source,
+                                  resourcename=resourcename,
+                                  extra_data=extra_data,
+                                  sheet=sheet,
+                                  rows=rows,
+                                  cols=cols,
+                                  fields=fields,
+                                  header_row=header_row):
+            return tree
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def xls2trees(cls, source,
+                  resourcename=None,
+                  extra_data=None,
+                  sheet=None,
+                  rows=None,
+                  cols=None,
+                  fields=None,
+                  header_row=True,
+                  batch_size=None):
+        """
+            Convert a table in an XLS (MS Excel) sheet into a sequence of
+            element trees (see: L{xls2tree}) of at most batch_size rows each
+
+            @param source: the XLS source (see: L{xls2tree})
+            @param resourcename: the resource name
+            @param extra_data: dict of extra cols to add to each row
+            @param sheet: sheet name or index, or an open XLRD sheet
+            @param rows: Rows range (see: L{xls2tree})
+            @param cols: Columns range (see: L{xls2tree})
+            @param fields: Field map (see: L{xls2tree})
+            @param header_row: the first row contains column headers
+            @param batch_size: the maximum number of rows per tree,
+                               None for all rows in one tree
+
+            @return: generator of etree.ElementTrees (at least one)
+        """
+
         import xlrd
         
         # Shortcuts
@@ -2252,9 +2318,12 @@ class S3XML(S3Codec):
         DEFAULT_SHEET_NAME = "SahanaData"
 
         # Root element
-        root = etree.Element(TAG.table)
-        if resourcename is not None:
-            root.set(ATTRIBUTE.name, resourcename)
+        def new_root():
+            root = etree.Element(TAG.table)
+            if resourcename is not None:
+                root.set(ATTRIBUTE.name, resourcename)
+            return root
+        root = new_root()
 
         if isinstance(sheet, xlrd.sheet.Sheet):
             # Open work sheet passed as argument => use this
@@ -2383,6 +2452,9 @@ class S3XML(S3Codec):
                                 extra_fields.discard(header)
                         check_headers = False
                 else:
+                    if batch_size and len(root) == batch_size:
+                        yield etree.ElementTree(root)
+                        root = new_root()
                     # Add output row
                     orow = SubElement(root, ROW)
                     for cidx, name in headers.items():
@@ -2403,8 +2475,8 @@ class S3XML(S3Codec):
                             add_col(orow, key, None, extra_data[key])
                 record_idx += 1
 
-        return  etree.ElementTree(root)
-        
+        yield etree.ElementTree(root)
+
     # -------------------------------------------------------------------------
     @classmethod
     def csv2tree(cls, source,
@@ -2425,6 +2497,37 @@ class S3XML(S3Codec):
             @todo: add a character encoding parameter to skip the guessing
         """
 
+        for tree in cls.csv2trees(source,
+                                  resourcename=resourcename,
+                                  extra_data=extra_data,
+                                  delimiter=delimiter,
+                                  quotechar=quotechar):
+            return tree
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def csv2trees(cls, source,
+                  resourcename=None,
+                  extra_data=None,
+                  delimiter=",",
+                  quotechar='"',
+                  batch_size=None):
+        """
+            Convert a table-form CSV source into a sequence of element trees
+            (see: L{csv2tree}) of at most batch_size rows each, reading the
+            source incrementally
+
+            @param source: the source (file-like object)
+            @param resourcename: the resource name
+            @param extra_data: dict of extra cols to add to each row
+            @param delimiter: delimiter for values
+            @param quotechar: quotation character
+            @param batch_size: the maximum number of rows per tree,
+                               None for all rows in one tree
+
+            @return: generator of etree.ElementTrees (at least one)
+        """
+
         import csv
 
         # Increase field sixe to be able to import WKTs
@@ -2435,11 +2538,14 @@ class S3XML(S3Codec):
         FIELD = ATTRIBUTE.field
         TAG = cls.TAG
         COL = TAG.col
+        ROW = TAG.row
         SubElement = etree.SubElement
 
-        root = etree.Element(TAG.table)
-        if resourcename is not None:
-            root.set(ATTRIBUTE.name, resourcename)
+        def new_root():
+            root = etree.Element(TAG.table)
+            if resourcename is not None:
+                root.set(ATTRIBUTE.name, resourcename)
+            return root
 
         def add_col(row, key, value):
             col = SubElement(row, COL)
@@ -2477,6 +2583,9 @@ class S3XML(S3Codec):
                     else:
                         e = encoding
                         break
+
+        root = new_root()
+        rows = 0
         try:
             import StringIO
             if not isinstance(source, StringIO.StringIO):
@@ -2484,8 +2593,11 @@ class S3XML(S3Codec):
             reader = csv.DictReader(source,
                                     delimiter=delimiter,
                                     quotechar=quotechar)
-            ROW = TAG.row
             for r in reader:
+                if batch_size and rows == batch_size:
+                    yield etree.ElementTree(root)
+                    root = new_root()
+                    rows = 0
                 row = SubElement(root, ROW)
                 for k in r:
                     add_col(row, k, r[k])
@@ -2493,6 +2605,7 @@ class S3XML(S3Codec):
                     for key in extra_data:
                         if key not in r:
                             add_col(row, key, extra_data[key])
+                rows += 1
         except csv.Error:
             e = sys.exc_info()[1]
             raise HTTP(400, body=cls.json_message(False, 400, e))
@@ -2500,7 +2613,7 @@ class S3XML(S3Codec):
         # Use this to debug the source tree if needed:
         #print >>sys.stderr, cls.tostring(root, pretty_print=True)
 
-        return  etree.ElementTree(root)
+        yield etree.ElementTree(root)
 
 # =============================================================================
 class S3XMLFormat(object):
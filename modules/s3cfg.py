@@ -488,6 +488,24 @@ class S3Config(Storage):
         return self.security.get("audit_read", False)
     def get_security_audit_write(self):
         return self.security.get("audit_write", False)
+    def get_security_audit_buffer(self):
+        """
+            How to write the audit trail:
+            False = insert each entry immediately (default)
+            True = collect the entries of a request and insert them
+                   all at once at commit
+            "log" = collect the entries of a request and append them to
+                    the audit log file at commit, to be bulk-loaded into
+                    the audit table by the s3_audit_load task
+            (Shell scripts and scheduler tasks always insert immediately)
+        """
+        return self.security.get("audit_buffer", False)
+    def get_security_audit_log(self):
+        """
+            Path of the audit log file for buffered auditing,
+            relative to the application folder
+        """
+        return self.security.get("audit_log", "private/audit.log")
     def get_security_policy(self):
         " Default is Simple Security Policy "
         return self.security.get("policy", 1)
@@ -536,6 +554,60 @@ class S3Config(Storage):
         """ Whether to prepopulate the database &, if so, which set of data to use for this """
         return self.base.get("prepopulate", 1)
 
+    def get_base_import_batch_size(self):
+        """
+            Number of rows to read, transform and import at a time in bulk
+            CSV/XLS imports (e.g. prepopulate), to limit the memory use for
+            large files - None to import each file in one go
+        """
+        return self.base.get("import_batch_size", None)
+
+    def get_base_task_queues(self):
+        """
+            Named queues (=scheduler groups) for asynchronous tasks, in
+            order of priority, as list of tuples (queue, [task name patterns]),
+            tasks not matching any pattern go into the "main" queue
+
+            Workers can be dedicated to queues, e.g.:
+                python web2py.py -K eden:interactive,eden:main:batch
+        """
+        return self.base.get("task_queues",
+                             [("interactive", ["crop_image",
+                                               "msg_parse",
+                                               "msg_process_outbox",
+                                               "notify_*",
+                                               "s3_run_deferred_hooks",
+                                               ]),
+                              ("main", None),
+                              ("batch", ["*_aggregate*",
+                                         "*_rebuild_*",
+                                         "*_update_matches",
+                                         "msg_process_keygraph",
+                                         "gis_export_ldata",
+                                         "gis_update_location_tree",
+                                         "inv_stock_snapshot",
+                                         "maintenance",
+                                         "s3_audit_load",
+                                         "sync_synchronize",
+                                         ]),
+                              ])
+
+    def get_base_count_cache(self):
+        """
+            Time in seconds to cache the total numbers of records matching
+            resource queries (invalidated by writes to the tables involved),
+            set to 0 to disable
+        """
+        return self.base.get("count_cache", 300)
+
+    def get_base_count_approximate(self):
+        """
+            Use the query planner's row estimate instead of counting when it
+            is above this number of records (PostgreSQL only), None to
+            always count exactly
+        """
+        return self.base.get("count_approximate", None)
+
     def get_base_guided_tour(self):
         """ Whether the guided tours are enabled """
         return self.base.get("guided_tour", False)
@@ -623,6 +695,14 @@ class S3Config(Storage):
             line number, function name), useful for diagnostics
         """
         return self.log.get("caller_info", False)
+
+    def get_log_profile(self):
+        """
+            True to profile the models pipeline (time and DB queries per
+            model file, model and menu), reported in the X-S3-Profile
+            response header and in admin/profile
+        """
+        return self.log.get("profile", False)
         
     # -------------------------------------------------------------------------
     # Database settings
@@ -739,6 +819,16 @@ class S3Config(Storage):
         """
         return self.gis.get("clear_layers", False)
 
+    def get_gis_config_cache(self):
+        """
+            Time (in seconds) to keep compiled map configurations (merged
+            configs and layers) in the cache, False to disable. Changes to
+            configs, layers, markers, projections and symbologies invalidate
+            the cache immediately, other changes affecting the personal
+            config (e.g. org memberships) only once it has expired.
+        """
+        return self.gis.get("config_cache", 3600)
+
     def get_gis_countries(self):
         """
             Which country codes should be accessible to the location selector?
@@ -764,6 +854,21 @@ class S3Config(Storage):
         " Should Addresses imported from CSV be passed to a Geocoder to try and automate Lat/Lon? "
         return self.gis.get("geocode_imported_addresses", False)
 
+    def get_gis_gazetteer(self):
+        """
+            Whether to resolve addresses from the local gazetteer (the
+            names of the locations in the database) before using a remote
+            geocoder
+        """
+        return self.gis.get("gazetteer", True)
+
+    def get_gis_geocode_cache(self):
+        """
+            Number of days to keep results of remote geocoders in the
+            cache, 0 to disable the cache
+        """
+        return self.gis.get("geocode_cache", 30)
+
     def get_gis_geoserver_url(self):
         return self.gis.get("geoserver_url", "")
     def get_gis_geoserver_username(self):
@@ -1013,6 +1118,13 @@ class S3Config(Storage):
     def get_L10n_languages_readonly(self):
         return self.L10n.get("languages_readonly", True)
 
+    def get_L10n_compiled_catalogs(self):
+        """
+            Use compiled, memory-mapped language catalogs instead of
+            the dicts from languages/*.py (shared by all worker processes)
+        """
+        return self.L10n.get("compiled_catalogs", False)
+
     def get_L10n_religions(self):
         """
             Religions used in Person Registry
@@ -1112,6 +1224,25 @@ class S3Config(Storage):
         """
         return self.L10n.get("translate_gis_location", False)
 
+    def get_L10n_translate_workers(self):
+        """
+            Number of processes to extract strings from changed files
+            in parallel (translation tools), 1 to disable
+            - only used in shell scripts and scheduler tasks, web requests
+              always extract the strings in-process
+        """
+        request = current.request
+        if not request.is_shell and not request.is_scheduler:
+            return 1
+        workers = self.L10n.get("translate_workers", None)
+        if workers is None:
+            try:
+                import multiprocessing
+                workers = min(multiprocessing.cpu_count(), 4)
+            except (ImportError, NotImplementedError):
+                workers = 1
+        return workers
+
     def get_L10n_pootle_url(self):
         """ URL for Pootle server """
         return self.L10n.get("pootle_url", "http://pootle.sahanafoundation.org/")
@@ -1336,6 +1467,21 @@ class S3Config(Storage):
         """
         return self.ui.get("use_button_glyphicons", False)
 
+    def get_ui_keyset_pagination(self):
+        """
+            Page through data tables and data lists by seeking from the
+            last record of the previous page rather than with OFFSET
+        """
+        return self.ui.get("keyset_pagination", True)
+
+    def get_ui_deferred_totals(self):
+        """
+            Time in seconds for which the total number of records is
+            re-used when paging through the same data table or data list,
+            set to 0 to count for every page
+        """
+        return self.ui.get("deferred_totals", 300)
+
     # =========================================================================
     # Messaging
     #
@@ -1346,6 +1492,42 @@ class S3Config(Storage):
             to retry forever.
         """
         return self.msg.get("max_send_retries", 9)
+
+    def get_msg_outbox_workers(self):
+        """
+            Number of concurrent connections per outbound channel for
+            the outbox dispatcher, e.g. {"EMAIL": 4, "SMS": 2}
+        """
+        return self.msg.get("outbox_workers", {"EMAIL": 4, "SMS": 2})
+
+    def get_msg_outbox_rate(self):
+        """
+            Maximum number of messages per second per outbound channel,
+            e.g. {"SMS": 5} - unlimited if not set
+        """
+        return self.msg.get("outbox_rate", {})
+
+    def get_msg_poll_concurrent(self):
+        """
+            Poll all enabled RSS feeds and mailboxes together in one
+            scheduled task (per channel type) rather than one task per
+            channel
+        """
+        return self.msg.get("poll_concurrent", False)
+
+    def get_msg_poll_workers(self):
+        """
+            Maximum number of channels to poll concurrently
+        """
+        return self.msg.get("poll_workers", 8)
+
+    def get_msg_hashtag_definitions(self):
+        """
+            Whether to look up definitions of unknown hashtags from
+            tagdef.com for the keyword graph (definitions are cached,
+            max. S3KeyGraph.MAX_TAGDEFS lookups per batch of messages)
+        """
+        return self.msg.get("hashtag_definitions", False)
     
     # -------------------------------------------------------------------------
     # Mail settings
@@ -1390,6 +1572,12 @@ class S3Config(Storage):
         """
         return self.msg.get("parser", "default")
 
+    def get_msg_parser_batch_size(self):
+        """
+            Number of messages to parse at a time (per transaction)
+        """
+        return self.msg.get("parser_batch_size", 100)
+
     # -------------------------------------------------------------------------
     # Notifications
     def get_msg_notify_subject(self):
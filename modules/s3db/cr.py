@@ -42,6 +42,10 @@ class S3CampDataModel(S3Model):
              "cr_shelter_service",
              "cr_shelter",
              "cr_shelter_status",
+             "cr_shelter_aggregate",
+             "cr_shelter_aggregate_item",
+             "cr_shelter_update_aggregates",
+             "cr_shelter_rebuild_aggregates",
              ]
 
     # Define a function model() which takes no parameters (except self):
@@ -379,6 +383,7 @@ class S3CampDataModel(S3Model):
                   filter_widgets = filter_widgets,
                   list_fields = list_fields,
                   onaccept = self.cr_shelter_onaccept,
+                  ondelete = self.cr_shelter_ondelete,
                   report_options = Storage(
                         rows=report_fields,
                         cols=report_fields,
@@ -473,10 +478,117 @@ class S3CampDataModel(S3Model):
                 name_nice = T("Shelter Status"),
                 name_nice_plural = T("Shelter Statuses"))
 
+        configure(tablename,
+                  onaccept = self.cr_shelter_status_onaccept,
+                  )
+
+        # -------------------------------------------------------------------------
+        # Shelter aggregates
+        # - capacity, population and status counts per location (L0-L4)
+        #   and shelter type (None = all types), maintained incrementally
+        #   by cr_shelter_update_aggregates
+        #
+        tablename = "cr_shelter_aggregate"
+        define_table(tablename,
+                     self.gis_location_id(),
+                     Field("level", length=2,
+                           label = T("Level"),
+                           ),
+                     shelter_type_id(),
+                     Field("shelters", "integer",
+                           default = 0,
+                           label = T("Shelters"),
+                           ),
+                     Field("open", "integer",
+                           default = 0,
+                           label = T("Open"),
+                           ),
+                     Field("closed", "integer",
+                           default = 0,
+                           label = T("Closed"),
+                           ),
+                     Field("capacity_day", "integer",
+                           default = 0,
+                           label = T("Capacity (Day)"),
+                           represent = lambda v: IS_INT_AMOUNT.represent(v),
+                           ),
+                     Field("capacity_night", "integer",
+                           default = 0,
+                           label = T("Capacity (Night)"),
+                           represent = lambda v: IS_INT_AMOUNT.represent(v),
+                           ),
+                     Field("population", "integer",
+                           default = 0,
+                           label = T("Population"),
+                           represent = lambda v: IS_INT_AMOUNT.represent(v),
+                           ),
+                     Field("available", "integer",
+                           default = 0,
+                           label = T("Available Capacity (Night)"),
+                           represent = lambda v: IS_INT_AMOUNT.represent(v),
+                           ),
+                     *s3_meta_fields())
+
+        aggregate_fields = ["shelters",
+                            "open",
+                            "closed",
+                            "capacity_day",
+                            "capacity_night",
+                            "population",
+                            "available",
+                            ]
+
+        configure(tablename,
+                  deletable = False,
+                  editable = False,
+                  insertable = False,
+                  list_fields = ["location_id",
+                                 "level",
+                                 "shelter_type_id",
+                                 ] + aggregate_fields,
+                  report_options = Storage(
+                        rows = ["location_id", "level", "shelter_type_id"],
+                        cols = ["level", "shelter_type_id"],
+                        fact = [(T("Shelters"), "sum(shelters)"),
+                                (T("Open"), "sum(open)"),
+                                (T("Closed"), "sum(closed)"),
+                                (T("Capacity (Day)"), "sum(capacity_day)"),
+                                (T("Capacity (Night)"), "sum(capacity_night)"),
+                                (T("Population"), "sum(population)"),
+                                (T("Available Capacity (Night)"), "sum(available)"),
+                                ],
+                        defaults = Storage(rows = "location_id",
+                                           cols = "shelter_type_id",
+                                           fact = "sum(available)",
+                                           totals = True,
+                                           ),
+                        ),
+                  )
+
+        # -------------------------------------------------------------------------
+        # Shelter aggregate items
+        # - the last contribution of each shelter to the aggregates, so that
+        #   changes can be applied as differences
+        # - shelter_id is not a foreign key, so that the item is still there
+        #   when cr_shelter_ondelete subtracts it (removed there)
+        #
+        tablename = "cr_shelter_aggregate_item"
+        define_table(tablename,
+                     Field("shelter_id", "integer"),
+                     Field("location_ids", "list:integer"),
+                     Field("shelter_type_id", "integer"),
+                     Field("status", "integer"),
+                     Field("capacity_day", "integer"),
+                     Field("capacity_night", "integer"),
+                     Field("population", "integer"),
+                     )
+
         # Pass variables back to global scope (response.s3.*)
         return Storage(
                 ADD_SHELTER = ADD_SHELTER,
                 SHELTER_LABEL = SHELTER_LABEL,
+                cr_shelter_update_aggregates = self.cr_shelter_update_aggregates,
+                cr_shelter_rebuild_aggregates = self.cr_shelter_rebuild_aggregates,
             )
 
     # -----------------------------------------------------------------------------
@@ -500,6 +612,19 @@ class S3CampDataModel(S3Model):
         # Update Affiliation, record ownership and component ownership
         current.s3db.org_update_affiliations("cr_shelter", form.vars)
 
+        # Update the aggregates
+        S3CampDataModel.cr_shelter_update_aggregates(form.vars.id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cr_shelter_ondelete(row):
+        """
+            After DB I/O
+        """
+
+        # Remove the shelter from the aggregates
+        S3CampDataModel.cr_shelter_update_aggregates(row.id)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def cr_shelter_status_onaccept(form):
@@ -507,9 +632,257 @@ class S3CampDataModel(S3Model):
             After DB I/O
         """
 
-        # @ToDo: Update the cr_shelter record
-        # Status & Population
-        pass
+        db = current.db
+        s3db = current.s3db
+
+        record_id = form.vars.id
+        table = s3db.cr_shelter_status
+        record = db(table.id == record_id).select(table.shelter_id,
+                                                  limitby=(0, 1)).first()
+        if not record or not record.shelter_id:
+            return
+        shelter_id = record.shelter_id
+
+        # Update the cr_shelter record from the latest status
+        query = (table.shelter_id == shelter_id) & \
+                (table.deleted != True)
+        latest = db(query).select(table.id,
+                                  table.status,
+                                  table.population,
+                                  orderby=~table.date|~table.id,
+                                  limitby=(0, 1)).first()
+        if not latest or latest.id != record_id:
+            # Historical record
+            return
+        data = {}
+        if latest.status is not None:
+            data["status"] = latest.status
+        if latest.population is not None:
+            data["population"] = latest.population
+        if data:
+            db(s3db.cr_shelter.id == shelter_id).update(**data)
+            S3CampDataModel.cr_shelter_update_aggregates(shelter_id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cr_shelter_levels(location_ids):
+        """
+            Look up the L0-L4 locations a shelter location belongs to
+
+            @param location_ids: list of gis_location record IDs
+
+            @return: dict {location_id: [(level, id), ...]}
+        """
+
+        if not location_ids:
+            return {}
+
+        db = current.db
+        gtable = current.s3db.gis_location
+        rows = db(gtable.id.belongs(set(location_ids))).select(gtable.id,
+                                                               gtable.name,
+                                                               gtable.level,
+                                                               gtable.path,
+                                                               gtable.parent,
+                                                               )
+        paths = {}
+        ancestors = set()
+        update_location_tree = current.gis.update_location_tree
+        for row in rows:
+            path = row.path
+            if not path:
+                path = update_location_tree(row)
+            ids = [int(i) for i in path.split("/")] if path else [row.id]
+            paths[row.id] = ids
+            ancestors.update(ids)
+
+        levels = {}
+        if ancestors:
+            query = gtable.id.belongs(ancestors) & \
+                    gtable.level.belongs(("L0", "L1", "L2", "L3", "L4"))
+            for row in db(query).select(gtable.id, gtable.level):
+                levels[row.id] = row.level
+
+        return dict((location_id, [(levels[i], i) for i in ids if i in levels])
+                    for location_id, ids in paths.items())
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cr_shelter_contribution(row):
+        """
+            The contribution of a shelter to the aggregates
+
+            @param row: the cr_shelter (or cr_shelter_aggregate_item) Row
+        """
+
+        capacity_night = row.capacity_night or 0
+        population = row.population or 0
+        return {"shelters": 1,
+                "open": 1 if row.status == 2 else 0,
+                "closed": 1 if row.status == 1 else 0,
+                "capacity_day": row.capacity_day or 0,
+                "capacity_night": capacity_night,
+                "population": population,
+                "available": max(capacity_night - population, 0),
+                }
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cr_shelter_update_aggregates(shelter_id):
+        """
+            Update the aggregates for a shelter, by subtracting its previous
+            contribution and adding the current one
+
+            @param shelter_id: the cr_shelter record ID
+        """
+
+        if not shelter_id:
+            return
+
+        db = current.db
+        s3db = current.s3db
+
+        stable = s3db.cr_shelter
+        atable = s3db.cr_shelter_aggregate
+        itable = s3db.cr_shelter_aggregate_item
+
+        contribution = S3CampDataModel.cr_shelter_contribution
+
+        # Differences {(location_id, shelter_type_id): {field: delta}}
+        deltas = {}
+        levels = {}
+        def add(location_ids, shelter_type_id, values, sign):
+            for location_id in location_ids:
+                for type_id in set((shelter_type_id, None)):
+                    key = (location_id, type_id)
+                    delta = deltas.get(key)
+                    if delta is None:
+                        delta = deltas[key] = dict.fromkeys(values, 0)
+                    for fn, value in values.items():
+                        delta[fn] += sign * value
+
+        # Previous contribution
+        item = db(itable.shelter_id == shelter_id).select(limitby=(0, 1)).first()
+        if item:
+            add(item.location_ids or [],
+                item.shelter_type_id,
+                contribution(item),
+                -1)
+
+        # Current contribution
+        shelter = db(stable.id == shelter_id).select(stable.location_id,
+                                                     stable.shelter_type_id,
+                                                     stable.status,
+                                                     stable.capacity_day,
+                                                     stable.capacity_night,
+                                                     stable.population,
+                                                     stable.obsolete,
+                                                     stable.deleted,
+                                                     limitby=(0, 1)).first()
+        if shelter and not shelter.deleted and not shelter.obsolete:
+            location_id = shelter.location_id
+            hierarchy = S3CampDataModel.cr_shelter_levels([location_id])
+            hierarchy = hierarchy.get(location_id, [])
+            location_ids = []
+            for level, ancestor_id in hierarchy:
+                levels[ancestor_id] = level
+                location_ids.append(ancestor_id)
+            add(location_ids,
+                shelter.shelter_type_id,
+                contribution(shelter),
+                1)
+            data = {"location_ids": location_ids,
+                    "shelter_type_id": shelter.shelter_type_id,
+                    "status": shelter.status,
+                    "capacity_day": shelter.capacity_day,
+                    "capacity_night": shelter.capacity_night,
+                    "population": shelter.population,
+                    }
+            if item:
+                item.update_record(**data)
+            else:
+                itable.insert(shelter_id=shelter_id, **data)
+        elif item:
+            item.delete_record()
+
+        # Apply the differences
+        for (location_id, type_id), delta in deltas.items():
+            if not any(delta.values()):
+                continue
+            query = (atable.location_id == location_id) & \
+                    (atable.shelter_type_id == type_id) & \
+                    (atable.deleted != True)
+            updated = db(query).update(**dict((fn, atable[fn] + value)
+                                              for fn, value in delta.items()))
+            if not updated and location_id in levels:
+                atable.insert(location_id = location_id,
+                              level = levels[location_id],
+                              shelter_type_id = type_id,
+                              **delta)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cr_shelter_rebuild_aggregates():
+        """
+            Rebuild all shelter aggregates from scratch, e.g. after
+            changes in the location hierarchy or a bulk import
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        stable = s3db.cr_shelter
+        atable = s3db.cr_shelter_aggregate
+        itable = s3db.cr_shelter_aggregate_item
+
+        query = (stable.deleted != True) & \
+                ((stable.obsolete == False) | (stable.obsolete == None))
+        shelters = db(query).select(stable.id,
+                                    stable.location_id,
+                                    stable.shelter_type_id,
+                                    stable.status,
+                                    stable.capacity_day,
+                                    stable.capacity_night,
+                                    stable.population,
+                                    )
+
+        location_ids = set(row.location_id for row in shelters if row.location_id)
+        hierarchy = S3CampDataModel.cr_shelter_levels(location_ids)
+
+        contribution = S3CampDataModel.cr_shelter_contribution
+        aggregates = {}
+        items = []
+        for row in shelters:
+            values = contribution(row)
+            location_ids = []
+            for level, location_id in hierarchy.get(row.location_id, []):
+                location_ids.append(location_id)
+                for type_id in set((row.shelter_type_id, None)):
+                    key = (location_id, type_id)
+                    aggregate = aggregates.get(key)
+                    if aggregate is None:
+                        aggregate = aggregates[key] = dict.fromkeys(values, 0)
+                        aggregate.update(location_id = location_id,
+                                         level = level,
+                                         shelter_type_id = type_id,
+                                         )
+                    for fn, value in values.items():
+                        aggregate[fn] += value
+            items.append({"shelter_id": row.id,
+                          "location_ids": location_ids,
+                          "shelter_type_id": row.shelter_type_id,
+                          "status": row.status,
+                          "capacity_day": row.capacity_day,
+                          "capacity_night": row.capacity_night,
+                          "population": row.population,
+                          })
+
+        db(atable.id > 0).delete()
+        db(itable.id > 0).delete()
+        if aggregates:
+            atable.bulk_insert(aggregates.values())
+        if items:
+            itable.bulk_insert(items)
 
     # -------------------------------------------------------------------------
     @staticmethod
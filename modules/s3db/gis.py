@@ -34,6 +34,7 @@ __all__ = ["S3LocationModel",
            "S3LocationTagModel",
            "S3LocationGroupModel",
            "S3LocationHierarchyModel",
+           "S3GazetteerModel",
            "S3GISConfigModel",
            "S3LayerEntityModel",
            "S3FeatureLayerModel",
@@ -351,7 +352,9 @@ class S3LocationModel(S3Model):
                        deduplicate = self.gis_location_duplicate,
                        list_fields = list_fields,
                        list_orderby = "gis_location.name",
+                       deferred = {"geocode": gis_location_geocode},
                        onaccept = self.gis_location_onaccept,
+                       ondelete = self.gis_location_ondelete,
                        onvalidation = self.gis_location_onvalidation,
                        )
 
@@ -430,22 +433,64 @@ class S3LocationModel(S3Model):
         vars = form.vars
         id = vars.id
 
-        if vars.path and current.response.s3.bulk:
+        bulk = current.response.s3.bulk
+        if vars.path and bulk:
             # Don't import path from foreign sources as IDs won't match
             db = current.db
             db(db.gis_location.id == id).update(path=None)
 
+        if bulk and vars.get("addr_street") and vars.get("lat") is None and \
+           current.deployment_settings.get_gis_geocode_imported_addresses():
+            # Not resolved locally: geocode the imported address in the
+            # background, in batches
+            current.s3task.defer("gis_location", id, "geocode")
+
+        gis = current.gis
+        record = form.record
+        if record and record.parent and \
+           str(record.parent) != str(vars.get("parent", record.parent)):
+            # Moved to another parent: invalidate the cached hierarchy
+            # data of the previous parent
+            gis.invalidate_ldata([record.parent])
+
         if not auth.override and \
            not auth.rollback:
             # Update the Path (async if-possible)
             # (skip during prepop)
+            # - this also invalidates the cached hierarchy data
             feature = json.dumps(dict(id=id,
                                       level=vars.get("level", False),
                                       ))
             current.s3task.async("gis_update_location_tree",
                                  args=[feature])
+        else:
+            gis.invalidate_ldata([id])
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def gis_location_ondelete(row):
+        """
+            On Delete for GIS Locations: invalidate the cached hierarchy data
+        """
+
+        location_ids = [row.id]
+        table = current.s3db.gis_location
+        record = current.db(table.id == row.id).select(table.deleted_fk,
+                                                       limitby=(0, 1)).first()
+        if record and record.deleted_fk:
+            try:
+                deleted_fk = json.loads(record.deleted_fk)
+            except ValueError:
+                pass
+            else:
+                location_ids.append(deleted_fk.get("parent"))
+        current.gis.invalidate_ldata(location_ids)
+
+        # Remove from the gazetteer
+        gtable = current.s3db.gis_gazetteer
+        current.db(gtable.location_id == row.id).delete()
+
     # -------------------------------------------------------------------------
     @staticmethod
     def gis_location_onvalidation(form):
@@ -483,13 +528,12 @@ class S3LocationModel(S3Model):
                         Lx_ids = [parent]
                 else:
                     Lx_ids = None
-                results = gis.geocode(addr_street, postcode, Lx_ids, geocoder)
-                if isinstance(results, basestring):
-                    # Error
-                    current.log.error(results)
-                    form.errors["addr_street"] = results
-                    return
-                else:
+                # Try the gazetteer and the geocoding cache, addresses
+                # which can not be resolved locally get geocoded onaccept
+                results = S3Gazetteer().geocode(addr_street, postcode, Lx_ids,
+                                                geocoder=geocoder,
+                                                remote=False)
+                if isinstance(results, dict):
                     form_vars.lon = lon = results["lon"]
                     form_vars.lat = lat = results["lat"]
 
@@ -1104,11 +1148,51 @@ class S3LocationNameModel(S3Model):
 
         self.configure(tablename,
                        deduplicate = self.gis_location_name_deduplicate,
+                       onaccept = self.gis_location_name_onaccept,
+                       ondelete = self.gis_location_name_ondelete,
                        )
 
         # Pass names back to global scope (s3.*)
         return dict()
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def gis_location_name_onaccept(form):
+        """
+            On Accept for Location Names: invalidate the cached hierarchy data
+        """
+
+        location_id = form.vars.get("location_id")
+        if not location_id:
+            table = current.s3db.gis_location_name
+            row = current.db(table.id == form.vars.id).select(table.location_id,
+                                                              limitby=(0, 1)
+                                                              ).first()
+            if row:
+                location_id = row.location_id
+        if location_id:
+            current.gis.invalidate_ldata([location_id])
+            S3Gazetteer().update([location_id])
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def gis_location_name_ondelete(row):
+        """
+            On Delete for Location Names: invalidate the cached hierarchy data
+        """
+
+        table = current.s3db.gis_location_name
+        record = current.db(table.id == row.id).select(table.deleted_fk,
+                                                       limitby=(0, 1)).first()
+        if record and record.deleted_fk:
+            try:
+                deleted_fk = json.loads(record.deleted_fk)
+            except ValueError:
+                return
+            location_id = deleted_fk.get("location_id")
+            current.gis.invalidate_ldata([location_id])
+            S3Gazetteer().update([location_id])
+
     # -------------------------------------------------------------------------
     @staticmethod
     def gis_location_name_deduplicate(job):
@@ -1374,6 +1458,7 @@ class S3LocationHierarchyModel(S3Model):
         )
 
         self.configure(tablename,
+                       onaccept = self.gis_hierarchy_onaccept,
                        onvalidation = self.gis_hierarchy_onvalidation,
                        )
 
@@ -1445,6 +1530,19 @@ class S3LocationHierarchyModel(S3Model):
                             )
                         )
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def gis_hierarchy_onaccept(form):
+        """
+            Invalidate the cached hierarchy labels
+        """
+
+        location_ids = [form.vars.get("location_id")]
+        record = form.record
+        if record:
+            location_ids.append(record.location_id)
+        current.gis.invalidate_ldata(location_ids, hierarchy=True)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def gis_hierarchy_onvalidation(form):
@@ -1470,6 +1568,57 @@ class S3LocationHierarchyModel(S3Model):
                 for gap in gaps:
                     form.errors[gap] = hierarchy_gap
 
+# =============================================================================
+class S3GazetteerModel(S3Model):
+    """
+        Gazetteer model
+        - index of normalised location names for the local geocoder
+        - cache for the results of remote geocoders
+
+        Both tables are maintained by S3Gazetteer.
+    """
+
+    names = ["gis_gazetteer",
+             "gis_geocode_cache",
+             ]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Gazetteer
+        # - one entry per name (incl. local names) of each location
+        #
+        tablename = "gis_gazetteer"
+        define_table(tablename,
+                     Field("location_id", "integer"),
+                     # Normalised name
+                     Field("name", length=128),
+                     Field("level", length=2),
+                     Field("path", length=256),
+                     Field("lat", "double"),
+                     Field("lon", "double"),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Geocoding cache
+        #
+        tablename = "gis_geocode_cache"
+        define_table(tablename,
+                     # SHA1 of geocoder and normalised query
+                     Field("query_key", length=40),
+                     Field("provider"),
+                     # JSON
+                     Field("result", "text"),
+                     Field("created_on", "datetime",
+                           default = current.request.utcnow,
+                           ),
+                     )
+
+        # Pass names back to global scope (s3.*)
+        return dict()
+
 # =============================================================================
 class S3GISConfigModel(S3Model):
     """
@@ -1588,6 +1737,8 @@ class S3GISConfigModel(S3Model):
 
         configure(tablename,
                   deduplicate = self.gis_marker_deduplicate,
+                  onaccept = gis_config_invalidate,
+                  ondelete = gis_config_invalidate,
                   onvalidation = self.gis_marker_onvalidation,
                   )
 
@@ -1661,6 +1812,7 @@ class S3GISConfigModel(S3Model):
         configure(tablename,
                   deduplicate = self.gis_projection_deduplicate,
                   deletable = False,
+                  onaccept = gis_config_invalidate,
                   )
 
         # =====================================================================
@@ -1721,6 +1873,8 @@ class S3GISConfigModel(S3Model):
 
         configure(tablename,
                   deduplicate = self.gis_symbology_deduplicate,
+                  onaccept = gis_config_invalidate,
+                  ondelete = gis_config_invalidate,
                   )
 
         # =====================================================================
@@ -2124,6 +2278,8 @@ class S3GISConfigModel(S3Model):
             the region) but making it only editable by a MapAdmin.
         """
 
+        current.gis.invalidate_config()
+
         db = current.db
         auth = current.auth
 
@@ -2175,6 +2331,8 @@ class S3GISConfigModel(S3Model):
             If the currently-active config was deleted, clear the cache
         """
 
+        current.gis.invalidate_config()
+
         s3 = current.response.s3
         if s3.gis.config and \
            s3.gis.config.id == row.id:
@@ -2525,7 +2683,8 @@ class S3LayerEntityModel(S3Model):
 
         self.configure(tablename,
                        onvalidation=self.gis_layer_config_onvalidation,
-                       onaccept=self.gis_layer_config_onaccept)
+                       onaccept=self.gis_layer_config_onaccept,
+                       ondelete=gis_config_invalidate)
 
         # =====================================================================
         #  Layer Symbology link table
@@ -2563,6 +2722,10 @@ class S3LayerEntityModel(S3Model):
             msg_list_empty = T("No Symbologies currently defined for this Layer")
             )
 
+        self.configure(tablename,
+                       onaccept=gis_config_invalidate,
+                       ondelete=gis_config_invalidate)
+
         # Pass names back to global scope (s3.*)
         return dict(gis_layer_types = layer_types,
                     # Run from config() controller when saving state
@@ -2593,6 +2756,8 @@ class S3LayerEntityModel(S3Model):
             others in this config.
         """
 
+        current.gis.invalidate_config()
+
         vars = form.vars
         base = vars.base
         if base == "False":
@@ -2740,6 +2905,7 @@ class S3FeatureLayerModel(S3Model):
 
         self.configure(tablename,
                        onaccept=self.gis_layer_feature_onaccept,
+                       ondelete=gis_config_invalidate,
                        super_entity="gis_layer_entity",
                        deduplicate=self.gis_layer_feature_deduplicate,
                        list_fields=["id",
@@ -2991,6 +3157,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3027,6 +3194,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept=gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity="gis_layer_entity")
 
         # Components
@@ -3057,6 +3225,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3088,6 +3257,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3132,6 +3302,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3194,6 +3365,7 @@ class S3MapModel(S3Model):
         configure(tablename,
                   deduplicate = self.gis_layer_georss_deduplicate,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3241,6 +3413,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3303,6 +3476,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3356,6 +3530,7 @@ class S3MapModel(S3Model):
         configure(tablename,
                   deduplicate = self.gis_layer_kml_deduplicate,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity="gis_layer_entity",
                   )
 
@@ -3402,6 +3577,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3438,6 +3614,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3499,6 +3676,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3536,6 +3714,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3620,6 +3799,7 @@ class S3MapModel(S3Model):
         configure(tablename,
                   create_onaccept = self.gis_layer_shapefile_onaccept,
                   deduplicate = self.gis_layer_shapefile_deduplicate,
+                  ondelete = gis_config_invalidate,
                   #update_onaccept = self.gis_layer_shapefile_onaccept_update,
                   super_entity = "gis_layer_entity",
                   )
@@ -3689,6 +3869,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3793,6 +3974,7 @@ class S3MapModel(S3Model):
         configure(tablename,
                   deduplicate = self.gis_layer_wfs_deduplicate,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3937,6 +4119,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -3995,6 +4178,7 @@ class S3MapModel(S3Model):
 
         configure(tablename,
                   onaccept = gis_layer_onaccept,
+                  ondelete = gis_config_invalidate,
                   super_entity = "gis_layer_entity",
                   )
 
@@ -4463,6 +4647,8 @@ class S3GISThemeModel(S3Model):
                      *s3_meta_fields())
 
         configure(tablename,
+                  onaccept=gis_config_invalidate,
+                  ondelete=gis_config_invalidate,
                   super_entity="gis_layer_entity")
 
         # Components
@@ -4814,6 +5000,8 @@ def gis_layer_onaccept(form):
         Process the enable checkbox
     """
 
+    current.gis.invalidate_config()
+
     enable = current.request.post_vars.enable
 
     if enable:
@@ -4841,6 +5029,18 @@ def gis_layer_onaccept(form):
                           layer_id = layer_id,
                           enabled = True)
 
+# =============================================================================
+def gis_config_invalidate(record):
+    """
+        Invalidate the compiled map configurations after changes to
+        configs, layers, markers, projections or symbologies
+        - onaccept/ondelete for the respective tables
+
+        @param record: the form or the deleted row
+    """
+
+    current.gis.invalidate_config()
+
 # =============================================================================
 def gis_hierarchy_editable(level, id):
     """
@@ -4879,6 +5079,18 @@ def gis_hierarchy_editable(level, id):
 
     return editable
 
+# =============================================================================
+def gis_location_geocode(record_ids):
+    """
+        Deferred hook to geocode the addresses of imported locations
+
+        @param record_ids: the gis_location record IDs
+    """
+
+    geocoder = current.deployment_settings.get_gis_geocode_imported_addresses()
+    if geocoder:
+        current.gis.geocode_locations(record_ids, geocoder=geocoder)
+
 # =============================================================================
 def gis_location_filter(r):
     """
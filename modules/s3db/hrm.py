@@ -756,6 +756,7 @@ class S3HRModel(S3Model):
                   #extra_fields = ["person_id"]
                   filter_widgets = filter_widgets,
                   mark_required = mark_required,
+                  deferred = {"affiliations": hrm_human_resource_update_affiliations},
                   onaccept = hrm_human_resource_onaccept,
                   ondelete = self.hrm_human_resource_ondelete,
                   realm_components = ["presence"],
@@ -1186,7 +1187,8 @@ class S3HRModel(S3Model):
                 return
 
             if person_id:
-                current.s3db.pr_update_affiliations(htable, record)
+                current.s3task.defer("hrm_human_resource", row.id,
+                                     "affiliations")
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -4089,7 +4091,8 @@ def hrm_human_resource_onaccept(form):
     organisation_id = record.organisation_id
 
     # Affiliation, record ownership and component ownership
-    s3db.pr_update_affiliations(htable, record)
+    # - deferred to the scheduler, as this can take a while
+    current.s3task.defer("hrm_human_resource", id, "affiliations")
 
     # Realm_entity for the pr_person record
     ptable = s3db.pr_person
@@ -4245,6 +4248,19 @@ def hrm_human_resource_onaccept(form):
         htable.person_id.update = None
         db(query).update(site_contact = False)
 
+# =============================================================================
+def hrm_human_resource_update_affiliations(record_ids):
+    """
+        Deferred hook to update the affiliations of HR records
+
+        @param record_ids: the hrm_human_resource record IDs
+    """
+
+    htable = current.s3db.hrm_human_resource
+    update_affiliations = current.s3db.pr_update_affiliations
+    for record_id in record_ids:
+        update_affiliations(htable, record_id)
+
 # =============================================================================
 def hrm_compose():
     """
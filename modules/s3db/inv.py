@@ -31,6 +31,8 @@ __all__ = ["S3WarehouseModel",
            "S3InventoryModel",
            "S3InventoryTrackingModel",
            "S3InventoryAdjustModel",
+           "S3InventoryLedgerModel",
+           "S3StockLedger",
            "inv_tabs",
            "inv_rheader",
            "inv_rfooter",
@@ -44,8 +46,16 @@ __all__ = ["S3WarehouseModel",
            "inv_InvItemRepresent",
            ]
 
+import datetime
 import itertools
 
+try:
+    # Python 2.7
+    from collections import OrderedDict
+except:
+    # Python 2.6
+    from gluon.contrib.simplejson.ordered_dict import OrderedDict
+
 from gluon import *
 from gluon.sqlhtml import RadioWidget
 from gluon.storage import Storage
@@ -658,6 +668,8 @@ S3OptionsFilter({
                                        ],
                        filter_widgets = filter_widgets,
                        list_fields = list_fields,
+                       onaccept = self.inv_inv_item_onaccept,
+                       ondelete = self.inv_inv_item_ondelete,
                        onvalidation = self.inv_inv_item_onvalidate,
                        report_options = report_options,
                        super_entity = "supply_item_entity",
@@ -728,6 +740,25 @@ S3OptionsFilter({
                                            "is already used by %s.") % \
                                            (item_source_no, org)
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def inv_inv_item_onaccept(form):
+        """
+            Post direct changes of the stock level (e.g. imports) to the
+            stock movement ledger
+        """
+
+        current.s3db.inv_stock_post(form.vars.id, "edit")
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def inv_inv_item_ondelete(row):
+        """
+            Post the removal of stock to the stock movement ledger
+        """
+
+        current.s3db.inv_stock_post(row.id, "edit")
+
     # -------------------------------------------------------------------------
     @staticmethod
     def inv_remove(inv_rec,
@@ -774,6 +805,7 @@ S3OptionsFilter({
                 db(inv_item_table.id == inv_rec.id).update(quantity = new_qnty)
             else:
                 db(inv_item_table.id == inv_rec.id).update(deleted = True)
+            current.s3db.inv_stock_post(inv_rec.id, "send")
 
         return send_item_quantity
 
@@ -2785,6 +2817,7 @@ S3OptionsFilter({
                                        new_track_pack_quantity
                                        )
             db(inv_item_table.id == stock_item).update(quantity = newTotal)
+            s3db.inv_stock_post(stock_item.id, "send", track_item_id=id)
         if form_vars.send_id and form_vars.recv_id:
             send_ref = db(stable.id == form_vars.send_id).select(stable.send_ref,
                                                                  limitby=(0, 1)
@@ -2866,6 +2899,8 @@ S3OptionsFilter({
                                                     source_type = source_type,
                                                     status = record.inv_item_status,
                                                     )
+            s3db.inv_stock_post(inv_item_id, "recv", track_item_id=id)
+
             # If this item is linked to a request, then update the quantity fulfil
             if use_req and record.req_item_id:
                 req_item = db(ritable.id == record.req_item_id).select(ritable.quantity_fulfil,
@@ -2975,6 +3010,7 @@ S3OptionsFilter({
             trackTotal = record.quantity
             # Remove the total from this record and place it back in the warehouse
             db(inv_item_table.id == record.send_inv_item_id).update(quantity = inv_item_table.quantity + trackTotal)
+            s3db.inv_stock_post(record.send_inv_item_id, "cancel", track_item_id=id)
             db(tracktable.id == id).update(quantity = 0,
                                            comments = "%sQuantity was: %s" % (inv_item_table.comments, trackTotal))
         return True
@@ -4159,6 +4195,181 @@ class S3InventoryAdjustModel(S3Model):
             else:
                 return repr
 
+# =============================================================================
+class S3InventoryLedgerModel(S3Model):
+    """
+        Stock Movement Ledger
+
+        An append-only record of all changes to the stock levels in
+        inv_inv_item, with periodic per-site/per-item snapshots, to
+        find the stock at any date (see S3StockLedger)
+    """
+
+    names = ["inv_stock_movement",
+             "inv_stock_snapshot",
+             "inv_stock_post",
+             "inv_stock_update_snapshots",
+             ]
+
+    def model(self):
+
+        T = current.T
+
+        item_id = self.supply_item_id
+        site_id = lambda: self.super_link("site_id", "org_site",
+                                          label = current.deployment_settings.get_inv_facility_label(),
+                                          readable = True,
+                                          represent = self.org_site_represent,
+                                          )
+
+        crud_strings = current.response.s3.crud_strings
+        define_table = self.define_table
+
+        quantity_represent = lambda v: IS_FLOAT_AMOUNT.represent(v, precision=2)
+
+        # ---------------------------------------------------------------------
+        # Stock Movements
+        # - quantities are in base units of the supply item (pack quantity 1)
+        # - inv_item_id is not a foreign key, so that the ledger entries
+        #   survive the removal of the inventory item
+        # - snapshot is the watermark of the first snapshot which includes
+        #   the movement (None if not included in any snapshot yet)
+        #
+        movement_type = S3StockLedger.TYPES
+        tablename = "inv_stock_movement"
+        define_table(tablename,
+                     Field("inv_item_id", "integer",
+                           label = T("Stock Item"),
+                           represent = self.inv_item_represent,
+                           ),
+                     site_id(),
+                     item_id(),
+                     s3_datetime(default = "now",
+                                 label = T("Date"),
+                                 ),
+                     Field("type",
+                           label = T("Type"),
+                           requires = IS_IN_SET(movement_type),
+                           represent = S3Represent(options=movement_type),
+                           ),
+                     Field("quantity", "double",
+                           label = T("Quantity"),
+                           represent = quantity_represent,
+                           ),
+                     Field("balance", "double",
+                           label = T("Balance"),
+                           represent = quantity_represent,
+                           ),
+                     Field("track_item_id", "integer",
+                           readable = False,
+                           ),
+                     Field("adj_id", "integer",
+                           readable = False,
+                           ),
+                     Field("snapshot", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
+                     *s3_meta_fields())
+
+        crud_strings[tablename] = Storage(
+            title_display = T("Stock Movement Details"),
+            title_list = T("Stock Movements"),
+            title_report = T("Stock Movement Report"),
+            msg_list_empty = T("No Stock Movements currently registered"))
+
+        self.configure(tablename,
+                       deletable = False,
+                       editable = False,
+                       insertable = False,
+                       list_fields = ["date",
+                                      "site_id",
+                                      "item_id",
+                                      "type",
+                                      "quantity",
+                                      "balance",
+                                      ],
+                       orderby = "inv_stock_movement.date desc",
+                       report_options = Storage(
+                            rows = ["item_id", "item_id$item_category_id", "type"],
+                            cols = ["site_id", "type"],
+                            fact = [(T("Quantity"), "sum(quantity)"),
+                                    (T("Number of Movements"), "count(id)"),
+                                    ],
+                            defaults = Storage(rows = "item_id",
+                                               cols = "type",
+                                               fact = "sum(quantity)",
+                                               totals = True,
+                                               ),
+                            ),
+                       )
+
+        # ---------------------------------------------------------------------
+        # Stock Snapshots
+        # - stock per site and supply item at the time of the snapshot,
+        #   in base units; items not listed had no stock at that time
+        # - watermark identifies the snapshot, and increases with every
+        #   snapshot (see S3StockLedger.snapshot)
+        #
+        tablename = "inv_stock_snapshot"
+        define_table(tablename,
+                     site_id(),
+                     item_id(),
+                     s3_datetime(label = T("Date"),
+                                 ),
+                     Field("watermark", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
+                     Field("quantity", "double",
+                           label = T("Quantity"),
+                           represent = quantity_represent,
+                           ),
+                     )
+
+        crud_strings[tablename] = Storage(
+            title_list = T("Stock Snapshots"),
+            title_report = T("Stock History"),
+            msg_list_empty = T("No Stock Snapshots currently available"))
+
+        self.configure(tablename,
+                       deletable = False,
+                       editable = False,
+                       insertable = False,
+                       report_options = Storage(
+                            rows = ["item_id", "item_id$item_category_id"],
+                            cols = ["date", "site_id"],
+                            fact = [(T("Quantity"), "sum(quantity)")],
+                            defaults = Storage(rows = "item_id",
+                                               cols = "date",
+                                               fact = "sum(quantity)",
+                                               totals = True,
+                                               ),
+                            ),
+                       )
+
+        # ---------------------------------------------------------------------
+        # Pass names back to global scope (s3.*)
+        #
+        return dict(inv_stock_post = S3StockLedger.post,
+                    inv_stock_update_snapshots = self.inv_stock_update_snapshots,
+                    )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def inv_stock_update_snapshots():
+        """
+            Reconcile the ledger with the current stock levels and take
+            a new snapshot, called by the inv_stock_snapshot task
+
+            @return: the number of discrepancies found
+        """
+
+        ledger = S3StockLedger()
+        discrepancies = ledger.verify(repair=True)
+        ledger.snapshot()
+        return len(discrepancies)
+
 # =============================================================================
 def inv_adj_rheader(r):
     """ Resource Header for Inventory Adjustments """
@@ -4244,6 +4455,433 @@ def duplicator(job, query):
         return _duplicate.id
     return False
 
+# =============================================================================
+class S3StockLedger(object):
+    """
+        Stock Movement Ledger
+
+        - every change of inv_inv_item.quantity gets posted as a movement
+          with the difference against the ledger balance of that item
+        - periodic snapshots hold the stock per site and supply item,
+          so that the stock at any date only needs the movements since
+          the last snapshot before that date
+        - every snapshot marks the movements it includes with its
+          watermark, so that movements committed after a snapshot are
+          never lost, whatever their date
+    """
+
+    TYPES = OrderedDict([("opening", T("Opening Balance")),
+                         ("edit", T("Stock Edit")),
+                         ("send", T("Shipment Sent")),
+                         ("recv", T("Shipment Received")),
+                         ("return", T("Shipment Returned")),
+                         ("cancel", T("Shipment Canceled")),
+                         ("adj", T("Stock Adjustment")),
+                         ("correction", T("Correction")),
+                         ])
+
+    # Tolerance for rounding differences
+    EPSILON = 1e-6
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def post(cls, inv_item_ids, movement_type="edit", track_item_id=None, adj_id=None):
+        """
+            Post the changes of inventory items to the ledger, to be
+            called after any update of inv_inv_item.quantity
+
+            @param inv_item_ids: inv_inv_item record ID or list of IDs
+            @param movement_type: the type of the movement (see TYPES)
+            @param track_item_id: the inv_track_item record ID causing
+                                  the movement
+            @param adj_id: the inv_adj record ID causing the movement
+
+            @return: the number of movements posted
+        """
+
+        if not isinstance(inv_item_ids, (list, tuple, set)):
+            inv_item_ids = [inv_item_ids]
+        inv_item_ids = set(int(i) for i in inv_item_ids if i)
+        if not inv_item_ids:
+            return 0
+
+        stock = cls._stock(inv_item_ids)
+        balances = cls._balances(inv_item_ids)
+
+        now = datetime.datetime.utcnow()
+        movements = []
+        for inv_item_id in inv_item_ids:
+            balance = balances.get(inv_item_id, 0.0)
+            item = stock.get(inv_item_id)
+            if item is None:
+                # Removed from stock
+                if not balance:
+                    continue
+                item = cls._lookup(inv_item_id)
+                if item is None:
+                    continue
+                item.quantity = 0.0
+            delta = item.quantity - balance
+            if abs(delta) < cls.EPSILON:
+                continue
+            if inv_item_id not in balances and movement_type == "edit":
+                mtype = "opening"
+            else:
+                mtype = movement_type
+            movements.append(dict(inv_item_id = inv_item_id,
+                                  site_id = item.site_id,
+                                  item_id = item.item_id,
+                                  date = now,
+                                  type = mtype,
+                                  quantity = delta,
+                                  balance = item.quantity,
+                                  track_item_id = track_item_id,
+                                  adj_id = adj_id,
+                                  ))
+        if movements:
+            current.s3db.inv_stock_movement.bulk_insert(movements)
+        return len(movements)
+
+    # -------------------------------------------------------------------------
+    def stock(self, date=None, site_ids=None, item_ids=None):
+        """
+            Get the stock at a date
+
+            @param date: the date (datetime), None for now
+            @param site_ids: limit to these sites
+            @param item_ids: limit to these supply items
+
+            @return: dict {(site_id, item_id): quantity in base units}
+        """
+
+        db = current.db
+        stable = current.s3db.inv_stock_snapshot
+
+        # Latest snapshot before the date
+        query = (stable.watermark != None)
+        if date is not None:
+            query &= (stable.date <= date)
+        latest = stable.watermark.max()
+        watermark = db(query).select(latest).first()[latest]
+
+        stock = self._snapshot(watermark, site_ids, item_ids)
+
+        # Add the movements not included in that snapshot
+        for key, quantity in self.movements(end = date,
+                                            site_ids = site_ids,
+                                            item_ids = item_ids,
+                                            snapshot = watermark,
+                                            ).items():
+            stock[key] = stock.get(key, 0.0) + quantity
+
+        return dict((k, v) for k, v in stock.items()
+                           if abs(v) >= self.EPSILON)
+
+    # -------------------------------------------------------------------------
+    def movements(self, start=None, end=None, site_ids=None, item_ids=None,
+                  summary=True, snapshot=None):
+        """
+            Get the movements within a period
+
+            @param start: start of the period (exclusive), None for
+                          since the beginning
+            @param end: end of the period (inclusive), None for until now
+            @param site_ids: limit to these sites
+            @param item_ids: limit to these supply items
+            @param summary: return the net movements per site and item
+                            rather than the individual movements
+            @param snapshot: only movements not included in the snapshot
+                             with this watermark
+
+            @return: dict {(site_id, item_id): quantity} if summary,
+                     otherwise Rows of inv_stock_movement
+        """
+
+        table = current.s3db.inv_stock_movement
+
+        query = (table.deleted != True)
+        if start is not None:
+            query &= (table.date > start)
+        if end is not None:
+            query &= (table.date <= end)
+        if snapshot is not None:
+            query &= (table.snapshot == None) | (table.snapshot > snapshot)
+        query &= self._filter(table, site_ids, item_ids)
+
+        if not summary:
+            return current.db(query).select(table.ALL,
+                                            orderby = (table.date, table.id),
+                                            )
+        return self._sum(query)
+
+    # -------------------------------------------------------------------------
+    def snapshot(self, date=None):
+        """
+            Store the current stock as snapshot
+
+            @param date: the date of the snapshot, None for now
+
+            @return: the number of snapshot entries
+        """
+
+        db = current.db
+        s3db = current.s3db
+        mtable = s3db.inv_stock_movement
+        stable = s3db.inv_stock_snapshot
+
+        if date is None:
+            date = datetime.datetime.utcnow()
+
+        # Previous snapshot
+        latest = stable.watermark.max()
+        previous = db(stable.watermark != None).select(latest).first()[latest]
+
+        # The watermark of the new snapshot, higher than the IDs of all
+        # movements so far and the watermarks of all previous snapshots
+        max_id = mtable.id.max()
+        max_snapshot = mtable.snapshot.max()
+        row = db(mtable.id > 0).select(max_id, max_snapshot).first()
+        watermark = max(row[max_id] or 0,
+                        (row[max_snapshot] or 0) + 1,
+                        (previous or 0) + 1)
+
+        # Include all movements not yet included in any snapshot (in a
+        # single statement, so that nothing committed meanwhile can slip
+        # through between marking and adding up)
+        db((mtable.snapshot == None) &
+           (mtable.deleted != True)).update(snapshot = watermark)
+
+        # Previous snapshot plus all movements included since
+        stock = self._snapshot(previous)
+        query = (mtable.deleted != True) & \
+                (mtable.snapshot <= watermark)
+        if previous is not None:
+            query &= (mtable.snapshot > previous)
+        for key, quantity in self._sum(query).items():
+            stock[key] = stock.get(key, 0.0) + quantity
+
+        records = [dict(site_id = site_id,
+                        item_id = item_id,
+                        date = date,
+                        watermark = watermark,
+                        quantity = quantity,
+                        )
+                   for (site_id, item_id), quantity in stock.items()
+                   if abs(quantity) >= self.EPSILON]
+        if records:
+            stable.bulk_insert(records)
+        return len(records)
+
+    # -------------------------------------------------------------------------
+    def verify(self, site_ids=None, repair=False):
+        """
+            Verify the ledger balances against the current stock levels
+
+            @param site_ids: limit to these sites
+            @param repair: post corrections for all discrepancies
+
+            @return: list of Storages (inv_item_id, site_id, item_id,
+                     ledger, stock) for all discrepancies
+        """
+
+        db = current.db
+        table = current.s3db.inv_stock_movement
+
+        query = (table.deleted != True)
+        if site_ids is not None:
+            query &= (table.site_id.belongs(site_ids))
+        quantity = table.quantity.sum()
+        rows = db(query).select(table.inv_item_id,
+                                quantity,
+                                groupby = table.inv_item_id,
+                                )
+        balances = dict((row[table.inv_item_id], row[quantity] or 0.0)
+                        for row in rows)
+
+        stock = self._stock(site_ids=site_ids)
+
+        discrepancies = []
+        for inv_item_id in set(balances.keys()) | set(stock.keys()):
+            balance = balances.get(inv_item_id, 0.0)
+            item = stock.get(inv_item_id)
+            quantity = item.quantity if item else 0.0
+            if abs(quantity - balance) >= self.EPSILON:
+                discrepancies.append(Storage(inv_item_id = inv_item_id,
+                                             site_id = item.site_id if item else None,
+                                             item_id = item.item_id if item else None,
+                                             ledger = balance,
+                                             stock = quantity,
+                                             ))
+        if repair and discrepancies:
+            inv_item_ids = [d.inv_item_id for d in discrepancies]
+            opening = [i for i in inv_item_ids if i not in balances]
+            if opening:
+                self.post(opening, "opening")
+            self.post([i for i in inv_item_ids if i in balances], "correction")
+        return discrepancies
+
+    # -------------------------------------------------------------------------
+    def _snapshot(self, watermark, site_ids=None, item_ids=None):
+        """
+            Get the stock in a snapshot
+
+            @param watermark: the watermark of the snapshot
+            @param site_ids: limit to these sites
+            @param item_ids: limit to these supply items
+
+            @return: dict {(site_id, item_id): quantity}
+        """
+
+        stock = {}
+        if watermark is None:
+            return stock
+
+        table = current.s3db.inv_stock_snapshot
+        query = (table.watermark == watermark)
+        query &= self._filter(table, site_ids, item_ids)
+        rows = current.db(query).select(table.site_id,
+                                        table.item_id,
+                                        table.quantity,
+                                        )
+        for row in rows:
+            stock[(row.site_id, row.item_id)] = row.quantity
+        return stock
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _sum(query):
+        """
+            Get the net movements per site and item
+
+            @param query: the query for inv_stock_movement
+
+            @return: dict {(site_id, item_id): quantity}
+        """
+
+        table = current.s3db.inv_stock_movement
+        quantity = table.quantity.sum()
+        rows = current.db(query).select(table.site_id,
+                                        table.item_id,
+                                        quantity,
+                                        groupby = (table.site_id, table.item_id),
+                                        )
+        return dict(((row[table.site_id], row[table.item_id]),
+                     row[quantity] or 0.0) for row in rows)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _filter(table, site_ids=None, item_ids=None):
+        """
+            Query to filter ledger/snapshot entries by site and item
+
+            @param table: the table
+            @param site_ids: the site IDs
+            @param item_ids: the supply item IDs
+        """
+
+        query = (table.id > 0)
+        if site_ids is not None:
+            query &= (table.site_id.belongs(site_ids))
+        if item_ids is not None:
+            query &= (table.item_id.belongs(item_ids))
+        return query
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _stock(inv_item_ids=None, site_ids=None):
+        """
+            Look up the current stock of inventory items in base units
+
+            @param inv_item_ids: the inv_inv_item record IDs
+            @param site_ids: the site IDs
+
+            @return: dict {inv_item_id: Storage(site_id, item_id, quantity)},
+                     without deleted inventory items
+        """
+
+        db = current.db
+        s3db = current.s3db
+        itable = s3db.inv_inv_item
+        ptable = s3db.supply_item_pack
+
+        query = (itable.deleted != True)
+        if inv_item_ids is not None:
+            query &= (itable.id.belongs(inv_item_ids))
+        if site_ids is not None:
+            query &= (itable.site_id.belongs(site_ids))
+        left = ptable.on(ptable.id == itable.item_pack_id)
+        rows = db(query).select(itable.id,
+                                itable.site_id,
+                                itable.item_id,
+                                itable.quantity,
+                                ptable.quantity,
+                                left = left,
+                                )
+        stock = {}
+        for row in rows:
+            item = row.inv_inv_item
+            pack_quantity = row.supply_item_pack.quantity or 1.0
+            stock[item.id] = Storage(site_id = item.site_id,
+                                     item_id = item.item_id,
+                                     quantity = (item.quantity or 0.0) * pack_quantity,
+                                     )
+        return stock
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _balances(inv_item_ids):
+        """
+            Look up the ledger balances of inventory items
+
+            @param inv_item_ids: the inv_inv_item record IDs
+
+            @return: dict {inv_item_id: balance}, without items which
+                     have never been posted
+        """
+
+        table = current.s3db.inv_stock_movement
+        query = (table.inv_item_id.belongs(inv_item_ids)) & \
+                (table.deleted != True)
+        quantity = table.quantity.sum()
+        rows = current.db(query).select(table.inv_item_id,
+                                        quantity,
+                                        groupby = table.inv_item_id,
+                                        )
+        return dict((row[table.inv_item_id], row[quantity] or 0.0)
+                    for row in rows)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _lookup(inv_item_id):
+        """
+            Look up site and supply item of a removed inventory item,
+            falling back to the last ledger entry if the record has been
+            deleted from the database
+
+            @param inv_item_id: the inv_inv_item record ID
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        itable = s3db.inv_inv_item
+        row = db(itable.id == inv_item_id).select(itable.site_id,
+                                                  itable.item_id,
+                                                  limitby = (0, 1),
+                                                  ).first()
+        if not row:
+            table = s3db.inv_stock_movement
+            row = db(table.inv_item_id == inv_item_id).select(table.site_id,
+                                                              table.item_id,
+                                                              limitby = (0, 1),
+                                                              orderby = ~table.id,
+                                                              ).first()
+        if row:
+            return Storage(site_id = row.site_id,
+                           item_id = row.item_id,
+                           )
+        return None
+
 # =============================================================================
 class inv_InvItemRepresent(S3Represent):
     
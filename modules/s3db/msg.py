@@ -41,6 +41,7 @@ __all__ = ["S3ChannelModel",
            "S3TwilioModel",
            "S3TwitterModel",
            "S3TwitterSearchModel",
+           "S3KeyGraphModel",
            "S3XFormsModel",
            "S3BaseStationModel",
            "msg_search_subscription_notifications",
@@ -155,6 +156,24 @@ class S3ChannelModel(S3Model):
                            #label = T("Status")
                            #represent = s3_yes_no_represent,
                            ),
+                     # Statistics of the last poll
+                     Field("polled_on", "datetime",
+                           readable = False,
+                           writable = False,
+                           ),
+                     # Seconds
+                     Field("latency", "double",
+                           readable = False,
+                           writable = False,
+                           ),
+                     Field("items", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
+                     Field("new_items", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
                      *s3_meta_fields())
 
         # ---------------------------------------------------------------------
@@ -193,14 +212,29 @@ class S3ChannelModel(S3Model):
 
         # Do we have an existing Task?
         ttable = db.scheduler_task
-        args = '["%s", %s]' % (tablename, channel_id)
-        query = ((ttable.function_name == "msg_poll") & \
+        if tablename in ("msg_email_channel", "msg_rss_channel") and \
+           current.deployment_settings.get_msg_poll_concurrent():
+            # Polled together with all other channels of this type
+            function_name = "msg_poll_channels"
+            args = '["%s"]' % tablename
+        else:
+            function_name = "msg_poll"
+            args = '["%s", %s]' % (tablename, channel_id)
+        query = ((ttable.function_name == function_name) & \
                  (ttable.args == args) & \
                  (ttable.status.belongs(["RUNNING", "QUEUED", "ALLOCATED"])))
         exists = db(query).select(ttable.id,
                                   limitby=(0, 1)).first()
         if exists:
             return "Channel already enabled"
+        elif function_name == "msg_poll_channels":
+            current.s3task.schedule_task(function_name,
+                                         args=[tablename],
+                                         period=300,  # seconds
+                                         timeout=600, # seconds
+                                         repeats=0    # unlimited
+                                         )
+            return "Channel enabled"
         else:
             current.s3task.schedule_task("msg_poll",
                                          args=[tablename, channel_id],
@@ -567,6 +601,15 @@ class S3EmailModel(S3ChannelModel):
                      # Set true to delete messages from the remote
                      # inbox after fetching them.
                      Field("delete_from_server", "boolean"),
+                     # IMAP: UID of the last message fetched
+                     Field("last_uid", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
+                     Field("uidvalidity", "integer",
+                           readable = False,
+                           writable = False,
+                           ),
                      *s3_meta_fields())
 
         configure(tablename,
@@ -783,6 +826,11 @@ class S3ParsingModel(S3Model):
                                        (parsed and [T("Parsed")] or \
                                                    [T("Not Parsed")])[0],
                            label = T("Parsing Status")),
+                     # Set if the parser failed for this message
+                     Field("parse_error", "text",
+                           label = T("Parsing Error"),
+                           writable = False,
+                           ),
                      message_id("reply_id",
                                 label = T("Reply"),
                                 ondelete = "CASCADE",
@@ -1092,6 +1140,11 @@ class S3RSSModel(S3ChannelModel):
                      Field("from_address",
                            label = T("Link"),
                            ),
+                     # SHA1 of the link, for duplicate checks
+                     Field("link_hash", length=40,
+                           readable = False,
+                           writable = False,
+                           ),
                      # http://pythonhosted.org/feedparser/reference-feed-author_detail.html
                      Field("author",
                            label = T("Author"),
@@ -1982,6 +2035,93 @@ S3.timeline.now="''', now.isoformat(), '''"
         else:
             r.error(405, current.ERROR.BAD_METHOD)
 # =============================================================================
+class S3KeyGraphModel(S3Model):
+    """
+        Keyword co-occurrence graphs of inbound messages, and cached
+        hashtag definitions
+
+        All tables are maintained by S3KeyGraph.
+    """
+
+    names = ["msg_keygraph",
+             "msg_keygraph_term",
+             "msg_keygraph_edge",
+             "msg_hashtag",
+             ]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # ---------------------------------------------------------------------
+        # Keyword Graph
+        # - one per Twitter Search, or for all inbound messages (no search)
+        #
+        tablename = "msg_keygraph"
+        define_table(tablename,
+                     Field("search_id", "reference msg_twitter_search",
+                           ondelete = "CASCADE",
+                           ),
+                     # ID of the last message processed
+                     Field("last_id", "integer",
+                           default = 0,
+                           ),
+                     # Number of messages processed
+                     Field("documents", "integer",
+                           default = 0,
+                           ),
+                     # Topic clusters (JSON)
+                     Field("topics", "text"),
+                     Field("updated_on", "datetime"),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Term counts of a Keyword Graph
+        #
+        tablename = "msg_keygraph_term"
+        define_table(tablename,
+                     Field("keygraph_id", "reference msg_keygraph",
+                           ondelete = "CASCADE",
+                           ),
+                     Field("term", length=128),
+                     Field("count", "integer",
+                           default = 0,
+                           ),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Co-occurrence counts of a Keyword Graph
+        # - term1 < term2
+        #
+        tablename = "msg_keygraph_edge"
+        define_table(tablename,
+                     Field("keygraph_id", "reference msg_keygraph",
+                           ondelete = "CASCADE",
+                           ),
+                     Field("term1", length=128),
+                     Field("term2", length=128),
+                     Field("count", "integer",
+                           default = 0,
+                           ),
+                     )
+
+        # ---------------------------------------------------------------------
+        # Hashtag Definitions
+        #
+        tablename = "msg_hashtag"
+        define_table(tablename,
+                     Field("tag", length=128),
+                     # None if no definition found
+                     Field("definition", "text"),
+                     Field("retrieved_on", "datetime",
+                           default = current.request.utcnow,
+                           ),
+                     )
+
+        # ---------------------------------------------------------------------
+        return dict()
+
+# =============================================================================
 class S3XFormsModel(S3Model):
     """
         XForms are used by the ODK Collect mobile client
@@ -869,6 +869,18 @@ class S3PersonModel(S3Model):
                        crud_form = crud_form,
                        deduplicate = self.person_deduplicate,
                        filter_widgets = filter_widgets,
+                       merge_candidates = {"fields": ["first_name",
+                                                      "middle_name",
+                                                      "last_name",
+                                                      "date_of_birth",
+                                                      "gender",
+                                                      "contact.value",
+                                                      ],
+                                           "keys": self.pr_person_duplicate_keys,
+                                           "similarity": self.pr_person_similarity,
+                                           "threshold": 0.85,
+                                           "represent": pr_PersonRepresent(),
+                                           },
                        list_fields = ["id",
                                       "first_name",
                                       "middle_name",
@@ -1103,6 +1115,105 @@ class S3PersonModel(S3Model):
                              last_name = vars.last_name,
                              )
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_person_phones(record):
+        """
+            Normalized phone numbers of a person record for duplicate
+            detection: the last 9 digits of all contacts which look like
+            phone numbers
+
+            @param record: the record as extracted by S3DuplicateFinder
+        """
+
+        values = record.get("pr_contact.value")
+        if not values:
+            return set()
+        elif type(values) is not list:
+            values = [values]
+
+        phones = set()
+        for value in values:
+            digits = "".join(c for c in s3_unicode(value) if c.isdigit())
+            if len(digits) >= 7:
+                phones.add(digits[-9:])
+        return phones
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_person_duplicate_keys(record):
+        """
+            Blocking keys for S3DuplicateFinder: Soundex of first and
+            last name (in either order), date of birth with initial,
+            and phone numbers
+
+            @param record: the record as extracted by S3DuplicateFinder
+        """
+
+        code = S3DuplicateFinder.soundex
+        first_name = code(record.get("pr_person.first_name"))
+        last_name = code(record.get("pr_person.last_name"))
+
+        keys = []
+        if first_name and last_name:
+            # Names are often swapped, so make the key order-independent
+            keys.append("n:%s" % "".join(sorted((first_name, last_name))))
+        dob = record.get("pr_person.date_of_birth")
+        if dob:
+            keys.append("d:%s:%s" % (dob.isoformat(),
+                                     (first_name or last_name)[:1]))
+        for phone in S3PersonModel.pr_person_phones(record):
+            keys.append("p:%s" % phone)
+        return keys
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_person_similarity(a, b):
+        """
+            Similarity function for S3DuplicateFinder
+
+            @param a: the first record
+            @param b: the second record
+
+            @return: the similarity (0.0 to 1.0)
+        """
+
+        similarity = S3DuplicateFinder.name_similarity
+
+        def mean(values):
+            values = [v for v in values if v is not None]
+            return sum(values) / len(values) if values else 0.0
+
+        fa = a.get("pr_person.first_name")
+        la = a.get("pr_person.last_name")
+        fb = b.get("pr_person.first_name")
+        lb = b.get("pr_person.last_name")
+
+        # Name similarity, considering swapped first/last names
+        score = max(mean((similarity(fa, fb), similarity(la, lb))),
+                    mean((similarity(fa, lb), similarity(la, fb))))
+        if not score:
+            return 0.0
+
+        # Date of Birth
+        dob_a = a.get("pr_person.date_of_birth")
+        dob_b = b.get("pr_person.date_of_birth")
+        if dob_a and dob_b:
+            score += 0.1 if dob_a == dob_b else -0.3
+
+        # Gender (1 = unknown)
+        gender_a = a.get("pr_person.gender")
+        gender_b = b.get("pr_person.gender")
+        if gender_a in (2, 3) and gender_b in (2, 3) and gender_a != gender_b:
+            score -= 0.3
+
+        # Phone
+        phones = S3PersonModel.pr_person_phones
+        if phones(a) & phones(b):
+            score += 0.1
+
+        return max(0.0, min(score, 1.0))
+
     # -------------------------------------------------------------------------
     @staticmethod
     def person_deduplicate(item):
@@ -33,6 +33,7 @@ __all__ = ["S3RequestModel",
            "S3RequestRecurringModel",
            "S3RequestSummaryModel",
            "S3RequestTaskModel",
+           "S3RequestMatchModel",
            "S3CommitModel",
            "S3CommitItemModel",
            "S3CommitPersonModel",
@@ -41,6 +42,7 @@ __all__ = ["S3RequestModel",
            "req_update_status",
            "req_rheader",
            "req_match",
+           "S3RequestMatcher",
            "req_add_from_template",
            "req_customise_req_fields",
            "req_req_list_layout",
@@ -48,6 +50,8 @@ __all__ = ["S3RequestModel",
            "req_commit_list_layout",
            ]
 
+import math
+
 from gluon import *
 from gluon.storage import Storage
 from ..s3 import *
@@ -1236,29 +1240,16 @@ S3OptionsFilter({
         output["title"] = T("Check Request")
         output["rheader"] = req_rheader(r, check_page=True)
 
-        stable = s3db.org_site
-        ltable = s3db.gis_location
-        query = (stable.id == site_id ) & \
-                (stable.location_id == ltable.id)
-        location_r = db(query).select(ltable.lat,
-                                      ltable.lon,
-                                      limitby=(0, 1)).first()
-        query = (stable.id == r.record.site_id ) & \
-                (stable.location_id == ltable.id)
-        req_location_r = db(query).select(ltable.lat,
-                                          ltable.lon,
-                                          limitby=(0, 1)).first()
-
+        matcher = S3RequestMatcher(req_ids=[r.id])
         try:
-            distance = current.gis.greatCircleDistance(location_r.lat,
-                                                       location_r.lon,
-                                                       req_location_r.lat,
-                                                       req_location_r.lon,)
+            site_id = long(site_id)
+        except (ValueError, TypeError):
+            site_id = None
+        distance = matcher.distance(site_id, r.record.site_id)
+        if distance is not None:
             output["rheader"][0].append(TR(TH(T("Distance from %s:") % site_name),
                                            TD(T("%.1f km") % distance)
                                            ))
-        except:
-            pass
 
         output["subtitle"] = T("Request Items")
 
@@ -1275,22 +1266,11 @@ S3OptionsFilter({
                                      table.quantity_commit,
                                      table.quantity_transit,
                                      table.quantity_fulfil)
-        itable = s3db.inv_inv_item
-        query = (itable.site_id == site_id ) & \
-                (itable.deleted == False )
-        inv_items_dict = {}
-        inv_items = db(query).select(itable.item_id,
-                                     itable.quantity,
-                                     itable.item_pack_id,
-                                     # VF
-                                     #itable.pack_quantity,
-                                     )
-        for item in inv_items:
-            item_id = item.item_id
-            if item_id in inv_items_dict:
-                inv_items_dict[item_id] += item.quantity * item.pack_quantity()
-            else:
-                inv_items_dict[item_id] = item.quantity * item.pack_quantity()
+        stock = matcher.stock_index([item.item_id for item in req_items],
+                                    site_ids=[site_id])
+        inv_items_dict = dict((item_id, sites[site_id])
+                              for item_id, sites in stock.items()
+                              if site_id in sites)
 
         if len(req_items):
             row = TR(TH(table.item_id.label),
@@ -2291,6 +2271,121 @@ class S3RequestTaskModel(S3Model):
         #
         return dict()
 
+# =============================================================================
+class S3RequestMatchModel(S3Model):
+    """
+        Pre-computed candidate supplier sites for open item requests,
+        see S3RequestMatcher
+    """
+
+    names = ["req_candidate",
+             "req_update_matches",
+             ]
+
+    def model(self):
+
+        T = current.T
+
+        # -----------------------------------------------------------------
+        # Candidate sites to supply requested items
+        #
+        tablename = "req_candidate"
+        self.define_table(tablename,
+                          self.req_req_id(empty=False),
+                          self.super_link("site_id", "org_site",
+                                          label = T("Supplier Site"),
+                                          readable = True,
+                                          represent = self.org_site_represent,
+                                          ),
+                          Field("rank", "integer",
+                                label = T("Rank"),
+                                ),
+                          Field("distance", "double",
+                                label = T("Distance (km)"),
+                                represent = lambda v: \
+                                    "%.1f" % v if v is not None \
+                                               else current.messages["NONE"],
+                                ),
+                          Field("items", "integer",
+                                label = T("Requested Items"),
+                                ),
+                          Field("matched", "integer",
+                                label = T("Items in Stock"),
+                                ),
+                          Field("complete", "integer",
+                                label = T("Items in Sufficient Quantity"),
+                                ),
+                          Field("coverage", "double",
+                                label = T("Coverage"),
+                                represent = lambda v: \
+                                    "%d%%" % round(v * 100) if v is not None \
+                                                            else current.messages["NONE"],
+                                ),
+                          Field("date", "datetime",
+                                default = current.request.utcnow,
+                                label = T("Updated"),
+                                represent = S3DateTime.datetime_represent,
+                                ),
+                          )
+
+        current.response.s3.crud_strings[tablename] = Storage(
+            title_list = T("Best Matches"),
+            title_display = T("Candidate Site"),
+            title_report = T("Best Matches Report"),
+            msg_list_empty = T("No matching stock found for open requests"),
+            )
+
+        self.configure(tablename,
+                       deletable = False,
+                       editable = False,
+                       insertable = False,
+                       list_fields = ["req_id",
+                                      "req_id$site_id",
+                                      "rank",
+                                      "site_id",
+                                      "distance",
+                                      "items",
+                                      "matched",
+                                      "complete",
+                                      "coverage",
+                                      ],
+                       orderby = "req_candidate.req_id,req_candidate.rank",
+                       report_options = Storage(
+                            rows = ["req_id", "req_id$site_id", "site_id"],
+                            cols = ["rank", "site_id"],
+                            fact = [(T("Number of Requests"), "count(req_id)"),
+                                    (T("Items in Sufficient Quantity"), "sum(complete)"),
+                                    (T("Coverage"), "avg(coverage)"),
+                                    (T("Distance (km)"), "min(distance)"),
+                                    ],
+                            defaults = Storage(rows = "site_id",
+                                               cols = "rank",
+                                               fact = "count(req_id)",
+                                               totals = True,
+                                               ),
+                            ),
+                       )
+
+        # ---------------------------------------------------------------------
+        # Pass names back to global scope (s3.*)
+        #
+        return dict(req_update_matches = self.req_update_matches,
+                    )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def req_update_matches(req_ids=None):
+        """
+            Re-compute the candidate sites for open requests
+
+            @param req_ids: list of req_req record IDs, None for all
+                            open requests
+
+            @return: the number of candidates found
+        """
+
+        return S3RequestMatcher(req_ids=req_ids).update()
+
 # =============================================================================
 class S3CommitModel(S3Model):
     """
@@ -3267,6 +3362,9 @@ def req_item_onaccept(form):
     # Update Request Status
     req_update_status(req_id)
 
+    # Discard the pre-computed matches
+    S3RequestMatcher.invalidate(req_id)
+
     # Update req_item_category link table
     item_id = form.vars.get("item_id", None)
     db = current.db
@@ -3297,6 +3395,10 @@ def req_item_ondelete(row):
     fks = json.loads(item.deleted_fk)
     req_id = fks["req_id"]
     item_id = fks["item_id"]
+
+    # Discard the pre-computed matches
+    S3RequestMatcher.invalidate(req_id)
+
     citable = db.supply_catalog_item
     cats = db(citable.item_id == item_id).select(citable.item_category_id)
     for cat in cats:
@@ -3694,6 +3796,445 @@ def req_rheader(r, check_page=False):
                 return rheader
     return None
 
+# =============================================================================
+class S3RequestMatcher(object):
+    """
+        Matching engine for open item requests vs. inventory stock
+
+        - indexes the stock (in base units) by item and site
+        - indexes the sites by location on a lat/lon grid, so that
+          candidates can be ranked by distance to the requesting site
+          without computing all distances
+        - stores the best candidates per request in req_candidate
+          (see req_update_matches task)
+    """
+
+    # Grid cell size (degrees) for the site location index
+    CELL = 1.0
+
+    # Approximate length of one degree latitude (km)
+    DEGREE = 111.19
+
+    # -------------------------------------------------------------------------
+    def __init__(self, req_ids=None, limit=10):
+        """
+            Constructor
+
+            @param req_ids: list of req_req record IDs to match,
+                            None for all open requests
+            @param limit: maximum number of candidates per request
+        """
+
+        self.req_ids = req_ids
+        self.limit = limit
+
+        self._needs = None
+        self._stock = None
+        self._locations = {}
+        self._grid = None
+
+    # -------------------------------------------------------------------------
+    @property
+    def needs(self):
+        """
+            The outstanding quantities (in base units) of requested items,
+            as dict {req_id: Storage(site_id=site_id, items={item_id: qty})}
+        """
+
+        needs = self._needs
+        if needs is None:
+
+            db = current.db
+            s3db = current.s3db
+
+            rtable = s3db.req_req
+            ritable = s3db.req_req_item
+            ptable = s3db.supply_item_pack
+
+            query = (ritable.req_id == rtable.id) & \
+                    (ritable.deleted != True) & \
+                    (ritable.item_pack_id == ptable.id) & \
+                    (rtable.deleted != True)
+            req_ids = self.req_ids
+            if req_ids is not None:
+                query &= (rtable.id.belongs(req_ids))
+            else:
+                query &= ((rtable.is_template == False) | \
+                          (rtable.is_template == None)) & \
+                         ((rtable.cancel == False) | \
+                          (rtable.cancel == None)) & \
+                         ((rtable.fulfil_status == None) | \
+                          (rtable.fulfil_status != REQ_STATUS_COMPLETE))
+
+            rows = db(query).select(rtable.id,
+                                    rtable.site_id,
+                                    ritable.item_id,
+                                    ritable.quantity,
+                                    ritable.quantity_commit,
+                                    ritable.quantity_transit,
+                                    ritable.quantity_fulfil,
+                                    ptable.quantity,
+                                    )
+
+            use_commit = current.deployment_settings.get_req_use_commit()
+
+            needs = {}
+            for row in rows:
+                req = row.req_req
+                item = row.req_req_item
+                done = max(item.quantity_transit or 0,
+                           item.quantity_fulfil or 0)
+                if use_commit:
+                    done = max(done, item.quantity_commit or 0)
+                quantity = ((item.quantity or 0) - done) * \
+                           (row.supply_item_pack.quantity or 1)
+                if quantity <= 0:
+                    continue
+                need = needs.get(req.id)
+                if need is None:
+                    need = needs[req.id] = Storage(site_id=req.site_id,
+                                                   items={})
+                items = need.items
+                items[item.item_id] = items.get(item.item_id, 0) + quantity
+            self._needs = needs
+        return needs
+
+    # -------------------------------------------------------------------------
+    @property
+    def stock(self):
+        """
+            The stock of all requested items, as dict
+            {item_id: {site_id: quantity in base units}}
+        """
+
+        stock = self._stock
+        if stock is None:
+            item_ids = set()
+            for need in self.needs.values():
+                item_ids.update(need.items.keys())
+            stock = self._stock = self.stock_index(item_ids)
+        return stock
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stock_index(item_ids, site_ids=None):
+        """
+            Look up the stock of items
+
+            @param item_ids: the supply_item record IDs
+            @param site_ids: the site IDs (None for all sites)
+
+            @return: dict {item_id: {site_id: quantity in base units}}
+        """
+
+        stock = {}
+        if not item_ids:
+            return stock
+
+        db = current.db
+        s3db = current.s3db
+
+        itable = s3db.inv_inv_item
+        ptable = s3db.supply_item_pack
+
+        query = (itable.item_id.belongs(set(item_ids))) & \
+                (itable.deleted != True) & \
+                (itable.quantity > 0) & \
+                (itable.item_pack_id == ptable.id)
+        if site_ids is not None:
+            query &= (itable.site_id.belongs(set(site_ids)))
+
+        quantity = (itable.quantity * ptable.quantity).sum()
+        rows = db(query).select(itable.item_id,
+                                itable.site_id,
+                                quantity,
+                                groupby = [itable.item_id, itable.site_id],
+                                )
+        for row in rows:
+            item_id = row[itable.item_id]
+            sites = stock.get(item_id)
+            if sites is None:
+                sites = stock[item_id] = {}
+            sites[row[itable.site_id]] = row[quantity] or 0
+        return stock
+
+    # -------------------------------------------------------------------------
+    def locations(self, site_ids):
+        """
+            Look up the lat/lon of sites (cached)
+
+            @param site_ids: the site IDs
+
+            @return: dict {site_id: (lat, lon)} for all sites with
+                     coordinates
+        """
+
+        locations = self._locations
+        missing = [site_id for site_id in site_ids
+                           if site_id and site_id not in locations]
+        if missing:
+            db = current.db
+            s3db = current.s3db
+            stable = s3db.org_site
+            gtable = s3db.gis_location
+            query = (stable.site_id.belongs(set(missing))) & \
+                    (stable.location_id == gtable.id) & \
+                    (gtable.lat != None) & \
+                    (gtable.lon != None)
+            rows = db(query).select(stable.site_id, gtable.lat, gtable.lon)
+            for site_id in missing:
+                locations[site_id] = None
+            for row in rows:
+                location = row.gis_location
+                locations[row.org_site.site_id] = (location.lat, location.lon)
+        return dict((site_id, locations[site_id]) for site_id in site_ids
+                    if site_id and locations.get(site_id))
+
+    # -------------------------------------------------------------------------
+    def distance(self, site_id, other_id):
+        """
+            Distance between two sites
+
+            @param site_id: the site ID
+            @param other_id: the other site ID
+
+            @return: the distance in km, or None if not available
+        """
+
+        locations = self.locations([site_id, other_id])
+        if site_id not in locations or other_id not in locations:
+            return None
+        lat1, lon1 = locations[site_id]
+        lat2, lon2 = locations[other_id]
+        try:
+            return current.gis.greatCircleDistance(lat1, lon1, lat2, lon2)
+        except ValueError:
+            # acos domain error for identical positions
+            return 0.0
+
+    # -------------------------------------------------------------------------
+    @property
+    def grid(self):
+        """
+            Spatial index of all sites with stock of requested items,
+            as dict {(row, col): [(site_id, lat, lon), ...]}
+        """
+
+        grid = self._grid
+        if grid is None:
+            grid = self._grid = {}
+            site_ids = set()
+            for sites in self.stock.values():
+                site_ids.update(sites.keys())
+            cell = self.CELL
+            for site_id, (lat, lon) in self.locations(site_ids).items():
+                key = (int(math.floor(lat / cell)), int(math.floor(lon / cell)))
+                grid.setdefault(key, []).append((site_id, lat, lon))
+        return grid
+
+    # -------------------------------------------------------------------------
+    def nearest(self, lat, lon, site_ids):
+        """
+            Generator for sites in order of increasing distance from
+            a position, using the spatial index (ring search)
+
+            @param lat: the latitude
+            @param lon: the longitude
+            @param site_ids: set of site IDs to consider
+
+            @return: generator of tuples (distance, site_id)
+        """
+
+        grid = self.grid
+        if not grid:
+            return
+
+        cell = self.CELL
+        row0 = int(math.floor(lat / cell))
+        col0 = int(math.floor(lon / cell))
+        # Number of indexed sites to find
+        site_ids = set(site_ids)
+        total = sum(1 for sites in grid.values()
+                      for site in sites if site[0] in site_ids)
+
+        half = int(math.ceil(180 / cell))
+        max_ring = max(max(abs(k[0] - row0) for k in grid), half)
+
+        def cells(ring):
+            # Grid cells on the perimeter of a ring around (row0, col0)
+            if not ring:
+                yield row0, col0
+                return
+            for c in xrange(col0 - ring, col0 + ring + 1):
+                yield row0 - ring, c
+                yield row0 + ring, c
+            for r in xrange(row0 - ring + 1, row0 + ring):
+                yield r, col0 - ring
+                yield r, col0 + ring
+
+        great_circle = current.gis.greatCircleDistance
+        def distance(lat2, lon2):
+            try:
+                return great_circle(lat, lon, lat2, lon2)
+            except ValueError:
+                return 0.0
+
+        # Pending results, sorted by distance
+        pending = []
+        seen = set()
+        for ring in xrange(max_ring + 1):
+            # Collect the sites in all cells of this ring
+            for r, c in cells(ring):
+                # Wrap around the date line
+                c = (c + half) % (2 * half) - half
+                for site_id, lat2, lon2 in grid.get((r, c), ()):
+                    if site_id in site_ids and site_id not in seen:
+                        seen.add(site_id)
+                        pending.append((distance(lat2, lon2), site_id))
+            pending.sort(reverse=True)
+
+            # Anything beyond this ring is at least this far away
+            factor = math.cos(math.radians(min(abs(lat) + (ring + 1) * cell, 90)))
+            bound = ring * cell * self.DEGREE * max(factor, 0)
+            while pending and pending[-1][0] <= bound:
+                yield pending.pop()
+            if len(seen) == total:
+                break
+        while pending:
+            yield pending.pop()
+
+    # -------------------------------------------------------------------------
+    def match(self, req_id):
+        """
+            Find the best candidate sites for a request
+
+            @param req_id: the req_req record ID
+
+            @return: list of Storages (site_id, distance, items, matched,
+                     complete, coverage), best first
+        """
+
+        need = self.needs.get(req_id)
+        if not need:
+            return []
+
+        stock = self.stock
+        items = need.items
+
+        # Candidates = all other sites with stock of any requested item
+        site_ids = set()
+        for item_id in items:
+            site_ids.update(stock.get(item_id, {}).keys())
+        site_ids.discard(need.site_id)
+        if not site_ids:
+            return []
+
+        def candidate(site_id, distance):
+            matched = complete = 0
+            coverage = 0.0
+            for item_id, quantity in items.items():
+                available = stock.get(item_id, {}).get(site_id, 0)
+                if available > 0:
+                    matched += 1
+                    if available >= quantity:
+                        complete += 1
+                    coverage += min(available, quantity) / float(quantity)
+            return Storage(site_id = site_id,
+                           distance = distance,
+                           items = len(items),
+                           matched = matched,
+                           complete = complete,
+                           coverage = coverage / len(items),
+                           )
+
+        limit = self.limit
+        candidates = []
+        origin = self.locations([need.site_id]).get(need.site_id)
+        if origin:
+            # Nearest sites first, until enough complete matches are found
+            full = 0
+            for distance, site_id in self.nearest(origin[0], origin[1], site_ids):
+                c = candidate(site_id, distance)
+                candidates.append(c)
+                site_ids.discard(site_id)
+                if c.complete == c.items:
+                    full += 1
+                    if full >= limit:
+                        site_ids = set()
+                        break
+        # Sites without known distance
+        candidates.extend(candidate(site_id, None) for site_id in site_ids)
+
+        far = float("inf")
+        candidates.sort(key=lambda c: (-c.coverage,
+                                       c.distance if c.distance is not None else far))
+        return candidates[:limit]
+
+    # -------------------------------------------------------------------------
+    def update(self):
+        """
+            Compute and store the candidates for all requests
+
+            @return: the number of candidates
+        """
+
+        db = current.db
+        table = current.s3db.req_candidate
+
+        req_ids = self.req_ids
+        if req_ids is None:
+            db(table.id > 0).delete()
+        else:
+            db(table.req_id.belongs(req_ids)).delete()
+
+        now = current.request.utcnow
+        records = []
+        for req_id in self.needs:
+            for rank, c in enumerate(self.match(req_id), 1):
+                c.update(req_id = req_id,
+                         rank = rank,
+                         date = now,
+                         )
+                records.append(c)
+        if records:
+            table.bulk_insert(records)
+        return len(records)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def invalidate(req_id):
+        """
+            Discard the stored candidates for a request (e.g. when its
+            items have changed); they will be re-computed on demand, or
+            with the next run of the req_update_matches task
+
+            @param req_id: the req_req record ID
+        """
+
+        table = current.s3db.req_candidate
+        current.db(table.req_id == req_id).delete()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def candidates(cls, req_id):
+        """
+            Get the stored candidates for a request, computing them if
+            necessary
+
+            @param req_id: the req_req record ID
+
+            @return: Rows of req_candidate
+        """
+
+        db = current.db
+        table = current.s3db.req_candidate
+        query = (table.req_id == req_id)
+        rows = db(query).select(orderby=table.rank)
+        if not rows:
+            if cls(req_ids=[req_id]).update():
+                rows = db(query).select(orderby=table.rank)
+        return rows
+
 # =============================================================================
 def req_match():
     """
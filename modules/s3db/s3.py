@@ -27,7 +27,10 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3HierarchyModel"]
+__all__ = ["S3HierarchyModel",
+           "S3DuplicateModel",
+           "S3DeferredHookModel",
+           ]
 
 from gluon import *
 from ..s3 import *
@@ -64,5 +67,102 @@ class S3HierarchyModel(S3Model):
 
         return {}
 
+# =============================================================================
+class S3DuplicateModel(S3Model):
+    """ Model for duplicate candidates found by S3DuplicateFinder """
+
+    names = ["s3_merge_candidate"]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # -------------------------------------------------------------------------
+        # Duplicate Candidates
+        #
+        # - pairs of records in the same table which are likely duplicates,
+        #   record_id being the older record
+        #
+        status_opts = {"OPEN": "Open",
+                       "IGNORED": "Ignored",
+                       "MERGED": "Merged",
+                       }
+
+        tablename = "s3_merge_candidate"
+        define_table(tablename,
+                     Field("tablename",
+                           length=64),
+                     Field("record_id", "integer"),
+                     Field("duplicate_id", "integer"),
+                     Field("score", "double",
+                           default=0.0),
+                     Field("status",
+                           length=16,
+                           default="OPEN",
+                           requires=IS_IN_SET(status_opts, zero=None),
+                           represent=lambda opt: \
+                                     status_opts.get(opt, opt)),
+                     *s3_timestamp())
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
+
+# =============================================================================
+class S3DeferredHookModel(S3Model):
+    """ Model for post-commit hooks deferred to the scheduler, see S3Task.defer """
+
+    names = ["s3_deferred_hook"]
+
+    def model(self):
+
+        define_table = self.define_table
+
+        # -------------------------------------------------------------------------
+        # Deferred Hooks
+        #
+        # - one entry per record and hook, to be run in batches per table
+        #   and hook by the s3_run_deferred_hooks task
+        #
+        status_opts = {"PENDING": "Pending",
+                       "FAILED": "Failed",
+                       }
+
+        tablename = "s3_deferred_hook"
+        define_table(tablename,
+                     Field("tablename",
+                           length=64),
+                     Field("hook",
+                           length=64),
+                     Field("record_id", "integer"),
+                     Field("status",
+                           length=16,
+                           default="PENDING",
+                           requires=IS_IN_SET(status_opts, zero=None),
+                           represent=lambda opt: \
+                                     status_opts.get(opt, opt)),
+                     Field("attempts", "integer",
+                           default=0),
+                     Field("next_attempt", "datetime"),
+                     Field("error", "text"),
+                     *s3_timestamp())
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return {}
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return {}
 
 # END =========================================================================
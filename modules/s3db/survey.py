@@ -37,6 +37,7 @@ __all__ = ["S3SurveyTemplateModel",
            "S3SurveyFormatterModel",
            "S3SurveySeriesModel",
            "S3SurveyCompleteModel",
+           "S3SurveyStatsModel",
            "S3SurveyTranslateModel",
            "survey_template_represent",
            "survey_answer_list_represent",
@@ -59,6 +60,8 @@ __all__ = ["S3SurveyTemplateModel",
            "survey_save_answers_for_series",
            "survey_updateMetaData",
            "survey_getAllAnswersForQuestionInSeries",
+           "survey_getQuestionStats",
+           "survey_rebuildQuestionStats",
            "survey_getQstnLayoutRules",
            "survey_getSeries",
            "survey_getSeriesName",
@@ -89,6 +92,7 @@ from ..s3 import *
 from s3chart import S3Chart
 from s3survey import survey_question_type, \
                      survey_analysis_type, \
+                     S3SurveyStats, \
                      _debug
 
 # =============================================================================
@@ -2006,14 +2010,23 @@ $('#chart_btn').click(function(){
         getAnswers = survey_getAllAnswersForQuestionInSeries
         gqstn = survey_getQuestionFromName(labelQuestion, series_id)
         gqstn_id = gqstn["qstn_id"]
-        ganswers = getAnswers(gqstn_id, series_id)
+        gqstn_type = gqstn["type"]
+        ganswers = None
         dataList = []
         legendLabels = []
         for numericQuestion in numQstnList:
             if numericQuestion == "Count":
                 # get the count of replies for the label question
-                gqstn_type = gqstn["type"]
-                analysisTool = survey_analysis_type[gqstn_type](gqstn_id, ganswers)
+                stats = survey_getQuestionStats(gqstn_id, series_id, gqstn_type)
+                if stats is not None and stats.histogram:
+                    analysisTool = survey_analysis_type[gqstn_type](gqstn_id,
+                                                                    [],
+                                                                    stats)
+                else:
+                    if ganswers is None:
+                        ganswers = getAnswers(gqstn_id, series_id)
+                    analysisTool = survey_analysis_type[gqstn_type](gqstn_id,
+                                                                    ganswers)
                 map = analysisTool.uniqueCount()
                 label = map.keys()
                 data = map.values()
@@ -2028,6 +2041,8 @@ $('#chart_btn').click(function(){
                 if len(label) > 20:
                     label = "%s..." % label[0:20]
                 legendLabels.append(label)
+                if ganswers is None:
+                    ganswers = getAnswers(gqstn_id, series_id)
                 grouped = analysisTool.groupData(ganswers)
                 aggregate = "Sum"
                 filtered = analysisTool.filter(aggregate, grouped)
@@ -2160,8 +2175,10 @@ $('#chart_btn').click(function(){
                 pqstn_id = pqstn["qstn_id"]
                 answers = survey_getAllAnswersForQuestionInSeries(pqstn_id,
                                                                   series_id)
+                stats = survey_getQuestionStats(pqstn_id, series_id, "Numeric")
                 analysisTool = survey_analysis_type["Numeric"](pqstn_id,
-                                                               answers)
+                                                               answers,
+                                                               stats)
                 analysisTool.advancedResults()
             else:
                 analysisTool = None
@@ -2511,10 +2528,17 @@ def buildSeriesSummary(series_id, posn_offset):
         br.append(widgetObj.fullName())
         #br.append(question["name"])
         type = widgetObj.type_represent()
-        answers = survey_getAllAnswersForQuestionInSeries(question_id,
-                                                          series_id)
-        analysisTool = survey_analysis_type[question["type"]](question_id,
-                                                              answers)
+        qstn_type = question["type"]
+        stats = survey_getQuestionStats(question_id, series_id, qstn_type)
+        if stats is not None:
+            analysisTool = survey_analysis_type[qstn_type](question_id,
+                                                           [],
+                                                           stats)
+        else:
+            answers = survey_getAllAnswersForQuestionInSeries(question_id,
+                                                              series_id)
+            analysisTool = survey_analysis_type[qstn_type](question_id,
+                                                           answers)
         chart = analysisTool.chartButton(series_id)
         cell = TD()
         cell.append(type)
@@ -2609,6 +2633,7 @@ class S3SurveyCompleteModel(S3Model):
         configure(tablename,
                   deduplicate = self.survey_complete_duplicate,
                   onaccept = self.complete_onaccept,
+                  ondelete = self.complete_ondelete,
                   onvalidation = self.complete_onvalidate,
                   )
 
@@ -2733,20 +2758,56 @@ class S3SurveyCompleteModel(S3Model):
         S3Chart.purgeCache(purgePrefix)
         if series_id == None:
             return
+        # Remember the previous answers to update the question statistics
+        old_answers = survey_getAnswersForComplete(complete_id)
+        old_location = location = record.location
         # Save all the answers from answerList in the survey_answer table
         answerList = record.answer_list
-        S3SurveyCompleteModel.importAnswers(complete_id, answerList)
+        s3 = current.response.s3
+        s3.survey_stats_deferred = True
+        try:
+            S3SurveyCompleteModel.importAnswers(complete_id, answerList)
+        finally:
+            s3.survey_stats_deferred = False
         # Extract the default template location question and save the
         # answer in the location field
         templateRec = survey_getTemplateFromSeries(series_id)
         locDetails = templateRec["location_detail"]
-        if not locDetails:
+        if locDetails:
+            widgetObj = get_default_location(complete_id)
+            if widgetObj:
+                location = widgetObj.repr()
+                current.db(rtable.id == complete_id).update(location = location)
+            locations = get_location_details(complete_id)
+            S3SurveyCompleteModel.importLocations(locations)
+        # Update the question statistics
+        survey_updateQuestionStats(series_id,
+                                   old_answers,
+                                   survey_getAnswersForComplete(complete_id),
+                                   old_location,
+                                   location)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def complete_ondelete(row):
+        """
+            The answers of a deleted assessment must no longer be included
+            in the question statistics for the series
+        """
+
+        table = current.s3db.survey_complete
+        record = current.db(table.id == row.id).select(table.series_id,
+                                                       table.deleted_fk,
+                                                       limitby=(0, 1)
+                                                       ).first()
+        if not record:
             return
-        widgetObj = get_default_location(complete_id)
-        if widgetObj:
-            current.db(rtable.id == complete_id).update(location = widgetObj.repr())
-        locations = get_location_details(complete_id)
-        S3SurveyCompleteModel.importLocations(locations)
+        series_id = record.series_id
+        if not series_id and record.deleted_fk:
+            series_id = json.loads(record.deleted_fk).get("series_id")
+        if series_id:
+            S3Chart.purgeCache("survey_series_%s" % series_id)
+            survey_invalidateQuestionStats(series_id)
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -2888,6 +2949,15 @@ class S3SurveyCompleteModel(S3Model):
                 query = (atable.question_id == question_id) & \
                         (atable.complete_id == complete_id)
                 current.db(query).update(value = newValue)
+            if not current.response.s3.survey_stats_deferred:
+                # Individual answer edited => rebuild the statistics
+                ctable = current.s3db.survey_complete
+                record = current.db(ctable.id == complete_id).select(
+                                                    ctable.series_id,
+                                                    limitby=(0, 1)).first()
+                if record:
+                    survey_invalidateQuestionStats(record.series_id,
+                                                   question_id)
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -2906,6 +2976,225 @@ class S3SurveyCompleteModel(S3Model):
                     (table.complete_id == rid)
             return duplicator(job, query)
 
+# =============================================================================
+class S3SurveyStatsModel(S3Model):
+    """
+        Pre-aggregated answer statistics
+
+        The survey_question_stats table holds summary statistics for the
+        answers to each question within a series (see S3SurveyStats).
+        These are maintained incrementally when completed assessments are
+        imported or updated, and rebuilt from the answers when they have
+        been marked as dirty (e.g. after an individual answer was edited).
+    """
+
+    names = ["survey_question_stats",
+             ]
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        tablename = "survey_question_stats"
+        self.define_table(tablename,
+                          self.survey_series_id(),
+                          self.survey_question_id(),
+                          Field("replies", "integer",
+                                default = 0,
+                                ),
+                          Field("valid", "integer",
+                                default = 0,
+                                ),
+                          Field("total", "double",
+                                default = 0.0,
+                                ),
+                          Field("sumsq", "double",
+                                default = 0.0,
+                                ),
+                          Field("minimum", "double"),
+                          Field("maximum", "double"),
+                          # JSON: {value: count}
+                          Field("histogram", "text"),
+                          # JSON: {location: [replies, total]}
+                          Field("locations", "text"),
+                          Field("dirty", "boolean",
+                                default = False,
+                                ),
+                          *s3_timestamp())
+
+        # ---------------------------------------------------------------------
+        return dict()
+
+# =============================================================================
+def survey_getAnswersForComplete(complete_id):
+    """
+        Function to return all the answers of a completed assessment
+        as a dict {question_id: value}
+    """
+
+    atable = current.s3db.survey_answer
+    query = (atable.complete_id == complete_id) & \
+            (atable.deleted != True)
+    rows = current.db(query).select(atable.question_id,
+                                    atable.value)
+    return dict((row.question_id, row.value) for row in rows)
+
+# =============================================================================
+def survey_getQuestionStats(question_id, series_id, type):
+    """
+        Function to return the pre-aggregated statistics for the answers
+        to a question within a series, rebuilding them if they are missing
+        or dirty
+
+        @param question_id: the question ID
+        @param series_id: the series ID
+        @param type: the question type
+
+        @return: S3SurveyStats, or None if the analysis of this question
+                 type can not be based on summary statistics
+    """
+
+    if not S3SurveyStats.supported(type):
+        return None
+
+    table = current.s3db.survey_question_stats
+    query = (table.question_id == question_id) & \
+            (table.series_id == series_id)
+    row = current.db(query).select(table.ALL, limitby=(0, 1)).first()
+    if row and not row.dirty:
+        return S3SurveyStats.fromRow(type, row)
+    stats = survey_rebuildQuestionStats(series_id,
+                                        [{"qstn_id": question_id,
+                                          "type": type,
+                                          }])
+    return stats.get(question_id)
+
+# =============================================================================
+def survey_rebuildQuestionStats(series_id, questions=None):
+    """
+        Function to rebuild the pre-aggregated statistics for the answers
+        to questions within a series
+
+        @param series_id: the series ID
+        @param questions: the questions (list of dicts with qstn_id and type,
+                          as returned by survey_getAllQuestionsForSeries),
+                          defaults to all questions in the series
+
+        @return: dict {question_id: S3SurveyStats}
+    """
+
+    db = current.db
+    s3db = current.s3db
+
+    if questions is None:
+        questions = survey_getAllQuestionsForSeries(series_id)
+    types = dict((q["qstn_id"], q["type"]) for q in questions
+                 if S3SurveyStats.supported(q["type"]))
+    if not types:
+        return {}
+    stats = dict((question_id, S3SurveyStats(type))
+                 for question_id, type in types.items())
+
+    # Aggregate all answers in a single pass
+    ctable = s3db.survey_complete
+    atable = s3db.survey_answer
+    query = (ctable.series_id == series_id) & \
+            (ctable.deleted != True) & \
+            (atable.complete_id == ctable.id) & \
+            (atable.deleted != True)
+    if len(types) == 1:
+        query &= (atable.question_id == types.keys()[0])
+    else:
+        query &= (atable.question_id.belongs(types.keys()))
+    rows = db(query).select(atable.question_id,
+                            atable.value,
+                            ctable.location)
+    for row in rows:
+        answer = row.survey_answer
+        stats[answer.question_id].add(answer.value,
+                                      row.survey_complete.location)
+
+    # Store the results
+    table = s3db.survey_question_stats
+    for question_id, s in stats.items():
+        query = (table.question_id == question_id) & \
+                (table.series_id == series_id)
+        record = s.record()
+        if not db(query).update(**record):
+            table.insert(series_id=series_id,
+                         question_id=question_id,
+                         **record)
+    return stats
+
+# =============================================================================
+def survey_updateQuestionStats(series_id,
+                               old_answers,
+                               new_answers,
+                               old_location=None,
+                               new_location=None):
+    """
+        Function to update the pre-aggregated statistics after the answers
+        of a completed assessment have changed
+
+        Statistics which have not been built yet or are dirty are left
+        alone (they will be rebuilt from the answers when next accessed),
+        and statistics which can not be updated incrementally are marked
+        as dirty.
+
+        @param series_id: the series ID
+        @param old_answers: the previous answers {question_id: value}
+        @param new_answers: the current answers {question_id: value}
+        @param old_location: the previous location of the assessment
+        @param new_location: the current location of the assessment
+    """
+
+    changed = []
+    for question_id in set(old_answers.keys()) | set(new_answers.keys()):
+        old_value = old_answers.get(question_id)
+        new_value = new_answers.get(question_id)
+        if old_value != new_value or old_location != new_location:
+            changed.append(question_id)
+    if not changed:
+        return
+
+    db = current.db
+    table = current.s3db.survey_question_stats
+    query = (table.series_id == series_id) & \
+            (table.question_id.belongs(changed)) & \
+            (table.dirty != True)
+    rows = db(query).select(table.ALL)
+    if not rows:
+        return
+
+    types = dict((q["qstn_id"], q["type"])
+                 for q in survey_getAllQuestionsForSeries(series_id))
+    for row in rows:
+        question_id = row.question_id
+        type = types.get(question_id)
+        if not S3SurveyStats.supported(type):
+            continue
+        stats = S3SurveyStats.fromRow(type, row)
+        if question_id in old_answers:
+            stats.remove(old_answers[question_id], old_location)
+        if question_id in new_answers:
+            stats.add(new_answers[question_id], new_location)
+        if stats.stale:
+            row.update_record(dirty=True)
+        else:
+            row.update_record(**stats.record())
+
+# =============================================================================
+def survey_invalidateQuestionStats(series_id, question_id=None):
+    """
+        Function to mark the pre-aggregated statistics for a series
+        (or just one question within the series) as dirty
+    """
+
+    table = current.s3db.survey_question_stats
+    query = (table.series_id == series_id)
+    if question_id is not None:
+        query &= (table.question_id == question_id)
+    current.db(query).update(dirty=True)
+
 # =============================================================================
 def survey_answerlist_dataTable_pre():
     """
@@ -3100,7 +3389,32 @@ def buildCompletedList(series_id, question_id_list):
     """
 
     db = current.db
-    qtable = current.s3db.survey_question
+    s3db = current.s3db
+    qtable = s3db.survey_question
+    ctable = s3db.survey_complete
+    atable = s3db.survey_answer
+
+    # Load all question names and answers at once
+    rows = db(qtable.id.belongs(question_id_list)).select(qtable.id,
+                                                          qtable.name)
+    names = dict((row.id, row.name) for row in rows)
+    query = (atable.question_id.belongs(question_id_list)) & \
+            (atable.complete_id == ctable.id) & \
+            (ctable.series_id == series_id)
+    rows = db(query).select(atable.question_id,
+                            atable.value,
+                            atable.complete_id,
+                            orderby=atable.id)
+    answer_lookup = {}
+    for row in rows:
+        answer = {"value": row.value,
+                  "complete_id": row.complete_id,
+                  }
+        question_id = row.question_id
+        if question_id in answer_lookup:
+            answer_lookup[question_id].append(answer)
+        else:
+            answer_lookup[question_id] = [answer]
 
     headers = []
     happend = headers.append
@@ -3110,13 +3424,11 @@ def buildCompletedList(series_id, question_id_list):
     rowLen = len(question_id_list)
     complete_lookup = {}
     for question_id in question_id_list:
-        answers = survey_getAllAnswersForQuestionInSeries(question_id,
-                                                          series_id)
+        question_id = int(question_id)
+        answers = answer_lookup.get(question_id, [])
         widgetObj = survey_getWidgetFromQuestion(question_id)
 
-        question = db(qtable.id == question_id).select(qtable.name,
-                                                       limitby=(0, 1)).first()
-        happend(question.name)
+        happend(names.get(question_id))
         types.append(widgetObj.db_type())
 
         for answer in answers:
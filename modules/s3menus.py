@@ -380,6 +380,7 @@ class S3OptionsMenu(object):
         ADMIN = current.session.s3.system_roles.ADMIN
         settings_messaging = self.settings_messaging()
         translate = current.deployment_settings.has_module("translate")
+        profile = current.deployment_settings.get_log_profile()
 
         # NB: Do not specify a controller for the main menu to allow
         #     re-use of this menu by other controllers
@@ -400,6 +401,9 @@ class S3OptionsMenu(object):
                         M("Raw Database access", c="appadmin", f="index")
                     ),
                     M("Error Tickets", c="admin", f="errors"),
+                    M("Task Queues", c="admin", f="task_metrics"),
+                    M("Request Profile", c="admin", f="profile",
+                      check=profile),
                     M("Synchronization", c="sync", f="index")(
                         M("Settings", f="config", args=[1], m="update"),
                         M("Repositories", f="repository"),
@@ -588,6 +592,7 @@ class S3OptionsMenu(object):
                         #M("Search"),
                         M("Map", m="map"),
                         M("Report", m="report"),
+                        M("Capacity", f="shelter_aggregate", m="report"),
                         M("Import", m="import", p="create"),
                     ),
                     M(types, restrict=[ADMIN])(
@@ -1135,6 +1140,10 @@ class S3OptionsMenu(object):
                           vars=dict(report="inc")),
                         M("Summary of Releases", c="inv", f="track_item",
                           vars=dict(report="rel")),
+                        M("Stock Movements", c="inv", f="stock_movement",
+                          m="report"),
+                        M("Stock History", c="inv", f="stock_snapshot",
+                          m="report"),
                     ),
                     M(inv_recv_list, c="inv", f="recv")(
                         M("Create", m="create"),
@@ -1659,6 +1668,8 @@ class S3OptionsMenu(object):
                           check=req_skills),
                         M("Search All Requested Skills", f="req_skill",
                           check=req_skills),
+                        M("Best Matches", f="candidate", m="report",
+                          check=req_items),
                     ),
                     M("Commitments", f="commit", check=use_commit)(
                         #M("Search")
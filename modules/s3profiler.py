@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+""" S3 Request Pipeline Profiler
+
+    @copyright: (c) 2014 Sahana Software Foundation
+    @license: MIT
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import datetime
+import threading
+import time
+
+from gluon import current
+
+# =============================================================================
+class S3Profiler(object):
+    """
+        Simple profiler for the models pipeline, records wall time and
+        number of DB queries per model file, per S3Model instantiation
+        and per menu build.
+
+        Activated in 000_config.py by:
+
+            settings.log.profile = True
+
+        The results of each request are returned in the X-S3-Profile
+        response header, and aggregated (per server process) for the
+        admin/profile report.
+
+        Times are inclusive, i.e. the time for a model which loads other
+        models includes the time for those.
+    """
+
+    HEADER = "X-S3-Profile"
+
+    # Maximum number of models/menus to report in the response header
+    HEADER_ITEMS = 10
+
+    # Aggregated statistics {(category, name): [count, seconds, max, queries]}
+    stats = {}
+    requests = 0
+    lock = threading.Lock()
+
+    def __init__(self, start=None):
+        """
+            Constructor
+
+            @param start: the start time of the request (datetime), e.g.
+                          request.now to include the time before the
+                          profiler has been set up
+        """
+
+        now = time.time()
+        if isinstance(start, datetime.datetime):
+            delta = datetime.datetime.now() - start
+            start = now - delta.seconds - delta.microseconds / 1000000.0
+        elif start is None:
+            start = now
+
+        self.start = start
+        self.last = start
+        self.queries = 0
+        self.last_queries = 0
+
+        # List of (category, name, seconds, queries)
+        self.entries = []
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setup(cls, db=None, start=None):
+        """
+            Set up current.profiler (if activated in deployment settings)
+
+            @param db: the database to count queries for
+            @param start: the start time of the request (datetime)
+        """
+
+        if current.deployment_settings.get_log_profile():
+            profiler = cls(start=start)
+            if db is not None:
+                profiler.attach(db)
+        else:
+            profiler = None
+        # Must always be set since current persists across requests
+        # in the same thread
+        current.profiler = profiler
+        return profiler
+
+    # -------------------------------------------------------------------------
+    def attach(self, db):
+        """
+            Count the queries executed on a database
+
+            @param db: the database (DAL instance)
+        """
+
+        adapter = db._adapter
+        execute = adapter.execute
+        profiler = self
+        def counted_execute(*args, **kwargs):
+            profiler.queries += 1
+            return execute(*args, **kwargs)
+        adapter.execute = counted_execute
+
+    # -------------------------------------------------------------------------
+    def checkpoint(self, name):
+        """
+            Record the time and queries since the previous checkpoint,
+            called at the end of each model file
+
+            @param name: the name of the model file
+        """
+
+        now = time.time()
+        queries = self.queries
+        self.entries.append(("file",
+                             name,
+                             now - self.last,
+                             queries - self.last_queries))
+        self.last = now
+        self.last_queries = queries
+
+    # -------------------------------------------------------------------------
+    def timer(self):
+        """
+            Start measuring something, use with record()
+
+            @return: the timer
+        """
+
+        return (time.time(), self.queries)
+
+    # -------------------------------------------------------------------------
+    def record(self, category, name, timer):
+        """
+            Record the time and queries since a timer has been started
+
+            @param category: the category ("model" or "menu")
+            @param name: the name of the model class or menu
+            @param timer: the timer
+        """
+
+        start, queries = timer
+        self.entries.append((category,
+                             name,
+                             time.time() - start,
+                             self.queries - queries))
+
+    # -------------------------------------------------------------------------
+    def header(self):
+        """
+            Summary of the request for the response header, e.g.
+
+                total=85.3ms/12q; file:00_db.py=10.2ms/2q; ...
+
+            Only the slowest models and menus are included.
+        """
+
+        total = time.time() - self.start
+        items = ["total=%.1fms/%dq" % (total * 1000, self.queries)]
+
+        files = []
+        others = []
+        for entry in self.entries:
+            if entry[0] == "file":
+                files.append(entry)
+            else:
+                others.append(entry)
+        others.sort(key=lambda entry: entry[2], reverse=True)
+
+        for category, name, seconds, queries in \
+            files + others[:self.HEADER_ITEMS]:
+            items.append("%s:%s=%.1fms/%dq" % (category,
+                                               name,
+                                               seconds * 1000,
+                                               queries))
+        return "; ".join(items)
+
+    # -------------------------------------------------------------------------
+    def finish(self):
+        """
+            Add the profile of this request to the response headers and
+            the aggregated statistics, called at the end of the models
+            pipeline
+        """
+
+        current.response.headers[self.HEADER] = self.header()
+
+        cls = self.__class__
+        stats = cls.stats
+        with cls.lock:
+            cls.requests += 1
+            for category, name, seconds, queries in self.entries:
+                key = (category, name)
+                if key in stats:
+                    item = stats[key]
+                    item[0] += 1
+                    item[1] += seconds
+                    if seconds > item[2]:
+                        item[2] = seconds
+                    item[3] += queries
+                else:
+                    stats[key] = [1, seconds, seconds, queries]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def report(cls):
+        """
+            Get the aggregated statistics
+
+            @return: tuple (number of requests, list of dicts with
+                     category, name, count, total, average, max (ms)
+                     and queries (average per call)), ordered by
+                     total time descending
+        """
+
+        with cls.lock:
+            items = [(key, list(value)) for key, value in cls.stats.items()]
+            requests = cls.requests
+
+        rows = []
+        for (category, name), (count, seconds, maximum, queries) in items:
+            rows.append({"category": category,
+                         "name": name,
+                         "count": count,
+                         "total": seconds * 1000,
+                         "average": seconds * 1000 / count,
+                         "max": maximum * 1000,
+                         "queries": float(queries) / count,
+                         })
+        rows.sort(key=lambda row: row["total"], reverse=True)
+        return requests, rows
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def reset(cls):
+        """ Clear the aggregated statistics """
+
+        with cls.lock:
+            cls.stats = {}
+            cls.requests = 0
+
+# END =========================================================================
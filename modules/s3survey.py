@@ -2714,26 +2714,26 @@ class S3QuestionTypeGridChildWidget(S3QuestionTypeAbstractWidget):
 ###############################################################################
 
 # Analysis Types
-def analysis_stringType(question_id, answerList):
-    return S3StringAnalysis("String", question_id, answerList)
-def analysis_textType(question_id, answerList):
-    return S3TextAnalysis("Text", question_id, answerList)
-def analysis_numericType(question_id, answerList):
-    return S3NumericAnalysis("Numeric", question_id, answerList)
-def analysis_dateType(question_id, answerList):
-    return S3DateAnalysis("Date", question_id, answerList)
-def analysis_timeType(question_id, answerList):
-    return S3TimeAnalysis("Date", question_id, answerList)
-def analysis_optionType(question_id, answerList):
-    return S3OptionAnalysis("Option", question_id, answerList)
-def analysis_ynType(question_id, answerList):
-    return S3OptionYNAnalysis("YesNo", question_id, answerList)
-def analysis_yndType(question_id, answerList):
-    return S3OptionYNDAnalysis("YesNoDontKnow", question_id, answerList)
-def analysis_optionOtherType(question_id, answerList):
-    return S3OptionOtherAnalysis("OptionOther", question_id, answerList)
-def analysis_multiOptionType(question_id, answerList):
-    return S3MultiOptionAnalysis("MultiOption", question_id, answerList)
+def analysis_stringType(question_id, answerList, stats=None):
+    return S3StringAnalysis("String", question_id, answerList, stats)
+def analysis_textType(question_id, answerList, stats=None):
+    return S3TextAnalysis("Text", question_id, answerList, stats)
+def analysis_numericType(question_id, answerList, stats=None):
+    return S3NumericAnalysis("Numeric", question_id, answerList, stats)
+def analysis_dateType(question_id, answerList, stats=None):
+    return S3DateAnalysis("Date", question_id, answerList, stats)
+def analysis_timeType(question_id, answerList, stats=None):
+    return S3TimeAnalysis("Date", question_id, answerList, stats)
+def analysis_optionType(question_id, answerList, stats=None):
+    return S3OptionAnalysis("Option", question_id, answerList, stats)
+def analysis_ynType(question_id, answerList, stats=None):
+    return S3OptionYNAnalysis("YesNo", question_id, answerList, stats)
+def analysis_yndType(question_id, answerList, stats=None):
+    return S3OptionYNDAnalysis("YesNoDontKnow", question_id, answerList, stats)
+def analysis_optionOtherType(question_id, answerList, stats=None):
+    return S3OptionOtherAnalysis("OptionOther", question_id, answerList, stats)
+def analysis_multiOptionType(question_id, answerList, stats=None):
+    return S3MultiOptionAnalysis("MultiOption", question_id, answerList, stats)
 def analysis_locationType(question_id, answerList):
     return S3LocationAnalysis("Location", question_id, answerList)
 def analysis_linkType(question_id, answerList):
@@ -2838,6 +2838,252 @@ class S3AnalysisPriority():
         else:
             return "%s - %s" % (pBand[key], pBand[key+1])
 
+# =============================================================================
+class S3SurveyStats(object):
+    """
+        Mergeable summary statistics for the answers to a single question
+        within a series, as stored in the survey_question_stats table.
+
+        The statistics can be updated incrementally when answers are added
+        or removed, so that the series analysis does not have to load and
+        re-analyse all answers on every request.
+
+        Properties
+        ==========
+        type      - The question type
+        replies   - The number of answers
+        valid     - The number of answers which could be analysed
+        total     - Sum of all valid numeric answers
+        sumsq     - Sum of the squares of all valid numeric answers
+        minimum   - The smallest valid numeric answer
+        maximum   - The largest valid numeric answer
+        histogram - Dict of the number of occurances of each value
+                    (numeric and option type questions only)
+        locations - Dict {location: [replies, total]} of the answers
+                    grouped by the location of the completed assessment
+        stale     - True if the statistics can not be maintained
+                    incrementally any more and must be rebuilt
+    """
+
+    NUMERIC = ("Numeric",)
+    OPTIONS = ("Option", "YesNo", "YesNoDontKnow", "OptionOther")
+    MULTIPLE = ("MultiOption",)
+    COUNTED = ("String", "Text", "Date", "Time")
+
+    def __init__(self,
+                 type,
+                 replies=0,
+                 valid=0,
+                 total=0.0,
+                 sumsq=0.0,
+                 minimum=None,
+                 maximum=None,
+                 histogram=None,
+                 locations=None,
+                 ):
+
+        self.type = type
+        self.replies = replies or 0
+        self.valid = valid or 0
+        self.total = total or 0.0
+        self.sumsq = sumsq or 0.0
+        self.minimum = minimum
+        self.maximum = maximum
+        self.histogram = histogram or {}
+        self.locations = locations or {}
+        self.stale = False
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def supported(cls, type):
+        """
+            Check whether the analysis of a question type can be based
+            on the summary statistics (rather than on the answers)
+
+            @param type: the question type
+        """
+
+        return type in cls.NUMERIC or \
+               type in cls.OPTIONS or \
+               type in cls.MULTIPLE or \
+               type in cls.COUNTED
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def fromRow(cls, type, row):
+        """
+            Instantiate from a survey_question_stats record
+
+            @param type: the question type
+            @param row: the survey_question_stats Row
+        """
+
+        histogram = row.histogram
+        if histogram:
+            histogram = json.loads(histogram)
+            if type in cls.NUMERIC:
+                histogram = dict((float(k), v) for k, v in histogram.items())
+        locations = row.locations
+        if locations:
+            locations = json.loads(locations)
+        return cls(type,
+                   replies = row.replies,
+                   valid = row.valid,
+                   total = row.total,
+                   sumsq = row.sumsq,
+                   minimum = row.minimum,
+                   maximum = row.maximum,
+                   histogram = histogram,
+                   locations = locations,
+                   )
+
+    # -------------------------------------------------------------------------
+    def record(self):
+        """
+            Get the field values to store in survey_question_stats
+        """
+
+        histogram = self.histogram
+        if self.type in self.NUMERIC:
+            histogram = dict((repr(k), v) for k, v in histogram.items())
+        return dict(replies = self.replies,
+                    valid = self.valid,
+                    total = self.total,
+                    sumsq = self.sumsq,
+                    minimum = self.minimum,
+                    maximum = self.maximum,
+                    histogram = json.dumps(histogram),
+                    locations = json.dumps(self.locations),
+                    dirty = False,
+                    )
+
+    # -------------------------------------------------------------------------
+    def add(self, value, location=None):
+        """
+            Add an answer to the statistics
+
+            @param value: the raw answer value (as stored in survey_answer)
+            @param location: the location of the completed assessment
+        """
+
+        self.update(value, location, 1)
+
+    # -------------------------------------------------------------------------
+    def remove(self, value, location=None):
+        """
+            Remove an answer from the statistics
+
+            @param value: the raw answer value (as stored in survey_answer)
+            @param location: the location of the completed assessment
+        """
+
+        self.update(value, location, -1)
+
+    # -------------------------------------------------------------------------
+    def update(self, value, location, sign):
+        """
+            Add (sign=1) or remove (sign=-1) an answer
+
+            @param value: the raw answer value
+            @param location: the location of the completed assessment
+            @param sign: 1 to add, -1 to remove the answer
+        """
+
+        type = self.type
+        self.replies += sign
+
+        number = None
+        keys = None
+        if type in self.NUMERIC:
+            try:
+                number = float(value)
+            except (ValueError, TypeError):
+                pass
+            else:
+                keys = [number]
+        elif type in self.OPTIONS:
+            keys = [value]
+        elif type in self.MULTIPLE:
+            keys = current.s3db.survey_json2list(value)
+            if not isinstance(keys, list):
+                keys = [keys]
+        elif value is not None:
+            keys = []
+
+        if keys is not None:
+            self.valid += sign
+
+            histogram = self.histogram
+            for key in keys:
+                count = histogram.get(key, 0) + sign
+                if count > 0:
+                    histogram[key] = count
+                else:
+                    histogram.pop(key, None)
+
+        if number is not None:
+            self.total += sign * number
+            self.sumsq += sign * number * number
+            if sign > 0:
+                if self.minimum is None or number < self.minimum:
+                    self.minimum = number
+                if self.maximum is None or number > self.maximum:
+                    self.maximum = number
+            elif self.valid == 0:
+                self.minimum = self.maximum = None
+            elif number == self.minimum or number == self.maximum:
+                # Can not tell the next-smallest/largest value
+                if number not in self.histogram:
+                    self.stale = True
+
+        if location is not None:
+            locations = self.locations
+            location = "%s" % location
+            entry = locations.get(location)
+            if entry is None:
+                entry = locations[location] = [0, 0.0]
+            entry[0] += sign
+            if number is not None:
+                entry[1] += sign * number
+            if entry[0] <= 0:
+                del locations[location]
+
+    # -------------------------------------------------------------------------
+    def mean(self):
+        """
+            The mean of all valid numeric answers
+        """
+
+        if not self.valid:
+            return None
+        return self.total / float(self.valid)
+
+    # -------------------------------------------------------------------------
+    def std(self):
+        """
+            The (population) standard deviation of all valid numeric answers
+        """
+
+        import math
+
+        mean = self.mean()
+        if mean is None:
+            return None
+        variance = self.sumsq / float(self.valid) - mean * mean
+        return math.sqrt(max(variance, 0.0))
+
+    # -------------------------------------------------------------------------
+    def values(self):
+        """
+            Expand the histogram into a list of values (e.g. for charts)
+        """
+
+        values = []
+        extend = values.extend
+        for key in sorted(self.histogram):
+            extend([key] * self.histogram[key])
+        return values
+
 # -----------------------------------------------------------------------------
 class S3AbstractAnalysis():
     """
@@ -2855,6 +3101,10 @@ class S3AbstractAnalysis():
         answerList     - A list of answers, taken from the survey_answer
                          id, complete_id and value
                          See models/survey.py getAllAnswersForQuestionInSeries()
+        stats          - S3SurveyStats for the question, if given then the
+                         results are taken from these rather than from
+                         the answerList
+        replies        - The number of answers
         valueList      - A list of validated & sanitised values
         result         - A list of results before formatting
         type           - The question type
@@ -2867,9 +3117,11 @@ class S3AbstractAnalysis():
                  type,
                  question_id,
                  answerList,
+                 stats=None,
                 ):
         self.question_id = question_id
         self.answerList = answerList
+        self.stats = stats
         self.valueList = []
         self.result = []
         self.type = type
@@ -2878,6 +3130,11 @@ class S3AbstractAnalysis():
         self.priorityGroups = {"default" : [-1, -0.5, 0, 0.5, 1],
                                "standard" : [-2, -1, 0, 1, 2],
                                }
+        if stats is not None:
+            self.replies = stats.replies
+            self.loadStats(stats)
+            return
+        self.replies = len(answerList)
         for answer in self.answerList:
             if self.valid(answer):
                 try:
@@ -2919,6 +3176,24 @@ class S3AbstractAnalysis():
         """
         pass
 
+    # -------------------------------------------------------------------------
+    def loadStats(self, stats):
+        """
+            Take the basic results from the pre-aggregated statistics
+            instead of calculating them from the answer set.
+            Where necessary, this will function be overridden.
+        """
+        pass
+
+    # -------------------------------------------------------------------------
+    def validCount(self):
+        """
+            The number of valid answers
+        """
+        if self.stats is not None:
+            return self.stats.valid
+        return len(self.valueList)
+
     # -------------------------------------------------------------------------
     def chartButton(self, series_id):
         """
@@ -2926,7 +3201,7 @@ class S3AbstractAnalysis():
             When a chart is not appropriate then the subclass will override this
             function with a nul function.
         """
-        if len(self.valueList) == 0:
+        if self.validCount() == 0:
             return None
         if series_id == None:
             return None
@@ -2984,7 +3259,7 @@ class S3AbstractAnalysis():
 
             Where necessary, this will function be overridden.
         """
-        self.result.append(([current.T("Replies")], len(self.answerList)))
+        self.result.append(([current.T("Replies")], self.replies))
         return self.format()
 
     # -------------------------------------------------------------------------
@@ -3002,6 +3277,8 @@ class S3AbstractAnalysis():
         """
             Calculate the number of occurances of each value
         """
+        if self.stats is not None:
+            return dict(self.stats.histogram)
         map = {}
         for answer in self.valueList:
             if answer in map:
@@ -3097,9 +3374,11 @@ class S3NumericAnalysis(S3AbstractAnalysis):
     def __init__(self,
                  type,
                  question_id,
-                 answerList
+                 answerList,
+                 stats=None,
                 ):
-        S3AbstractAnalysis.__init__(self, type, question_id, answerList)
+        S3AbstractAnalysis.__init__(self, type, question_id, answerList,
+                                    stats)
         self.histCutoff = 10
 
     # -------------------------------------------------------------------------
@@ -3127,7 +3406,7 @@ class S3NumericAnalysis(S3AbstractAnalysis):
     # -------------------------------------------------------------------------
     def count(self):
         T = current.T
-        self.result.append((T("Replies"), len(self.answerList)))
+        self.result.append((T("Replies"), self.replies))
         self.result.append((T("Valid"), self.cnt))
         return self.format()
 
@@ -3152,16 +3431,38 @@ class S3NumericAnalysis(S3AbstractAnalysis):
                 self.min = answer
         self.average = self.sum / float(self.cnt)
 
+    # -------------------------------------------------------------------------
+    def loadStats(self, stats):
+        self.cnt = stats.valid
+        if self.cnt == 0:
+            self.sum = None
+            self.average = None
+            self.max = None
+            self.min = None
+            return
+        self.sum = stats.total
+        self.max = stats.maximum
+        self.min = stats.minimum
+        self.average = stats.mean()
+
     # -------------------------------------------------------------------------
     def advancedResults(self):
-        try:
-            from numpy import array
-        except:
-            print >> sys.stderr, "ERROR: S3Survey requires numpy library installed."
+        if self.stats is not None:
+            # Use the pre-aggregated moments
+            if self.stats.valid:
+                self.std = self.stats.std()
+                self.mean = self.stats.mean()
+            else:
+                self.std = self.mean = float("nan")
+        else:
+            try:
+                from numpy import array
+            except:
+                print >> sys.stderr, "ERROR: S3Survey requires numpy library installed."
 
-        array = array(self.valueList)
-        self.std = array.std()
-        self.mean = array.mean()
+            array = array(self.valueList)
+            self.std = array.std()
+            self.mean = array.mean()
         self.zscore = {}
         for answer in self.answerList:
             complete_id = answer["complete_id"]
@@ -3170,7 +3471,10 @@ class S3NumericAnalysis(S3AbstractAnalysis):
             except:
                 continue
             if value != None:
-                self.zscore[complete_id] = (value - self.mean) / self.std
+                if self.std:
+                    self.zscore[complete_id] = (value - self.mean) / self.std
+                else:
+                    self.zscore[complete_id] = 0.0
 
     # -------------------------------------------------------------------------
     def priority(self, complete_id, priorityObj):
@@ -3206,7 +3510,7 @@ class S3NumericAnalysis(S3AbstractAnalysis):
         # At the moment only draw charts for integers
         if self.qstnWidget.get("Format", "n") != "n":
             return None
-        if len(self.valueList) < self.histCutoff:
+        if self.validCount() < self.histCutoff:
             return None
         return S3AbstractAnalysis.chartButton(self, series_id)
 
@@ -3221,8 +3525,12 @@ class S3NumericAnalysis(S3AbstractAnalysis):
         chart = S3Chart(path=chartFile)
         chart.asInt = True
         if data == None:
+            if self.stats is not None:
+                valueList = self.stats.values()
+            else:
+                valueList = self.valueList
             chart.survey_hist(self.qstnWidget.question.name,
-                              self.valueList,
+                              valueList,
                               10,
                               0,
                               self.max,
@@ -3274,6 +3582,16 @@ class S3OptionAnalysis(S3AbstractAnalysis):
                 self.list[answer] += 1
             else:
                 self.list[answer] = 1
+        self.percentages()
+
+    # -------------------------------------------------------------------------
+    def loadStats(self, stats):
+        self.cnt = stats.valid
+        self.list = dict(stats.histogram)
+        self.percentages()
+
+    # -------------------------------------------------------------------------
+    def percentages(self):
         self.listp = {}
         if self.cnt != 0:
             for (key, value) in self.list.items():
@@ -3311,8 +3629,8 @@ class S3OptionYNAnalysis(S3OptionAnalysis):
 
 
     # -------------------------------------------------------------------------
-    def basicResults(self):
-        S3OptionAnalysis.basicResults(self)
+    def percentages(self):
+        S3OptionAnalysis.percentages(self)
         T = current.T
         if "Yes" in self.listp:
             self.yesp = self.listp["Yes"]
@@ -3343,8 +3661,8 @@ class S3OptionYNDAnalysis(S3OptionAnalysis):
         return self.format()
 
     # -------------------------------------------------------------------------
-    def basicResults(self):
-        S3OptionAnalysis.basicResults(self)
+    def percentages(self):
+        S3OptionAnalysis.percentages(self)
         T = current.T
         if "Yes" in self.listp:
             self.yesp = self.listp["Yes"]
@@ -3402,6 +3720,10 @@ class S3MultiOptionAnalysis(S3OptionAnalysis):
                     self.list[answer] += 1
                 else:
                     self.list[answer] = 1
+        self.percentages()
+
+    # -------------------------------------------------------------------------
+    def percentages(self):
         self.listp = {}
         if self.cnt != 0:
             for (key, value) in self.list.items():
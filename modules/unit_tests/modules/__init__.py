@@ -1 +1,2 @@
 from s3layouts import *
+from s3profiler import *
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Profiler Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/modules/s3profiler.py
+#
+import datetime
+import unittest
+
+from gluon import current
+from s3profiler import S3Profiler
+
+# =============================================================================
+class S3ProfilerTests(unittest.TestCase):
+    """ Tests for the models pipeline profiler """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        settings = current.deployment_settings
+        self.profile = settings.log.get("profile")
+        self.profiler = current.profiler
+
+        # Keep the aggregated statistics of this process
+        self.stats = S3Profiler.stats
+        self.requests = S3Profiler.requests
+        S3Profiler.reset()
+
+    # -------------------------------------------------------------------------
+    def testDisabled(self):
+        """ Test that the profiler is not set up unless activated """
+
+        current.deployment_settings.log.profile = False
+
+        profiler = S3Profiler.setup(db=current.db)
+        self.assertEqual(profiler, None)
+        self.assertEqual(current.profiler, None)
+
+    # -------------------------------------------------------------------------
+    def testSetup(self):
+        """ Test set up with request start time """
+
+        current.deployment_settings.log.profile = True
+
+        start = datetime.datetime.now() - datetime.timedelta(seconds=2)
+        profiler = S3Profiler.setup(start=start)
+        self.assertTrue(isinstance(profiler, S3Profiler))
+        self.assertTrue(current.profiler is profiler)
+
+        # Time before the setup is included
+        self.assertTrue(profiler.header().startswith("total="))
+        total = float(profiler.header().split("=", 1)[1].split("ms", 1)[0])
+        self.assertTrue(total >= 2000)
+
+    # -------------------------------------------------------------------------
+    def testRecord(self):
+        """ Test recording of checkpoints and timers """
+
+        assertEqual = self.assertEqual
+
+        profiler = S3Profiler()
+
+        profiler.queries += 2
+        profiler.checkpoint("00_db.py")
+
+        timer = profiler.timer()
+        profiler.queries += 3
+        profiler.record("model", "S3PersonModel", timer)
+
+        timer = profiler.timer()
+        profiler.record("menu", "main", timer)
+
+        entries = profiler.entries
+        assertEqual(len(entries), 3)
+        assertEqual(entries[0][:2], ("file", "00_db.py"))
+        assertEqual(entries[0][3], 2)
+        assertEqual(entries[1][:2], ("model", "S3PersonModel"))
+        assertEqual(entries[1][3], 3)
+        assertEqual(entries[2][3], 0)
+        self.assertTrue(all(entry[2] >= 0 for entry in entries))
+
+        header = profiler.header()
+        self.assertTrue("total=" in header)
+        self.assertTrue("/5q" in header)
+        self.assertTrue("file:00_db.py=" in header)
+        self.assertTrue("model:S3PersonModel=" in header)
+
+    # -------------------------------------------------------------------------
+    def testStats(self):
+        """ Test aggregation of statistics over requests """
+
+        assertEqual = self.assertEqual
+
+        for queries in (1, 3):
+            profiler = S3Profiler()
+            profiler.entries = [("file", "00_db.py", 0.010 * queries, queries),
+                                ("model", "S3PersonModel", 0.001, 0),
+                                ]
+            profiler.finish()
+            self.assertTrue(S3Profiler.HEADER in current.response.headers)
+
+        requests, rows = S3Profiler.report()
+        assertEqual(requests, 2)
+        assertEqual(len(rows), 2)
+
+        row = rows[0]
+        assertEqual(row["name"], "00_db.py")
+        assertEqual(row["count"], 2)
+        self.assertAlmostEqual(row["total"], 40.0)
+        self.assertAlmostEqual(row["average"], 20.0)
+        self.assertAlmostEqual(row["max"], 30.0)
+        assertEqual(row["queries"], 2.0)
+
+        S3Profiler.reset()
+        assertEqual(S3Profiler.report(), (0, []))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings.log.profile = self.profile
+        current.profiler = self.profiler
+        current.response.headers.pop(S3Profiler.HEADER, None)
+
+        S3Profiler.stats = self.stats
+        S3Profiler.requests = self.requests
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3ProfilerTests,
+    )
+
+# END ========================================================================
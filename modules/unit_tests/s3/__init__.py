@@ -4,6 +4,7 @@ from unit_tests.s3.s3crud import *
 from unit_tests.s3.s3datatable import *
 from unit_tests.s3.s3fields import *
 from unit_tests.s3.s3filter import *
+from unit_tests.s3.s3gis import *
 from unit_tests.s3.s3hierarchy import *
 from unit_tests.s3.s3import import *
 from unit_tests.s3.s3model import *
@@ -11,7 +12,9 @@ from unit_tests.s3.s3msg import *
 from unit_tests.s3.s3resource import *
 from unit_tests.s3.s3rest import *
 from unit_tests.s3.s3sync import *
+from unit_tests.s3.s3task import *
 from unit_tests.s3.s3timeplot import *
+from unit_tests.s3.s3translate import *
 from unit_tests.s3.s3validators import *
 from unit_tests.s3.s3widgets import *
 from unit_tests.s3.s3xml import *
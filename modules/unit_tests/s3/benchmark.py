@@ -43,8 +43,34 @@
 # If you get FAIL messages, then the overall performance of Sahana Eden in
 # your enviroment is likely to be completely unacceptable.
 #
-import unittest
+# The workload benchmarks (S3WorkloadBenchmarks) seed locations, offices,
+# persons and inventory items at several data sizes (all data is rolled
+# back afterwards), and measure select/datatable/pivot/export/import/geojson
+# and permission checks. The results are written to a JSON file, which can
+# be kept as baseline for later runs to flag regressions, e.g.:
+#
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/benchmark.py -A --sizes 100,1000,10000 --output before.json
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/benchmark.py -A --output after.json --baseline before.json
+#
+import datetime
+import os
+import random
+import sys
 import timeit
+import unittest
+
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+
+from gluon import current
+from gluon.storage import Storage
+
+from s3.s3data import S3PivotTable
 
 # =============================================================================
 #@unittest.skip("Comment or remove this line in modules/unit_tests/eden/benchmark.py to activate this test")
@@ -124,6 +150,37 @@ class S3PerformanceTests(unittest.TestCase):
             print "S3Model.__getitem__(non-table) = %s µs" % mlt
             self.assertTrue(mlt<10)
 
+    def testS3ModelLoad(self):
+        """ Per-request model loading """
+
+        s3db = current.s3db
+        response = current.response
+        LOAD = s3db.LOAD
+
+        print ""
+        loaded = list(response.get(LOAD) or [])
+
+        # Load just the model defining pr_person
+        location = s3db.manifest()["names"].get("pr_person")
+        if location:
+            prefix, name = location
+            model = current.models.__dict__[prefix].__dict__[name]
+            def load_model():
+                response[LOAD] = []
+                model(prefix)
+            mlt = timeit.Timer(load_model).timeit(number=10) * 100
+            print "S3Model load (pr_person) = %s ms" % mlt
+            self.assertTrue(mlt<100)
+
+        # Load all models
+        def load_all_models():
+            response[LOAD] = []
+            s3db.load_all_models()
+        mlt = timeit.Timer(load_all_models).timeit(number=3) * 1000 / 3
+        print "S3Model load (all models) = %s ms" % mlt
+
+        response[LOAD] = list(set(loaded) | set(response[LOAD]))
+
     def testS3ModelConfigure(self):
 
         s3db = current.s3db
@@ -277,6 +334,450 @@ class S3PerformanceTests(unittest.TestCase):
 
         current.auth.override = False
 
+# =============================================================================
+class S3BenchmarkData(object):
+    """
+        Generator for benchmark data: seeds locations, sites (offices),
+        persons and inventory items in the current transaction, so that
+        they can be discarded with db.rollback() after the benchmark
+    """
+
+    def __init__(self, seed=42):
+        """
+            Constructor
+
+            @param seed: seed for the random generator (to produce the
+                         same data set on every run)
+        """
+
+        self.random = random.Random(seed)
+
+        self.locations = []
+        self.sites = []
+        self.persons = []
+        self.inv_items = []
+
+        self.organisation_id = None
+        self.supply_items = []
+
+    # -------------------------------------------------------------------------
+    def seed(self, size):
+        """
+            Extend the data set to (at least) size records per table
+
+            @param size: the number of records per table
+        """
+
+        db = current.db
+        s3db = current.s3db
+        rand = self.random
+
+        if self.organisation_id is None:
+            otable = s3db.org_organisation
+            self.organisation_id = otable.insert(name="Benchmark Organisation")
+
+            # Supply items for inventory (fixed number, so that the pivot
+            # table grows in rows rather than in columns)
+            itable = s3db.supply_item
+            ptable = s3db.supply_item_pack
+            for i in xrange(20):
+                item_id = itable.insert(name="Benchmark Item %s" % i,
+                                        um="piece")
+                pack_id = ptable.insert(item_id=item_id,
+                                        name="piece",
+                                        quantity=1)
+                self.supply_items.append((item_id, pack_id))
+
+        # Locations
+        ltable = s3db.gis_location
+        locations = self.locations
+        for i in xrange(len(locations), size):
+            lat = rand.uniform(-60.0, 60.0)
+            lon = rand.uniform(-180.0, 180.0)
+            location_id = ltable.insert(name="Benchmark Location %s" % i,
+                                        lat=lat,
+                                        lon=lon,
+                                        wkt="POINT (%s %s)" % (lon, lat),
+                                        lat_min=lat,
+                                        lat_max=lat,
+                                        lon_min=lon,
+                                        lon_max=lon)
+            locations.append(location_id)
+
+        # Sites (offices)
+        stable = s3db.org_office
+        sites = self.sites
+        update_super = s3db.update_super
+        for i in xrange(len(sites), size):
+            record = Storage(name="Benchmark Office %s" % i,
+                             organisation_id=self.organisation_id,
+                             location_id=rand.choice(locations))
+            record.id = stable.insert(**record)
+            update_super(stable, record)
+            sites.append(record.site_id)
+
+        # Persons
+        ptable = s3db.pr_person
+        persons = self.persons
+        for i in xrange(len(persons), size):
+            record = Storage(first_name="Benchmark%s" % i,
+                             last_name=rand.choice(("Smith", "Jones", "Garcia",
+                                                    "Nguyen", "Okafor")),
+                             gender=rand.choice((2, 3)),
+                             date_of_birth=datetime.date(rand.randint(1930, 2010),
+                                                         rand.randint(1, 12),
+                                                         rand.randint(1, 28)))
+            record.id = ptable.insert(**record)
+            update_super(ptable, record)
+            persons.append(record.id)
+
+        # Inventory items
+        itable = s3db.inv_inv_item
+        inv_items = self.inv_items
+        for i in xrange(len(inv_items), size):
+            item_id, pack_id = rand.choice(self.supply_items)
+            inv_item_id = itable.insert(site_id=rand.choice(sites),
+                                        item_id=item_id,
+                                        item_pack_id=pack_id,
+                                        quantity=rand.randint(1, 1000))
+            inv_items.append(inv_item_id)
+
+    # -------------------------------------------------------------------------
+    def person_xml(self, number, offset=0):
+        """
+            Generate an S3XML source with new person records
+
+            @param number: the number of records
+            @param offset: the index of the first record (to generate
+                           unique names)
+        """
+
+        from lxml import etree
+
+        resources = []
+        for i in xrange(offset, offset + number):
+            resources.append("""
+  <resource name="pr_person">
+    <data field="first_name">Imported%s</data>
+    <data field="last_name">Benchmark</data>
+    <resource name="pr_contact">
+      <data field="contact_method" value="SMS"/>
+      <data field="value">%s</data>
+    </resource>
+  </resource>""" % (i, 9460000000 + i))
+
+        xmlstr = "<s3xml>%s\n</s3xml>" % "".join(resources)
+        return etree.ElementTree(etree.fromstring(xmlstr))
+
+# =============================================================================
+class S3BenchmarkResults(object):
+    """
+        Collector for benchmark results, writes them to a JSON file and
+        compares them against a stored baseline
+    """
+
+    def __init__(self):
+
+        self.results = {}
+
+    # -------------------------------------------------------------------------
+    def add(self, name, size, ms, records=None):
+        """
+            Add a result
+
+            @param name: the name of the benchmark
+            @param size: the data size (records per table)
+            @param ms: the time (milliseconds) per run
+            @param records: the number of records processed per run
+        """
+
+        result = {"ms": round(ms, 4)}
+        if records:
+            result["records"] = records
+            if ms:
+                result["rec_sec"] = int(records * 1000 / ms)
+        self.results.setdefault(name, {})[str(size)] = result
+
+        print "%s (n=%s) = %s ms%s" % (name,
+                                       size,
+                                       result["ms"],
+                                       " (=%s rec/sec)" % result["rec_sec"]
+                                       if "rec_sec" in result else "")
+
+    # -------------------------------------------------------------------------
+    def as_dict(self):
+        """ Return the results with meta data as dict """
+
+        request = current.request
+        return {"meta": {"date": request.utcnow.isoformat(),
+                         "application": request.application,
+                         "database": current.db._dbname,
+                         "python": sys.version.split()[0],
+                         "platform": sys.platform,
+                         },
+                "results": self.results,
+                }
+
+    # -------------------------------------------------------------------------
+    def write(self, path):
+        """
+            Write the results to a JSON file
+
+            @param path: the file path
+        """
+
+        output = open(path, "w")
+        try:
+            json.dump(self.as_dict(), output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+        print "Results written to %s" % path
+
+    # -------------------------------------------------------------------------
+    def compare(self, path, tolerance=0.2, minimum=0.5):
+        """
+            Compare the results against a baseline
+
+            @param path: the file path of the baseline JSON file
+            @param tolerance: the relative slow-down to tolerate
+            @param minimum: the minimum absolute slow-down (milliseconds)
+                            to consider a regression (measuring noise)
+
+            @return: list of tuples (name, size, baseline ms, current ms)
+                     for all regressions
+        """
+
+        source = open(path, "r")
+        try:
+            baseline = json.load(source).get("results", {})
+        finally:
+            source.close()
+
+        regressions = []
+        for name, sizes in self.results.items():
+            if name not in baseline:
+                continue
+            for size, result in sizes.items():
+                previous = baseline[name].get(size)
+                if not previous:
+                    continue
+                before, after = previous["ms"], result["ms"]
+                if after > before * (1 + tolerance) and \
+                   after - before > minimum:
+                    regressions.append((name, size, before, after))
+
+        regressions.sort()
+        for name, size, before, after in regressions:
+            print "REGRESSION: %s (n=%s) %s ms => %s ms (%+d%%)" % \
+                  (name, size, before, after, (after / before - 1) * 100)
+        return regressions
+
+# =============================================================================
+class S3WorkloadBenchmarks(unittest.TestCase):
+    """
+        Workload benchmarks at several data sizes
+
+        Options (pass with -A after the script name):
+
+            --sizes 100,1000        the data sizes (records per table)
+            --output FILE           write the results to this JSON file
+            --baseline FILE         compare the results against this file
+            --tolerance 0.2         the relative slow-down to tolerate
+    """
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def options():
+        """ Parse the command line options """
+
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--sizes", default="100,1000")
+        parser.add_argument("--output",
+                            default=os.path.join(current.request.folder,
+                                                 "private",
+                                                 "benchmark.json"))
+        parser.add_argument("--baseline", default=None)
+        parser.add_argument("--tolerance", type=float, default=0.2)
+        options = parser.parse_known_args(sys.argv[1:])[0]
+
+        options.sizes = [int(size) for size in options.sizes.split(",")]
+        return options
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def measure(func, number=1, repeat=3):
+        """
+            Measure the best run time of a function
+
+            @param func: the function
+            @param number: the number of calls per run
+            @param repeat: the number of runs
+
+            @return: the time per call in milliseconds
+        """
+
+        timer = timeit.Timer(func)
+        return min(timer.repeat(repeat=repeat, number=number)) * 1000.0 / number
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+        current.db.rollback()
+
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testWorkload(self):
+        """ Workload benchmarks """
+
+        options = self.options()
+        results = S3BenchmarkResults()
+        data = S3BenchmarkData()
+
+        print ""
+        for size in sorted(options.sizes):
+            data.seed(size)
+            self.benchmarkSelect(results, size)
+            self.benchmarkDataTable(results, size)
+            self.benchmarkPivotTable(results, size)
+            self.benchmarkExport(results, size)
+            self.benchmarkImport(results, size, data)
+            self.benchmarkGeoJSON(results, size)
+            self.benchmarkPermission(results, size, data)
+
+        if options.output:
+            results.write(options.output)
+        if options.baseline:
+            regressions = results.compare(options.baseline,
+                                          tolerance=options.tolerance)
+            self.assertEqual(regressions, [])
+
+    # -------------------------------------------------------------------------
+    def benchmarkSelect(self, results, size):
+        """ S3Resource.select with represent """
+
+        resource = current.s3db.resource("pr_person")
+        fields = ["first_name", "last_name", "gender", "date_of_birth"]
+
+        x = lambda: resource.select(fields, represent=True)
+        mlt = self.measure(x)
+        results.add("S3Resource.select", size, mlt, resource.count())
+
+    # -------------------------------------------------------------------------
+    def benchmarkDataTable(self, results, size):
+        """ S3Resource.datatable (first page incl. total count) """
+
+        s3db = current.s3db
+        fields = ["first_name", "last_name", "gender", "date_of_birth"]
+
+        def x():
+            resource = s3db.resource("pr_person")
+            dt, numrows, ids = resource.datatable(fields=fields,
+                                                  start=0,
+                                                  limit=25,
+                                                  orderby=~resource.table.id)
+            dt.html(numrows, numrows, "datatable")
+        mlt = self.measure(x)
+        results.add("S3Resource.datatable", size, mlt)
+
+    # -------------------------------------------------------------------------
+    def benchmarkPivotTable(self, results, size):
+        """ S3PivotTable for inventory stock per site and item """
+
+        s3db = current.s3db
+
+        def x():
+            resource = s3db.resource("inv_inv_item")
+            S3PivotTable(resource, "site_id", "item_id",
+                         [("quantity", "sum")])
+        mlt = self.measure(x)
+        results.add("S3PivotTable", size, mlt)
+
+    # -------------------------------------------------------------------------
+    def benchmarkExport(self, results, size):
+        """ S3Resource.export_xml """
+
+        resource = current.s3db.resource("pr_person")
+
+        x = lambda: resource.export_xml(dereference=False, mcomponents=None)
+        mlt = self.measure(x)
+        results.add("S3Resource.export_xml", size, mlt, resource.count())
+
+    # -------------------------------------------------------------------------
+    def benchmarkImport(self, results, size, data):
+        """ S3Resource.import_xml (inserts, one tenth of the data size) """
+
+        db = current.db
+        resource = current.s3db.resource("pr_person")
+        number = max(1, size / 10)
+
+        # Each run imports new records, so use savepoints to discard them
+        mlt = None
+        for i in xrange(3):
+            tree = data.person_xml(number, offset=i * number)
+            db.executesql("SAVEPOINT s3benchmark;")
+            start = timeit.default_timer()
+            resource.import_xml(tree)
+            duration = (timeit.default_timer() - start) * 1000.0
+            db.executesql("ROLLBACK TO SAVEPOINT s3benchmark;")
+            mlt = duration if mlt is None else min(mlt, duration)
+        results.add("S3Resource.import_xml", size, mlt, number)
+
+    # -------------------------------------------------------------------------
+    def benchmarkGeoJSON(self, results, size):
+        """ GeoJSON export of a feature resource (offices) """
+
+        permission = current.auth.permission
+        request = current.request
+
+        stylesheet = os.path.join(request.folder,
+                                  "static", "formats", "geojson", "export.xsl")
+        resource = current.s3db.resource("org_office")
+
+        format = permission.format
+        permission.format = "geojson"
+        try:
+            x = lambda: resource.export_xml(stylesheet=stylesheet,
+                                            dereference=False,
+                                            mcomponents=None)
+            mlt = self.measure(x)
+        finally:
+            permission.format = format
+        results.add("S3Resource.export_geojson", size, mlt, resource.count())
+
+    # -------------------------------------------------------------------------
+    def benchmarkPermission(self, results, size, data):
+        """ Record permission checks and accessible-queries """
+
+        auth = current.auth
+        s3db = current.s3db
+
+        table = s3db.pr_person
+        record_ids = data.persons[:100]
+
+        auth.override = False
+        try:
+            def x():
+                has_permission = auth.s3_has_permission
+                for record_id in record_ids:
+                    has_permission("read", table, record_id=record_id)
+            mlt = self.measure(x)
+            results.add("S3Permission.has_permission", size,
+                        mlt / len(record_ids))
+
+            def x():
+                query = auth.s3_accessible_query("read", table)
+                current.db(query).count()
+            mlt = self.measure(x)
+            results.add("S3Permission.accessible_query", size, mlt)
+        finally:
+            auth.override = True
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -294,6 +795,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3PerformanceTests,
+        S3WorkloadBenchmarks,
     )
 
 # END ========================================================================
@@ -5,11 +5,14 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3aaa.py
 #
+import os
+import shutil
+import tempfile
 import unittest
 
 from gluon import *
 from gluon.storage import Storage
-from s3.s3aaa import S3EntityRoleManager, S3Permission
+from s3.s3aaa import S3Audit, S3EntityRoleManager, S3Permission
 from s3.s3fields import s3_meta_fields
 
 # =============================================================================
@@ -4144,6 +4147,143 @@ class EntityRoleManagerTests(unittest.TestCase):
     def tearDownClass(cls):
         pass
 
+# =============================================================================
+class AuditBufferTests(unittest.TestCase):
+    """ Tests for buffered auditing """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        security = current.deployment_settings.security
+        self.settings = dict((key, security.get(key))
+                             for key in ("audit_write",
+                                         "audit_buffer",
+                                         "audit_log"))
+        security.audit_write = True
+
+        self.folder = tempfile.mkdtemp()
+        security.audit_log = os.path.join(self.folder, "audit.log")
+
+        # Buffering requires the request commit hook, i.e. is
+        # disabled in shell scripts (like this test run)
+        request = current.request
+        self.context = (request.is_shell, request.is_scheduler)
+        request.is_shell = request.is_scheduler = False
+
+        # Don't actually commit
+        response = current.response
+        self.hooks = (response.custom_commit, response.s3.commit_hooks)
+        self.commits = commits = []
+        response.custom_commit = lambda adapter: commits.append(adapter)
+        response.s3.commit_hooks = None
+
+    # -------------------------------------------------------------------------
+    def count(self, table):
+        """ Count the audit entries of this test """
+
+        query = (table.tablename == "audit_test")
+        return current.db(query).count()
+
+    # -------------------------------------------------------------------------
+    def testBuffer(self):
+        """ Test bulk insert of buffered entries """
+
+        current.deployment_settings.security.audit_buffer = True
+        audit = S3Audit()
+        table = audit.table
+
+        for record_id in (1, 2, 3):
+            audit("create", "audit", "test", record=record_id)
+        self.assertEqual(len(audit.buffer), 3)
+        self.assertEqual(self.count(table), 0)
+
+        audit.flush()
+        self.assertEqual(audit.buffer, [])
+        self.assertEqual(self.count(table), 3)
+
+    # -------------------------------------------------------------------------
+    def testCommitHook(self):
+        """ Test flushing of buffered entries by the request commit hook """
+
+        current.deployment_settings.security.audit_buffer = True
+        audit = S3Audit()
+        table = audit.table
+
+        audit("create", "audit", "test", record=1)
+        audit("create", "audit", "test", record=2)
+        self.assertEqual(self.count(table), 0)
+
+        # web2py calls the hook with the adapter of each connection
+        adapter = current.db._adapter
+        current.response.custom_commit(adapter)
+        self.assertEqual(self.commits, [adapter])
+        self.assertEqual(audit.buffer, [])
+        self.assertEqual(self.count(table), 2)
+
+    # -------------------------------------------------------------------------
+    def testNoCommitHook(self):
+        """ Test that entries are written immediately in shell scripts """
+
+        current.deployment_settings.security.audit_buffer = True
+        current.request.is_shell = True
+        audit = S3Audit()
+        table = audit.table
+
+        self.assertFalse(audit.buffered)
+        audit("create", "audit", "test", record=1)
+        self.assertEqual(audit.buffer, [])
+        self.assertEqual(self.count(table), 1)
+
+    # -------------------------------------------------------------------------
+    def testLog(self):
+        """ Test appending to and loading from the audit log """
+
+        current.deployment_settings.security.audit_buffer = "log"
+        audit = S3Audit()
+        table = audit.table
+
+        audit("create", "audit", "test", record=1)
+        audit.flush()
+        audit("update", "audit", "test", record=2)
+        audit.flush()
+        self.assertEqual(self.count(table), 0)
+
+        with open(audit.log_path()) as log:
+            self.assertEqual(len(log.readlines()), 2)
+
+        self.assertEqual(audit.load(), 2)
+        self.assertEqual(self.count(table), 2)
+        self.assertFalse(os.path.exists(audit.log_path()))
+
+        # Nothing left to load
+        self.assertEqual(audit.load(), 0)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        db = current.db
+        db.rollback()
+
+        if "s3_audit" in db:
+            table = db.s3_audit
+            db(table.tablename == "audit_test").delete()
+            db.commit()
+
+        request = current.request
+        request.is_shell, request.is_scheduler = self.context
+
+        response = current.response
+        response.custom_commit, response.s3.commit_hooks = self.hooks
+
+        security = current.deployment_settings.security
+        for key, value in self.settings.items():
+            if value is None:
+                security.pop(key, None)
+            else:
+                security[key] = value
+
+        shutil.rmtree(self.folder, ignore_errors=True)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -4172,6 +4312,7 @@ if __name__ == "__main__":
         RealmEntityTests,
         LinkToPersonTests,
         EntityRoleManagerTests,
+        AuditBufferTests,
     )
 
 # END ========================================================================
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# S3GIS Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3gis.py
+#
+import os
+import unittest
+
+from gluon import *
+
+from s3.s3gis import GIS, S3Gazetteer
+
+# =============================================================================
+class GISConfigCacheTests(unittest.TestCase):
+    """ Tests for the compiled map configuration cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        settings = current.deployment_settings
+        self.config_cache = settings.gis.get("config_cache")
+        settings.gis.config_cache = 60
+
+        self.config = current.response.s3.gis.config
+
+    # -------------------------------------------------------------------------
+    def testInvalidate(self):
+        """ Test invalidation of compiled configurations """
+
+        key = GIS.config_cache_key("config", 0, None)
+        self.assertEqual(GIS.config_cache_key("config", 0, None), key)
+
+        GIS.invalidate_config()
+        self.assertNotEqual(GIS.config_cache_key("config", 0, None), key)
+
+    # -------------------------------------------------------------------------
+    def testInvalidateAfterCommit(self):
+        """ Test that the new revision is started only after commit """
+
+        request = current.request
+        response = current.response
+
+        # Simulate an HTTP request, but don't actually commit
+        context = (request.is_shell, request.is_scheduler)
+        hooks = (response.custom_commit, response.s3.commit_hooks)
+        request.is_shell = request.is_scheduler = False
+        response.custom_commit = lambda adapter: None
+        response.s3.commit_hooks = None
+
+        shared = lambda: current.cache.disk("gis_config_revision",
+                                            lambda: None,
+                                            time_expire = None)
+        try:
+            key = GIS.config_cache_key("config", 0, None)
+            revision = shared()
+
+            # Request uses a revision of its own until commit
+            GIS.invalidate_config()
+            pending = GIS.config_cache_key("config", 0, None)
+            self.assertNotEqual(pending, key)
+            self.assertEqual(shared(), revision)
+
+            response.custom_commit(current.db._adapter)
+            self.assertNotEqual(shared(), revision)
+            self.assertNotEqual(GIS.config_cache_key("config", 0, None), key)
+            self.assertNotEqual(GIS.config_cache_key("config", 0, None), pending)
+        finally:
+            request.is_shell, request.is_scheduler = context
+            response.custom_commit, response.s3.commit_hooks = hooks
+
+    # -------------------------------------------------------------------------
+    def testSetConfig(self):
+        """ Test that the compiled config is not modified by requests """
+
+        config = GIS.set_config(0)
+        if not config:
+            return
+        config.zoom = -1
+        config.ids.append(0)
+
+        config = GIS.set_config(0)
+        self.assertNotEqual(config.zoom, -1)
+        self.assertFalse(0 in config.ids)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        settings = current.deployment_settings
+        if self.config_cache is None:
+            settings.gis.pop("config_cache", None)
+        else:
+            settings.gis.config_cache = self.config_cache
+
+        current.response.s3.gis.config = self.config
+
+# =============================================================================
+class GazetteerTests(unittest.TestCase):
+    """ Tests for the local geocoder """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        table = current.s3db.gis_location
+        update_location_tree = current.gis.update_location_tree
+
+        location_ids = {}
+        for code, name, level, parent, lat in (
+            ("L0", "Gazetteer Test Country", "L0", None, 10.0),
+            ("L1A", "Gazetteer Test North", "L1", "L0", 11.0),
+            ("L1B", "Gazetteer Test South", "L1", "L0", 9.0),
+            ("L2A", u"Gazetteer Test Sañ-José", "L2", "L1A", 11.5),
+            ("L2B", u"Gazetteer Test San José", "L2", "L1B", 8.5),
+            ):
+            location_id = table.insert(name = name,
+                                       level = level,
+                                       parent = location_ids.get(parent),
+                                       lat = lat,
+                                       lon = 20.0,
+                                       )
+            update_location_tree(dict(id=location_id, level=level))
+            location_ids[code] = location_id
+        self.location_ids = location_ids
+
+        self.gazetteer = gazetteer = S3Gazetteer()
+        gazetteer.update(location_ids.values())
+
+    # -------------------------------------------------------------------------
+    def testNormalise(self):
+        """ Test normalisation of names """
+
+        normalise = S3Gazetteer.normalise
+        self.assertEqual(normalise(u"  Sañ-José, (Centro) "), "san jose centro")
+        self.assertEqual(normalise(None), "")
+
+    # -------------------------------------------------------------------------
+    def testGeocodeLocal(self):
+        """ Test forward geocoding from the gazetteer """
+
+        assertEqual = self.assertEqual
+
+        geocode = self.gazetteer.geocode
+        location_ids = self.location_ids
+
+        # Ambiguous without context
+        result = geocode("Gazetteer Test San Jose", geocoder=None)
+        assertEqual(result, "Multiple results found")
+
+        # Disambiguated by the Lx
+        result = geocode("Gazetteer Test San Jose",
+                         Lx_ids=[location_ids["L0"], location_ids["L1B"]],
+                         geocoder=None)
+        assertEqual(result, {"lat": 8.5, "lon": 20.0})
+
+        # Disambiguated by the address
+        result = geocode("Gazetteer Test San Jose, Gazetteer Test North",
+                         geocoder=None)
+        assertEqual(result, {"lat": 11.5, "lon": 20.0})
+
+        # No approximate result for street addresses without trying
+        # the remote geocoder
+        address = "1 No Such Street, Gazetteer Test South"
+        result = geocode(address, geocoder=None)
+        assertEqual(result, "No results found")
+        result = geocode(address, remote=False)
+        assertEqual(result, "No results found")
+
+    # -------------------------------------------------------------------------
+    def testGeocodeApproximate(self):
+        """ Test fallback to the gazetteer if the remote geocoder fails """
+
+        address = "1 No Such Street, Gazetteer Test South"
+
+        geocode_remote = GIS.geocode_remote
+        GIS.geocode_remote = staticmethod(lambda *args, **kwargs: \
+                                          "No results found")
+        try:
+            result = self.gazetteer.geocode(address)
+        finally:
+            GIS.geocode_remote = geocode_remote
+        self.assertEqual(result, {"lat": 9.0, "lon": 20.0})
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class HierarchyCacheTests(unittest.TestCase):
+    """ Tests for the cached hierarchy data files """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        # Simulate an HTTP request, but don't actually commit
+        request = current.request
+        self.context = (request.is_shell, request.is_scheduler)
+        request.is_shell = request.is_scheduler = False
+
+        response = current.response
+        self.hooks = (response.custom_commit, response.s3.commit_hooks)
+        response.custom_commit = lambda adapter: None
+        response.s3.commit_hooks = None
+
+        # Use an ID which doesn't exist
+        self.location_id = 2147483647
+        self.path = GIS._hierarchy_cache_path("hdata", self.location_id)
+
+    # -------------------------------------------------------------------------
+    def testInvalidateAfterCommit(self):
+        """ Test that cache files are removed only after commit """
+
+        path = self.path
+
+        # Overwrite an existing file
+        GIS._write_cache_file(path, "old")
+        GIS._write_cache_file(path, "new")
+        with open(path) as f:
+            self.assertEqual(f.read(), "new")
+
+        GIS.invalidate_ldata([self.location_id], hierarchy=True)
+        self.assertTrue(os.path.exists(path))
+
+        current.response.custom_commit(current.db._adapter)
+        self.assertFalse(os.path.exists(path))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        request = current.request
+        request.is_shell, request.is_scheduler = self.context
+
+        response = current.response
+        response.custom_commit, response.s3.commit_hooks = self.hooks
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        GISConfigCacheTests,
+        GazetteerTests,
+        HierarchyCacheTests,
+    )
+
+# END ========================================================================
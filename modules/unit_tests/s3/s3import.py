@@ -9,6 +9,13 @@ import unittest
 
 from gluon import *
 
+try:
+    from cStringIO import StringIO    # Faster, where available
+except:
+    from StringIO import StringIO
+
+from s3.s3csvmap import S3CSVMapping
+
 try:
     import json # try stdlib (Python 2.6)
 except ImportError:
@@ -384,6 +391,130 @@ class FailedReferenceTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class S3CSVMappingTests(unittest.TestCase):
+    """ Tests for native conversion of CSV sources with column maps """
+
+    SPEC = {"resource": "org_organisation",
+            "unique": ["Organisation"],
+            "fields": [{"field": "name", "column": "Organisation"},
+                       {"field": "organisation_type_id",
+                        "lookup": "organisation_type",
+                        },
+                       ],
+            "components": [{"resource": "org_sector_organisation",
+                            "split": "Sectors",
+                            "fields": [{"field": "sector_id",
+                                        "lookup": "sector",
+                                        "item": True,
+                                        },
+                                       ],
+                            },
+                           ],
+            "lookups": {"organisation_type": {"resource": "org_organisation_type",
+                                              "columns": ["Type"],
+                                              "match": {"name": 0},
+                                              "fields": [{"field": "name", "key": 0}],
+                                              },
+                        "sector": {"resource": "org_sector",
+                                   "fields": [{"field": "name", "key": 0}],
+                                   },
+                        },
+            }
+
+    CSV = """Organisation,Type,Sectors
+MapTestOrg1,MapTestType,"Health, Shelter"
+MapTestOrg1,MapTestType,
+MapTestOrg2,MapTestType,Health"""
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def testSupports(self):
+        """ Test detection of columns not covered by the column map """
+
+        xml = current.xml
+        mapping = S3CSVMapping(self.SPEC)
+
+        tree = xml.csv2tree(StringIO(self.CSV))
+        self.assertTrue(mapping.supports(tree))
+
+        # Unknown column without values is fine
+        tree = xml.csv2tree(StringIO("Organisation,Other\nMapTestOrg1,"))
+        self.assertTrue(mapping.supports(tree))
+
+        # ...but with values it is not
+        tree = xml.csv2tree(StringIO("Organisation,Other\nMapTestOrg1,X"))
+        self.assertFalse(mapping.supports(tree))
+
+    # -------------------------------------------------------------------------
+    def testTransform(self):
+        """ Test conversion of a batch into S3XML """
+
+        assertEqual = self.assertEqual
+
+        xml = current.xml
+        mapping = S3CSVMapping(self.SPEC)
+
+        tree = xml.csv2tree(StringIO(self.CSV))
+        root = mapping.transform(tree).getroot()
+
+        orgs = root.findall("resource[@name='org_organisation']")
+        assertEqual(len(orgs), 2)
+        assertEqual(orgs[0].findtext("data[@field='name']"), "MapTestOrg1")
+
+        # Lookup record emitted only once, and referenced by tuid
+        types = root.findall("resource[@name='org_organisation_type']")
+        assertEqual(len(types), 1)
+        tuid = types[0].get("tuid")
+        for org in orgs:
+            reference = org.find("reference[@field='organisation_type_id']")
+            assertEqual(reference.get("tuid"), tuid)
+
+        # Split column produces one component per item
+        links = orgs[0].findall("resource[@name='org_sector_organisation']")
+        assertEqual(len(links), 2)
+        sectors = root.findall("resource[@name='org_sector']")
+        assertEqual(sorted(s.findtext("data[@field='name']") for s in sectors),
+                    ["Health", "Shelter"])
+
+    # -------------------------------------------------------------------------
+    def testLookupIndex(self):
+        """ Test that lookup records found in the DB are referenced by UUID """
+
+        db = current.db
+        s3db = current.s3db
+
+        ttable = s3db.org_organisation_type
+        type_id = ttable.insert(name="MapTestType")
+        uuid = ttable[type_id].uuid
+
+        xml = current.xml
+        mapping = S3CSVMapping(self.SPEC)
+
+        tree = xml.csv2tree(StringIO(self.CSV))
+        root = mapping.transform(tree).getroot()
+
+        types = root.findall("resource[@name='org_organisation_type']")
+        self.assertEqual(len(types), 0)
+        reference = root.find("resource/reference[@field='organisation_type_id']")
+        self.assertEqual(reference.get(xml.UID), uuid)
+
+        # Subsequent batches use the index
+        self.assertEqual(mapping.index[("organisation_type",
+                                        "org_organisation_type",
+                                        ("MapTestType",))],
+                         (type_id, uuid))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -405,6 +536,7 @@ if __name__ == "__main__":
         ComponentDisambiguationTests,
         PostParseTests,
         FailedReferenceTests,
+        S3CSVMappingTests,
     )
 
 # END ========================================================================
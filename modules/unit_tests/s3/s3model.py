@@ -227,6 +227,46 @@ class S3SuperEntityTests(unittest.TestCase):
         super_record = super_table[se_id]
         self.assertFalse(super_record.deleted)
 
+# =============================================================================
+class S3ModelManifestTests(unittest.TestCase):
+
+    # -------------------------------------------------------------------------
+    def testNames(self):
+        """ Test lookup of defining models in the manifest """
+
+        manifest = current.s3db.manifest()
+
+        names = manifest["names"]
+        self.assertEqual(tuple(names["pr_person"]), ("pr", "S3PersonModel"))
+        self.assertEqual(tuple(names["pr_person_represent"]),
+                         ("pr", "S3PersonModel"))
+        self.assertFalse("pr_nonexistent" in names)
+
+    # -------------------------------------------------------------------------
+    def testTable(self):
+        """ Test loading of tables and names via the manifest """
+
+        s3db = current.s3db
+
+        table = s3db.table("pr_person")
+        self.assertNotEqual(table, None)
+        self.assertEqual(table._tablename, "pr_person")
+
+        represent = s3db.get("pr_person_represent")
+        self.assertNotEqual(represent, None)
+
+        self.assertEqual(s3db.table("pr_nonexistent"), None)
+
+    # -------------------------------------------------------------------------
+    def testReferences(self):
+        """ Test references in the generated manifest """
+
+        references = current.s3db.manifest().get("references")
+        if references is None:
+            # No generated manifest
+            return
+        self.assertTrue("pr_address" in references.get("pr_pentity", []))
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -245,6 +285,7 @@ if __name__ == "__main__":
     run_suite(
         #S3ModelTests,
         S3SuperEntityTests,
+        S3ModelManifestTests,
     )
 
 # END ========================================================================
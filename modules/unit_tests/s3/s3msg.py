@@ -7,12 +7,15 @@
 #
 import unittest
 import datetime
+import smtplib
 from lxml import etree
 from gluon import *
 from gluon.storage import Storage
 from gluon.dal import Row
 from s3.s3resource import *
 from s3.s3fields import s3_meta_fields
+from s3.s3msg import S3KeyGraph, S3Msg, S3MsgDispatcher, S3MsgPoller
+from s3.s3parser import S3Parsing
 
 # =============================================================================
 class S3OutboxTests(unittest.TestCase):
@@ -25,6 +28,25 @@ class S3OutboxTests(unittest.TestCase):
     
         self.msg = current.msg
         self.save_email = self.msg.send_email
+
+        # Send through a dummy SMTP server, which accepts or rejects
+        # recipients as per the (dummy) send_email method
+        self.data = []
+        self.save_smtp = (smtplib.SMTP, smtplib.SMTP_SSL)
+        smtplib.SMTP = smtplib.SMTP_SSL = self.connect
+
+        mail_settings = current.mail.settings
+        settings = current.deployment_settings
+        self.save_settings = (mail_settings.server,
+                              mail_settings.tls,
+                              mail_settings.login,
+                              settings.mail.get("sender"),
+                              )
+        mail_settings.server = "localhost:25"
+        mail_settings.tls = False
+        mail_settings.login = None
+        settings.mail.sender = "sender@example.com"
+
         xmlstr = """
 <s3xml>
     <resource name="pr_person" uuid="MsgTestPerson1">
@@ -118,6 +140,35 @@ class S3OutboxTests(unittest.TestCase):
         self.assertTrue("test1@example.com" in self.sent)
         self.assertTrue("test2@example.com" in self.sent)
 
+    # -------------------------------------------------------------------------
+    def testProcessEmailInChunks(self):
+        """ Test processing the outbox in chunks """
+
+        s3db = current.s3db
+        resource = s3db.resource("pr_person", uid=["MsgTestPerson1",
+                                                   "MsgTestPerson2"])
+        rows = resource.select(["pe_id"], as_rows=True)
+
+        self.sent = []
+
+        outbox = s3db.msg_outbox
+        outbox_ids = []
+        for row in rows:
+            outbox_ids.append(outbox.insert(pe_id = row.pe_id,
+                                            message_id = self.message_id))
+
+        self.msg.OUTBOX_CHUNK = 1
+        self.msg.send_email = self.send_email
+        try:
+            self.msg.process_outbox()
+        finally:
+            del self.msg.OUTBOX_CHUNK
+        self.assertEqual(len(self.sent), 2)
+
+        query = (outbox.id.belongs(outbox_ids))
+        rows = current.db(query).select(outbox.status)
+        self.assertEqual([row.status for row in rows], [2, 2])
+
     # -------------------------------------------------------------------------
     def testProcessEmailToGroup(self):
         """ Test processing emails to groups """
@@ -287,6 +338,71 @@ class S3OutboxTests(unittest.TestCase):
         out_msg = outbox[outbox_id]
         self.assertEqual(out_msg.status, 5) # Failed
 
+    # -------------------------------------------------------------------------
+    def testProcessHTMLEmail(self):
+        """ Test that HTML email bodies are sent as text/html """
+
+        db = current.db
+        s3db = current.s3db
+
+        mailbox = s3db.msg_email
+        mail_id = mailbox.insert(subject = "Test Email",
+                                 body = "<html><body>Unit Test</body></html>",
+                                 )
+        record = db(mailbox.id == mail_id).select(mailbox.id,
+                                                  mailbox.message_id,
+                                                  limitby=(0, 1)).first()
+        s3db.update_super(mailbox, record)
+
+        resource = s3db.resource("pr_person", uid=["MsgTestPerson1"])
+        row = resource.select(["pe_id"], as_rows=True).first()
+
+        outbox = s3db.msg_outbox
+        outbox.insert(pe_id = row.pe_id,
+                      message_id = record.message_id)
+
+        self.msg.send_email = self.send_email
+        self.msg.process_outbox()
+        self.assertEqual(self.sent, ["test1@example.com"])
+        self.assertTrue("Content-Type: text/html" in self.data[0])
+
+        # Plain text bodies are still sent as text/plain
+        self.data = []
+        outbox.insert(pe_id = row.pe_id,
+                      message_id = self.message_id)
+        self.msg.process_outbox()
+        self.assertTrue("Content-Type: text/plain" in self.data[0])
+
+    # -------------------------------------------------------------------------
+    def connect(self, *args, **kwargs):
+        """ Dummy SMTP connection """
+
+        test = self
+
+        class SMTP(object):
+
+            def ehlo(self):
+                pass
+
+            def starttls(self):
+                pass
+
+            def login(self, username, password):
+                pass
+
+            def sendmail(self, sender, recipients, data):
+                for recipient in recipients:
+                    if not test.msg.send_email(recipient):
+                        raise smtplib.SMTPRecipientsRefused(
+                                {recipient: (550, "Rejected")})
+                    test.data.append(data)
+                return {}
+
+            def quit(self):
+                pass
+
+        return SMTP()
+
     # -------------------------------------------------------------------------
     def send_email(self, recipient, *args, **kwargs):
         """ Dummy send mechanism """
@@ -324,6 +440,757 @@ class S3OutboxTests(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
         self.msg.send_email = self.save_email
+        smtplib.SMTP, smtplib.SMTP_SSL = self.save_smtp
+
+        server, tls, login, sender = self.save_settings
+        mail_settings = current.mail.settings
+        mail_settings.server = server
+        mail_settings.tls = tls
+        mail_settings.login = login
+        current.deployment_settings.mail.sender = sender
+
+# =============================================================================
+class S3MsgDispatcherTests(unittest.TestCase):
+    """ Tests for the concurrent outbound message dispatcher """
+
+    # -------------------------------------------------------------------------
+    def send(self, local, message):
+        """ Dummy send function """
+
+        local.count = (local.count or 0) + 1
+        if message.to == "error":
+            return False, "Error"
+        elif message.to == "exception":
+            raise RuntimeError("Exception")
+        return True, message.to
+
+    # -------------------------------------------------------------------------
+    def close(self, local):
+        """ Dummy close function """
+
+        self.counts.append(local.count)
+
+    # -------------------------------------------------------------------------
+    def testRun(self):
+        """ Test concurrent dispatch """
+
+        assertEqual = self.assertEqual
+
+        self.counts = []
+        dispatcher = S3MsgDispatcher("TEST",
+                                     self.send,
+                                     workers = 3,
+                                     close = self.close,
+                                     )
+        messages = [(i, Storage(to="test%s" % i)) for i in xrange(10)]
+        messages.append((10, Storage(to="error")))
+        messages.append((11, Storage(to="exception")))
+
+        results, stats = dispatcher.run(messages)
+        assertEqual(len(results), 12)
+        assertEqual(results[3], (True, "test3"))
+        assertEqual(results[10], (False, "Error"))
+        assertEqual(results[11], (False, "Exception"))
+
+        assertEqual(stats.sent, 10)
+        assertEqual(stats.failed, 2)
+        assertEqual(sorted(stats.sent_ids), range(10))
+
+        # Each worker closes its connections once
+        assertEqual(len(self.counts), 3)
+        assertEqual(sum(count for count in self.counts if count), 12)
+
+    # -------------------------------------------------------------------------
+    def testThrottle(self):
+        """ Test rate limiting """
+
+        dispatcher = S3MsgDispatcher("TEST",
+                                     self.send,
+                                     workers = 2,
+                                     rate = 20,
+                                     )
+        messages = [(i, Storage(to="test%s" % i)) for i in xrange(6)]
+
+        results, stats = dispatcher.run(messages)
+        self.assertEqual(stats.sent, 6)
+        self.assertTrue(stats.seconds >= 0.25)
+
+# =============================================================================
+class S3MsgPollerTests(unittest.TestCase):
+    """ Tests for the concurrent channel poller """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        s3db = current.s3db
+
+        table = s3db.msg_rss_channel
+        channel = {"name": "Poller Test", "url": "http://example.com/feed"}
+        channel["id"] = table.insert(**channel)
+        s3db.update_super(table, channel)
+        self.channel_id = channel["channel_id"]
+
+        table = s3db.msg_email_channel
+        channel = {"name": "Poller Test",
+                   "server": "imap.example.com",
+                   "protocol": "imap",
+                   "port": 143,
+                   "delete_from_server": True,
+                   "last_uid": 5,
+                   "uidvalidity": 1,
+                   }
+        channel["id"] = table.insert(**channel)
+        s3db.update_super(table, channel)
+        self.email_channel_id = channel["channel_id"]
+
+    # -------------------------------------------------------------------------
+    def feed(self, *links):
+        """ Dummy feed """
+
+        entries = [Storage(title=link, link=link, description=link)
+                   for link in links]
+        return Storage(bozo=0, entries=entries)
+
+    # -------------------------------------------------------------------------
+    def testRun(self):
+        """ Test polling and duplicate detection """
+
+        assertEqual = self.assertEqual
+
+        channel_id = self.channel_id
+        poller = S3MsgPoller(workers=2)
+
+        feed = self.feed("http://example.com/1", "http://example.com/2")
+        poller.fetch_rss = lambda channel: Storage(feed=feed)
+        results = poller.run("msg_rss_channel", [channel_id])
+        assertEqual(results, {channel_id: "OK"})
+
+        stable = current.s3db.msg_channel_status
+        status = current.db(stable.channel_id == channel_id).select().first()
+        assertEqual(status.items, 2)
+        assertEqual(status.new_items, 2)
+
+        # Second poll only adds the new entry
+        feed = self.feed("http://example.com/2", "http://example.com/3")
+        poller.fetch_rss = lambda channel: Storage(feed=feed)
+        poller.run("msg_rss_channel", [channel_id])
+
+        status = current.db(stable.channel_id == channel_id).select().first()
+        assertEqual(status.items, 2)
+        assertEqual(status.new_items, 1)
+
+        mtable = current.s3db.msg_rss
+        query = (mtable.channel_id == channel_id)
+        assertEqual(current.db(query).count(), 3)
+
+        row = current.db(mtable.from_address == "http://example.com/3").select().first()
+        assertEqual(row.link_hash, S3MsgPoller.link_hash("http://example.com/3"))
+
+    # -------------------------------------------------------------------------
+    def testError(self):
+        """ Test handling of fetch errors """
+
+        def fetch(channel):
+            raise RuntimeError("Test Error")
+
+        poller = S3MsgPoller()
+        poller.fetch_rss = fetch
+        results = poller.run("msg_rss_channel", [self.channel_id])
+        self.assertEqual(results, {self.channel_id: "Test Error"})
+
+    # -------------------------------------------------------------------------
+    def testStoreEmail(self):
+        """ Test storing emails, and deleting them from the server """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        s3db = current.s3db
+
+        channel_id = self.email_channel_id
+        ctable = s3db.msg_email_channel
+        query = (ctable.channel_id == channel_id)
+        def last_uid():
+            return db(query).select(ctable.last_uid,
+                                    limitby=(0, 1)).first().last_uid
+
+        calls = []
+        class IMAP(object):
+            """ Dummy IMAP connection """
+            def uid(self, command, *args):
+                calls.append((command, args[0]))
+            def expunge(self):
+                calls.append(("expunge", None))
+            def close(self):
+                calls.append(("close", None))
+            def logout(self):
+                pass
+
+        def fetch(messages):
+            return lambda channel: Storage(messages = messages,
+                                           protocol = "imap",
+                                           connection = IMAP(),
+                                           delete = [6, 7],
+                                           last_uid = 7,
+                                           uidvalidity = 1,
+                                           )
+
+        poller = S3MsgPoller()
+
+        # Storing fails: last UID unchanged, nothing deleted from the server
+        poller.fetch_email = fetch(["From: test@example.com\n\nTest", None])
+        results = poller.run("msg_email_channel", [channel_id])
+        self.assertNotEqual(results[channel_id], "OK")
+        assertEqual(last_uid(), 5)
+        assertEqual(calls, [("close", None)])
+
+        mtable = s3db.msg_email
+        assertEqual(db(mtable.channel_id == channel_id).count(), 0)
+
+        # Stored: last UID updated, messages deleted from the server
+        del calls[:]
+        poller.fetch_email = fetch(["From: test@example.com\n\nTest 1",
+                                    "From: test@example.com\n\nTest 2",
+                                    ])
+        results = poller.run("msg_email_channel", [channel_id])
+        assertEqual(results[channel_id], "OK")
+        assertEqual(last_uid(), 7)
+        assertEqual(calls, [("store", "6,7"),
+                            ("expunge", None),
+                            ("close", None),
+                            ])
+        assertEqual(db(mtable.channel_id == channel_id).count(), 2)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        db = current.db
+        s3db = current.s3db
+
+        # Poller commits, so remove the test data explicitly
+        db.rollback()
+        channel_ids = [self.channel_id, self.email_channel_id]
+        for tablename in ("msg_rss", "msg_email"):
+            table = s3db[tablename]
+            query = (table.channel_id.belongs(channel_ids))
+            message_ids = [row.message_id for row in db(query).select(table.message_id)]
+            db(query).delete()
+            table = s3db.msg_message
+            db(table.message_id.belongs(message_ids)).delete()
+        for tablename in ("msg_channel_status",
+                          "msg_rss_channel",
+                          "msg_email_channel",
+                          "msg_channel",
+                          ):
+            table = s3db[tablename]
+            db(table.channel_id.belongs(channel_ids)).delete()
+        db.commit()
+
+# =============================================================================
+class S3KeyGraphTests(unittest.TestCase):
+    """ Tests for the keyword co-occurrence graph """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        settings = current.deployment_settings
+        self.hashtag_definitions = settings.msg.get("hashtag_definitions")
+        settings.msg.hashtag_definitions = False
+
+        self.hashtag_id = current.s3db.msg_hashtag.insert(
+                                tag="eqnz",
+                                definition="Earthquake New Zealand")
+        self.search_id = None
+
+    # -------------------------------------------------------------------------
+    def testTokenize(self):
+        """ Test tokenization of messages """
+
+        documents = S3KeyGraph().tokenize([
+            "RT @someone: Bridge collapsed http://t.co/x #EQNZ #eqnz",
+            None,
+            ])
+
+        self.assertEqual(documents[0], ["bridge", "collapsed", "eqnz",
+                                        "earthquake", "new", "zealand"])
+        self.assertEqual(documents[1], [])
+
+    # -------------------------------------------------------------------------
+    def testTopics(self):
+        """ Test clustering of terms into topics """
+
+        keygraph = S3KeyGraph()
+        terms = {"bridge": 4, "collapsed": 3, "water": 5, "shortage": 5,
+                 "random": 1}
+        edges = {"bridge collapsed": 3,
+                 "shortage water": 5,
+                 "bridge water": 1,
+                 "random water": 1,
+                 }
+        topics = keygraph.topics(terms, edges)
+
+        self.assertEqual(len(topics), 2)
+        self.assertEqual(topics[0]["terms"], ["shortage", "water"])
+        self.assertEqual(topics[0]["weight"], 10)
+        self.assertEqual(topics[1]["terms"], ["bridge", "collapsed"])
+        self.assertEqual(topics[1]["edges"], [["bridge", "collapsed", 3]])
+
+    # -------------------------------------------------------------------------
+    def testUpdate(self):
+        """ Test incremental update of the graph """
+
+        db = current.db
+        s3db = current.s3db
+
+        search_id = s3db.msg_twitter_search.insert(keywords="KeyGraphTest")
+        self.search_id = search_id
+        rtable = s3db.msg_twitter_result
+        def add(*texts):
+            for text in texts:
+                rtable.insert(search_id=search_id, body=text)
+
+        add("Bridge collapsed", "Bridge collapsed downtown")
+        keygraph = S3KeyGraph(search_id)
+        self.assertEqual(keygraph.update(), 2)
+
+        # Counts are stored as rows
+        record = keygraph.record()
+        ttable = s3db.msg_keygraph_term
+        etable = s3db.msg_keygraph_edge
+        def count(table, **keys):
+            query = (table.keygraph_id == record.id)
+            for fn, value in keys.items():
+                query &= (table[fn] == value)
+            row = db(query).select(table.count, limitby=(0, 1)).first()
+            return row.count if row else None
+
+        self.assertEqual(count(ttable, term="bridge"), 2)
+        self.assertEqual(count(ttable, term="downtown"), 1)
+        self.assertEqual(count(etable, term1="bridge", term2="collapsed"), 2)
+
+        # Only new messages are added to the existing counts
+        add("Collapsed bridge", "Water shortage")
+        self.assertEqual(keygraph.update(), 2)
+        self.assertEqual(keygraph.update(), 0)
+        self.assertEqual(count(ttable, term="bridge"), 3)
+        self.assertEqual(count(ttable, term="water"), 1)
+        self.assertEqual(count(etable, term1="bridge", term2="collapsed"), 3)
+
+        topics = keygraph.get_topics()
+        self.assertEqual(len(topics), 1)
+        self.assertEqual(topics[0]["terms"], ["bridge", "collapsed"])
+
+    # -------------------------------------------------------------------------
+    def testUpdateInterrupted(self):
+        """ Test that an interrupted update continues after the last batch """
+
+        db = current.db
+        s3db = current.s3db
+
+        search_id = s3db.msg_twitter_search.insert(keywords="KeyGraphTest")
+        self.search_id = search_id
+        rtable = s3db.msg_twitter_result
+        for text in ("Bridge collapsed", "Water shortage", "Bridge closed"):
+            rtable.insert(search_id=search_id, body=text)
+
+        # Interrupt the update in the second batch
+        keygraph = S3KeyGraph(search_id)
+        keygraph.BATCH_SIZE = 2
+        batches = []
+        prune = keygraph.prune
+        def interrupt(keygraph_id):
+            batches.append(keygraph_id)
+            if len(batches) == 2:
+                raise RuntimeError("Interrupted")
+            prune(keygraph_id)
+        keygraph.prune = interrupt
+        self.assertRaises(RuntimeError, keygraph.update)
+        db.rollback()
+
+        # The first batch has been committed
+        record = keygraph.record()
+        self.assertEqual(record.documents, 2)
+
+        # The next update continues with the second batch
+        keygraph.prune = prune
+        self.assertEqual(keygraph.update(), 1)
+        record = keygraph.record()
+        self.assertEqual(record.documents, 3)
+
+        ttable = s3db.msg_keygraph_term
+        query = (ttable.keygraph_id == record.id) & \
+                (ttable.term == "bridge")
+        row = db(query).select(ttable.count, limitby=(0, 1)).first()
+        self.assertEqual(row.count, 2)
+        self.assertNotEqual(record.topics, None)
+
+    # -------------------------------------------------------------------------
+    def testPrune(self):
+        """ Test pruning of the graph """
+
+        db = current.db
+        s3db = current.s3db
+
+        keygraph = S3KeyGraph()
+        keygraph.MAX_EDGES = 2
+        keygraph_id = s3db.msg_keygraph.insert()
+
+        ttable = s3db.msg_keygraph_term
+        for term, count in (("a1", 1), ("a2", 1), ("b1", 3), ("b2", 3)):
+            ttable.insert(keygraph_id=keygraph_id, term=term, count=count)
+        etable = s3db.msg_keygraph_edge
+        for term1, term2, count in (("a1", "a2", 1),
+                                    ("a1", "b1", 1),
+                                    ("b1", "b2", 3)):
+            etable.insert(keygraph_id=keygraph_id,
+                          term1=term1,
+                          term2=term2,
+                          count=count,
+                          )
+        keygraph.prune(keygraph_id)
+
+        rows = db(etable.keygraph_id == keygraph_id).select(etable.term1,
+                                                            etable.term2)
+        self.assertEqual([(row.term1, row.term2) for row in rows],
+                         [("b1", "b2")])
+        rows = db(ttable.keygraph_id == keygraph_id).select(ttable.term,
+                                                            orderby=ttable.term)
+        self.assertEqual([row.term for row in rows], ["b1", "b2"])
+
+    # -------------------------------------------------------------------------
+    def testTagdefs(self):
+        """ Test lookup and caching of hashtag definitions """
+
+        s3db = current.s3db
+
+        lookups = []
+        def lookup(tag):
+            lookups.append(tag)
+            return "Definition of %s" % tag
+
+        table = s3db.msg_hashtag
+        yesterday = current.request.utcnow - datetime.timedelta(days=1)
+        expired = current.request.utcnow - \
+                  datetime.timedelta(days=S3KeyGraph.TAGDEF_RETRY + 1)
+        table.insert(tag="keygraphnone", definition=None,
+                     retrieved_on=yesterday)
+        table.insert(tag="keygraphexpired", definition=None,
+                     retrieved_on=expired)
+
+        tags = ["eqnz", "keygraphnone", "keygraphexpired", "keygraphnew"]
+
+        # Lookups are disabled by default
+        definitions = S3KeyGraph.tagdefs(tags)
+        self.assertEqual(definitions, {"eqnz": "Earthquake New Zealand",
+                                       "keygraphnone": None,
+                                       })
+
+        current.deployment_settings.msg.hashtag_definitions = True
+        tagdef_lookup = S3Msg.tagdef_lookup
+        S3Msg.tagdef_lookup = staticmethod(lookup)
+        try:
+            definitions = S3KeyGraph.tagdefs(tags)
+        finally:
+            S3Msg.tagdef_lookup = tagdef_lookup
+
+        # Missing and expired definitions are looked up
+        self.assertEqual(sorted(lookups), ["keygraphexpired", "keygraphnew"])
+        self.assertEqual(definitions["keygraphexpired"],
+                         "Definition of keygraphexpired")
+        self.assertEqual(definitions["keygraphnone"], None)
+
+        # ...and cached
+        definitions = S3KeyGraph.tagdefs(tags)
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(definitions["keygraphnew"],
+                         "Definition of keygraphnew")
+
+        # Lookups are limited per batch
+        del lookups[:]
+        S3Msg.tagdef_lookup = staticmethod(lookup)
+        try:
+            S3KeyGraph.tagdefs(["keygraph%s" % i for i in xrange(20)])
+        finally:
+            S3Msg.tagdef_lookup = tagdef_lookup
+        self.assertEqual(len(lookups), S3KeyGraph.MAX_TAGDEFS)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        db = current.db
+        s3db = current.s3db
+        db.rollback()
+
+        # Remove what has been committed by S3KeyGraph.update
+        search_id = self.search_id
+        if search_id:
+            table = s3db.msg_keygraph
+            keygraph_ids = db(table.search_id == search_id)._select(table.id)
+            for tn in ("msg_keygraph_term", "msg_keygraph_edge"):
+                table = s3db[tn]
+                db(table.keygraph_id.belongs(keygraph_ids)).delete()
+            db(s3db.msg_keygraph.search_id == search_id).delete()
+            db(s3db.msg_twitter_result.search_id == search_id).delete()
+            db(s3db.msg_twitter_search.id == search_id).delete()
+        db(s3db.msg_hashtag.id == self.hashtag_id).delete()
+        db.commit()
+
+        settings = current.deployment_settings
+        if self.hashtag_definitions is None:
+            settings.msg.pop("hashtag_definitions", None)
+        else:
+            settings.msg.hashtag_definitions = self.hashtag_definitions
+
+# =============================================================================
+class S3ParsingTests(unittest.TestCase):
+    """ Tests for batch message parsing """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+
+        ptable = s3db.pr_person
+        person = {"first_name": "Parsing", "last_name": "Test"}
+        person_id = ptable.insert(**person)
+        person["id"] = person_id
+        s3db.update_super(ptable, person)
+        s3db.pr_contact.insert(pe_id = person["pe_id"],
+                               contact_method = "EMAIL",
+                               value = "parsing.test@example.com",
+                               )
+        self.person_id = person_id
+
+    # -------------------------------------------------------------------------
+    def testPrefetch(self):
+        """ Test lookups from prefetched contacts """
+
+        assertEqual = self.assertEqual
+
+        address = S3Parsing.sender("Parsing Test <parsing.test@example.com>")
+        assertEqual(address, "parsing.test@example.com")
+
+        contacts = S3Parsing.prefetch_contacts(set([address,
+                                                    "unknown@example.com"]))
+        assertEqual(contacts[("EMAIL", address)].person_ids,
+                    set([self.person_id]))
+        assertEqual(contacts[("EMAIL", "unknown@example.com")].person_ids,
+                    set())
+
+        S3Parsing.contacts = contacts
+        try:
+            assertEqual(S3Parsing.lookup_person(address), self.person_id)
+            assertEqual(S3Parsing.lookup_person("unknown@example.com"), None)
+            assertEqual(S3Parsing.lookup_human_resource(address), None)
+        finally:
+            S3Parsing.contacts = None
+
+        # Same results without prefetch
+        assertEqual(S3Parsing.lookup_person(address), self.person_id)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class S3ParseBatchTests(unittest.TestCase):
+    """ Tests for S3Parsing.parse_batch """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.msg_rss_channel
+        channel = {"name": "Parser Test", "url": "http://example.com/parser"}
+        channel["id"] = table.insert(**channel)
+        s3db.update_super(table, channel)
+        self.channel_id = channel["channel_id"]
+
+        table = s3db.msg_email
+        stable = s3db.msg_parsing_status
+        self.message_ids = []
+        self.status_ids = []
+        for body in ("Message 1", "fail", "Message 3"):
+            email = {"body": body,
+                     "from_address": "Parser Test <parser.test@example.com>",
+                     "inbound": True,
+                     }
+            email["id"] = table.insert(**email)
+            s3db.update_super(table, email)
+            message_id = email["message_id"]
+            self.message_ids.append(message_id)
+            self.status_ids.append(stable.insert(channel_id = self.channel_id,
+                                                 message_id = message_id,
+                                                 ))
+        db.commit()
+
+        self.parsed = []
+        self.parser_function = S3Parsing.parser_function
+        S3Parsing.parser_function = staticmethod(lambda name: self.parse)
+        self.send = current.msg.send
+        current.msg.send = lambda recipient, message: self.message_ids[0]
+
+    # -------------------------------------------------------------------------
+    def parse(self, message):
+        """ Dummy parser """
+
+        self.parsed.append(message.message_id)
+
+        # Log in as the sender
+        current.auth.user = Storage(id=0)
+
+        # Write something, then fail for one message
+        current.s3db.msg_hashtag.insert(tag = "parsertest%s" % message.message_id)
+        if message.body == "fail":
+            raise RuntimeError("Parser failed")
+        return "Reply"
+
+    # -------------------------------------------------------------------------
+    def status(self):
+        """ Get the parsing status of the test messages """
+
+        stable = current.s3db.msg_parsing_status
+        query = (stable.id.belongs(self.status_ids))
+        rows = current.db(query).select(stable.is_parsed,
+                                        stable.parse_error,
+                                        stable.reply_id,
+                                        orderby = stable.id,
+                                        )
+        return [(row.is_parsed, row.parse_error, row.reply_id) for row in rows]
+
+    # -------------------------------------------------------------------------
+    def testParseBatch(self):
+        """ Test batch parsing and bulk status update """
+
+        auth = current.auth
+        user_id = auth.user.id if auth.user else None
+
+        # Skip the failing message
+        stable = current.s3db.msg_parsing_status
+        current.db(stable.id == self.status_ids[1]).update(is_parsed = True)
+
+        total = S3Parsing.parse_batch(self.channel_id, "test", batch_size=1)
+        self.assertEqual(total, 2)
+        self.assertEqual(self.parsed, [self.message_ids[0], self.message_ids[2]])
+
+        # Impersonation restored after each message
+        self.assertEqual(auth.user.id if auth.user else None, user_id)
+
+        reply_id = self.message_ids[0]
+        status = self.status()
+        self.assertEqual(status[0], (True, None, reply_id))
+        self.assertEqual(status[2], (True, None, reply_id))
+
+        # Nothing left to parse
+        self.assertEqual(S3Parsing.parse_batch(self.channel_id, "test"), 0)
+
+    # -------------------------------------------------------------------------
+    def testParseError(self):
+        """ Test that messages with parser errors are not marked as parsed """
+
+        db = current.db
+        s3db = current.s3db
+
+        total = S3Parsing.parse_batch(self.channel_id, "test")
+        self.assertEqual(total, 2)
+
+        status = self.status()
+        self.assertTrue(status[0][0])
+        self.assertFalse(status[1][0])
+        self.assertEqual(status[1][1], "Parser failed")
+        self.assertTrue(status[2][0])
+
+        # The writes of the failed parser have been rolled back
+        table = s3db.msg_hashtag
+        tags = ["parsertest%s" % message_id for message_id in self.message_ids]
+        rows = db(table.tag.belongs(tags)).select(table.tag, orderby=table.id)
+        self.assertEqual([row.tag for row in rows], [tags[0], tags[2]])
+
+        # Failed messages are not parsed again
+        self.parsed = []
+        self.assertEqual(S3Parsing.parse_batch(self.channel_id, "test"), 0)
+        self.assertEqual(self.parsed, [])
+
+    # -------------------------------------------------------------------------
+    def testLoginInBatch(self):
+        """ Test that a login applies to the subsequent messages of a batch """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+        session = current.session
+
+        # Skip the failing message, first message is a login
+        stable = s3db.msg_parsing_status
+        db(stable.id == self.status_ids[1]).update(is_parsed = True)
+        mtable = s3db.msg_message
+        db(mtable.message_id == self.message_ids[0]).update(body = "LOGIN secret")
+
+        sender = "Parser Test <parser.test@example.com>"
+        impersonated = []
+        def login_bare(email, password):
+            auth.user = Storage(id=0, email=email)
+            session.auth = {"expiration": 3600}
+            return auth.user
+        def s3_impersonate(user_id):
+            impersonated.append(user_id)
+            auth.user = Storage(id=0, email=user_id) if user_id else None
+
+        login_bare_, s3_impersonate_ = auth.login_bare, auth.s3_impersonate
+        session_auth = session.auth
+        auth.login_bare = login_bare
+        auth.s3_impersonate = s3_impersonate
+        try:
+            total = S3Parsing.parse_batch(self.channel_id, "test")
+        finally:
+            auth.login_bare = login_bare_
+            auth.s3_impersonate = s3_impersonate_
+            session.auth = session_auth
+
+        self.assertEqual(total, 2)
+        self.assertEqual(self.parsed, [self.message_ids[0], self.message_ids[2]])
+
+        # Third message has been parsed in the session of the first
+        self.assertTrue(sender in impersonated)
+
+        table = s3db.msg_session
+        query = (table.from_address == "parser.test@example.com")
+        self.assertEqual(db(query).count(), 1)
+        db(query).delete()
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        S3Parsing.parser_function = self.parser_function
+        current.msg.send = self.send
+
+        db = current.db
+        s3db = current.s3db
+        db.rollback()
+
+        table = s3db.msg_hashtag
+        db(table.tag.like("parsertest%")).delete()
+        table = s3db.msg_parsing_status
+        db(table.id.belongs(self.status_ids)).delete()
+        table = s3db.msg_email
+        db(table.message_id.belongs(self.message_ids)).delete()
+        table = s3db.msg_message
+        db(table.message_id.belongs(self.message_ids)).delete()
+        table = s3db.msg_rss_channel
+        db(table.channel_id == self.channel_id).delete()
+        table = s3db.msg_channel
+        db(table.channel_id == self.channel_id).delete()
+        db.commit()
+
+        current.auth.override = False
 
 # =============================================================================
 def run_suite(*test_classes):
@@ -342,6 +1209,11 @@ if __name__ == "__main__":
 
     run_suite(
         S3OutboxTests,
+        S3MsgDispatcherTests,
+        S3MsgPollerTests,
+        S3KeyGraphTests,
+        S3ParsingTests,
+        S3ParseBatchTests,
     )
 
 # END ========================================================================
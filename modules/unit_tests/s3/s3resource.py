@@ -1618,6 +1618,297 @@ class ResourceDataAccessTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class ResourceKeysetPaginationTests(unittest.TestCase):
+    """ Test keyset pagination in S3Resource.select """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        current.auth.override = True
+        otable = current.s3db.org_organisation
+        for i in (3, 1, 5, 2, 4):
+            otable.insert(name="KSTestOrg%s" % i)
+
+    # -------------------------------------------------------------------------
+    def resource(self):
+
+        resource = current.s3db.resource("org_organisation")
+        resource.add_filter(S3FieldSelector("name").like("KSTestOrg%"))
+        return resource
+
+    # -------------------------------------------------------------------------
+    def testSeek(self):
+        """ Test paging through a resource by seeking """
+
+        assertEqual = self.assertEqual
+
+        otable = current.s3db.org_organisation
+        for orderby in (otable.name, ~otable.name):
+
+            names = []
+            seek = None
+            while True:
+                data = self.resource().select(["name"],
+                                              limit=2,
+                                              orderby=orderby,
+                                              count=True,
+                                              seek=seek,
+                                              represent=False)
+                names.extend([row["org_organisation.name"]
+                              for row in data["rows"]])
+                assertEqual(data["numrows"], 5)
+                seek = data["seek"]
+                if seek is None:
+                    break
+                assertEqual(len(seek), 2)
+
+            expected = ["KSTestOrg%s" % i for i in (1, 2, 3, 4, 5)]
+            if orderby is not otable.name:
+                expected.reverse()
+            assertEqual(names, expected)
+
+    # -------------------------------------------------------------------------
+    def testSeekLeftJoin(self):
+        """ Test paging through a resource with left joins by seeking """
+
+        assertEqual = self.assertEqual
+
+        otable = current.s3db.org_organisation
+
+        names = []
+        seek = None
+        while True:
+            data = self.resource().select(["name",
+                                           "organisation_type_id$name",
+                                           ],
+                                          limit=2,
+                                          orderby=otable.name,
+                                          count=True,
+                                          seek=seek,
+                                          represent=False)
+            rows = data["rows"]
+            names.extend([row["org_organisation.name"] for row in rows])
+            assertEqual(data["numrows"], 5)
+            if seek is not None:
+                # Only the IDs of the page are selected
+                assertEqual(len(data["ids"]), len(rows))
+            seek = data["seek"]
+            if seek is None:
+                break
+        assertEqual(names, ["KSTestOrg%s" % i for i in (1, 2, 3, 4, 5)])
+
+    # -------------------------------------------------------------------------
+    def testSeekJSON(self):
+        """ Test paging through a JSON export by seeking """
+
+        from gluon.contrib import simplejson as json
+
+        assertEqual = self.assertEqual
+
+        otable = current.s3db.org_organisation
+
+        names = []
+        seek = None
+        while True:
+            data = json.loads(self.resource().json(["name"],
+                                                   limit=2,
+                                                   orderby=otable.name,
+                                                   seek=seek,
+                                                   cursor=True))
+            names.extend([row["org_organisation.name"]
+                          for row in data["rows"]])
+            seek = data["seek"]
+            if seek is None:
+                break
+        assertEqual(names, ["KSTestOrg%s" % i for i in (1, 2, 3, 4, 5)])
+
+        # Cursor with as_rows
+        rows = self.resource().select(["name"],
+                                      limit=2,
+                                      orderby=otable.name,
+                                      as_rows=True)
+        assertEqual(rows.seek[0], "KSTestOrg2")
+        rows = self.resource().select(["name"],
+                                      limit=2,
+                                      orderby=otable.name,
+                                      seek=rows.seek,
+                                      as_rows=True)
+        assertEqual([row.name for row in rows], ["KSTestOrg3", "KSTestOrg4"])
+
+    # -------------------------------------------------------------------------
+    def testSeekFallback(self):
+        """ Test fallback to OFFSET if keyset pagination isn't possible """
+
+        otable = current.s3db.org_organisation
+
+        # Invalid cursor
+        data = self.resource().select(["name"],
+                                      start=2,
+                                      limit=2,
+                                      orderby=otable.name,
+                                      seek=("KSTestOrg2",),
+                                      represent=False)
+        names = [row["org_organisation.name"] for row in data["rows"]]
+        self.assertEqual(names, ["KSTestOrg3", "KSTestOrg4"])
+
+        # Nullable orderby field
+        data = self.resource().select(["name"],
+                                      limit=2,
+                                      orderby=otable.acronym,
+                                      represent=False)
+        self.assertEqual(data["seek"], None)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class ResourceCountCacheTests(unittest.TestCase):
+    """ Test caching of record counts """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        # Simulate an HTTP request, which updates the versions at commit
+        request = current.request
+        self.is_shell = request.is_shell
+        self.is_scheduler = request.is_scheduler
+        request.is_shell = request.is_scheduler = False
+
+        # Don't actually commit (the test records are rolled back)
+        response = current.response
+        self.hooks = (response.custom_commit, response.s3.commit_hooks)
+        response.custom_commit = lambda adapter: None
+        response.s3.commit_hooks = None
+
+    # -------------------------------------------------------------------------
+    def count(self):
+
+        resource = current.s3db.resource("org_organisation")
+        resource.add_filter(S3FieldSelector("name").like("CCTestOrg%"))
+        return resource.count()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def commit():
+        """ Run the commit hook the way web2py does """
+
+        current.response.custom_commit(current.db._adapter)
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test invalidation of cached counts by committed writes """
+
+        assertEqual = self.assertEqual
+        assertNotEqual = self.assertNotEqual
+
+        if not current.deployment_settings.get_base_count_cache():
+            self.skipTest("Count cache disabled")
+
+        otable = current.s3db.org_organisation
+        query = (otable.name.like("CCTestOrg%"))
+
+        key = S3CountCache.key(otable, query)
+        assertNotEqual(key, None)
+        assertEqual(self.count(), 0)
+
+        # Insert
+        record_id = otable.insert(name="CCTestOrg1")
+        self.commit()
+        new_key = S3CountCache.key(otable, query)
+        assertNotEqual(new_key, None)
+        assertNotEqual(new_key, key)
+        assertEqual(self.count(), 1)
+
+        # Update
+        key = new_key
+        current.db(otable.id == record_id).update(deleted=True)
+        self.commit()
+        new_key = S3CountCache.key(otable, query)
+        assertNotEqual(new_key, None)
+        assertNotEqual(new_key, key)
+        assertEqual(self.count(), 0)
+
+    # -------------------------------------------------------------------------
+    def testUncommittedWrite(self):
+        """ Test counts taken between write and commit """
+
+        assertEqual = self.assertEqual
+
+        if not current.deployment_settings.get_base_count_cache():
+            self.skipTest("Count cache disabled")
+
+        otable = current.s3db.org_organisation
+        query = (otable.name.like("CCTestOrg%"))
+
+        version = S3CountCache.version("org_organisation")
+        assertEqual(self.count(), 0)
+
+        # Write, but don't commit yet
+        otable.insert(name="CCTestOrg1")
+        otable.insert(name="CCTestOrg2")
+
+        # Version unchanged and count not cached, but correct
+        assertEqual(S3CountCache.version("org_organisation"), version)
+        assertEqual(S3CountCache.key(otable, query), None)
+        assertEqual(self.count(), 2)
+
+        # Version updated (once) after commit
+        self.commit()
+        self.assertNotEqual(S3CountCache.version("org_organisation"), version)
+        self.assertNotEqual(S3CountCache.key(otable, query), None)
+        assertEqual(self.count(), 2)
+
+    # -------------------------------------------------------------------------
+    def testClear(self):
+        """ Test periodic clearing of cached counts """
+
+        assertEqual = self.assertEqual
+
+        expire = current.deployment_settings.get_base_count_cache()
+        if not expire:
+            self.skipTest("Count cache disabled")
+
+        S3CountCache.cleared = None
+        S3CountCache.set("s3_count_test1", 1)
+        assertEqual(S3CountCache.get("s3_count_test1"), 1)
+
+        # Counts are dropped once the expiry time has passed
+        S3CountCache.cleared -= expire + 1
+        S3CountCache.set("s3_count_test2", 2)
+        assertEqual(S3CountCache.get("s3_count_test1"), None)
+        assertEqual(S3CountCache.get("s3_count_test2"), 2)
+
+    # -------------------------------------------------------------------------
+    def testUnregisteredTable(self):
+        """ Test that counts for tables without write version aren't cached """
+
+        table = current.db.auth_user
+        self.assertEqual(S3CountCache.key(table, table.id > 0), None)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+        pending = current.response.s3.count_cache_pending
+        if pending:
+            pending.clear()
+        response = current.response
+        response.custom_commit, response.s3.commit_hooks = self.hooks
+
+        request = current.request
+        request.is_shell = self.is_shell
+        request.is_scheduler = self.is_scheduler
+
 # =============================================================================
 class ResourceAxisFilterTests(unittest.TestCase):
     """ Test Axis Filters """
@@ -4468,6 +4759,8 @@ if __name__ == "__main__":
         ResourceDataObjectAPITests,
 
         ResourceDataAccessTests,
+        ResourceKeysetPaginationTests,
+        ResourceCountCacheTests,
         ResourceAxisFilterTests,
         ResourceDataTableFilterTests,
         ResourceGetTests,
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# S3Task Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3task.py
+#
+import datetime
+import unittest
+
+from gluon import *
+
+# =============================================================================
+class S3TaskQueueTests(unittest.TestCase):
+    """ Tests for named task queues """
+
+    # -------------------------------------------------------------------------
+    def testQueue(self):
+        """ Test queue lookup for tasks """
+
+        s3task = current.s3task
+        queue = s3task.queue
+
+        self.assertEqual(queue("msg_process_outbox"), "interactive")
+        self.assertEqual(queue("notify_notify"), "interactive")
+        self.assertEqual(queue("cr_shelter_rebuild_aggregates"), "batch")
+        self.assertEqual(queue("no_such_task"), s3task.DEFAULT_QUEUE)
+
+    # -------------------------------------------------------------------------
+    def testPriority(self):
+        """ Test head start for higher priority queues """
+
+        s3task = current.s3task
+
+        high = s3task._task_record("msg_process_outbox", [], {}, 300)
+        low = s3task._task_record("maintenance", [], {}, 300)
+
+        self.assertEqual(high["group_name"], "interactive")
+        self.assertEqual(low["group_name"], "batch")
+        self.assertTrue(high["next_run_time"] < low["next_run_time"])
+
+    # -------------------------------------------------------------------------
+    def testCoalesce(self):
+        """ Test lookup of identical queued tasks """
+
+        s3task = current.s3task
+        record = s3task._task_record("maintenance", [], {"period": "test"}, 300)
+        task_id = current.db.scheduler_task.insert(**record)
+
+        self.assertEqual(s3task._queued_task("maintenance", [], {"period": "test"}),
+                         task_id)
+        self.assertEqual(s3task._queued_task("maintenance", [], {"period": "other"}),
+                         None)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+
+# =============================================================================
+class S3DeferredHookTests(unittest.TestCase):
+    """ Tests for post-commit hooks deferred to the scheduler """
+
+    TABLENAME = "org_organisation"
+    HOOK = "unittest"
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        s3db = current.s3db
+        s3 = current.response.s3
+
+        self.calls = []
+        self.error = None
+        def hook(record_ids):
+            self.calls.append(list(record_ids))
+            if self.error:
+                raise RuntimeError(self.error)
+
+        s3db.table(self.TABLENAME)
+        self.hooks = s3db.get_config(self.TABLENAME, "deferred")
+        hooks = dict(self.hooks or {})
+        hooks[self.HOOK] = hook
+        s3db.configure(self.TABLENAME, deferred=hooks)
+
+        self.deferred = (s3.deferred_hooks, s3.deferred_task)
+        s3.deferred_hooks = s3.deferred_task = None
+
+    # -------------------------------------------------------------------------
+    def entries(self):
+        """ Get the deferred hook entries of this test """
+
+        table = current.s3db.s3_deferred_hook
+        query = (table.tablename == self.TABLENAME) & \
+                (table.hook == self.HOOK)
+        return current.db(query).select(orderby=table.record_id)
+
+    # -------------------------------------------------------------------------
+    def testCoalesce(self):
+        """ Test coalescing of repeated defer calls """
+
+        assertEqual = self.assertEqual
+
+        s3task = current.s3task
+        s3task._is_alive = lambda: True
+
+        for record_id in (1, 2, 1, 1):
+            assertEqual(s3task.defer(self.TABLENAME, record_id, self.HOOK), True)
+
+        # One entry per record, nothing run yet
+        assertEqual([row.record_id for row in self.entries()], [1, 2])
+        assertEqual(self.calls, [])
+
+        # Only one task queued
+        task_id = current.response.s3.deferred_task
+        self.assertNotEqual(task_id, None)
+        s3task.defer(self.TABLENAME, 3, self.HOOK)
+        assertEqual(current.response.s3.deferred_task, task_id)
+
+        # Undeclared hooks are rejected
+        assertEqual(s3task.defer(self.TABLENAME, 1, "nohook"), False)
+
+    # -------------------------------------------------------------------------
+    def testSynchronous(self):
+        """ Test synchronous fallback if no worker is running """
+
+        s3task = current.s3task
+        s3task._is_alive = lambda: False
+
+        self.assertEqual(s3task.defer(self.TABLENAME, 5, self.HOOK), None)
+        self.assertEqual(self.calls, [[5]])
+        self.assertEqual(len(self.entries()), 0)
+
+    # -------------------------------------------------------------------------
+    def testRetry(self):
+        """ Test batch run, retry with back-off and FAILED status """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        s3task = current.s3task
+        table = current.s3db.s3_deferred_hook
+
+        for record_id in (7, 6, 7):
+            table.insert(tablename = self.TABLENAME,
+                         hook = self.HOOK,
+                         record_id = record_id,
+                         )
+        # run_deferred_hooks commits/rolls back per batch
+        db.commit()
+
+        # Failure => retry later
+        self.error = "Test failure"
+        start = datetime.datetime.utcnow()
+        s3task.run_deferred_hooks()
+        assertEqual(self.calls, [[6, 7]])
+        entries = self.entries()
+        assertEqual(len(entries), 3)
+        for entry in entries:
+            assertEqual(entry.status, "PENDING")
+            assertEqual(entry.attempts, 1)
+            assertEqual(entry.error, "Test failure")
+            self.assertTrue(entry.next_attempt >= start + datetime.timedelta(minutes=2))
+
+        # Not yet due => not run again
+        s3task.run_deferred_hooks()
+        assertEqual(len(self.calls), 1)
+
+        # Last attempt fails => FAILED
+        query = (table.id.belongs([entry.id for entry in entries]))
+        db(query).update(attempts = s3task.DEFERRED_ATTEMPTS - 1,
+                         next_attempt = None,
+                         )
+        db.commit()
+        s3task.run_deferred_hooks()
+        assertEqual(len(self.calls), 2)
+        for entry in self.entries():
+            assertEqual(entry.status, "FAILED")
+            assertEqual(entry.attempts, s3task.DEFERRED_ATTEMPTS)
+
+        # Success => entries removed
+        self.error = None
+        db(query).update(status = "PENDING", next_attempt = None)
+        db.commit()
+        self.assertTrue(s3task.run_deferred_hooks() >= 3)
+        assertEqual(self.calls[-1], [6, 7])
+        assertEqual(len(self.entries()), 0)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        db = current.db
+        s3 = current.response.s3
+        s3task = current.s3task
+
+        db.rollback()
+        if "_is_alive" in s3task.__dict__:
+            del s3task._is_alive
+        s3.deferred_hooks, s3.deferred_task = self.deferred
+
+        # Remove committed entries
+        table = current.s3db.s3_deferred_hook
+        db(table.hook == self.HOOK).delete()
+        db.commit()
+
+        current.s3db.configure(self.TABLENAME, deferred=self.hooks)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3TaskQueueTests,
+        S3DeferredHookTests,
+    )
+
+# END ========================================================================
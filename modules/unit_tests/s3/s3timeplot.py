@@ -389,6 +389,85 @@ class EventFrameTests(unittest.TestCase):
             result = period.aggregate("max", field="test", event_type="A")
             assertEqual(result, expected_result[1])
 
+    # -------------------------------------------------------------------------
+    def testAggregate(self):
+        """ Test sweep-line aggregation over all periods """
+
+        dt = datetime.datetime
+
+        ef = S3TimePlotEventFrame(dt(2012,1,1),
+                                  dt(2012,12,15),
+                                  slots="3 months")
+        ef.extend(self.events)
+
+        assertEqual = self.assertEqual
+
+        # Must give the same results as per-period aggregation
+        for method in S3TimePlotPeriod.methods:
+            results = ef.aggregate(method, field="test", event_type="A")
+            periods = list(ef)
+            assertEqual(len(results), len(periods))
+            for i, (start, end, value) in enumerate(results):
+                period = periods[i]
+                assertEqual(start, period.start)
+                assertEqual(end, period.end)
+                expected = period.aggregate(method,
+                                            field="test",
+                                            event_type="A")
+                assertEqual(value, expected)
+
+        # Count events
+        results = ef.aggregate("count", event_type="A")
+        assertEqual([r[2] for r in results], [3, 5, 4, 4])
+
+        # Other event type
+        results = ef.aggregate("sum", field="test", event_type="B")
+        assertEqual([r[2] for r in results], [0, 0, 0, 0])
+
+    # -------------------------------------------------------------------------
+    def testAggregateGroups(self):
+        """ Test aggregation of pre-aggregated event groups """
+
+        dt = datetime.datetime
+
+        ef = S3TimePlotEventFrame(dt(2012,1,1),
+                                  dt(2012,12,15),
+                                  slots="3 months")
+        ef.extend([
+            S3TimePlotEventGroup(1,
+                                 start=dt(2012,2,1),
+                                 end=dt(2012,5,1),
+                                 size=3,
+                                 totals={"test": (2, 7, 3, 4)},
+                                 event_type="A"),
+            S3TimePlotEventGroup(2,
+                                 start=dt(2012,5,1),
+                                 end=None,
+                                 size=2,
+                                 totals={"test": (2, 12, 1, 11)},
+                                 event_type="A"),
+            ])
+
+        assertEqual = self.assertEqual
+
+        results = ef.aggregate("count", event_type="A")
+        assertEqual([r[2] for r in results], [3, 5, 2, 2])
+
+        results = ef.aggregate("count", field="test", event_type="A")
+        assertEqual([r[2] for r in results], [2, 4, 2, 2])
+
+        results = ef.aggregate("sum", field="test", event_type="A")
+        assertEqual([r[2] for r in results], [7, 19, 12, 12])
+
+        results = ef.aggregate("min", field="test", event_type="A")
+        assertEqual([r[2] for r in results], [3, 1, 1, 1])
+
+        results = ef.aggregate("max", field="test", event_type="A")
+        assertEqual([r[2] for r in results], [4, 11, 11, 11])
+
+        results = ef.aggregate("avg", field="test", event_type="A")
+        assertEqual([r[2] for r in results], [3.5, 4.75, 6.0, 6.0])
+
     # -------------------------------------------------------------------------
     def testPeriodsDays(self):
         """ Test iteration over periods (days) """
@@ -708,6 +787,50 @@ class TimePlotTests(unittest.TestCase):
         self.assertEqual(ef.start, dt(2011, 1, 3, 0, 0, 0))
         self.assertTrue(self.is_now(ef.end))
 
+    # -------------------------------------------------------------------------
+    def testEventTotals(self):
+        """ Test aggregation of event data in the database """
+
+        s3db = current.s3db
+        dt = datetime.datetime
+
+        resource = s3db.resource("tp_test_events")
+        event_start = resource.resolve_selector("event_start")
+        event_end = resource.resolve_selector("event_end")
+        fact = resource.resolve_selector("parameter1")
+
+        tp = S3TimePlot()
+        tp.resource = resource
+
+        for method in ("count", "sum", "min", "max", "avg"):
+
+            ef1 = S3TimePlotEventFrame(dt(2011,1,1),
+                                       dt(2013,1,1),
+                                       slots="3 months")
+            success = tp.add_event_totals(ef1,
+                                          resource,
+                                          event_start,
+                                          event_end,
+                                          fact,
+                                          method)
+            self.assertTrue(success)
+
+            ef2 = S3TimePlotEventFrame(dt(2011,1,1),
+                                       dt(2013,1,1),
+                                       slots="3 months")
+            tp.add_event_data(ef2,
+                              resource,
+                              event_start,
+                              event_end,
+                              [fact])
+
+            options = {"method": method,
+                       "field": fact.colname,
+                       "event_type": "tp_test_events",
+                       }
+            self.assertEqual(ef1.aggregate(**options),
+                             ef2.aggregate(**options))
+
     # -------------------------------------------------------------------------
     def testAutomaticSlotLength(self):
         """ Test automatic determination of reasonable aggregation time slot """
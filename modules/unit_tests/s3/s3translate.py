@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#
+# S3Translate Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3translate.py
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+from gluon import *
+from gluon.languages import write_dict
+
+from s3.s3translate import TranslateCatalog, TranslateReadFiles, TranslateStringCache
+
+# =============================================================================
+class TranslateCatalogTests(unittest.TestCase):
+    """ Tests for compiled language catalogs """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, "xx.py")
+        self.target = os.path.join(self.folder, "catalogs", "xx.cat")
+
+        write_dict(self.source, {"!langcode!": "xx",
+                                 "Name": "Nom",
+                                 "Organization": "Organisation",
+                                 "Übersetzung": "Traduction",
+                                 "": "",
+                                 })
+
+    # -------------------------------------------------------------------------
+    def testLookup(self):
+        """ Test lookup of strings in a compiled catalog """
+
+        assertEqual = self.assertEqual
+
+        TranslateCatalog.compile(self.source, self.target)
+        catalog = TranslateCatalog(self.target)
+
+        assertEqual(len(catalog), 5)
+        assertEqual(catalog.get("Name"), "Nom")
+        assertEqual(catalog["Organization"], "Organisation")
+        assertEqual(catalog.get("Übersetzung"), "Traduction")
+        assertEqual(catalog.get(u"Übersetzung"), "Traduction")
+        assertEqual(catalog.get("!langcode!"), "xx")
+        assertEqual(catalog.get(""), "")
+        assertEqual(catalog.get("Person"), None)
+        self.assertRaises(KeyError, catalog.__getitem__, "Person")
+        self.assertTrue("Name" in catalog)
+        self.assertFalse("Nam" in catalog)
+
+        keys = catalog.keys()
+        assertEqual(keys, sorted(keys))
+
+        # Strings added at runtime
+        catalog["Person"] = "Personne"
+        assertEqual(catalog.get("Person"), "Personne")
+        assertEqual(len(catalog), 6)
+        self.assertTrue("Person" in catalog.keys())
+
+    # -------------------------------------------------------------------------
+    def testCurrent(self):
+        """ Test detection of changed language files """
+
+        TranslateCatalog.compile(self.source, self.target)
+        catalog = TranslateCatalog(self.target)
+        self.assertTrue(catalog.current(os.stat(self.source)))
+
+        write_dict(self.source, {"Name": "Nom de famille"})
+        os.utime(self.source, (0, 0))
+        self.assertFalse(catalog.current(os.stat(self.source)))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+# =============================================================================
+class TranslateStringCacheTests(unittest.TestCase):
+    """ Tests for the cache of extracted translation strings """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+
+        # Use a temporary cache
+        cache = TranslateStringCache
+        self.cache = (cache.__dict__["path"], cache._cache, cache._dirty)
+        path = os.path.join(self.folder, "translate_strings.pkl")
+        cache.path = staticmethod(lambda: path)
+        cache._cache = None
+        cache._dirty = False
+
+        # Extract strings in-process, and count the extractions
+        L10n = current.deployment_settings.L10n
+        self.workers = L10n.get("translate_workers")
+        L10n.translate_workers = 1
+
+        self.extracted = []
+        self.extract = TranslateReadFiles.__dict__["extract"]
+        TranslateReadFiles.extract = staticmethod(self.extract_strings)
+
+    # -------------------------------------------------------------------------
+    def extract_strings(self, fileName, spmods, modlist):
+        """ Dummy string extraction: the file contents per module """
+
+        self.extracted.append((os.path.basename(fileName), list(spmods)))
+        with open(fileName) as f:
+            contents = f.read()
+        return dict((spmod, [(1, "%s %s" % (contents, spmod))])
+                    for spmod in spmods)
+
+    # -------------------------------------------------------------------------
+    def write(self, fileName, contents, mtime=None):
+        """ Write a test file """
+
+        path = os.path.join(self.folder, fileName)
+        with open(path, "w") as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    # -------------------------------------------------------------------------
+    def testHit(self):
+        """ Test that unchanged files are not parsed again """
+
+        assertEqual = self.assertEqual
+
+        path = self.write("test.py", "A", mtime=1000000)
+        assertEqual(TranslateStringCache.get(path, "ALL"), [(1, "A ALL")])
+        assertEqual(len(self.extracted), 1)
+
+        # Cached in memory
+        assertEqual(TranslateStringCache.get(path, "ALL"), [(1, "A ALL")])
+        assertEqual(len(self.extracted), 1)
+
+        # ...and in the cache file
+        TranslateStringCache._cache = None
+        assertEqual(TranslateStringCache.get(path, "ALL"), [(1, "A ALL")])
+        assertEqual(len(self.extracted), 1)
+
+    # -------------------------------------------------------------------------
+    def testTouched(self):
+        """ Test that files which have only been touched are not parsed again """
+
+        assertEqual = self.assertEqual
+
+        path = self.write("test.py", "A", mtime=1000000)
+        TranslateStringCache.get(path, "ALL")
+
+        os.utime(path, (2000000, 2000000))
+        assertEqual(TranslateStringCache.get(path, "ALL"), [(1, "A ALL")])
+        assertEqual(len(self.extracted), 1)
+
+        # The new modification time has been stored
+        entry = TranslateStringCache.load()[path]
+        assertEqual(entry["stat"], TranslateStringCache.stat(path))
+
+    # -------------------------------------------------------------------------
+    def testChanged(self):
+        """ Test that changed files are parsed again """
+
+        assertEqual = self.assertEqual
+
+        path = self.write("test.py", "A", mtime=1000000)
+        TranslateStringCache.get(path, "ALL")
+
+        self.write("test.py", "B", mtime=2000000)
+        assertEqual(TranslateStringCache.get(path, "ALL"), [(1, "B ALL")])
+        assertEqual(len(self.extracted), 2)
+
+    # -------------------------------------------------------------------------
+    def testSpecialFiles(self):
+        """ Test caching of the strings of multiple modules per file """
+
+        assertEqual = self.assertEqual
+
+        for fileName in ("s3menus.py", "s3cfg.py", "000_config.py"):
+            self.extracted = []
+            path = self.write(fileName, "A", mtime=1000000)
+
+            # All modules are extracted at once
+            TranslateStringCache.prefetch([(path, "org"), (path, "hrm")], [])
+            assertEqual(self.extracted, [(fileName, ["hrm", "org"])])
+            assertEqual(TranslateStringCache.get(path, "org"), [(1, "A org")])
+            assertEqual(TranslateStringCache.get(path, "hrm"), [(1, "A hrm")])
+
+            # Another module is added to the same entry
+            assertEqual(TranslateStringCache.get(path, "inv"), [(1, "A inv")])
+            assertEqual(self.extracted[1:], [(fileName, ["inv"])])
+            assertEqual(TranslateStringCache.get(path, "org"), [(1, "A org")])
+            assertEqual(len(self.extracted), 2)
+
+            # A change invalidates all modules
+            self.write(fileName, "B", mtime=2000000)
+            assertEqual(TranslateStringCache.get(path, "hrm"), [(1, "B hrm")])
+            assertEqual(TranslateStringCache.get(path, "org"), [(1, "B org")])
+            assertEqual(len(self.extracted), 4)
+
+    # -------------------------------------------------------------------------
+    def testModuleList(self):
+        """ Test that a changed module list invalidates the special files """
+
+        assertEqual = self.assertEqual
+
+        get = TranslateStringCache.get
+        path = self.write("test.py", "A", mtime=1000000)
+        special = self.write("s3cfg.py", "A", mtime=1000000)
+
+        get(path, "ALL", ["org"])
+        get(special, "org", ["org"])
+        assertEqual(len(self.extracted), 2)
+
+        # Unchanged module list
+        get(special, "org", ["org"])
+        assertEqual(len(self.extracted), 2)
+
+        get(path, "ALL", ["org", "hrm"])
+        assertEqual(len(self.extracted), 2)
+        get(special, "org", ["org", "hrm"])
+        assertEqual(self.extracted[2:], [("s3cfg.py", ["org"])])
+
+        # ...also in the cache file, regardless of order
+        TranslateStringCache._cache = None
+        get(special, "org", ["hrm", "org"])
+        assertEqual(len(self.extracted), 3)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        TranslateReadFiles.extract = self.extract
+
+        cache = TranslateStringCache
+        cache.path, cache._cache, cache._dirty = self.cache
+
+        L10n = current.deployment_settings.L10n
+        if self.workers is None:
+            L10n.pop("translate_workers", None)
+        else:
+            L10n.translate_workers = self.workers
+
+        shutil.rmtree(self.folder)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        TranslateCatalogTests,
+        TranslateStringCacheTests,
+    )
+
+# END ========================================================================
@@ -178,6 +178,71 @@ class S3DataTableTests(unittest.TestCase):
                                           limit=2)
         self.assertEqual(len(table.rows), 1)
 
+# =============================================================================
+class S3OnCommitTests(unittest.TestCase):
+    """ Tests for request commit hooks """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        # Simulate an HTTP request, but don't actually commit
+        request = current.request
+        self.context = (request.is_shell, request.is_scheduler)
+        request.is_shell = request.is_scheduler = False
+
+        response = current.response
+        self.hooks = (response.custom_commit, response.s3.commit_hooks)
+        self.calls = calls = []
+        response.custom_commit = lambda adapter: calls.append(adapter)
+        response.s3.commit_hooks = None
+
+    # -------------------------------------------------------------------------
+    def testCommitHook(self):
+        """ Test callbacks before and after commit """
+
+        assertEqual = self.assertEqual
+
+        calls = self.calls
+        before = lambda: calls.append("before")
+        after = lambda: calls.append("after")
+
+        self.assertTrue(s3_on_commit(before))
+        self.assertTrue(s3_on_commit(before))
+        self.assertTrue(s3_on_commit(after, after=True))
+
+        # web2py calls the hook with the adapter of each connection
+        adapter = current.db._adapter
+        current.response.custom_commit(adapter)
+        assertEqual(calls, ["before", adapter, "after"])
+
+        # Callbacks run only once
+        del calls[:]
+        current.response.custom_commit(adapter)
+        assertEqual(calls, [adapter])
+
+        # Other connections are just committed
+        del calls[:]
+        s3_on_commit(before)
+        current.response.custom_commit("other")
+        assertEqual(calls, ["other"])
+
+    # -------------------------------------------------------------------------
+    def testNoCommitHook(self):
+        """ Test that callbacks can't be registered in shell scripts """
+
+        current.request.is_shell = True
+        self.assertFalse(s3_on_commit(lambda: None))
+        self.assertEqual(current.response.s3.commit_hooks, None)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        request = current.request
+        request.is_shell, request.is_scheduler = self.context
+
+        response = current.response
+        response.custom_commit, response.s3.commit_hooks = self.hooks
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -197,6 +262,7 @@ if __name__ == "__main__":
         S3FKWrappersTests,
         S3SQLTableTests,
         S3DataTableTests,
+        S3OnCommitTests,
     )
 
 # END ========================================================================
@@ -263,6 +263,50 @@ class S3XMLFormatTests(unittest.TestCase):
         self.assertEqual(len(root), 0)
         self.assertEqual(root.text, "Test")
 
+# =============================================================================
+class S3CSVBatchTests(unittest.TestCase):
+    """ Tests for incremental (batched) conversion of CSV sources """
+
+    CSV = """Name,Code
+Alpha,A
+Beta,B
+Gamma,C
+Delta,D
+Epsilon,E"""
+
+    # -------------------------------------------------------------------------
+    def testBatches(self):
+        """ Test conversion in batches """
+
+        xml = current.xml
+
+        trees = list(xml.csv2trees(StringIO(self.CSV),
+                                   resourcename="test",
+                                   batch_size=2))
+        self.assertEqual([len(tree.getroot()) for tree in trees], [2, 2, 1])
+
+        root = trees[1].getroot()
+        self.assertEqual(root.tag, xml.TAG.table)
+        self.assertEqual(root.get(xml.ATTRIBUTE.name), "test")
+
+        cols = root[0].findall(xml.TAG.col)
+        values = dict((col.get(xml.ATTRIBUTE.field), col.text) for col in cols)
+        self.assertEqual(values, {"Name": "Gamma", "Code": "C"})
+
+    # -------------------------------------------------------------------------
+    def testSingleTree(self):
+        """ Test that csv2tree still produces a single tree """
+
+        xml = current.xml
+
+        tree = xml.csv2tree(StringIO(self.CSV))
+        self.assertEqual(len(tree.getroot()), 5)
+
+        # Empty source still produces a (empty) tree
+        trees = list(xml.csv2trees(StringIO("Name,Code"), batch_size=2))
+        self.assertEqual(len(trees), 1)
+        self.assertEqual(len(trees[0].getroot()), 0)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -282,6 +326,7 @@ if __name__ == "__main__":
         S3TreeBuilderTests,
         S3JSONMessageTests,
         S3XMLFormatTests,
+        S3CSVBatchTests,
     )
 
 # END ========================================================================
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# CR Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3db/cr.py
+#
+import unittest
+
+from gluon import *
+from gluon.storage import Storage
+
+# =============================================================================
+@unittest.skipIf(not current.deployment_settings.has_module("cr"),
+                 "CR module deactivated")
+class ShelterAggregateTests(unittest.TestCase):
+    """ Tests for the shelter capacity/population aggregates """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        gtable = s3db.gis_location
+        update_location_tree = current.gis.update_location_tree
+
+        location_ids = Storage()
+        parent = None
+        for code, name, level in (("L0", "Shelter Test Country", "L0"),
+                                  ("L1", "Shelter Test Region", "L1"),
+                                  ("L2", "Shelter Test Province", "L2"),
+                                  ):
+            location_id = gtable.insert(name=name, level=level, parent=parent)
+            update_location_tree(dict(id=location_id, level=level))
+            location_ids[code] = location_id
+            parent = location_id
+        self.location_ids = location_ids
+
+        self.type_id = s3db.cr_shelter_type.insert(name="Shelter Test Type")
+
+    # -------------------------------------------------------------------------
+    def aggregate(self, location_id, shelter_type_id=None):
+        """ Get the aggregate for a location and shelter type """
+
+        atable = current.s3db.cr_shelter_aggregate
+        query = (atable.location_id == location_id) & \
+                (atable.shelter_type_id == shelter_type_id)
+        return current.db(query).select(limitby=(0, 1)).first()
+
+    # -------------------------------------------------------------------------
+    def testIncrementalUpdate(self):
+        """ Test incremental update of aggregates on shelter changes """
+
+        assertEqual = self.assertEqual
+
+        s3db = current.s3db
+        db = current.db
+
+        stable = s3db.cr_shelter
+        update = s3db.cr_shelter_update_aggregates
+        location_ids = self.location_ids
+
+        shelter_id = stable.insert(name="Shelter Test 1",
+                                   location_id = location_ids.L2,
+                                   shelter_type_id = self.type_id,
+                                   capacity_day = 100,
+                                   capacity_night = 80,
+                                   population = 30,
+                                   status = 2,
+                                   )
+        update(shelter_id)
+
+        for code in ("L0", "L1", "L2"):
+            for type_id in (self.type_id, None):
+                aggregate = self.aggregate(location_ids[code], type_id)
+                assertEqual(aggregate.shelters, 1)
+                assertEqual(aggregate.open, 1)
+                assertEqual(aggregate.capacity_night, 80)
+                assertEqual(aggregate.available, 50)
+        assertEqual(self.aggregate(location_ids.L1).level, "L1")
+
+        # Move to L1, close and fill up
+        db(stable.id == shelter_id).update(location_id = location_ids.L1,
+                                           population = 100,
+                                           status = 1,
+                                           )
+        update(shelter_id)
+
+        aggregate = self.aggregate(location_ids.L2)
+        assertEqual(aggregate.shelters, 0)
+        assertEqual(aggregate.capacity_night, 0)
+
+        aggregate = self.aggregate(location_ids.L1)
+        assertEqual(aggregate.shelters, 1)
+        assertEqual(aggregate.open, 0)
+        assertEqual(aggregate.closed, 1)
+        assertEqual(aggregate.population, 100)
+        assertEqual(aggregate.available, 0)
+
+        # Delete
+        resource = s3db.resource("cr_shelter", id=shelter_id)
+        self.assertTrue(resource.delete())
+        aggregate = self.aggregate(location_ids.L0)
+        assertEqual(aggregate.shelters, 0)
+        assertEqual(aggregate.population, 0)
+
+        itable = s3db.cr_shelter_aggregate_item
+        query = (itable.shelter_id == shelter_id)
+        assertEqual(db(query).count(), 0)
+
+    # -------------------------------------------------------------------------
+    def testRebuild(self):
+        """ Test rebuild of all aggregates """
+
+        s3db = current.s3db
+
+        stable = s3db.cr_shelter
+        location_ids = self.location_ids
+        for name, capacity in (("Shelter Test 1", 10), ("Shelter Test 2", 20)):
+            stable.insert(name = name,
+                          location_id = location_ids.L2,
+                          capacity_night = capacity,
+                          )
+
+        s3db.cr_shelter_rebuild_aggregates()
+
+        aggregate = self.aggregate(location_ids.L1)
+        self.assertEqual(aggregate.shelters, 2)
+        self.assertEqual(aggregate.capacity_night, 30)
+
+        aggregate = self.aggregate(location_ids.L2)
+        self.assertEqual(aggregate.shelters, 2)
+        self.assertEqual(aggregate.available, 30)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        ShelterAggregateTests,
+    )
+
+# END ========================================================================
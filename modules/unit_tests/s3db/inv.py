@@ -11,6 +11,8 @@ import datetime
 from gluon import *
 from gluon.storage import Storage
 
+from s3db.inv import S3StockLedger
+
 # =============================================================================
 class InvTests(unittest.TestCase):
     """ Inv Tests """
@@ -34,6 +36,155 @@ class InvTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class StockLedgerTests(unittest.TestCase):
+    """ Tests for the stock movement ledger """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+
+        wtable = s3db.inv_warehouse
+        record = Storage(name="Stock Ledger Test Warehouse")
+        record.id = wtable.insert(**record)
+        s3db.update_super(wtable, record)
+        self.site_id = record.site_id
+
+        self.item_id = s3db.supply_item.insert(name="Stock Ledger Test Item",
+                                               um="pc")
+        self.pack_id = s3db.supply_item_pack.insert(item_id=self.item_id,
+                                                    name="box",
+                                                    quantity=10)
+
+    # -------------------------------------------------------------------------
+    def testPost(self):
+        """ Test posting of stock changes """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        s3db = current.s3db
+
+        ledger = S3StockLedger()
+
+        itable = s3db.inv_inv_item
+        mtable = s3db.inv_stock_movement
+
+        inv_item_id = itable.insert(site_id = self.site_id,
+                                    item_id = self.item_id,
+                                    item_pack_id = self.pack_id,
+                                    quantity = 5)
+        assertEqual(S3StockLedger.post(inv_item_id), 1)
+        movement = db(mtable.inv_item_id == inv_item_id).select().last()
+        assertEqual(movement.type, "opening")
+        assertEqual(movement.quantity, 50)
+
+        # No change => no movement
+        assertEqual(S3StockLedger.post(inv_item_id, "send"), 0)
+
+        db(itable.id == inv_item_id).update(quantity = 3)
+        assertEqual(S3StockLedger.post(inv_item_id, "send"), 1)
+        movement = db(mtable.inv_item_id == inv_item_id).select().last()
+        assertEqual(movement.type, "send")
+        assertEqual(movement.quantity, -20)
+        assertEqual(movement.balance, 30)
+
+        key = (self.site_id, self.item_id)
+        stock = ledger.stock(site_ids=[self.site_id])
+        assertEqual(stock, {key: 30})
+
+        movements = ledger.movements(site_ids=[self.site_id])
+        assertEqual(movements, {key: 30})
+
+        # Snapshot plus later movements (even within the same request)
+        ledger.snapshot()
+        assertEqual(ledger.stock(site_ids=[self.site_id]), {key: 30})
+        db(itable.id == inv_item_id).update(deleted = True)
+        assertEqual(S3StockLedger.post(inv_item_id, "adj"), 1)
+        assertEqual(ledger.stock(site_ids=[self.site_id]), {})
+
+    # -------------------------------------------------------------------------
+    def testLateMovement(self):
+        """ Test movements committed after a snapshot, but dated before it """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        s3db = current.s3db
+
+        ledger = S3StockLedger()
+
+        itable = s3db.inv_inv_item
+        mtable = s3db.inv_stock_movement
+
+        inv_item_id = itable.insert(site_id = self.site_id,
+                                    item_id = self.item_id,
+                                    item_pack_id = self.pack_id,
+                                    quantity = 2)
+        S3StockLedger.post(inv_item_id)
+
+        date = datetime.datetime.utcnow()
+        ledger.snapshot(date)
+
+        # Movement from a transaction which started before the snapshot
+        mtable.insert(inv_item_id = inv_item_id,
+                      site_id = self.site_id,
+                      item_id = self.item_id,
+                      date = date - datetime.timedelta(minutes=5),
+                      type = "edit",
+                      quantity = 10,
+                      balance = 30,
+                      )
+
+        key = (self.site_id, self.item_id)
+        assertEqual(ledger.stock(site_ids=[self.site_id]), {key: 30})
+
+        # Included exactly once in the next snapshot
+        ledger.snapshot(date + datetime.timedelta(minutes=1))
+        assertEqual(ledger.stock(site_ids=[self.site_id]), {key: 30})
+        stable = s3db.inv_stock_snapshot
+        query = (stable.site_id == self.site_id) & \
+                (stable.item_id == self.item_id)
+        row = db(query).select(stable.quantity,
+                               orderby = ~stable.watermark,
+                               limitby = (0, 1)).first()
+        assertEqual(row.quantity, 30)
+
+    # -------------------------------------------------------------------------
+    def testVerify(self):
+        """ Test verification and repair of the ledger """
+
+        db = current.db
+        s3db = current.s3db
+
+        ledger = S3StockLedger()
+
+        itable = s3db.inv_inv_item
+        inv_item_id = itable.insert(site_id = self.site_id,
+                                    item_id = self.item_id,
+                                    item_pack_id = self.pack_id,
+                                    quantity = 2)
+        S3StockLedger.post(inv_item_id)
+
+        # Change without posting
+        db(itable.id == inv_item_id).update(quantity = 1)
+        discrepancies = ledger.verify(site_ids=[self.site_id])
+        self.assertEqual(len(discrepancies), 1)
+        self.assertEqual(discrepancies[0].ledger, 20)
+        self.assertEqual(discrepancies[0].stock, 10)
+
+        ledger.verify(site_ids=[self.site_id], repair=True)
+        self.assertEqual(ledger.verify(site_ids=[self.site_id]), [])
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -50,7 +201,8 @@ def run_suite(*test_classes):
 if __name__ == "__main__":
 
     run_suite(
-        StatsTests,
+        InvTests,
+        StockLedgerTests,
     )
 
 # END ========================================================================
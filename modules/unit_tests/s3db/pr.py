@@ -13,6 +13,7 @@ from gluon.storage import Storage
 
 from lxml import etree
 
+from s3.s3merge import S3DuplicateFinder
 from s3db.pr import S3SavedSearch
 
 # =============================================================================
@@ -441,6 +442,156 @@ class PersonDeduplicateTests(unittest.TestCase):
         self.pe_id = None
         self.person_id = None
 
+# =============================================================================
+class PersonDuplicateFinderTests(unittest.TestCase):
+    """ Test duplicate detection for persons """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        s3db = current.s3db
+        s3db.table("pr_person")
+        self.config = s3db.get_config("pr_person", "merge_candidates")
+
+    # -------------------------------------------------------------------------
+    def record(self, first_name, last_name, dob=None, gender=1, phone=None):
+
+        return Storage({"pr_person.first_name": first_name,
+                        "pr_person.last_name": last_name,
+                        "pr_person.date_of_birth": dob,
+                        "pr_person.gender": gender,
+                        "pr_contact.value": phone,
+                        })
+
+    # -------------------------------------------------------------------------
+    def testConfig(self):
+        """ Test duplicate detection configuration """
+
+        config = self.config
+        self.assertNotEqual(config, None)
+        self.assertTrue(callable(config["keys"]))
+        self.assertTrue(callable(config["similarity"]))
+
+    # -------------------------------------------------------------------------
+    def testKeys(self):
+        """ Test blocking keys """
+
+        keys = self.config["keys"]
+        dob = datetime.date(1974, 4, 13)
+
+        a = self.record("Test", "Userdedup", dob=dob, phone="+46 733 847589")
+        b = self.record("Userdedup", "Tset", phone=["test@example.com",
+                                                    "0733847589"])
+        keys_a = set(keys(a))
+        keys_b = set(keys(b))
+
+        # Swapped names and equal phone numbers share keys
+        self.assertEqual(len(keys_a & keys_b), 2)
+        self.assertTrue("p:733847589" in keys_b)
+
+        # Not enough data
+        c = self.record(None, None)
+        self.assertEqual(keys(c), [])
+
+    # -------------------------------------------------------------------------
+    def testSimilarity(self):
+        """ Test similarity function """
+
+        similarity = self.config["similarity"]
+        threshold = self.config["threshold"]
+        dob = datetime.date(1974, 4, 13)
+
+        a = self.record("Test", "Userdedup", dob=dob, gender=2)
+        b = self.record("Test", "Userdedup", dob=dob, gender=2)
+        self.assertEqual(similarity(a, b), 1.0)
+
+        # Swapped names
+        b = self.record("Userdedup", "Test", dob=dob)
+        self.assertTrue(similarity(a, b) >= threshold)
+
+        # Different date of birth and gender
+        b = self.record("Test", "Userdedup",
+                        dob=datetime.date(1980, 1, 1), gender=3)
+        self.assertTrue(similarity(a, b) < threshold)
+
+        # Different names
+        b = self.record("Other", "Person", dob=dob)
+        self.assertTrue(similarity(a, b) < threshold)
+
+    # -------------------------------------------------------------------------
+    def testNonLatinNames(self):
+        """ Test normalization of names in other scripts """
+
+        assertEqual = self.assertEqual
+        normalize = S3DuplicateFinder.normalize
+
+        # Accents are removed
+        assertEqual(normalize(u"Müller-Lüdenscheidt"), u"mullerludenscheidt")
+        assertEqual(S3DuplicateFinder.soundex(u"Müller"),
+                    S3DuplicateFinder.soundex("Muller"))
+
+        # Arabic script names are kept, without vowel marks and hamza
+        assertEqual(normalize(u"مُحَمَّد"), u"محمد")
+        assertEqual(normalize(u"أحمد"), normalize(u"احمد"))
+        assertEqual(normalize(u"فاطمة"), normalize(u"فاطمه"))
+        assertEqual(normalize(u"علی"), normalize(u"علي"))
+
+        # ...and can be matched
+        keys = self.config["keys"]
+        similarity = self.config["similarity"]
+        threshold = self.config["threshold"]
+
+        a = self.record(u"محمد", u"أحمدي")
+        b = self.record(u"احمدی", u"مُحَمَّد")
+        self.assertTrue(set(keys(a)) & set(keys(b)))
+        self.assertTrue(similarity(a, b) >= threshold)
+
+        b = self.record(u"فاطمة", u"حسيني")
+        self.assertTrue(similarity(a, b) < threshold)
+
+    # -------------------------------------------------------------------------
+    def testFinder(self):
+        """ Test candidate pair generation and storage """
+
+        s3db = current.s3db
+        auth = current.auth
+
+        auth.override = True
+        ptable = s3db.pr_person
+        for first_name, last_name in (("Test", "UserDUPFINDER"),
+                                      ("Tset", "UserDUPFINDER"),
+                                      ("Other", "PersonDUPFINDER"),
+                                      ):
+            person = Storage(first_name=first_name, last_name=last_name)
+            person_id = ptable.insert(**person)
+            person.update(id=person_id)
+            s3db.update_super(ptable, person)
+
+        finder = S3DuplicateFinder("pr_person", threshold=0.9)
+        finder()
+
+        ctable = s3db.s3_merge_candidate
+        query = (ctable.tablename == "pr_person") & \
+                (ctable.status == "OPEN")
+        rows = current.db(query).select(ctable.record_id,
+                                        ctable.duplicate_id)
+        ids = set()
+        for row in rows:
+            ids.add(row.record_id)
+            ids.add(row.duplicate_id)
+        query = (ptable.last_name == "UserDUPFINDER")
+        for row in current.db(query).select(ptable.id):
+            self.assertTrue(row.id in ids)
+        query = (ptable.last_name == "PersonDUPFINDER")
+        for row in current.db(query).select(ptable.id):
+            self.assertFalse(row.id in ids)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 class SavedSearchTests(unittest.TestCase):
     """
@@ -675,6 +826,7 @@ if __name__ == "__main__":
     run_suite(
         PRTests,
         PersonDeduplicateTests,
+        PersonDuplicateFinderTests,
         SavedSearchTests,
         ContactValidationTests,
     )
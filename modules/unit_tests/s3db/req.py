@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# REQ Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3db/req.py
+#
+import unittest
+
+from gluon import *
+from gluon.storage import Storage
+
+from s3db.req import S3RequestMatcher
+
+# =============================================================================
+class RequestMatcherTests(unittest.TestCase):
+    """ Tests for the request matching engine """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        matcher = S3RequestMatcher(limit=2)
+
+        # Request 1 from site 1 for 10 of item 1 and 5 of item 2
+        matcher._needs = {1: Storage(site_id=1, items={1: 10, 2: 5})}
+        matcher._stock = {1: {2: 10, 3: 10, 4: 10, 5: 4},
+                          2: {2: 5, 4: 5, 5: 5},
+                          }
+        matcher._locations = {1: (0.0, 0.0),
+                              2: (0.0, 3.0),
+                              3: (0.0, 0.5),
+                              4: (0.0, 10.0),
+                              5: None,
+                              }
+        self.matcher = matcher
+
+    # -------------------------------------------------------------------------
+    def testNearest(self):
+        """ Test ordering of sites by distance """
+
+        nearest = list(self.matcher.nearest(0.0, 0.0, set([2, 3, 4])))
+        self.assertEqual([site_id for distance, site_id in nearest], [3, 2, 4])
+
+        distances = [distance for distance, site_id in nearest]
+        self.assertEqual(distances, sorted(distances))
+
+    # -------------------------------------------------------------------------
+    def testMatch(self):
+        """ Test ranking of candidate sites """
+
+        assertEqual = self.assertEqual
+
+        candidates = self.matcher.match(1)
+        assertEqual(len(candidates), 2)
+
+        # Nearest site with full coverage first
+        best = candidates[0]
+        assertEqual(best.site_id, 2)
+        assertEqual(best.matched, 2)
+        assertEqual(best.complete, 2)
+        assertEqual(best.coverage, 1.0)
+        assertEqual(candidates[1].site_id, 4)
+
+        # Unknown requests have no candidates
+        assertEqual(self.matcher.match(2), [])
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        RequestMatcherTests,
+    )
+
+# END ========================================================================
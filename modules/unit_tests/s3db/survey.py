@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Survey Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3db/survey.py
+#
+import unittest
+
+from gluon import *
+from gluon.storage import Storage
+
+from s3survey import S3SurveyStats
+
+# =============================================================================
+class SurveyStatsTests(unittest.TestCase):
+    """ Tests for pre-aggregated answer statistics """
+
+    # -------------------------------------------------------------------------
+    def testNumeric(self):
+        """ Test incremental statistics for numeric questions """
+
+        assertEqual = self.assertEqual
+
+        stats = S3SurveyStats("Numeric")
+        for value, location in (("4", "A"), ("2", "A"), ("x", "B"), ("6", "B")):
+            stats.add(value, location)
+
+        assertEqual(stats.replies, 4)
+        assertEqual(stats.valid, 3)
+        assertEqual(stats.total, 12.0)
+        assertEqual(stats.sumsq, 56.0)
+        assertEqual(stats.minimum, 2.0)
+        assertEqual(stats.maximum, 6.0)
+        assertEqual(stats.mean(), 4.0)
+        self.assertAlmostEqual(stats.std(), (8.0 / 3) ** 0.5)
+        assertEqual(stats.values(), [2.0, 4.0, 6.0])
+        assertEqual(stats.locations, {"A": [2, 6.0], "B": [2, 6.0]})
+
+        # Removing an inner value can be done incrementally
+        stats.remove("4", "A")
+        assertEqual(stats.valid, 2)
+        assertEqual(stats.total, 8.0)
+        assertEqual(stats.locations, {"A": [1, 2.0], "B": [2, 6.0]})
+        self.assertFalse(stats.stale)
+
+        # Removing the maximum can not
+        stats.remove("6", "B")
+        self.assertTrue(stats.stale)
+
+    # -------------------------------------------------------------------------
+    def testOption(self):
+        """ Test incremental statistics for option questions """
+
+        assertEqual = self.assertEqual
+
+        stats = S3SurveyStats("YesNo")
+        for value in ("Yes", "No", "Yes"):
+            stats.add(value)
+        assertEqual(stats.replies, 3)
+        assertEqual(stats.valid, 3)
+        assertEqual(stats.histogram, {"Yes": 2, "No": 1})
+
+        stats.remove("No")
+        assertEqual(stats.histogram, {"Yes": 2})
+        self.assertFalse(stats.stale)
+
+    # -------------------------------------------------------------------------
+    def testRecord(self):
+        """ Test storing and restoring the statistics """
+
+        assertEqual = self.assertEqual
+
+        stats = S3SurveyStats("Numeric")
+        stats.add("1.5", "A")
+        stats.add("3", "A")
+
+        row = Storage(stats.record())
+        self.assertFalse(row.dirty)
+        restored = S3SurveyStats.fromRow("Numeric", row)
+        assertEqual(restored.valid, 2)
+        assertEqual(restored.total, 4.5)
+        assertEqual(restored.histogram, {1.5: 1, 3.0: 1})
+        assertEqual(restored.locations, {"A": [2, 4.5]})
+
+        self.assertTrue(S3SurveyStats.supported("MultiOption"))
+        self.assertFalse(S3SurveyStats.supported("Location"))
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        SurveyStatsTests,
+    )
+
+# END ========================================================================
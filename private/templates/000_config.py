@@ -80,6 +80,8 @@ settings.base.debug = False
 #settings.log.logfile = None
 # Uncomment to get detailed caller information
 #settings.log.caller_info = True
+# Uncomment to profile the models pipeline (see admin/profile)
+#settings.log.profile = True
 
 # Uncomment to use Content Delivery Networks to speed up Internet-facing sites
 #settings.base.cdn = True
@@ -137,6 +139,8 @@ settings.frontpage.rss = [
 
 # Allow language files to be updated automatically
 #settings.L10n.languages_readonly = False
+# Uncomment to use compiled, memory-mapped language catalogs (shared by all worker processes)
+#settings.L10n.compiled_catalogs = True
 
 # Fill this in to get Google Analytics for your site
 #settings.base.google_analytics_tracking_id = ""
@@ -218,6 +222,8 @@ if os.path.exists(path):
 
 # After 1st_run, set this for Production to save 1x DAL hit/request
 #settings.base.prepopulate = 0
+# Import large prepopulate CSV files in batches of rows to limit memory use
+#settings.base.import_batch_size = 500
 
 # =============================================================================
 # A version number to tell update_check if there is a need to refresh the
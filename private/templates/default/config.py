@@ -290,6 +290,8 @@ settings.L10n.decimal_separator = "."
 #settings.msg.parser = "mytemplatefolder"
 # Uncomment to turn off enforcement of E.123 international phone number notation
 #settings.msg.require_international_phone_numbers = False
+# Uncomment to look up the definitions of unknown hashtags from tagdef.com for the KeyGraph
+#settings.msg.hashtag_definitions = True
 
 # Use 'soft' deletes
 #settings.security.archive_not_delete = False
@@ -319,6 +321,10 @@ settings.L10n.decimal_separator = "."
 # NB Auditing (especially Reads) slows system down & consumes diskspace
 #settings.security.audit_read = True
 #settings.security.audit_write = True
+# Buffer audit entries and write them in bulk at the end of the request
+# (True), or append them to a log file which gets loaded by a scheduler
+# task ("log")
+#settings.security.audit_buffer = "log"
 
 # Lock-down access to Map Editing
 #settings.security.map = True
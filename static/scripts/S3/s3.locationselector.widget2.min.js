@@ -10,7 +10,7 @@ i18n.enter_value),!1):A.hasClass("required")?(S3.fieldError(d+"_L4",i18n.enter_v
 m){var g=S3.Ap.concat("/gis/hdata/"+e);$.ajaxS3({async:!1,url:g,dataType:"script",success:function(a){m={};try{for(var b in n)m[b]=n[b];h[e]=m;n=null}catch(f){}},error:function(a,b,f){msg="UNAUTHORIZED"==f?i18n.gis_requires_login:a.responseText;s3_debug(msg)}})}for(var s=h.d,q,p,d=["1","2","3","4","5"],k,g=0;5>g;g++)q=d[g],p=m[q]||s[q],k=c+"_L"+q,$(k).hasClass("required")?($(k+"__row label").html("<div>"+p+':<span class="req"> *</span></div>'),$(k+"__row1 label").html("<div>"+p+':<span class="req"> *</span></div>')):
 ($(k+"__row label").html(p+":"),$(k+"__row1 label").html(p+":")),$(k+' option[value=""]').html(i18n.select+" "+p)}if(e){for(q=a+1;6>q;q++)k=c+"_L"+q,f?($(k+"__row").hide(),$(k+"__row1").hide()):$(k+" option").remove('[value != ""]'),$(k).val("");u(b);a+=1;f=$(c+"_L"+a+"__row");if(f.length){f.removeClass("hide").show();$(c+"_L"+a+"__row1").removeClass("hide").show();f=!0;for(g in l)if(l[g].f==e){f=!1;break}f&&R(b,a,e);f=[];for(g in l)s=l[g],s.l==a&&s.f==e&&(s.i=g,f.push(s));f.sort(P);var s=f.length,
 r;q=$(c+"_L"+a);$(c+"_L"+a+" option").remove('[value != ""]');for(g=0;g<s;g++)p=f[g],r=p.i,d=e==r?' selected="selected"':"",p='<option value="'+r+'"'+d+">"+p.n+"</option>",q.append(p);q.prop("multiple")&&q.multiselect({allSelectedText:i18n.allSelectedText,selectedText:i18n.selectedText,header:!1,height:300,minWidth:0,selectedList:3,noneSelectedText:$(c+"_L"+a+' option[value=""]').html(),multiple:!1});if(1==s){t(b,a,r);return}}else $(c+"_geocode button").length&&H(b)}else for(u(b),q=a+1;6>q;q++)k=
-c+"_L"+q,f?($(k+"__row").hide(),$(k+"__row1").hide()):$(k+" option").remove('[value != ""]'),$(k).val("");B(b)},P=function(b,a){b=b.n;var e=[b,a.n];e.sort();return e[0]==b?-1:1},R=function(b,a,e){b="#"+b;var c=$(b+"_L"+a);c.hide();var f=$(b+"_L"+a+"__throbber");f.removeClass("hide").show();a=S3.Ap.concat("/gis/ldata/"+e);$.ajaxS3({async:!1,url:a,dataType:"script",success:function(a){for(var b in n)l[b]=n[b];n=null;f.hide();c.removeClass("hide").show()},error:function(a,b,e){msg="UNAUTHORIZED"==e?
+c+"_L"+q,f?($(k+"__row").hide(),$(k+"__row1").hide()):$(k+" option").remove('[value != ""]'),$(k).val("");B(b)},P=function(b,a){b=b.n;var e=[b,a.n];e.sort();return e[0]==b?-1:1},R=function(b,a,e){b="#"+b;var c=$(b+"_L"+a);c.hide();var f=$(b+"_L"+a+"__throbber");f.removeClass("hide").show();a=S3.Ap.concat("/gis/ldata/"+e);$.ajaxS3({async:!1,cache:!0,url:a,dataType:"script",success:function(a){for(var b in n)l[b]=n[b];n=null;f.hide();c.removeClass("hide").show()},error:function(a,b,e){msg="UNAUTHORIZED"==e?
 i18n.gis_requires_login:a.responseText;s3_debug(msg);S3.showAlert(msg,"error");f.hide();c.removeClass("hide").show()}})},w=function(b){b="#"+b+"_L";for(var a,e=5;-1<e;e--)if(a=$(b+e).val())return a;return l.d.id},u=function(b){var a="#"+b,e=$(a+"_parent"),c=$(a);if(c.data("specific"))c=w(b),e.val(c);else{var f=$(a+"_address").val(),m=$(a+"_postcode").val(),g=$(a+"_lat").val(),s=$(a+"_lon").val(),a=$(a+"_wkt").val();f||m||g||s||a?(c.val("dummy"),c=w(b),e.val(c)):(b=w(b),c.val(b),e.val(""))}},Q=function(b){var a=
 "#"+b;$(a+"_address__row").removeClass("hide").show();$(a+"_address__row1").removeClass("hide").show();$(a+"_postcode__row").removeClass("hide").show();$(a+"_postcode__row1").removeClass("hide").show();$(a+"_geocode button").length&&$(a+"_address,"+a+"_postcode").change(function(){H(b)})},H=function(b){var a="#"+b;if($(a+"_address").val()){var e,c,f=["1","2","3","4","5"];for(e=0;5>e;e++)if(c=f[e],c=$(a+"_L"+c),c.length&&!c.val()&&1<c[0].options.length)return;$(a).data("manually_geocoded")?($(a+"_geocode .geocode_success").hide(),
 $(a+"_geocode .geocode_fail").hide(),$(a+"_geocode button").removeClass("hide").show().click(function(){$(this).hide();I(b);u(b)})):I(b);u(b)}},I=function(b){var a="#"+b,e=$(a+"_geocode .geocode_fail"),c=$(a+"_geocode .geocode_success");e.hide();c.hide();var f=$(a+"_geocode .throbber");f.removeClass("hide").show();var m={address:$(a+"_address").val()},g=$(a+"_postcode").val();g&&(m.postcode=g);if(g=$(a+"_L0").val())m.L0=g;if(g=$(a+"_L1").val())m.L1=g;if(g=$(a+"_L2").val())m.L2=g;if(g=$(a+"_L3").val())m.L3=
@@ -416,6 +416,8 @@ def migrate():
     print(green("%s: Performing Migration" % env.host))
     with cd("/home/web2py"):
         run("sudo -H -u web2py python web2py.py -N -S eden -M -R applications/eden/static/scripts/tools/noop.py", pty=True)
+        # Post-migration data updates
+        run("sudo -H -u web2py python web2py.py -S eden -M -R applications/eden/static/scripts/tools/rss_link_hash.py", pty=True)
 
 def migrate_off():
     """ Disabling migrations """
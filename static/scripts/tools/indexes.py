@@ -37,3 +37,11 @@ try:
 except:
     # Index already present
     pass
+
+tablename = "msg_rss"
+field = "link_hash"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present (or table not present)
+    pass
@@ -0,0 +1,14 @@
+#!/usr/bin/python
+
+# Generate the model manifest (cache/s3model_manifest.json) which allows
+# S3Model to load exactly the models needed for a request
+# - re-run this whenever models have been added or modified
+
+# Needs to be run in the web2py environment
+# python web2py.py -S eden -M -R applications/eden/static/scripts/tools/model_manifest.py
+
+manifest = s3db.build_manifest()
+print "Model manifest: %s names, %s component masters, %s referenced tables" % \
+      (len(manifest["names"]),
+       len(manifest["components"]),
+       len(manifest["references"]))
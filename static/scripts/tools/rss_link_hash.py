@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Post-migration script to set the link_hash in all msg_rss records
+# stored before it was introduced (used for duplicate checks when
+# polling RSS feeds)
+#
+# Execute like: python web2py.py -S eden -M -R applications/eden/static/scripts/tools/rss_link_hash.py
+#
+# @todo: remove when obsolete
+#
+import sys
+
+from s3.s3msg import S3MsgPoller
+
+if settings.has_module("msg"):
+
+    table = s3db.msg_rss
+    query = (table.link_hash == None) & \
+            (table.from_address != None)
+    link_hash = S3MsgPoller.link_hash
+
+    updated = 0
+    while True:
+        rows = db(query).select(table.id,
+                                table.from_address,
+                                limitby = (0, 1000),
+                                )
+        if not rows:
+            break
+        for row in rows:
+            db(table.id == row.id).update(link_hash = link_hash(row.from_address))
+        db.commit()
+        updated += len(rows)
+
+    print >> sys.stderr, "Updated %s RSS posts." % updated